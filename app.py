@@ -4,11 +4,12 @@ from fastapi.middleware.cors import CORSMiddleware
 from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 from database import engine, Base
 import models
+import migrations
 from playwright_manager import close_browser
 
 
-# 自动创建所有表
-Base.metadata.create_all(bind=engine)
+# 建缺少的表、补齐已有表的列与索引（每项变更记日志，见 migrations.py）
+migrations.upgrade(engine)
 
 app = FastAPI(title="Overleaf Inviter 管理后台")
 app.add_middleware(ProxyHeadersMiddleware, trusted_hosts="*")
@@ -97,6 +98,43 @@ app.include_router(sync_router, tags=["sync"])
 app.include_router(manual_users_router, tags=["manual_users"])
 app.include_router(data_consistency_router, tags=["data_consistency"])
 
+@app.on_event("startup")
+async def on_startup():
+    # 异步邀请任务 worker 池（POST /api/v1/invite?mode=async）
+    from invite_jobs import invite_job_queue
+    from routers.invites import run_invite
+    invite_job_queue.start(run_invite)
+    # 后台工作项（重新激活后的原组清理等），处理函数在 routers 导入时注册
+    from work_queue import work_queue
+    work_queue.start()
+    # Overleaf 删除 / 撤销意图（outbox），崩溃后未完成的意图在这里继续执行
+    from outbox import outbox_dispatcher
+    outbox_dispatcher.start()
+    # 后台预热即将变冷的组长会话，邀请请求尽量不承担完整登录
+    from session_pool import session_warmer
+    session_warmer.start()
+    # 按 expires_at 精确触发过期成员清理（代替 30 分钟轮询，定时脚本保留为兜底）
+    from settings import settings
+    if settings.EXPIRY_SCHEDULER_ENABLED:
+        from expiry_scheduler import expiry_scheduler
+        expiry_scheduler.start()
+    # 定时维护任务（清理过期 / 更新 email_id / 系统整体维护）跑在 API 进程内，代替 crontab 启动脚本
+    if settings.MAINTENANCE_DAEMON_ENABLED:
+        from maintenance_daemon import maintenance_daemon
+        maintenance_daemon.start()
+
 @app.on_event("shutdown")
 async def on_shutdown():
+    from invite_jobs import invite_job_queue
+    await invite_job_queue.stop()
+    from work_queue import work_queue
+    await work_queue.stop()
+    from outbox import outbox_dispatcher
+    await outbox_dispatcher.stop()
+    from session_pool import session_warmer
+    await session_warmer.stop()
+    from expiry_scheduler import expiry_scheduler
+    await expiry_scheduler.stop()
+    from maintenance_daemon import maintenance_daemon
+    await maintenance_daemon.stop()
     await close_browser()
\ No newline at end of file
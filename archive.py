@@ -0,0 +1,156 @@
+# archive.py
+"""
+已处理邀请记录的归档
+原来 脚本目录/cleanup_history_records.py 先 shutil.copy2 整个数据库做备份，再硬删除 cleaned=1 的记录；
+不跑它时已处理的记录一直留在 invites 表里，计数、跨组检查、对账等查询都要跳过它们。
+这里把"已清理、且过期（手动用户按创建时间）超过 N 天"的记录分块移到 invites_archive 表：
+- 每块一条 INSERT ... SELECT（冗余组长邮箱与卡密码）+ 一条 DELETE，同一事务提交
+- 不会改变任何账户计数或卡密判断：同一账户同一邮箱还有未清理记录的不归档；
+  卡密的所有记录都满足条件时才一起归档（归档后卡密仍判断为已过期，见 card_state.py）；
+  outbox 中还没执行完的记录不归档
+- 归档后可按邮箱 / 卡密检索（search_archive，GET /api/v1/maintenance/archive）
+"""
+
+import time
+from typing import Optional, Dict, Any
+
+from sqlalchemy import select, insert, delete, func, and_, or_, exists, literal
+from sqlalchemy.orm import Session, aliased
+
+import models
+from models import normalize_email
+from outbox import IN_FLIGHT
+from settings import settings
+
+_ARCHIVE_COLUMNS = [
+    "id", "account_id", "account_email", "card_id", "card_code", "email", "email_key", "email_id",
+    "expires_at", "success", "result", "created_at", "archived_at",
+]
+
+
+def archivable(cutoff: int):
+    """invites 中可以归档的记录的条件"""
+    Invite = models.Invite
+    same_email = aliased(models.Invite)
+    same_card = aliased(models.Invite)
+    aged = lambda i: func.coalesce(i.expires_at, i.created_at) < cutoff
+    return and_(
+        Invite.cleaned.is_(True),
+        aged(Invite),
+        # 同一账户同一邮箱还有未清理记录时，保留历史（计数按每个邮箱最新一条计算）
+        ~exists().where(
+            same_email.account_id == Invite.account_id,
+            same_email.email == Invite.email,
+            same_email.cleaned.is_(False),
+        ),
+        # 卡密的记录整体归档，卡密绑定（第一条记录）不会变到另一条仍在热表里的记录上
+        or_(
+            Invite.card_id.is_(None),
+            ~exists().where(
+                same_card.card_id == Invite.card_id,
+                ~and_(same_card.cleaned.is_(True), aged(same_card)),
+            ),
+        ),
+        ~exists().where(
+            models.OutboxEntry.invite_id == Invite.id,
+            models.OutboxEntry.status.in_(IN_FLIGHT),
+        ),
+    )
+
+
+def archive_processed(
+    db: Session,
+    older_than_days: int = settings.ARCHIVE_AFTER_DAYS,
+    chunk_size: int = settings.ARCHIVE_CHUNK_SIZE,
+    dry_run: bool = False,
+    progress=None,
+    now_ts: Optional[int] = None,
+) -> Dict[str, Any]:
+    """把可归档的记录按 id 分块移到 invites_archive；dry_run 时只统计数量"""
+    if now_ts is None:
+        now_ts = int(time.time())
+    cutoff = now_ts - older_than_days * 86400
+    Invite = models.Invite
+    condition = archivable(cutoff)
+
+    total = db.query(func.count(Invite.id)).filter(condition).scalar() or 0
+    stats = {"candidates": total, "archived": 0, "chunks": 0, "cutoff": cutoff, "dry_run": dry_run}
+    if dry_run or not total:
+        return stats
+
+    last_id = 0
+    while True:
+        ids = [
+            row.id for row in
+            db.query(Invite.id).filter(condition, Invite.id > last_id).order_by(Invite.id).limit(chunk_size)
+        ]
+        if not ids:
+            break
+        last_id = ids[-1]
+        source = (
+            select(
+                Invite.id, Invite.account_id, models.Account.email, Invite.card_id, models.Card.code,
+                Invite.email, Invite.email_key, Invite.email_id, Invite.expires_at, Invite.success,
+                Invite.result, Invite.created_at, literal(now_ts),
+            )
+            .outerjoin(models.Account, models.Account.id == Invite.account_id)
+            .outerjoin(models.Card, models.Card.id == Invite.card_id)
+            .where(Invite.id.in_(ids))
+        )
+        try:
+            db.execute(insert(models.InviteArchive).from_select(_ARCHIVE_COLUMNS, source))
+            db.execute(delete(Invite).where(Invite.id.in_(ids)), execution_options={"synchronize_session": False})
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        stats["archived"] += len(ids)
+        stats["chunks"] += 1
+        if progress is not None:
+            progress(stats["archived"], total, None)
+    return stats
+
+
+def _archive_to_dict(row: models.InviteArchive) -> Dict[str, Any]:
+    return {column: getattr(row, column) for column in _ARCHIVE_COLUMNS}
+
+
+def search_archive(
+    db: Session,
+    email: Optional[str] = None,
+    card: Optional[str] = None,
+    account_email: Optional[str] = None,
+    limit: int = 50,
+    offset: int = 0,
+) -> Dict[str, Any]:
+    """按邮箱（不区分大小写等写法差异）/ 卡密 / 组长邮箱检索归档，按创建时间倒序"""
+    query = db.query(models.InviteArchive)
+    if email:
+        query = query.filter(models.InviteArchive.email_key == normalize_email(email))
+    if card:
+        query = query.filter(models.InviteArchive.card_code == card)
+    if account_email:
+        query = query.filter(models.InviteArchive.account_email == account_email)
+    total = query.count()
+    rows = (
+        query.order_by(models.InviteArchive.created_at.desc(), models.InviteArchive.id.desc())
+        .offset(offset).limit(limit).all()
+    )
+    return {"total": total, "records": [_archive_to_dict(row) for row in rows]}
+
+
+def archive_status(db: Session, older_than_days: int = settings.ARCHIVE_AFTER_DAYS) -> Dict[str, Any]:
+    """热表与归档表的规模，以及当前可归档的记录数"""
+    Archive = models.InviteArchive
+    archived, first_at, last_at = db.query(
+        func.count(Archive.id), func.min(Archive.archived_at), func.max(Archive.archived_at)
+    ).one()
+    cutoff = int(time.time()) - older_than_days * 86400
+    return {
+        "hot_rows": db.query(func.count(models.Invite.id)).scalar(),
+        "hot_cleaned_rows": db.query(func.count(models.Invite.id)).filter(models.Invite.cleaned.is_(True)).scalar(),
+        "archivable_rows": db.query(func.count(models.Invite.id)).filter(archivable(cutoff)).scalar(),
+        "archived_rows": archived,
+        "first_archived_at": first_at,
+        "last_archived_at": last_at,
+    }
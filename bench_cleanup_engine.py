@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+过期成员清理基准测试：模拟 Overleaf 的认证与 DELETE 延迟
+对比旧的逐条清理（每条记录认证一次再删除，串行）与按账号分组、账号间并行的清理引擎
+用法: python bench_cleanup_engine.py [账号数] [每个账号的过期成员数]
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+import tempfile
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models, crud
+import cleanup_engine
+from database import Base
+
+AUTH_LATENCY = 0.3     # 刷新 token / 登录
+DELETE_LATENCY = 0.05  # 一次 DELETE 请求
+
+
+class StandInResponse:
+    status_code = 204
+    text = ""
+
+
+class StandInSession:
+    def __init__(self, counter):
+        self.counter = counter
+
+    def delete(self, url, headers=None, timeout=None):
+        time.sleep(DELETE_LATENCY)
+        self.counter["deletes"] += 1
+        return StandInResponse()
+
+
+def make_opener(counter):
+    async def opener(acct):
+        await asyncio.sleep(AUTH_LATENCY)
+        counter["auths"] += 1
+        return StandInSession(counter), "sess", "csrf"
+    return opener
+
+
+def build_fixture(n_accounts: int, per_account: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+
+    now_ts = int(time.time())
+    db = Session()
+    rows = []
+    for i in range(n_accounts):
+        acct = models.Account(email=f"leader{i}@bench.com", password="p", group_id=f"g{i}",
+                              invites_sent=per_account)
+        db.add(acct)
+        db.flush()
+        for j in range(per_account):
+            rows.append({
+                "account_id": acct.id, "email": f"user{i}-{j}@bench.com", "email_id": f"uid{i}-{j}",
+                "expires_at": now_ts - 3600 + j, "success": True, "result": "{}",
+                "created_at": now_ts - 86400, "cleaned": False,
+            })
+    db.commit()
+    db.execute(models.Invite.__table__.insert(), rows)
+    db.commit()
+    db.close()
+    return Session
+
+
+async def legacy_cleanup(db, counter):
+    """重现旧逻辑：每条过期记录单独认证、单独删除、单独提交"""
+    opener = make_opener(counter)
+    for invites in cleanup_engine.load_expired(db, limit=10_000).values():
+        for inv in invites:
+            acct = db.get(models.Account, inv.account_id)
+            session, sess, csrf = await opener(acct)
+            item = cleanup_engine.CleanupItem(inv.id, inv.email, inv.email_id)
+            cleanup_engine._delete_one(session, csrf, acct.group_id, item, cleanup_engine.OVERLEAF_URL)
+            crud.update_account_tokens(db, acct, csrf, sess)
+            db.delete(inv)
+            db.commit()
+            crud.sync_account_invites_count(db, acct)
+
+
+async def engine_cleanup(db, counter):
+    await cleanup_engine.cleanup_expired(db, limit=10_000, interval=0, opener=make_opener(counter))
+
+
+def run(label, fn, n_accounts, per_account):
+    Session = build_fixture(n_accounts, per_account)
+    counter = {"auths": 0, "deletes": 0}
+    db = Session()
+    start = time.perf_counter()
+    asyncio.run(fn(db, counter))
+    elapsed = time.perf_counter() - start
+    left = db.query(models.Invite).count()
+    db.close()
+
+    rate = counter["deletes"] / elapsed
+    print(f"{label:<12} {elapsed:7.2f} s  {rate:6.1f} 条/秒  认证 {counter['auths']:4d} 次  剩余记录 {left}")
+    return elapsed
+
+
+def main():
+    n_accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    per_account = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print(f"清理基准: {n_accounts} 个账号 × {per_account} 个过期成员"
+          f"（认证 {AUTH_LATENCY * 1000:.0f} ms，DELETE {DELETE_LATENCY * 1000:.0f} ms）")
+    legacy = run("逐条清理", legacy_cleanup, n_accounts, per_account)
+    grouped = run("按账号并行", engine_cleanup, n_accounts, per_account)
+    print(f"加速比: {legacy / grouped:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
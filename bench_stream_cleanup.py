@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+过期记录积压清理基准测试（只涉及数据库，不访问 Overleaf）
+对比旧的 /maintenance/cleanup_expired（每次调用取 limit 条 ORM 对象逐条 db.delete，需要反复调用直到清空）
+与流式模式（按 (expires_at, id) 游标分块、每块一条 DELETE、结束后受影响账户各重新计数一次）
+用法: python bench_stream_cleanup.py [过期记录数] [账号数]
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import tempfile
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models
+from database import Base
+from invite_status_manager import InviteStatusManager
+
+LEGACY_LIMIT = 100   # 接口默认的 limit
+
+
+def build_fixture(n_rows: int, n_accounts: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+
+    now_ts = int(time.time())
+    db = Session()
+    accounts = []
+    for i in range(n_accounts):
+        acct = models.Account(email=f"leader{i}@bench.com", password="p", group_id=f"g{i}",
+                              invites_sent=n_rows // n_accounts)
+        db.add(acct)
+        accounts.append(acct)
+    db.flush()
+    rows = [{
+        "account_id": accounts[j % n_accounts].id, "email": f"user{j}@bench.com",
+        "email_id": f"uid{j}" if j % 2 else None, "expires_at": now_ts - 86400 + j % 3600,
+        "success": True, "result": "{}", "created_at": now_ts - 40 * 86400, "cleaned": False,
+    } for j in range(n_rows)]
+    db.commit()
+    db.execute(models.Invite.__table__.insert(), rows)
+    db.commit()
+    db.close()
+    return Session
+
+
+def legacy_cleanup(db):
+    """重现旧用法：反复调用直到没有过期记录，返回调用次数"""
+    calls = 0
+    while InviteStatusManager.batch_cleanup_expired(db, limit=LEGACY_LIMIT)["total_found"]:
+        calls += 1
+    return calls
+
+
+def stream_cleanup(db):
+    return InviteStatusManager.stream_cleanup_expired(db, chunk_size=1000)["chunks"]
+
+
+def run(label, fn, n_rows, n_accounts):
+    Session = build_fixture(n_rows, n_accounts)
+    db = Session()
+    start = time.perf_counter()
+    rounds = fn(db)
+    elapsed = time.perf_counter() - start
+    left = db.query(models.Invite).count()
+    db.close()
+    print(f"{label:<10} {elapsed:7.2f} s  {n_rows / elapsed:9.0f} 条/秒  调用/块 {rounds:5d}  剩余记录 {left}")
+    return elapsed
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    n_accounts = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    print(f"积压清理基准: {n_rows} 条过期记录，{n_accounts} 个账号（旧接口每次 limit={LEGACY_LIMIT}）")
+    legacy = run("逐条删除", legacy_cleanup, n_rows, n_accounts)
+    streamed = run("流式分块", stream_cleanup, n_rows, n_accounts)
+    print(f"加速比: {legacy / streamed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+对账引擎基准测试：10k 成员的群组
+对比旧的逐行对账（每条更新 db.get + 逐个 add）与变更集批量应用
+用法: python bench_sync_engine.py [成员数]
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import time
+import tempfile
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import models
+from database import Base
+from invite_status_manager import InviteStatusManager
+from sync_engine import reconcile_account
+
+
+def build_fixture(n_members: int):
+    """
+    生成文件型 SQLite（真实 fsync 开销）：
+    数据库 n 条记录，其中 1/4 待补 email_id、1/10 已不在 Overleaf；
+    Overleaf 另有 1/20 的数据库外用户。
+    """
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+
+    now_ts = int(time.time())
+    db = Session()
+    acct = models.Account(email="leader@bench.com", password="p", group_id="g", invites_sent=0)
+    db.add(acct)
+    db.commit()
+
+    rows, members = [], []
+    for i in range(n_members):
+        email = f"user{i}@bench.com"
+        accepted_in_db = i % 4 != 0
+        rows.append({
+            "account_id": acct.id, "email": email,
+            "email_id": f"uid{i}" if accepted_in_db else None,
+            "expires_at": now_ts + 86400, "success": True, "result": "{}",
+            "created_at": now_ts, "cleaned": False,
+        })
+        if i % 10 != 0:
+            members.append({"email": email, "user_id": f"uid{i}", "status": "accepted"})
+    for j in range(n_members // 20):
+        members.append({"email": f"external{j}@bench.com", "user_id": None, "status": "pending"})
+
+    db.execute(models.Invite.__table__.insert(), rows)
+    db.commit()
+    acct_id = acct.id
+    db.close()
+    return engine, Session, acct_id, members
+
+
+def legacy_sync(db, account, overleaf_members):
+    """重现旧 OverleafSyncer.sync_account 的逐行逻辑"""
+    db_invites = db.query(models.Invite).filter(models.Invite.account_id == account.id).all()
+    overleaf_status = {m["email"]: m for m in overleaf_members}
+    db_emails = {invite.email for invite in db_invites}
+
+    updates = []
+    for invite in db_invites:
+        if invite.email in overleaf_status:
+            ol_data = overleaf_status[invite.email]
+            if ol_data["status"] == "accepted" and not invite.email_id:
+                updates.append(("update_email_id", invite.id, ol_data["user_id"]))
+            if invite.cleaned:
+                updates.append(("unmark_cleaned", invite.id, None))
+        elif not invite.cleaned:
+            updates.append(("mark_cleaned", invite.id, None))
+
+    for action, invite_id, value in updates:
+        invite = db.get(models.Invite, invite_id)
+        if action == "update_email_id":
+            invite.email_id = value
+        elif action == "unmark_cleaned":
+            invite.cleaned = False
+        else:
+            invite.cleaned = True
+
+    for email, ol_data in overleaf_status.items():
+        if email not in db_emails:
+            db.add(models.Invite(
+                account_id=account.id, card_id=None, email=email,
+                email_id=ol_data["user_id"], expires_at=None, success=True,
+                result=json.dumps({"source": "manual_sync_from_overleaf"}),
+                created_at=int(time.time()), cleaned=False
+            ))
+
+    account.invites_sent = InviteStatusManager.calculate_invites_sent(db, account)
+    db.commit()
+
+
+def run(label, fn, n_members):
+    engine, Session, acct_id, members = build_fixture(n_members)
+    statements = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, stmt, params, ctx, many: statements.append(many))
+
+    db = Session()
+    account = db.get(models.Account, acct_id)
+    statements.clear()
+    start = time.perf_counter()
+    fn(db, account, members)
+    elapsed = time.perf_counter() - start
+    final_count = db.get(models.Account, acct_id).invites_sent
+    db.close()
+
+    print(f"{label:<12} {elapsed * 1000:9.1f} ms  {len(statements):6d} 条语句  计数={final_count}")
+    return elapsed
+
+
+def main():
+    n_members = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    print(f"对账基准: {n_members} 个成员")
+    legacy = run("逐行对账", legacy_sync, n_members)
+    engine = run("变更集批量", lambda db, a, m: reconcile_account(db, a, m), n_members)
+    print(f"加速比: {legacy / engine:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
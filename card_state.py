@@ -0,0 +1,237 @@
+# card_state.py
+"""
+卡密状态解析
+/detect、/reactivate 与 POST /invite 都要知道同一个卡密的状态：卡密是否存在、是否已使用、
+绑定的邀请记录（邮箱、过期时间）以及据此得出的模式。这里用一条 Card LEFT JOIN Invite 查询一次取齐：
+- 同一个 Session 的当前事务内记住结果（db.info），detect → reactivate → run_invite 不再重复查询
+- 跨请求缓存 CARD_STATE_CACHE_SECONDS 秒，只给只读判断用（/detect、/reactivate 找绑定邮箱）；
+  真正发邀请前的校验（validate_invite_card）传 max_age=0，总是读数据库
+- 本进程内对 cards / invites 的写入（ORM flush 或批量 UPDATE/DELETE）会让相关缓存失效
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple, Dict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+import models
+from models import normalize_email
+from settings import settings
+
+# 模式
+MISSING = "missing"        # 卡密不存在
+NEW = "new"                # 未使用，可首次邀请
+REACTIVATE = "reactivate"  # 已使用且绑定记录权益未过期，可重新激活
+EXPIRED = "expired"        # 已使用，绑定记录权益已过期（包括绑定记录已归档）
+UNBOUND = "unbound"        # 已使用但找不到关联记录
+
+_MEMO_KEY = "card_states"
+_CACHE_MAX_ENTRIES = 1024
+
+
+@dataclass(frozen=True)
+class CardState:
+    """某一时刻卡密及其绑定邀请记录的快照（不含 ORM 对象，可以跨 Session 缓存）"""
+    code: str
+    card_id: Optional[int] = None
+    days: Optional[int] = None
+    used: bool = False
+    invite_id: Optional[int] = None
+    email: Optional[str] = None
+    expires_at: Optional[int] = None
+    account_id: Optional[int] = None
+    archived: bool = False     # 绑定记录已移到 invites_archive（archive.py 只归档早已过期的记录）
+    resolved_at: int = 0
+
+    def mode(self, now_ts: Optional[int] = None) -> str:
+        if self.card_id is None:
+            return MISSING
+        if not self.used:
+            return NEW
+        if self.invite_id is None:
+            return EXPIRED if self.archived else UNBOUND
+        if now_ts is None:
+            now_ts = int(time.time())
+        if self.expires_at is None or self.expires_at <= now_ts:
+            return EXPIRED
+        return REACTIVATE
+
+    def remaining_days(self, now_ts: Optional[int] = None) -> int:
+        if now_ts is None:
+            now_ts = int(time.time())
+        return max(1, int(((self.expires_at or now_ts) - now_ts) / 86400))
+
+    def can_reactivate_for(self, email: str, now_ts: Optional[int] = None) -> bool:
+        """该邮箱能否用这张卡密在权益期内重新激活"""
+        return self.mode(now_ts) == REACTIVATE and normalize_email(self.email) == normalize_email(email)
+
+
+class CardStateCache:
+    """跨请求的短期缓存：{code: CardState}，另按 card_id 建索引以便邀请记录变化时失效"""
+
+    def __init__(self, ttl: int, max_entries: int = _CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._states: "OrderedDict[str, Tuple[CardState, float]]" = OrderedDict()
+        self._codes_by_card: Dict[int, str] = {}
+
+    def get(self, code: str, max_age: Optional[float] = None) -> Optional[CardState]:
+        max_age = self.ttl if max_age is None else min(max_age, self.ttl)
+        with self._lock:
+            entry = self._states.get(code)
+            if entry is None:
+                return None
+            state, stored_at = entry
+            if time.monotonic() - stored_at > max_age:
+                return None
+            self._states.move_to_end(code)
+            return state
+
+    def put(self, state: CardState) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._states[state.code] = (state, time.monotonic())
+            self._states.move_to_end(state.code)
+            if state.card_id is not None:
+                self._codes_by_card[state.card_id] = state.code
+            while len(self._states) > self.max_entries:
+                old_code, (old_state, _) = self._states.popitem(last=False)
+                self._codes_by_card.pop(old_state.card_id, None)
+
+    def invalidate(self, codes=(), card_ids=()) -> None:
+        with self._lock:
+            for card_id in card_ids:
+                code = self._codes_by_card.pop(card_id, None)
+                if code is not None:
+                    self._states.pop(code, None)
+            for code in codes:
+                state, _ = self._states.pop(code, (None, None))
+                if state is not None:
+                    self._codes_by_card.pop(state.card_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._states.clear()
+            self._codes_by_card.clear()
+
+
+cache = CardStateCache(settings.CARD_STATE_CACHE_SECONDS)
+
+
+def _memo(db: Session) -> Dict[str, Tuple[CardState, Optional[models.Card], Optional[models.Invite]]]:
+    # 同时持有 ORM 对象：identity map 是弱引用，不持有的话 bound_records 又要查一次
+    return db.info.setdefault(_MEMO_KEY, {})
+
+
+def _load(db: Session, code: str) -> Tuple[CardState, Optional[models.Card], Optional[models.Invite]]:
+    # 一张卡密通常只绑定一条记录（重新激活会更新同一条）；有多条时与原来的 .first() 一致取最早的
+    row = (
+        db.query(models.Card, models.Invite)
+        .outerjoin(models.Invite, models.Invite.card_id == models.Card.id)
+        .filter(models.Card.code == code)
+        .order_by(models.Invite.id)
+        .first()
+    )
+    now_ts = int(time.time())
+    if row is None:
+        return CardState(code=code, resolved_at=now_ts), None, None
+    card, invite = row
+    archived = None
+    if invite is None and card.used:
+        archived = (
+            db.query(models.InviteArchive)
+            .filter(models.InviteArchive.card_id == card.id)
+            .order_by(models.InviteArchive.id)
+            .first()
+        )
+    if archived is not None:
+        state = CardState(
+            code=code, card_id=card.id, days=card.days, used=True, email=archived.email,
+            expires_at=archived.expires_at, account_id=archived.account_id, archived=True, resolved_at=now_ts,
+        )
+        return state, card, None
+    state = CardState(
+        code=code,
+        card_id=card.id,
+        days=card.days,
+        used=bool(card.used),
+        invite_id=invite.id if invite else None,
+        email=invite.email if invite else None,
+        expires_at=invite.expires_at if invite else None,
+        account_id=invite.account_id if invite else None,
+        resolved_at=now_ts,
+    )
+    return state, card, invite
+
+
+def resolve(db: Session, code: str, max_age: Optional[float] = None) -> CardState:
+    """
+    卡密状态。当前事务内已经查过的直接复用；否则在 max_age 秒（默认 CARD_STATE_CACHE_SECONDS）
+    内的跨请求缓存可用时使用缓存；max_age=0 表示必须在本事务内读过数据库。
+    """
+    memo = _memo(db)
+    if code in memo:
+        return memo[code][0]
+    if max_age is None or max_age > 0:
+        state = cache.get(code, max_age)
+        if state is not None:
+            return state
+    memo[code] = _load(db, code)
+    state = memo[code][0]
+    cache.put(state)
+    return state
+
+
+def bound_records(db: Session, state: CardState) -> Tuple[Optional[models.Card], Optional[models.Invite]]:
+    """取卡密与绑定记录的 ORM 对象：本事务内解析过的直接返回，来自缓存的按主键加载"""
+    entry = _memo(db).get(state.code)
+    if entry is not None and entry[0] is state:
+        return entry[1], entry[2]
+    card = db.get(models.Card, state.card_id) if state.card_id is not None else None
+    invite = db.get(models.Invite, state.invite_id) if state.invite_id is not None else None
+    return card, invite
+
+
+# -------- 失效 --------
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_after_flush(session, flush_context):
+    # after_flush 时 new/dirty/deleted 与属性历史仍是 flush 前的状态
+    codes, card_ids = set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, models.Card):
+            codes.add(obj.code)
+            codes.update(inspect(obj).attrs.code.history.deleted)
+            if obj.id is not None:
+                card_ids.add(obj.id)
+        elif isinstance(obj, models.Invite):
+            # 改绑到其他卡密时，原卡密的状态同样失效
+            history = inspect(obj).attrs.card_id.history
+            card_ids.update(c for c in (obj.card_id, *history.deleted) if c is not None)
+    codes.discard(None)
+    if codes or card_ids:
+        session.info.pop(_MEMO_KEY, None)
+        cache.invalidate(codes=codes, card_ids=card_ids)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _invalidate_on_bulk_write(orm_execute_state):
+    # 批量 UPDATE / DELETE（以及 Core INSERT）不经过 flush，只能整体失效
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return
+    tables = {getattr(m, "persist_selectable", None) for m in orm_execute_state.all_mappers}
+    if models.Card.__table__ in tables or models.Invite.__table__ in tables:
+        orm_execute_state.session.info.pop(_MEMO_KEY, None)
+        cache.clear()
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _end_of_transaction(session):
+    session.info.pop(_MEMO_KEY, None)
@@ -0,0 +1,297 @@
+# cleanup_engine.py
+"""
+过期成员清理引擎
+原来的清理对每条过期邀请单独调用 remove_member：每条都要刷新 token（甚至完整登录）再发一次阻塞的 DELETE，
+同一个组有 40 条过期记录就要认证 40 次。这里：
+1. 一条查询取出过期且未清理的邀请（最早过期的优先），按组长账号分组
+2. 每个账号只认证一次（open_group_session），在同一个 session 上依次删除该组的成员 / 撤销未接受的邀请
+3. 账号之间并行，最多 CLEANUP_ACCOUNT_CONCURRENCY 个账号同时进行；网络阶段不访问数据库
+4. 全部结束后在一个事务里删除成功的记录、写回 token、同步各账号计数，并给出按账号的报告
+Overleaf 返回 404（成员 / 邀请已不存在）同样视为清理成功；失败的记录保持原状，下次继续处理。
+第 2~4 步（clean_groups）与记录从哪里来无关，批量撤销未接受的邀请（/member/revoke_batch）同样使用。
+"""
+
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field, asdict
+from typing import Optional, List, Dict, Any, Callable, Awaitable, Tuple
+
+import requests
+from sqlalchemy.orm import Session
+
+import models, crud
+import invite_events
+from settings import settings
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+OVERLEAF_URL = "https://www.overleaf.com"
+
+# 单条记录的结果
+REMOVED = "removed"      # 已接受的成员已从组中删除
+REVOKED = "revoked"      # 未接受的邀请已撤销
+NOT_FOUND = "not_found"  # Overleaf 上已不存在
+
+# opener(acct) -> (session, overleaf_session2, csrf)，默认 overleaf_utils.open_group_session
+SessionOpener = Callable[[models.Account], Awaitable[Tuple[requests.Session, str, str]]]
+# progress(completed, total, current_item)；可以是协程函数（如 JobLease.update_progress_async），会被 await
+ProgressCallback = Callable[[int, int, Optional[str]], Optional[Awaitable[Any]]]
+
+
+@dataclass
+class CleanupItem:
+    """网络阶段使用的记录快照（不在线程里碰 ORM 对象）"""
+    invite_id: int
+    email: str
+    email_id: Optional[str]
+
+
+@dataclass
+class AccountReport:
+    account_id: int
+    account_email: Optional[str]
+    total: int = 0
+    removed: int = 0
+    revoked: int = 0
+    not_found: int = 0
+    errors: int = 0
+    authenticated: bool = False
+    auth_seconds: float = 0.0
+    delete_seconds: float = 0.0
+    error: Optional[str] = None                     # 整个账号失败的原因（如登录失败）
+    failures: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def cleaned(self) -> int:
+        return self.removed + self.revoked + self.not_found
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data["cleaned"] = self.cleaned
+        data["auth_seconds"] = round(self.auth_seconds, 3)
+        data["delete_seconds"] = round(self.delete_seconds, 3)
+        return data
+
+
+@dataclass
+class CleanupReport:
+    accounts: List[AccountReport] = field(default_factory=list)
+    duration: float = 0.0
+    invite_ids: List[int] = field(default_factory=list)   # 本批处理的记录
+    cleaned_ids: List[int] = field(default_factory=list)  # 其中已清理（记录已删除）的
+    outcomes: Dict[int, str] = field(default_factory=dict)  # {invite_id: REMOVED / REVOKED / NOT_FOUND}
+
+    @property
+    def cleaned(self) -> int:
+        return sum(a.cleaned for a in self.accounts)
+
+    def stats(self) -> Dict[str, int]:
+        """汇总统计（CleanupResponse.stats 的格式）"""
+        return {
+            "total_found": sum(a.total for a in self.accounts),
+            "accepted_removed": sum(a.removed for a in self.accounts),
+            "pending_revoked": sum(a.revoked for a in self.accounts),
+            "not_found": sum(a.not_found for a in self.accounts),
+            "deleted_records": self.cleaned,
+            "errors": sum(a.errors for a in self.accounts),
+            "accounts": len(self.accounts),
+            "authenticated_accounts": sum(1 for a in self.accounts if a.authenticated),
+        }
+
+
+def load_expired(
+    db: Session,
+    limit: Optional[int] = 100,
+    now_ts: Optional[int] = None,
+    invite_ids: Optional[List[int]] = None,
+    account_id: Optional[int] = None
+) -> "OrderedDict[int, List[models.Invite]]":
+    """
+    过期且未清理的邀请（排除手动添加的用户），最早过期的优先，按账号分组；limit=None 不限条数。
+    invite_ids 不为空时只取其中仍然过期且未清理的（到期调度按 id 触发，期间被续期的自然排除）
+    """
+    if now_ts is None:
+        now_ts = int(time.time())
+    query = db.query(models.Invite).filter(
+        models.Invite.expires_at.isnot(None),
+        models.Invite.expires_at < now_ts,
+        models.Invite.cleaned.is_(False)
+    )
+    if invite_ids is not None:
+        query = query.filter(models.Invite.id.in_(list(invite_ids)))
+    if account_id is not None:
+        query = query.filter(models.Invite.account_id == account_id)
+    invites = query.order_by(models.Invite.expires_at, models.Invite.id).limit(limit).all()
+    grouped: "OrderedDict[int, List[models.Invite]]" = OrderedDict()
+    for invite in invites:
+        grouped.setdefault(invite.account_id, []).append(invite)
+    return grouped
+
+
+def _delete_one(session: requests.Session, csrf: str, group_id: str, item: CleanupItem, base_url: str) -> str:
+    """已接受的成员按 email_id 删除，未接受的邀请按邮箱撤销；在线程中执行"""
+    if item.email_id:
+        url = f"{base_url}/manage/groups/{group_id}/user/{item.email_id}"
+        done = REMOVED
+    else:
+        url = f"{base_url}/manage/groups/{group_id}/invites/{requests.utils.quote(item.email, safe='')}"
+        done = REVOKED
+    resp = session.delete(url, headers={
+        "Accept": "application/json",
+        "x-csrf-token": csrf,
+        "Referer": f"{base_url}/manage/groups/{group_id}/members",
+        "User-Agent": "Mozilla/5.0"
+    }, timeout=30)
+    if resp.status_code in (200, 204):
+        return done
+    if resp.status_code == 404:
+        return NOT_FOUND
+    try:
+        detail = resp.json().get("error", {}).get("message", resp.text)
+    except ValueError:
+        detail = resp.text
+    raise RuntimeError(f"Overleaf API错误 {resp.status_code}: {detail}")
+
+
+async def clean_account(
+    acct: models.Account,
+    items: List[CleanupItem],
+    opener: SessionOpener,
+    base_url: str = OVERLEAF_URL,
+    interval: float = 0.0,
+) -> Tuple[AccountReport, Optional[Tuple[str, str]], Dict[int, str]]:
+    """
+    认证一次，在同一个 session 上依次处理该账号的记录。
+    返回 (报告, 新 token (session_cookie, csrf) 或 None, {invite_id: 结果})；不写数据库。
+    """
+    report = AccountReport(account_id=acct.id, account_email=acct.email, total=len(items))
+    outcomes: Dict[int, str] = {}
+
+    with span("cleanup", account_id=acct.id):
+        start = time.perf_counter()
+        try:
+            session, new_sess, new_csrf = await opener(acct)
+        except Exception as e:
+            report.auth_seconds = time.perf_counter() - start
+            report.error = f"登录失败: {e}"
+            report.errors = len(items)
+            logger.error(f"清理过期成员：账号 {acct.email} 登录失败，跳过 {len(items)} 条: {e}")
+            return report, None, outcomes
+        report.auth_seconds = time.perf_counter() - start
+        report.authenticated = True
+
+        start = time.perf_counter()
+        for pos, item in enumerate(items):
+            if pos and interval:
+                await asyncio.sleep(interval)
+            try:
+                with span("overleaf_delete"):
+                    outcome = await asyncio.to_thread(_delete_one, session, new_csrf, acct.group_id, item, base_url)
+            except Exception as e:
+                report.errors += 1
+                report.failures.append({"invite_id": item.invite_id, "email": item.email, "error": str(e)})
+                logger.error(f"清理过期成员失败: {item.email} (ID: {item.invite_id}) - {e}")
+                continue
+            outcomes[item.invite_id] = outcome
+            setattr(report, outcome, getattr(report, outcome) + 1)
+        report.delete_seconds = time.perf_counter() - start
+
+    return report, (new_sess, new_csrf), outcomes
+
+
+async def cleanup_expired(
+    db: Session,
+    limit: int = 100,
+    concurrency: int = settings.CLEANUP_ACCOUNT_CONCURRENCY,
+    interval: float = settings.CLEANUP_DELETE_INTERVAL,
+    base_url: str = OVERLEAF_URL,
+    opener: Optional[SessionOpener] = None,
+    progress: Optional[ProgressCallback] = None,
+    invite_ids: Optional[List[int]] = None,
+) -> CleanupReport:
+    """清理一批过期成员（可限定 invite_ids），返回按账号的报告；调用方负责持有 cleanup 租约"""
+    grouped = load_expired(db, limit, invite_ids=invite_ids)
+    report = await clean_groups(db, grouped, concurrency, interval, base_url, opener, progress)
+    if report.accounts:
+        logger.info(
+            f"清理过期成员完成：{len(report.accounts)} 个账号，清理 {report.cleaned} 条，"
+            f"失败 {report.stats()['errors']} 条，用时 {report.duration:.1f}s"
+        )
+    return report
+
+
+async def clean_groups(
+    db: Session,
+    grouped: "OrderedDict[int, List[models.Invite]]",
+    concurrency: int = settings.CLEANUP_ACCOUNT_CONCURRENCY,
+    interval: float = settings.CLEANUP_DELETE_INTERVAL,
+    base_url: str = OVERLEAF_URL,
+    opener: Optional[SessionOpener] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> CleanupReport:
+    """
+    在 Overleaf 上删除 / 撤销已按账号分组的记录：每个账号认证一次，账号之间最多 concurrency 个并行；
+    结束后一个事务删除成功的记录、写回 token、每个账号同步一次计数
+    """
+    if opener is None:
+        import overleaf_utils
+        opener = overleaf_utils.open_group_session
+
+    started = time.perf_counter()
+    if not grouped:
+        return CleanupReport()
+
+    accounts = {
+        a.id: a for a in db.query(models.Account).filter(models.Account.id.in_(list(grouped))).all()
+    }
+    total = sum(len(invites) for invites in grouped.values())
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    completed = 0
+
+    async def run(account_id: int, invites: List[models.Invite]):
+        nonlocal completed
+        acct = accounts.get(account_id)
+        if acct is None:
+            report = AccountReport(account_id=account_id, account_email=None, total=len(invites),
+                                   errors=len(invites), error="找不到关联的账户")
+            return report, None, {}
+        items = [CleanupItem(inv.id, inv.email, inv.email_id) for inv in invites]
+        async with semaphore:
+            result = await clean_account(acct, items, opener, base_url, interval)
+        completed += len(invites)
+        if progress is not None:
+            pending = progress(completed, total, acct.email)
+            if pending is not None:
+                await pending
+        return result
+
+    results = await asyncio.gather(*(run(aid, invites) for aid, invites in grouped.items()))
+
+    # 所有账号结束后一次性写回：删除成功的记录、保存 token、同步计数
+    report = CleanupReport()
+    with crud.unit_of_work(db):
+        for (account_report, tokens, outcomes), (account_id, invites) in zip(results, grouped.items()):
+            report.accounts.append(account_report)
+            report.invite_ids.extend(invite.id for invite in invites)
+            report.cleaned_ids.extend(invite.id for invite in invites if invite.id in outcomes)
+            report.outcomes.update(outcomes)
+            acct = accounts.get(account_id)
+            if acct is None:
+                continue
+            if tokens is not None:
+                crud.update_account_tokens(db, acct, tokens[1], tokens[0])
+            invite_events.record_rows(db, [
+                {"invite_id": invite.id, "account_id": invite.account_id,
+                 "kind": invite_events.REMOVED, "detail": outcomes[invite.id]}
+                for invite in invites if invite.id in outcomes
+            ])
+            for invite in invites:
+                if invite.id in outcomes:
+                    db.delete(invite)
+            if outcomes:
+                crud.sync_account_invites_count(db, acct)
+    report.duration = time.perf_counter() - started
+    return report
@@ -0,0 +1,255 @@
+# cleanup_plan.py
+"""
+过期成员清理的预演计划
+原来的 dry_run 只数出过期记录条数，看不出真正执行时要访问 Overleaf 多少次、哪些组长要完整登录、大概要多久。
+build_plan 用与执行相同的选取逻辑（cleanup_engine.load_expired），给出按组长账号的执行计划：
+- 删除（已接受，有 email_id）/ 撤销（未接受）各多少条
+- 会话热度（session_pool.session_warmth），冷账号要走 get_tokens + 验证码 + 登录
+- 预计 Overleaf 请求数与耗时：各阶段平均耗时取自本进程最近的分阶段统计（tracing.metrics），没有样本时用默认值；
+  总耗时按 concurrency 个账号并行、每个账号内删除之间间隔 interval 估算
+计划可以序列化（to_dict / from_dict），之后原样交给 execute_plan 执行：只处理计划中的 invite_ids，
+期间已被续期或已清理的记录由执行路径自然跳过（计入 skipped）。
+
+mode 对应各清理入口的执行方式：
+- overleaf：在 Overleaf 删除 / 撤销后删除记录（cleanup_engine，/member/cleanup_expired、清理过期成员.py）
+- delete_records：只删除数据库记录（/maintenance/cleanup_expired 默认）
+- mark_processed：只标记为已处理（/maintenance/cleanup_expired?delete_records=false、/data-consistency/cleanup-expired）
+后两种不访问 Overleaf，请求数与耗时为 0。
+"""
+
+import heapq
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+import models
+import cleanup_engine
+import tracing
+from invite_status_manager import InviteStatusManager
+from session_pool import session_warmth, COLD
+from settings import settings
+
+MODE_OVERLEAF = "overleaf"
+MODE_DELETE_RECORDS = "delete_records"
+MODE_MARK_PROCESSED = "mark_processed"
+MODES = (MODE_OVERLEAF, MODE_DELETE_RECORDS, MODE_MARK_PROCESSED)
+
+# 没有耗时样本时各阶段的默认耗时（秒）；阶段名与 overleaf_utils.open_group_session / clean_account 的 span 一致
+DEFAULT_LATENCY = {
+    "refresh_session": 0.8,
+    "get_new_csrf": 1.0,
+    "get_tokens": 5.0,
+    "get_captcha_token": 20.0,
+    "perform_login": 3.0,
+    "login_refresh_session": 0.8,
+    "login_get_new_csrf": 1.0,
+    "overleaf_delete": 0.8,
+}
+
+# 认证步骤：刷新已保存的 token（2 次请求）；完整登录（get_tokens、登录、刷新、取 CSRF 共 4 次 Overleaf 请求，
+# 验证码由打码服务完成，只计耗时）
+REFRESH_STAGES = ("refresh_session", "get_new_csrf")
+LOGIN_STAGES = ("get_tokens", "get_captcha_token", "perform_login", "login_refresh_session", "login_get_new_csrf")
+LOGIN_CALLS = 4
+
+
+def stage_latency(snapshot: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    各阶段的平均耗时：{stage: {"avg_seconds", "samples", "source"}}。
+    span 名按嵌套路径拼接（如 cleanup.overleaf_delete、revoke_batch.cleanup.refresh_session），
+    按最后一段汇总所有路径的样本；source 为 metrics（有样本）或 default
+    """
+    if snapshot is None:
+        snapshot = tracing.metrics.snapshot()
+    totals: Dict[str, List[float]] = {}
+    for name, snap in snapshot.items():
+        stage = name.rsplit(".", 1)[-1]
+        if stage in DEFAULT_LATENCY and snap.get("count"):
+            entry = totals.setdefault(stage, [0.0, 0])
+            entry[0] += snap["sum_seconds"]
+            entry[1] += snap["count"]
+    latency = {}
+    for stage, default in DEFAULT_LATENCY.items():
+        total, count = totals.get(stage, (0.0, 0))
+        if count:
+            latency[stage] = {"avg_seconds": round(total / count, 3), "samples": count, "source": "metrics"}
+        else:
+            latency[stage] = {"avg_seconds": default, "samples": 0, "source": "default"}
+    return latency
+
+
+@dataclass
+class AccountPlan:
+    account_id: int
+    account_email: Optional[str]
+    group_id: Optional[str] = None
+    session: Optional[str] = None              # hot / warm / cold
+    needs_login: bool = False                  # 预计要完整登录
+    invite_ids: List[int] = field(default_factory=list)
+    removals: int = 0                          # 已接受，按 email_id 删除
+    revokes: int = 0                           # 未接受，按邮箱撤销
+    auth_calls: int = 0
+    delete_calls: int = 0
+    estimated_calls: int = 0
+    auth_seconds: float = 0.0
+    delete_seconds: float = 0.0
+    estimated_seconds: float = 0.0
+    error: Optional[str] = None                # 执行时会整组失败的原因（如账号已不存在）
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass
+class CleanupPlan:
+    mode: str = MODE_OVERLEAF
+    created_at: int = 0
+    concurrency: int = settings.CLEANUP_ACCOUNT_CONCURRENCY
+    interval: float = settings.CLEANUP_DELETE_INTERVAL
+    accounts: List[AccountPlan] = field(default_factory=list)
+    estimated_seconds: float = 0.0             # 按 concurrency 个账号并行估算的总耗时
+    latency: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+    @property
+    def invite_ids(self) -> List[int]:
+        return [invite_id for a in self.accounts for invite_id in a.invite_ids]
+
+    def totals(self) -> Dict[str, Any]:
+        return {
+            "invites": sum(len(a.invite_ids) for a in self.accounts),
+            "removals": sum(a.removals for a in self.accounts),
+            "revokes": sum(a.revokes for a in self.accounts),
+            "accounts": len(self.accounts),
+            "cold_logins": sum(1 for a in self.accounts if a.needs_login),
+            "estimated_calls": sum(a.estimated_calls for a in self.accounts),
+            "estimated_seconds": self.estimated_seconds,
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "created_at": self.created_at,
+            "concurrency": self.concurrency,
+            "interval": self.interval,
+            "totals": self.totals(),
+            "accounts": [a.to_dict() for a in self.accounts],
+            "latency": self.latency,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CleanupPlan":
+        if data.get("mode", MODE_OVERLEAF) not in MODES:
+            raise ValueError(f"未知的清理方式: {data.get('mode')}")
+        fields = AccountPlan.__dataclass_fields__
+        return cls(
+            mode=data.get("mode", MODE_OVERLEAF),
+            created_at=data.get("created_at", 0),
+            concurrency=data.get("concurrency", settings.CLEANUP_ACCOUNT_CONCURRENCY),
+            interval=data.get("interval", settings.CLEANUP_DELETE_INTERVAL),
+            accounts=[AccountPlan(**{k: v for k, v in a.items() if k in fields}) for a in data.get("accounts", [])],
+            estimated_seconds=(data.get("totals") or {}).get("estimated_seconds", 0.0),
+            latency=data.get("latency") or {},
+        )
+
+
+def _estimate_account(plan: AccountPlan, acct: models.Account, interval: float,
+                      latency: Dict[str, Dict[str, Any]], now_ts: int) -> None:
+    """按 open_group_session 的实际步骤估算：有 token 先刷新，冷会话预计刷新失败后再完整登录"""
+    avg = {stage: entry["avg_seconds"] for stage, entry in latency.items()}
+    has_tokens = bool(acct.session_cookie and acct.csrf_token)
+    plan.session = session_warmth(acct, now_ts)
+    plan.needs_login = plan.session == COLD
+    if has_tokens:
+        plan.auth_calls += len(REFRESH_STAGES)
+        plan.auth_seconds += sum(avg[s] for s in REFRESH_STAGES)
+    if plan.needs_login:
+        plan.auth_calls += LOGIN_CALLS
+        plan.auth_seconds += sum(avg[s] for s in LOGIN_STAGES)
+    plan.delete_calls = len(plan.invite_ids)
+    plan.delete_seconds = plan.delete_calls * avg["overleaf_delete"] + max(0, plan.delete_calls - 1) * interval
+    plan.estimated_calls = plan.auth_calls + plan.delete_calls
+    plan.auth_seconds = round(plan.auth_seconds, 3)
+    plan.delete_seconds = round(plan.delete_seconds, 3)
+    plan.estimated_seconds = round(plan.auth_seconds + plan.delete_seconds, 3)
+
+
+def _makespan(durations: List[float], concurrency: int) -> float:
+    """账号按计划顺序依次占用 concurrency 个并行名额（与 clean_groups 的信号量一致）"""
+    workers = [0.0] * max(1, concurrency)
+    for seconds in durations:
+        heapq.heappush(workers, heapq.heappop(workers) + seconds)
+    return round(max(workers), 3)
+
+
+def build_plan(
+    db: Session,
+    limit: Optional[int] = 100,
+    mode: str = MODE_OVERLEAF,
+    invite_ids: Optional[List[int]] = None,
+    account_id: Optional[int] = None,
+    concurrency: int = settings.CLEANUP_ACCOUNT_CONCURRENCY,
+    interval: float = settings.CLEANUP_DELETE_INTERVAL,
+    now_ts: Optional[int] = None,
+    latency: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> CleanupPlan:
+    """生成执行计划，不访问 Overleaf、不写数据库；limit=None 表示全部过期记录"""
+    if mode not in MODES:
+        raise ValueError(f"未知的清理方式: {mode}")
+    if now_ts is None:
+        now_ts = int(time.time())
+    overleaf = mode == MODE_OVERLEAF
+    if latency is None:
+        latency = stage_latency() if overleaf else {}
+
+    grouped = cleanup_engine.load_expired(db, limit, now_ts=now_ts, invite_ids=invite_ids, account_id=account_id)
+    accounts = {
+        a.id: a for a in db.query(models.Account).filter(models.Account.id.in_(list(grouped))).all()
+    }
+    plan = CleanupPlan(mode=mode, created_at=now_ts, concurrency=concurrency, interval=interval, latency=latency)
+    for aid, invites in grouped.items():
+        acct = accounts.get(aid)
+        entry = AccountPlan(
+            account_id=aid,
+            account_email=acct.email if acct else None,
+            group_id=acct.group_id if acct else None,
+            invite_ids=[invite.id for invite in invites],
+            removals=sum(1 for invite in invites if invite.email_id),
+            revokes=sum(1 for invite in invites if not invite.email_id),
+        )
+        if acct is None:
+            entry.error = "找不到关联的账户"
+        elif overleaf:
+            _estimate_account(entry, acct, interval, latency, now_ts)
+        plan.accounts.append(entry)
+    if overleaf:
+        plan.estimated_seconds = _makespan([a.estimated_seconds for a in plan.accounts], concurrency)
+    return plan
+
+
+async def execute_plan(
+    db: Session,
+    plan: CleanupPlan,
+    opener: Optional[cleanup_engine.SessionOpener] = None,
+    progress: Optional[cleanup_engine.ProgressCallback] = None,
+) -> Dict[str, Any]:
+    """
+    按计划执行（CleanupResponse 的格式）：只处理计划中仍然过期且未清理的记录，其余计入 stats.skipped。
+    调用方负责持有 cleanup 租约
+    """
+    invite_ids = plan.invite_ids
+    if plan.mode == MODE_OVERLEAF:
+        report = await cleanup_engine.cleanup_expired(
+            db, limit=len(invite_ids), concurrency=plan.concurrency, interval=plan.interval,
+            opener=opener, progress=progress, invite_ids=invite_ids,
+        ) if invite_ids else cleanup_engine.CleanupReport()
+        stats = report.stats()
+        stats["skipped"] = len(invite_ids) - stats["total_found"]
+        return {"cleaned": report.cleaned, "stats": stats, "accounts": [a.to_dict() for a in report.accounts]}
+
+    stats = InviteStatusManager.batch_cleanup_expired(
+        db, limit=len(invite_ids), delete_records=plan.mode == MODE_DELETE_RECORDS, invite_ids=invite_ids,
+    )
+    stats["skipped"] = len(invite_ids) - stats["total_found"]
+    return {"cleaned": stats["deleted_records"] + stats["marked_processed"], "stats": stats}
@@ -0,0 +1,188 @@
+# conftest.py
+"""
+pytest 共用设置
+直接使用 database.SessionLocal 的测试（test_reactivation.py 等）改用 overleaf_inviter.db 的临时副本，
+并在副本上显式执行结构升级（migrations.py）；运行测试不会改动仓库中的数据库文件。
+
+其余测试使用下面的隔离数据库 fixture（每个测试一个新库）：
+- engine / session_factory / db：内存数据库（StaticPool，所有会话共用一个连接，可跨线程）
+- file_engine / file_session_factory / file_db：临时文件数据库，每个会话独立连接，用于测试多线程并发写入与锁
+- job_leases：任务租约（job_coordinator）也读写 session_factory 的数据库
+- load_script / sync_script：按路径加载维护脚本（如 脚本目录/sync_with_overleaf.py），脚本的 SessionLocal 指向 session_factory
+- fake_overleaf：假的 Overleaf 组管理 session 与 open_group_session，不访问 Overleaf
+模块级的 SessionLocal 用 monkeypatch 替换为 session_factory，测试结束后自动恢复。
+"""
+
+import os
+import time
+import shutil
+import asyncio
+import threading
+import importlib.util
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+_TEST_DB = os.path.join(tempfile.mkdtemp(prefix="overleaf_test_"), "overleaf_inviter.db")
+shutil.copyfile(os.path.join(_BASE_DIR, "overleaf_inviter.db"), _TEST_DB)
+os.environ["OVERLEAF_INVITER_DB"] = _TEST_DB
+
+import migrations  # noqa: E402  须在设置 OVERLEAF_INVITER_DB 之后导入 database
+from database import Base  # noqa: E402
+
+migrations.upgrade()
+
+
+def _create_schema(engine):
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+@pytest.fixture
+def engine():
+    engine = _create_schema(create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool
+    ))
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session_factory(engine):
+    return sessionmaker(bind=engine, autoflush=False)
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def job_leases(session_factory, monkeypatch):
+    import job_coordinator
+    monkeypatch.setattr(job_coordinator, "SessionLocal", session_factory)
+    return session_factory
+
+
+@pytest.fixture
+def load_script(session_factory, monkeypatch):
+    def load(relative_path):
+        path = os.path.join(_BASE_DIR, relative_path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        monkeypatch.setattr(module, "SessionLocal", session_factory)
+        return module
+    return load
+
+
+@pytest.fixture
+def sync_script(load_script):
+    return load_script(os.path.join("脚本目录", "sync_with_overleaf.py"))
+
+
+@pytest.fixture
+def file_engine(tmp_path):
+    engine = _create_schema(create_engine(
+        f"sqlite:///{tmp_path / 'test.db'}",
+        connect_args={"check_same_thread": False}
+    ))
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def file_session_factory(file_engine):
+    return sessionmaker(bind=file_engine, autoflush=False)
+
+
+@pytest.fixture
+def file_db(file_session_factory):
+    session = file_session_factory()
+    yield session
+    session.close()
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = "error" if status_code >= 400 else ""
+
+    def json(self):
+        return {}
+
+
+class FakeOverleafSession:
+    """按 URL 末段（email_id 或邮箱）返回 statuses 中的状态码，未列出的返回 status；
+    statuses 为列表时按请求顺序依次取用"""
+
+    def __init__(self, status=204, statuses=None, latency=0.0):
+        self.status = status
+        self.statuses = statuses if statuses is not None else {}
+        self.latency = latency
+        self.deleted = []
+
+    def delete(self, url, headers=None, timeout=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.deleted.append(url)
+        if isinstance(self.statuses, list):
+            return FakeResponse(self.statuses.pop(0))
+        key = url.rsplit("/", 1)[-1].replace("%40", "@")
+        return FakeResponse(self.statuses.get(key, self.status))
+
+
+class FakeOverleaf:
+    """代替 open_group_session：记录认证的组长账号（calls）与同时认证的最大数量（max_active），
+    fail 中的账号认证失败；同一账号重复认证时沿用同一个 session，deleted 汇总所有 DELETE 请求"""
+
+    def __init__(self, status=204, statuses=None, fail=(), latency=0.0):
+        self.status = status
+        self.statuses = statuses
+        self.fail = set(fail)
+        self.latency = latency
+        self.calls = []
+        self.sessions = {}
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    async def __call__(self, acct):
+        self.calls.append(acct.email)
+        if acct.email in self.fail:
+            raise RuntimeError("captcha")
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(self.latency)
+        with self._lock:
+            self.active -= 1
+        session = self.sessions.get(acct.email)
+        if session is None:
+            session = self.sessions[acct.email] = FakeOverleafSession(self.status, self.statuses)
+        return session, f"sess-{acct.id}", f"csrf-{acct.id}"
+
+    @property
+    def deleted(self):
+        return [url for session in self.sessions.values() for url in session.deleted]
+
+
+@pytest.fixture
+def fake_overleaf(monkeypatch):
+    """fake_overleaf(status=..., statuses=..., fail=..., latency=..., patch=模块) 返回 FakeOverleaf；
+    给出 patch 时把该模块的 open_group_session 替换为它，测试结束后自动恢复"""
+    def make(patch=None, **options):
+        fake = FakeOverleaf(**options)
+        if patch is not None:
+            monkeypatch.setattr(patch, "open_group_session", fake)
+        return fake
+    return make
@@ -1,9 +1,49 @@
 import time
 import requests
-from typing import Optional
+from contextlib import contextmanager
+from typing import Optional, Iterable
 from sqlalchemy.orm import Session
 import models
+import invite_result
+import invite_events
 from invite_status_manager import InviteStatusManager
+from session_pool import routing_key
+from group_capacity import is_known_full
+
+_UOW_DEPTH = "crud_unit_of_work_depth"
+
+@contextmanager
+def unit_of_work(db: Session):
+    """
+    单次事务模式：块内的 crud 写函数只修改会话中的对象，不逐个 commit/refresh，
+    块正常结束时统一提交一次（SQLite 上只有一次写事务、一轮 fsync），抛出异常则全部回滚。
+    可以嵌套，只有最外层提交。
+    块内不会主动 flush，调用 Overleaf 等慢操作期间不会持有 SQLite 写锁；
+    需要读到本次修改的函数（如 sync_account_invites_count）会先 flush。
+    """
+    depth = db.info.get(_UOW_DEPTH, 0)
+    db.info[_UOW_DEPTH] = depth + 1
+    try:
+        yield db
+        if depth == 0:
+            db.commit()
+    except BaseException:
+        if depth == 0:
+            db.rollback()
+        raise
+    finally:
+        db.info[_UOW_DEPTH] = depth
+
+def in_unit_of_work(db: Session) -> bool:
+    return db.info.get(_UOW_DEPTH, 0) > 0
+
+def _save(db: Session, *objs) -> None:
+    """普通模式下立即提交并刷新对象；单次事务模式下留给 unit_of_work 统一提交"""
+    if in_unit_of_work(db):
+        return
+    db.commit()
+    for obj in objs:
+        db.refresh(obj)
 
 def create_account(
     db: Session,
@@ -75,54 +115,52 @@ def get_card_for_reactivation(db: Session, code: str, email: str) -> tuple[Optio
     else:
         return None, "卡密已被其他用户使用或权益已过期"
 
-def get_available_account(db: Session) -> Optional[models.Account]:
+def get_available_account(db: Session, exclude_ids: Iterable[int] = ()) -> Optional[models.Account]:
     """
-    获取可用的账户，使用实时计算的邀请数量
+    获取可用的账户，使用实时计算的邀请数量；
+    会话热的账户优先（不必完整登录），同热度内剩余名额多的优先，再按最久未使用；
+    各账户的邀请数量一次查询算出（InviteStatusManager.active_counts）；
+    Overleaf 上已知满员的组跳过（本地计数可能因为手动添加的成员而偏小）。
+    exclude_ids: 本次已尝试失败的账户（单次事务模式下 updated_at 尚未落库，不能靠排序把它们排到后面）
     """
-    accounts = (
-        db.query(models.Account)
-        .order_by(models.Account.updated_at.asc())
-        .all()
+    query = db.query(models.Account)
+    if exclude_ids:
+        query = query.filter(models.Account.id.notin_(list(exclude_ids)))
+    now_ts = int(time.time())
+    accounts = query.all()
+    counts = InviteStatusManager.active_counts(
+        db, [a.id for a in accounts] if exclude_ids else None, now_ts
     )
+    spare = {a.id: (a.max_invites or 0) - counts.get(a.id, 0) for a in accounts}
+    accounts.sort(key=lambda a: routing_key(a, now_ts, spare[a.id]))
     
     for account in accounts:
         # 使用实时计算的邀请数量
-        real_invites_count = InviteStatusManager.calculate_invites_sent(db, account)
+        real_invites_count = counts.get(account.id, 0)
         if real_invites_count < account.max_invites:
+            if is_known_full(account, now_ts):
+                # 本来会选中它：记一次省下的 group_full 调用
+                account.group_full_avoided = (account.group_full_avoided or 0) + 1
+                _save(db, account)
+                continue
             # 如果缓存的计数不准确，同步一下
             if account.invites_sent != real_invites_count:
                 account.invites_sent = real_invites_count
                 account.updated_at = int(time.time())
-                db.commit()
-                db.refresh(account)
+                _save(db, account)
             return account
     
     return None
 
-def get_available_account_exclude(db: Session, exclude_account_id: int) -> Optional[models.Account]:
+def get_available_account_exclude(
+    db: Session,
+    exclude_account_id: int,
+    exclude_ids: Iterable[int] = ()
+) -> Optional[models.Account]:
     """
-    获取可用账户，排除指定账户（通常是失效的原组长）
+    获取可用账户，排除指定账户（通常是失效的原组长）以及 exclude_ids 中本次已尝试失败的账户
     """
-    accounts = (
-        db.query(models.Account)
-        .filter(models.Account.id != exclude_account_id)  # 排除原组长
-        .order_by(models.Account.updated_at.asc())  # 选择最久未使用的
-        .all()
-    )
-    
-    for account in accounts:
-        # 使用实时计算的邀请数量
-        real_invites_count = InviteStatusManager.calculate_invites_sent(db, account)
-        if real_invites_count < account.max_invites:
-            # 如果缓存的计数不准确，同步一下
-            if account.invites_sent != real_invites_count:
-                account.invites_sent = real_invites_count
-                account.updated_at = int(time.time())
-                db.commit()
-                db.refresh(account)
-            return account
-    
-    return None
+    return get_available_account(db, exclude_ids={exclude_account_id, *exclude_ids})
 
 def update_account_tokens(
     db: Session,
@@ -133,8 +171,34 @@ def update_account_tokens(
     account.csrf_token     = csrf_token
     account.session_cookie = session_cookie
     account.updated_at     = int(time.time())
-    db.commit()
-    db.refresh(account)
+    account.session_validated_at = account.updated_at
+    _save(db, account)
+    return account
+
+def mark_session_validated(db: Session, account: models.Account) -> models.Account:
+    """已保存的 token 刚被成功使用过（例如直接发出了邀请）"""
+    account.session_validated_at = int(time.time())
+    _save(db, account)
+    return account
+
+def mark_group_full(db: Session, account: models.Account) -> models.Account:
+    """Overleaf 返回 group_full：在重新确认容量之前，选账号时跳过该组"""
+    account.group_full_at   = int(time.time())
+    account.group_full_hits = (account.group_full_hits or 0) + 1
+    account.updated_at      = account.group_full_at
+    _save(db, account)
+    return account
+
+def mark_session_cold(db: Session, account: models.Account) -> models.Account:
+    """已保存的 token 刷新失败，选账号时不再视为热会话"""
+    account.session_validated_at = 0
+    _save(db, account)
+    return account
+
+def touch_account(db: Session, account: models.Account) -> models.Account:
+    """刷新 updated_at，让该账户在 get_available_account 的排序中排到后面（例如本次邀请失败）"""
+    account.updated_at = int(time.time())
+    _save(db, account)
     return account
 
 def increment_invites(db: Session, account: models.Account) -> models.Account:
@@ -154,20 +218,20 @@ def sync_account_invites_count(db: Session, account: models.Account) -> models.A
     """
     同步账户邀请计数到实际值（在记录创建/更新完成后调用）
     """
+    if in_unit_of_work(db):
+        db.flush()  # 计数需要看到本次事务中新建/更新的邀请记录
     real_count = InviteStatusManager.calculate_invites_sent(db, account)
     if account.invites_sent != real_count:
         old_count = account.invites_sent
         account.invites_sent = real_count
         account.updated_at = int(time.time())
-        db.commit()
-        db.refresh(account)
+        _save(db, account)
         print(f"账户 {account.email} 邀请计数同步: {old_count} -> {real_count}")
     return account
 
 def mark_card_used(db: Session, card: models.Card) -> models.Card:
     card.used = True
-    db.commit()
-    db.refresh(card)
+    _save(db, card)
     return card
 
 def create_invite_record(
@@ -187,13 +251,13 @@ def create_invite_record(
         email_id    = None,
         expires_at  = expires_ts,
         success     = success,
-        result      = str(result),
+        result      = invite_result.dumps(result),
         created_at  = now_ts,
         cleaned     = False
     )
     db.add(rec)
-    db.commit()
-    db.refresh(rec)
+    invite_events.record(db, rec, invite_events.INVITED, expires_at=expires_ts)
+    _save(db, rec)
     return rec
 
 def update_invite_expiry(
@@ -209,16 +273,20 @@ def update_invite_expiry(
     不修改 created_at，保留首次邀请时间。
     """
     invite.expires_at = new_expires_at
-    invite.result     = str(result)
+    invite.result     = invite_result.dumps(result)
     invite.success    = True
     invite.cleaned    = False
     
     # 如果提供了新的账号，更新 account_id
-    if new_account:
+    if new_account and new_account.id != invite.account_id:
+        old_account_id = invite.account_id
         invite.account_id = new_account.id
+        invite_events.record(db, invite, invite_events.REACTIVATED, expires_at=new_expires_at,
+                             from_account_id=old_account_id)
+    else:
+        invite_events.record(db, invite, invite_events.RENEWED, expires_at=new_expires_at)
     
-    db.commit()
-    db.refresh(invite)
+    _save(db, invite)
     return invite
 
 def create_card(db: Session, code: str, days: int = 7) -> models.Card:
@@ -5,9 +5,9 @@ from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-# 确保数据库文件在项目目录下
+# 确保数据库文件在项目目录下（OVERLEAF_INVITER_DB 可指定其他文件，测试用临时副本）
 BASE_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(BASE_DIR, "overleaf_inviter.db")
+DB_PATH = os.environ.get("OVERLEAF_INVITER_DB") or os.path.join(BASE_DIR, "overleaf_inviter.db")
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{DB_PATH}"
 
 engine = create_engine(
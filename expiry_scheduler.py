@@ -0,0 +1,305 @@
+# expiry_scheduler.py
+"""
+到期调度
+原来过期成员由每 30 分钟一次的定时脚本扫描 expires_at < now 的记录再清理：成员过期后最多还占 30 分钟席位，
+没有任何记录到期时也照样扫表。这里在 API 进程内维护一个按 expires_at 排序的小顶堆：
+- 启动时按 (cleaned, expires_at) 索引加载一次所有待到期的记录（只取 id 与 expires_at）
+- 本进程内新建 / 续期 / 重新激活 / 删除 / 清理邀请记录后，在事务提交时更新堆（Session 事件，
+  与 card_state 的失效方式一致）；批量 UPDATE / DELETE 无法逐条跟踪，会触发一次重新加载
+- 堆顶到期后 EXPIRY_FIRE_DELAY 秒，把已到期的记录（每批最多 EXPIRY_BATCH_SIZE 条）交给
+  cleanup_engine 清理；清理前在数据库里再确认一次（期间被续期、已清理的自然跳过）
+- 清理失败或 cleanup 租约被定时脚本占用时，EXPIRY_RETRY_SECONDS 秒后重试
+- 每 EXPIRY_RESYNC_SECONDS 秒重新加载一次，兜底其他进程 / 脚本写入的到期时间
+多个 API 进程各自调度，靠 cleanup 租约串行，后到的一批在数据库里确认时已无记录可清理。
+"""
+
+import time
+import heapq
+import asyncio
+import logging
+import threading
+from typing import Optional, List, Dict, Tuple, Any, Iterable
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+import models
+import cleanup_engine
+from database import SessionLocal
+from job_coordinator import JobLease, LeaseHeldError, SCOPE_CLEANUP
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+_PENDING_KEY = "expiry_changes"
+
+
+class ExpiryScheduler:
+    """expires_at 小顶堆 + 单个后台任务，到期时按批触发清理"""
+
+    def __init__(
+        self,
+        fire_delay: int = settings.EXPIRY_FIRE_DELAY,
+        batch_size: int = settings.EXPIRY_BATCH_SIZE,
+        retry_delay: int = settings.EXPIRY_RETRY_SECONDS,
+        resync_interval: int = settings.EXPIRY_RESYNC_SECONDS,
+        session_factory=SessionLocal,
+    ):
+        self.session_factory = session_factory
+        self.fire_delay = fire_delay
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.resync_interval = resync_interval
+        # 堆里可能有同一条记录的旧条目（续期后），以 _due 为准，弹出时跳过过时条目
+        self._heap: List[Tuple[int, int]] = []
+        self._due: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._reload_requested = False
+        self._loaded_at = 0.0
+        self.last_run: Optional[Dict[str, Any]] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    # -------- 堆操作（线程安全：同步接口在线程池里提交事务） --------
+
+    def schedule(self, invite_id: int, expires_at: Optional[int]) -> None:
+        """登记 / 更新一条记录的到期时间；expires_at 为 None（手动用户）时取消"""
+        if expires_at is None:
+            self.discard(invite_id)
+            return
+        with self._lock:
+            if self._due.get(invite_id) == expires_at:
+                return
+            earliest = self._peek_locked()
+            self._due[invite_id] = expires_at
+            heapq.heappush(self._heap, (expires_at, invite_id))
+        if earliest is None or expires_at < earliest:
+            self._notify()
+
+    def discard(self, invite_id: int) -> None:
+        with self._lock:
+            self._due.pop(invite_id, None)
+
+    def load(self, db: Session) -> int:
+        """从数据库重建堆：所有未清理且有到期时间的记录"""
+        rows = (
+            db.query(models.Invite.id, models.Invite.expires_at)
+            .filter(models.Invite.cleaned.is_(False), models.Invite.expires_at.isnot(None))
+            .all()
+        )
+        with self._lock:
+            self._due = {row.id: row.expires_at for row in rows}
+            self._heap = [(expires_at, invite_id) for invite_id, expires_at in self._due.items()]
+            heapq.heapify(self._heap)
+            self._reload_requested = False
+        self._loaded_at = time.monotonic()
+        self._notify()
+        return len(rows)
+
+    def request_reload(self) -> None:
+        self._reload_requested = True
+        self._notify()
+
+    def _peek_locked(self) -> Optional[int]:
+        while self._heap:
+            expires_at, invite_id = self._heap[0]
+            if self._due.get(invite_id) == expires_at:
+                return expires_at
+            heapq.heappop(self._heap)
+        return None
+
+    def next_due(self) -> Optional[int]:
+        with self._lock:
+            return self._peek_locked()
+
+    def pop_due(self, now_ts: int) -> List[int]:
+        """弹出最多 batch_size 条已到期（expires_at < now_ts）的记录"""
+        due = []
+        with self._lock:
+            while len(due) < self.batch_size:
+                expires_at = self._peek_locked()
+                if expires_at is None or expires_at >= now_ts:
+                    break
+                _, invite_id = heapq.heappop(self._heap)
+                del self._due[invite_id]
+                due.append(invite_id)
+        return due
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    # -------- 触发清理 --------
+
+    async def run_due(self, now_ts: Optional[int] = None, **cleanup_kwargs) -> Optional[cleanup_engine.CleanupReport]:
+        """清理一批已到期的记录；未清理成功的记录 retry_delay 秒后重试"""
+        if now_ts is None:
+            now_ts = int(time.time())
+        due = self.pop_due(now_ts)
+        if not due:
+            return None
+
+        lease = JobLease(SCOPE_CLEANUP)
+        try:
+            async with lease.hold():
+                db = self.session_factory()
+                try:
+                    report = await cleanup_engine.cleanup_expired(
+                        db, limit=len(due), invite_ids=due,
+                        progress=lease.update_progress_async,
+                        **cleanup_kwargs
+                    )
+                finally:
+                    db.close()
+        except LeaseHeldError:
+            logger.info(f"到期调度：清理任务正在进行，{len(due)} 条记录稍后重试")
+            self._retry(due)
+            return None
+        except Exception as e:
+            logger.exception(f"到期调度清理出错: {e}")
+            self._retry(due)
+            return None
+
+        # 数据库里已不再过期（被续期）或已清理的不会出现在 invite_ids 里，由提交事件重新登记
+        failed = set(report.invite_ids) - set(report.cleaned_ids)
+        self._retry(failed)
+        self.last_run = {
+            "at": now_ts,
+            "due": len(due),
+            "cleaned": len(report.cleaned_ids),
+            "failed": len(failed),
+            "duration": round(report.duration, 3),
+        }
+        if report.invite_ids:
+            logger.info(f"到期调度：清理 {len(report.cleaned_ids)}/{len(due)} 条，失败 {len(failed)} 条")
+        return report
+
+    def _retry(self, invite_ids: Iterable[int]) -> None:
+        # 只推迟调度时间，记录本身的 expires_at 不变；之后的提交事件或重新加载会覆盖
+        retry_at = int(time.time()) + self.retry_delay - self.fire_delay
+        for invite_id in invite_ids:
+            self.schedule(invite_id, retry_at)
+
+    # -------- 后台任务 --------
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info("到期调度已启动")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self._loop = None
+
+    def _notify(self) -> None:
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and wakeup is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def _reload(self) -> None:
+        db = self.session_factory()
+        try:
+            count = self.load(db)
+        finally:
+            db.close()
+        logger.info(f"到期调度：已加载 {count} 条待到期记录")
+
+    async def _run(self) -> None:
+        await asyncio.to_thread(self._reload)
+        while True:
+            try:
+                if self._reload_requested or time.monotonic() - self._loaded_at >= self.resync_interval:
+                    await asyncio.to_thread(self._reload)
+
+                # 先清除再计算等待时间，计算期间其他线程登记的更早记录不会丢失唤醒
+                self._wakeup.clear()
+                next_due = self.next_due()
+                timeout = self.resync_interval - (time.monotonic() - self._loaded_at)
+                if next_due is not None:
+                    timeout = min(timeout, next_due + self.fire_delay - time.time())
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                        continue  # 有更早的记录登记或需要重新加载，重新计算等待时间
+                    except asyncio.TimeoutError:
+                        pass
+                if next_due is not None and next_due + self.fire_delay <= time.time():
+                    await self.run_due(int(time.time()))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"到期调度出错: {e}")
+                await asyncio.sleep(self.retry_delay)
+
+    def status(self) -> Dict[str, Any]:
+        next_due = self.next_due()
+        return {
+            "running": self.running,
+            "scheduled": len(self),
+            "next_due_at": next_due,
+            "next_fire_in": None if next_due is None else max(0, next_due + self.fire_delay - int(time.time())),
+            "last_run": self.last_run,
+        }
+
+
+expiry_scheduler = ExpiryScheduler()
+
+
+# -------- 本进程内的写入 → 更新堆（只在调度运行时跟踪） --------
+
+@event.listens_for(Session, "after_flush")
+def _collect_expiry_changes(session, flush_context):
+    if not expiry_scheduler.running:
+        return
+    # 记下 flush 时的值（提交后属性会过期，再读要查询）；None 表示不再需要调度
+    changes = session.info.setdefault(_PENDING_KEY, {})
+    for obj in session.new:
+        if isinstance(obj, models.Invite):
+            changes[obj.id] = None if obj.cleaned else obj.expires_at
+    for obj in session.dirty:
+        if isinstance(obj, models.Invite):
+            state = inspect(obj)
+            if state.attrs.expires_at.history.has_changes() or state.attrs.cleaned.history.has_changes():
+                changes[obj.id] = None if obj.cleaned else obj.expires_at
+    for obj in session.deleted:
+        if isinstance(obj, models.Invite):
+            changes[obj.id] = None
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _reload_on_bulk_write(orm_execute_state):
+    if not expiry_scheduler.running:
+        return
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return
+    tables = {getattr(m, "persist_selectable", None) for m in orm_execute_state.all_mappers}
+    if models.Invite.__table__ in tables:
+        orm_execute_state.session.info[_PENDING_KEY + "_reload"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_expiry_changes(session):
+    changes = session.info.pop(_PENDING_KEY, None)
+    reload = session.info.pop(_PENDING_KEY + "_reload", False)
+    if not expiry_scheduler.running:
+        return
+    for invite_id, expires_at in (changes or {}).items():
+        expiry_scheduler.schedule(invite_id, expires_at)
+    if reload:
+        expiry_scheduler.request_reload()
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_expiry_changes(session):
+    session.info.pop(_PENDING_KEY, None)
+    session.info.pop(_PENDING_KEY + "_reload", None)
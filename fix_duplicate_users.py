@@ -5,6 +5,7 @@
 
 import sys
 import os
+import time
 from collections import defaultdict
 from datetime import datetime
 
@@ -12,42 +13,32 @@ from datetime import datetime
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from database import SessionLocal
-import models
+from memberships import cross_group_duplicates
+import invite_result
+import invite_events
 
-def analyze_duplicate_users():
-    """分析跨群组重复用户"""
-    db = SessionLocal()
+def analyze_duplicate_users(db=None):
+    """分析跨群组重复用户（传入 db 时沿用调用方的会话，以便修复时直接修改这些记录）"""
+    own_session = db is None
+    if own_session:
+        db = SessionLocal()
     
     try:
         print("🔍 检测跨群组重复用户...")
         
-        # 获取所有未清理的邀请记录
-        active_invites = (
-            db.query(models.Invite)
-            .filter(models.Invite.cleaned.is_(False))
-            .all()
-        )
-        
-        # 按邮箱分组
-        email_groups = defaultdict(list)
-        for invite in active_invites:
-            email_groups[invite.email.lower()].append(invite)
-        
-        # 找出重复用户
+        # 数据库里按 email_key 分组找出跨账户重复的邮箱，记录连同组长账号一次查出
         duplicates = {}
-        for email, invites in email_groups.items():
-            if len(invites) > 1:
-                # 按账户分组
-                account_groups = defaultdict(list)
-                for invite in invites:
-                    account_groups[invite.account_id].append(invite)
-                
-                if len(account_groups) > 1:  # 跨账户重复
-                    duplicates[email] = {
-                        'total_records': len(invites),
-                        'accounts': len(account_groups),
-                        'details': account_groups
-                    }
+        for email, memberships in cross_group_duplicates(db).items():
+            # 按账户分组
+            account_groups = defaultdict(list)
+            for m in memberships:
+                account_groups[m.account.id].append(m)
+            
+            duplicates[email] = {
+                'total_records': len(memberships),
+                'accounts': len(account_groups),
+                'details': account_groups
+            }
         
         if not duplicates:
             print("✅ 没有发现跨群组重复用户")
@@ -59,11 +50,11 @@ def analyze_duplicate_users():
             print(f"\n📧 {email}")
             print(f"   总记录数: {info['total_records']}, 涉及账户: {info['accounts']}个")
             
-            for account_id, records in info['details'].items():
-                account = db.get(models.Account, account_id)
-                print(f"   账户: {account.email} ({len(records)}条记录)")
+            for account_id, members in info['details'].items():
+                print(f"   账户: {members[0].account_email} ({len(members)}条记录)")
                 
-                for record in records:
+                for m in members:
+                    record = m.invite
                     created_time = datetime.fromtimestamp(record.created_at).strftime('%Y-%m-%d %H:%M:%S')
                     expires_info = "永不过期" if record.expires_at is None else datetime.fromtimestamp(record.expires_at).strftime('%Y-%m-%d %H:%M:%S')
                     print(f"     - ID:{record.id}, 创建:{created_time}, 过期:{expires_info}, email_id:{record.email_id}")
@@ -71,14 +62,15 @@ def analyze_duplicate_users():
         return duplicates
         
     finally:
-        db.close()
+        if own_session:
+            db.close()
 
 def fix_duplicate_users(dry_run=True):
     """修复重复用户（保留最新记录，清理旧记录）"""
     db = SessionLocal()
     
     try:
-        duplicates = analyze_duplicate_users()
+        duplicates = analyze_duplicate_users(db)
         if not duplicates:
             return
         
@@ -90,24 +82,24 @@ def fix_duplicate_users(dry_run=True):
             
             # 收集所有记录并按创建时间排序
             all_records = []
-            for account_id, records in info['details'].items():
-                all_records.extend(records)
+            for account_id, members in info['details'].items():
+                all_records.extend(members)
             
             # 按创建时间排序，保留最新的记录
-            all_records.sort(key=lambda x: x.created_at, reverse=True)
-            keep_record = all_records[0]
+            all_records.sort(key=lambda m: m.invite.created_at, reverse=True)
+            keep = all_records[0]
             remove_records = all_records[1:]
             
-            keep_account = db.get(models.Account, keep_record.account_id)
-            print(f"   保留记录: ID:{keep_record.id} 在账户 {keep_account.email}")
+            print(f"   保留记录: ID:{keep.invite.id} 在账户 {keep.account_email}")
             
-            for record in remove_records:
-                remove_account = db.get(models.Account, record.account_id)
-                print(f"   {'[DRY-RUN] ' if dry_run else ''}清理记录: ID:{record.id} 在账户 {remove_account.email}")
+            for m in remove_records:
+                print(f"   {'[DRY-RUN] ' if dry_run else ''}清理记录: ID:{m.invite.id} 在账户 {m.account_email}")
                 
                 if not dry_run:
-                    record.cleaned = True
-                    record.result = f"自动清理：跨群组重复用户，保留了账户{keep_account.email}中的最新记录"
+                    m.invite.cleaned = True
+                    invite_result.update(m.invite, processed_at=int(time.time()), processed_reason="cross_group_duplicate")
+                    invite_events.record(db, m.invite, invite_events.PROCESSED, detail="cross_group_duplicate",
+                                         kept_account=keep.account_email)
             
             if not dry_run:
                 db.commit()
@@ -0,0 +1,88 @@
+# group_capacity.py
+"""
+Overleaf 侧的组容量模型
+本地计数只反映经本系统发出的邀请，Overleaf 上手动添加的成员会让组在本地看来"还有名额"却返回 group_full。
+每个组长账号记录：
+- 上次拉取成员列表时的 Overleaf 成员数 / 待接受邀请数（overleaf_member_count / overleaf_pending_count / member_count_at）
+- 最近一次 group_full 的时间（group_full_at）
+选账号时跳过已知满员的组，直到成员列表重新拉取确认有空位（或超过 GROUP_FULL_RECHECK_SECONDS 后再试一次）。
+group_full_hits / group_full_avoided 统计实际撞上与提前避开的 group_full 次数。
+"""
+
+import time
+from typing import Optional, Dict, Any, Iterable
+
+from sqlalchemy.orm import Session
+
+import models
+from settings import settings
+
+
+def is_known_full(acct: models.Account, now_ts: Optional[int] = None) -> bool:
+    """该组是否已知在 Overleaf 上满员（且尚未重新确认）"""
+    if now_ts is None:
+        now_ts = int(time.time())
+    window = settings.GROUP_FULL_RECHECK_SECONDS
+    member_count_at = acct.member_count_at or 0
+
+    # 撞上 group_full 之后还没有拉取到有空位的成员列表（拉到时 group_full_at 会被清零）
+    full_at = acct.group_full_at or 0
+    if full_at and now_ts - full_at < window:
+        return True
+
+    # 最近一次拉取的成员列表本身就已满
+    if (acct.overleaf_member_count is not None and member_count_at
+            and acct.overleaf_member_count >= (acct.max_invites or 0)
+            and now_ts - member_count_at < window):
+        return True
+    return False
+
+
+def membership_values(
+    members: Iterable[Dict[str, Any]],
+    max_invites: int,
+    now_ts: Optional[int] = None
+) -> Dict[str, int]:
+    """
+    成员列表拉取后要写入 Account 的列（members 为 members_from_overleaf_users 的格式）；
+    列表有空位说明容量已重新确认，同时清除 group_full 标记
+    """
+    members = list(members)
+    values = {
+        "overleaf_member_count": len(members),
+        "overleaf_pending_count": sum(1 for m in members if m.get("status") == "pending"),
+        "member_count_at": now_ts if now_ts is not None else int(time.time()),
+    }
+    if len(members) < (max_invites or 0):
+        values["group_full_at"] = 0
+    return values
+
+
+def capacity_stats(db: Session, now_ts: Optional[int] = None) -> Dict[str, Any]:
+    """各组的容量快照与 group_full 统计"""
+    if now_ts is None:
+        now_ts = int(time.time())
+    accounts = db.query(models.Account).order_by(models.Account.id).all()
+    groups = [
+        {
+            "account_id": acct.id,
+            "email": acct.email,
+            "max_invites": acct.max_invites,
+            "invites_sent": acct.invites_sent,
+            "overleaf_member_count": acct.overleaf_member_count,
+            "overleaf_pending_count": acct.overleaf_pending_count,
+            "member_count_at": acct.member_count_at or None,
+            "group_full_at": acct.group_full_at or None,
+            "known_full": is_known_full(acct, now_ts),
+            "group_full_hits": acct.group_full_hits or 0,
+            "group_full_avoided": acct.group_full_avoided or 0,
+        }
+        for acct in accounts
+    ]
+    return {
+        "total_accounts": len(groups),
+        "known_full": sum(1 for g in groups if g["known_full"]),
+        "group_full_hits": sum(g["group_full_hits"] for g in groups),
+        "group_full_avoided": sum(g["group_full_avoided"] for g in groups),
+        "groups": groups,
+    }
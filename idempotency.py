@@ -0,0 +1,221 @@
+# idempotency.py
+"""
+幂等键：客户端超时重试 /invite、/reactivate、/member/remove、/member/revoke_unaccepted 时，
+同一个键只真正执行一次。
+- 第一次请求在 idempotency_records 中占位（in_flight），执行完成后保存 2xx 响应
+- 执行期间的重复请求等待第一次完成（跨进程靠轮询数据库），之后直接返回保存的响应，
+  响应头带 Idempotent-Replayed: true，不再触达 Overleaf
+- 非 2xx（HTTPException 等）不保存，占位删除，重试会重新执行
+- 客户端未传 Idempotency-Key 时，/invite 由请求内容派生（卡密 + 邮箱），派生键只保留较短时间；
+  删除 / 撤销 / 重新激活对同一邮箱或卡密的再次请求可能是正当的新操作，只在客户端传键时去重
+- 等待第一次完成最多 WAIT_TIMEOUT 秒，超时返回 409，客户端稍后重试
+"""
+
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+from typing import Optional, Callable, Awaitable, Any, Dict
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from sqlalchemy import update, delete
+from sqlalchemy.exc import IntegrityError
+
+import models
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER    = "Idempotent-Replayed"
+
+EXPLICIT_KEY_TTL = 24 * 3600  # 客户端提供的键
+DERIVED_KEY_TTL  = 10 * 60    # 由请求内容派生的键
+IN_FLIGHT_TTL    = 300        # 执行中的占位超过这个时间视为持有者已崩溃，可被接管
+WAIT_TIMEOUT     = 60         # 重复请求等待第一次完成的最长时间（须小于 IN_FLIGHT_TTL）
+POLL_INTERVAL    = 0.25
+
+# 本进程内的等待者直接用 Event 唤醒，不必等下一次轮询
+_local_events: Dict[str, asyncio.Event] = {}
+
+
+def derive_key(*parts: Any) -> str:
+    """由请求内容派生默认键"""
+    raw = "\x1f".join(str(p).strip().lower() for p in parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def fingerprint(payload: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(jsonable_encoder(payload), sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def _try_claim(record_key: str, owner: str, request_hash: str, now_ts: int) -> Optional[models.IdempotencyRecord]:
+    """
+    占位：插入新记录，或接管已过期的记录。成功返回 None；
+    键已被占用则返回现有记录（已脱离会话的快照）。
+    """
+    db = SessionLocal()
+    try:
+        try:
+            db.add(models.IdempotencyRecord(
+                key=record_key, status="in_flight", owner=owner,
+                request_hash=request_hash, created_at=now_ts,
+                expires_at=now_ts + IN_FLIGHT_TTL,
+            ))
+            db.commit()
+            return None
+        except IntegrityError:
+            db.rollback()
+
+        taken = db.execute(
+            update(models.IdempotencyRecord)
+            .where(
+                models.IdempotencyRecord.key == record_key,
+                models.IdempotencyRecord.expires_at < now_ts,
+            )
+            .values(
+                status="in_flight", owner=owner, request_hash=request_hash,
+                status_code=None, response=None, created_at=now_ts,
+                expires_at=now_ts + IN_FLIGHT_TTL,
+            )
+        ).rowcount
+        db.commit()
+        if taken:
+            return None
+
+        record = db.get(models.IdempotencyRecord, record_key)
+        if record is None:
+            # 刚好被删除（上一次执行失败），下一轮再试
+            return models.IdempotencyRecord(key=record_key, status="missing")
+        db.expunge(record)
+        return record
+    finally:
+        db.close()
+
+
+def _finish(record_key: str, owner: str, status_code: int, body: Any, ttl: int) -> None:
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(models.IdempotencyRecord)
+            .where(models.IdempotencyRecord.key == record_key, models.IdempotencyRecord.owner == owner)
+            .values(
+                status="done",
+                status_code=status_code,
+                response=json.dumps(body, ensure_ascii=False),
+                expires_at=int(time.time()) + ttl,
+            )
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _release(record_key: str, owner: str) -> None:
+    db = SessionLocal()
+    try:
+        db.execute(
+            delete(models.IdempotencyRecord)
+            .where(models.IdempotencyRecord.key == record_key, models.IdempotencyRecord.owner == owner)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def purge_expired(now_ts: Optional[int] = None) -> int:
+    """删除已过期的记录（维护任务调用）"""
+    if now_ts is None:
+        now_ts = int(time.time())
+    db = SessionLocal()
+    try:
+        deleted = db.execute(
+            delete(models.IdempotencyRecord).where(models.IdempotencyRecord.expires_at < now_ts)
+        ).rowcount
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+
+def _replay(record: models.IdempotencyRecord) -> JSONResponse:
+    return JSONResponse(
+        status_code=record.status_code,
+        content=json.loads(record.response),
+        headers={REPLAYED_HEADER: "true"},
+    )
+
+
+def _to_status_and_body(result: Any):
+    if isinstance(result, Response):
+        return result.status_code, json.loads(result.body) if result.body else None
+    return 200, jsonable_encoder(result)
+
+
+async def run_idempotent(
+    scope: str,
+    key: Optional[str],
+    derived_key: Optional[str],
+    request_payload: Any,
+    handler: Callable[[], Awaitable[Any]],
+) -> Any:
+    """
+    以幂等方式执行 handler。
+    scope: 接口名，与键一起组成记录主键；key: 客户端的 Idempotency-Key（可为空）；
+    derived_key: 没有客户端键时使用的派生键，为 None 时不去重直接执行；
+    request_payload: 用于检测同一键被用于不同请求。
+    """
+    explicit = bool(key)
+    if not explicit and derived_key is None:
+        return await handler()
+    record_key = f"{scope}:{key if explicit else derived_key}"
+    ttl = EXPLICIT_KEY_TTL if explicit else DERIVED_KEY_TTL
+    request_hash = fingerprint(request_payload)
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + WAIT_TIMEOUT
+
+    while True:
+        existing = await asyncio.to_thread(_try_claim, record_key, owner, request_hash, int(time.time()))
+        if existing is None:
+            break
+        if explicit and existing.request_hash and existing.request_hash != request_hash:
+            raise HTTPException(422, f"{IDEMPOTENCY_HEADER} 已用于内容不同的请求")
+        if existing.status == "done":
+            logger.info(f"幂等键命中，返回已保存的响应: {record_key}")
+            return _replay(existing)
+
+        # 第一次请求仍在执行：等待它完成（或占位过期后接管），最多 WAIT_TIMEOUT 秒
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise HTTPException(409, "相同的请求仍在处理中，请稍后重试")
+        event = _local_events.get(record_key)
+        try:
+            if event is not None:
+                await asyncio.wait_for(event.wait(), timeout=min(POLL_INTERVAL * 4, remaining))
+            else:
+                await asyncio.sleep(min(POLL_INTERVAL, remaining))
+        except asyncio.TimeoutError:
+            pass
+
+    event = _local_events.setdefault(record_key, asyncio.Event())
+    try:
+        result = await handler()
+    except BaseException:
+        await asyncio.to_thread(_release, record_key, owner)
+        raise
+    else:
+        status_code, body = _to_status_and_body(result)
+        if 200 <= status_code < 300:
+            await asyncio.to_thread(_finish, record_key, owner, status_code, body, ttl)
+        else:
+            await asyncio.to_thread(_release, record_key, owner)
+        return result
+    finally:
+        _local_events.pop(record_key, None)
+        event.set()
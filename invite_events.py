@@ -0,0 +1,133 @@
+# invite_events.py
+"""
+邀请记录的生命周期事件
+原来每一步（邀请、重新激活、原组清理进展、发现 email_id、标记处理、手动设置过期时间）都把
+invites.result 整段 json.loads 再 json.dumps 写回，历史混在当前状态里，也查不出"某条记录何时被处理"。
+现在：
+- invites 只保留当前状态（列 + result 中邀请时的响应 / 导入信息、处理原因）
+- 每一步在同一事务里向 invite_events 追加一行（kind / detail / 少量 JSON 数据），不读也不改写原记录
+- 批量路径（对账、email_id 回填、流式清理）一条语句写入一批事件
+- compact 定期整理：进展类事件只留最新一条，已被硬删除的记录的旧事件删除（归档的记录保留）
+"""
+
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, exists, func, insert, literal, select
+from sqlalchemy.orm import Session, aliased
+
+import models
+import invite_result
+from settings import settings
+
+INVITED = "invited"                            # 新邀请
+RENEWED = "renewed"                            # 同一条记录续期 / 重新邀请
+REACTIVATED = "reactivated"                    # 重新激活并转到新组长
+REACTIVATION_CLEANUP = "reactivation_cleanup"  # 原组清理进展（detail 为 queued / retrying / succeeded / failed）
+EMAIL_ID = "email_id"                          # 发现或更新 Overleaf user id（detail 为 id）
+PROCESSED = "processed"                        # 标记已清理（detail 为原因）
+RESTORED = "restored"                          # 对账发现仍在 Overleaf，取消已清理
+REMOVED = "removed"                            # 从 Overleaf 删除后记录被删除（detail 为 removed / revoked / not_found 或原因）
+EXPIRY_SET = "expiry_set"                      # 手动用户设置过期时间
+
+# 只有最新一条有意义的进展类事件，压缩时每条记录每类只保留最新一条
+COLLAPSIBLE = (REACTIVATION_CLEANUP, EMAIL_ID)
+
+_COLUMNS = ("invite_id", "account_id", "kind", "detail", "data", "at")
+
+
+def record(db: Session, invite: models.Invite, kind: str, detail: Optional[str] = None,
+           at: Optional[int] = None, **data) -> models.InviteEvent:
+    """追加一条事件，由调用方提交；记录还没有 id 时随同一次 flush 写入"""
+    event = models.InviteEvent(
+        invite_id=invite.id, account_id=invite.account_id, kind=kind,
+        detail=detail, data=data or None, at=at or int(time.time()),
+    )
+    if invite.id is None:
+        event.invite = invite
+    db.add(event)
+    return event
+
+
+def record_rows(db: Session, rows: Iterable[Dict[str, Any]], at: Optional[int] = None) -> int:
+    """一条 executemany 追加一批事件；rows 至少包含 invite_id、kind"""
+    at = at or int(time.time())
+    values = [{**{column: None for column in _COLUMNS}, "at": at, **row} for row in rows]
+    if values:
+        db.execute(insert(models.InviteEvent), values)
+    return len(values)
+
+
+def record_for_ids(db: Session, invite_ids: List[int], kind: str, detail: Optional[str] = None,
+                   at: Optional[int] = None) -> None:
+    """INSERT ... SELECT：为一批仍在 invites 中的记录各追加一条同样的事件（流式清理按块调用）"""
+    source = select(
+        models.Invite.id, models.Invite.account_id, literal(kind), literal(detail), literal(at or int(time.time())),
+    ).where(models.Invite.id.in_(invite_ids))
+    db.execute(insert(models.InviteEvent).from_select(
+        ["invite_id", "account_id", "kind", "detail", "at"], source
+    ))
+
+
+def to_dict(event: models.InviteEvent) -> Dict[str, Any]:
+    return {
+        "id": event.id, "invite_id": event.invite_id, "account_id": event.account_id,
+        "kind": event.kind, "detail": event.detail,
+        "data": invite_result.parse(event.data) if event.data else None, "at": event.at,
+    }
+
+
+def history(db: Session, invite_id: int) -> List[models.InviteEvent]:
+    """某条记录的全部事件，按发生顺序"""
+    return (
+        db.query(models.InviteEvent)
+        .filter(models.InviteEvent.invite_id == invite_id)
+        .order_by(models.InviteEvent.id)
+        .all()
+    )
+
+
+def latest(db: Session, invite_id: int, kind: str) -> Optional[models.InviteEvent]:
+    return (
+        db.query(models.InviteEvent)
+        .filter(models.InviteEvent.invite_id == invite_id, models.InviteEvent.kind == kind)
+        .order_by(models.InviteEvent.id.desc())
+        .first()
+    )
+
+
+def compact(
+    db: Session,
+    older_than_days: int = settings.INVITE_EVENTS_COMPACT_AFTER_DAYS,
+    now_ts: Optional[int] = None,
+) -> Dict[str, Any]:
+    """整理早于 older_than_days 天的事件，返回删除的条数"""
+    if now_ts is None:
+        now_ts = int(time.time())
+    cutoff = now_ts - older_than_days * 86400
+    Event = models.InviteEvent
+    newer = aliased(models.InviteEvent)
+
+    try:
+        collapsed = db.execute(
+            delete(Event).where(
+                Event.at < cutoff,
+                Event.kind.in_(COLLAPSIBLE),
+                exists().where(newer.invite_id == Event.invite_id, newer.kind == Event.kind, newer.id > Event.id),
+            ),
+            execution_options={"synchronize_session": False},
+        ).rowcount
+        orphaned = db.execute(
+            delete(Event).where(
+                Event.at < cutoff,
+                ~exists().where(models.Invite.id == Event.invite_id),
+                ~exists().where(models.InviteArchive.id == Event.invite_id),
+            ),
+            execution_options={"synchronize_session": False},
+        ).rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    remaining = db.query(func.count(Event.id)).scalar()
+    return {"collapsed": collapsed, "orphaned": orphaned, "remaining": remaining, "cutoff": cutoff}
@@ -0,0 +1,290 @@
+# invite_jobs.py
+"""
+异步邀请任务队列
+POST /api/v1/invite?mode=async 只做卡密校验并写入 invite_jobs，立即返回 job id；
+每个 API 进程内的一组 worker 用带条件的 UPDATE 认领任务（多进程不会重复认领），
+执行与同步模式完全相同的邀请流程（routers.invites.run_invite），进度和结果落库。
+同一组长账号的邀请在 routers.invites 中按账号串行，避免并发刷新同一份 token。
+
+worker 崩溃后任务租约过期：从未进入发送阶段的任务重新排队，进入过发送阶段的任务
+（send_attempted，换账号重试回到 selecting_account 后也保留）标记失败，避免重复发送或重复占用卡密。
+任务状态的读写都通过 asyncio.to_thread 执行，不在事件循环上等待 SQLite 写锁。
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from typing import Optional, Callable, Awaitable, List
+
+from fastapi import HTTPException
+from sqlalchemy import update, and_
+from sqlalchemy.orm import Session
+
+import models, schemas
+from database import SessionLocal
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+JOB_LEASE_SECONDS = 300  # 每次上报进度都会续期
+TERMINAL_STATUSES = ("succeeded", "failed")
+# 在这些阶段中断、且从未进入过发送阶段（send_attempted）的任务还没有触达 Overleaf，可以安全地重新排队
+REQUEUE_SAFE_STAGES = ("queued", "validating", "selecting_account")
+
+InviteHandler = Callable[..., Awaitable[schemas.InviteResponse]]
+
+
+def enqueue_invite(db: Session, email: str, card_code: str) -> models.InviteJob:
+    """
+    写入一条排队中的任务。同一卡密 + 邮箱已有未结束的任务时直接返回该任务，
+    客户端重复提交不会产生第二次邀请。
+    """
+    existing = (
+        db.query(models.InviteJob)
+        .filter(
+            models.InviteJob.card_code == card_code,
+            models.InviteJob.email == email,
+            models.InviteJob.status.in_(("queued", "running")),
+        )
+        .first()
+    )
+    if existing:
+        return existing
+
+    job = models.InviteJob(
+        id=uuid.uuid4().hex,
+        email=email,
+        card_code=card_code,
+        status="queued",
+        stage="queued",
+        attempt=0,
+        created_at=int(time.time()),
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def job_to_schema(job: models.InviteJob) -> schemas.InviteJobStatus:
+    return schemas.InviteJobStatus(
+        job_id=job.id,
+        status=job.status,
+        stage=job.stage,
+        email=job.email,
+        attempt=job.attempt or 0,
+        account_email=job.account_email,
+        result=schemas.InviteResponse(**json.loads(job.response)) if job.response else None,
+        error=job.error,
+        error_status=job.error_status,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+    )
+
+
+def get_job_status(job_id: str) -> Optional[schemas.InviteJobStatus]:
+    db = SessionLocal()
+    try:
+        job = db.get(models.InviteJob, job_id)
+        return job_to_schema(job) if job else None
+    finally:
+        db.close()
+
+
+async def wait_for_job(job_id: str, timeout: float, poll_interval: float = 0.5) -> Optional[schemas.InviteJobStatus]:
+    """长轮询：任务结束或超时后返回当前状态（任务可能在其他进程中执行，所以轮询数据库）"""
+    deadline = time.monotonic() + timeout
+    while True:
+        status = await asyncio.to_thread(get_job_status, job_id)
+        if status is None or status.status in TERMINAL_STATUSES or time.monotonic() >= deadline:
+            return status
+        await asyncio.sleep(min(poll_interval, max(0.0, deadline - time.monotonic())))
+
+
+def claim_next_job(owner: str) -> Optional[str]:
+    """认领最早的排队任务；条件 UPDATE 保证多进程下只有一个 worker 认领成功"""
+    db = SessionLocal()
+    try:
+        for _ in range(5):
+            candidate = (
+                db.query(models.InviteJob.id)
+                .filter(models.InviteJob.status == "queued")
+                .order_by(models.InviteJob.created_at, models.InviteJob.id)
+                .first()
+            )
+            if candidate is None:
+                return None
+            now_ts = int(time.time())
+            result = db.execute(
+                update(models.InviteJob)
+                .where(models.InviteJob.id == candidate.id, models.InviteJob.status == "queued")
+                .values(
+                    status="running",
+                    stage="validating",
+                    worker=owner,
+                    started_at=now_ts,
+                    lease_expires_at=now_ts + JOB_LEASE_SECONDS,
+                )
+            )
+            db.commit()
+            if result.rowcount == 1:
+                return candidate.id
+        return None
+    finally:
+        db.close()
+
+
+def _update_job(job_id: str, owner: str, **values) -> None:
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(models.InviteJob)
+            .where(models.InviteJob.id == job_id, models.InviteJob.worker == owner)
+            .values(**values)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def recover_interrupted_jobs(now_ts: Optional[int] = None) -> int:
+    """回收租约已过期的运行中任务，返回处理的任务数"""
+    if now_ts is None:
+        now_ts = int(time.time())
+    db = SessionLocal()
+    try:
+        stale = and_(models.InviteJob.status == "running", models.InviteJob.lease_expires_at < now_ts)
+        requeued = db.execute(
+            update(models.InviteJob)
+            .where(stale, models.InviteJob.stage.in_(REQUEUE_SAFE_STAGES),
+                   models.InviteJob.send_attempted.isnot(True))
+            .values(status="queued", stage="queued", worker=None, lease_expires_at=None)
+        ).rowcount
+        failed = db.execute(
+            update(models.InviteJob)
+            .where(stale)
+            .values(
+                status="failed",
+                error="任务在发送阶段中断，请查询邀请记录确认是否已发出",
+                error_status=500,
+                finished_at=now_ts,
+                lease_expires_at=None,
+            )
+        ).rowcount
+        db.commit()
+        if requeued or failed:
+            logger.warning(f"回收中断的邀请任务: 重新排队 {requeued} 个，标记失败 {failed} 个")
+        return requeued + failed
+    finally:
+        db.close()
+
+
+class InviteJobQueue:
+    """单个进程内的 worker 池"""
+
+    def __init__(self, workers: int = settings.INVITE_JOB_WORKERS, poll_interval: float = 1.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._handler: Optional[InviteHandler] = None
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self, handler: InviteHandler) -> None:
+        """handler(req, db, progress) 执行一次邀请并返回 InviteResponse，失败抛 HTTPException"""
+        if self._tasks:
+            return
+        self._handler = handler
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker_loop(i)) for i in range(self.workers)]
+        logger.info(f"邀请任务队列已启动: {self.workers} 个 worker ({self.owner})")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        """有新任务入队时唤醒空闲 worker（其他进程的 worker 靠轮询发现）"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _worker_loop(self, index: int) -> None:
+        if index == 0:
+            # 启动时回收上次遗留的中断任务
+            await asyncio.to_thread(recover_interrupted_jobs)
+        while True:
+            job_id = await asyncio.to_thread(claim_next_job, self.owner)
+            if job_id is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    # 顺带回收其他进程遗留的中断任务
+                    await asyncio.to_thread(recover_interrupted_jobs)
+                continue
+            try:
+                await self.process(job_id)
+            except Exception as e:
+                logger.exception(f"worker {index} 处理任务 {job_id} 时出错: {e}")
+
+    async def process(self, job_id: str) -> None:
+        db = SessionLocal()
+        try:
+            job = db.get(models.InviteJob, job_id)
+            req = schemas.InviteRequest(email=job.email, card=job.card_code)
+
+            async def progress(stage: str, account_email: Optional[str] = None, attempt: Optional[int] = None):
+                values = {"stage": stage, "lease_expires_at": int(time.time()) + JOB_LEASE_SECONDS}
+                if stage == "sending":
+                    values["send_attempted"] = True
+                if account_email is not None:
+                    values["account_email"] = account_email
+                if attempt is not None:
+                    values["attempt"] = attempt
+                await asyncio.to_thread(_update_job, job_id, self.owner, **values)
+
+            try:
+                response = await self._handler(req, db, progress=progress)
+            except HTTPException as e:
+                await asyncio.to_thread(
+                    _update_job,
+                    job_id, self.owner,
+                    status="failed", stage="failed",
+                    error=str(e.detail), error_status=e.status_code,
+                    finished_at=int(time.time()), lease_expires_at=None,
+                )
+                return
+            except Exception as e:
+                db.rollback()
+                await asyncio.to_thread(
+                    _update_job,
+                    job_id, self.owner,
+                    status="failed", stage="failed",
+                    error=f"{type(e).__name__}: {e}", error_status=500,
+                    finished_at=int(time.time()), lease_expires_at=None,
+                )
+                return
+
+            await asyncio.to_thread(
+                _update_job,
+                job_id, self.owner,
+                status="succeeded", stage="done",
+                response=response.model_dump_json(),
+                finished_at=int(time.time()), lease_expires_at=None,
+            )
+        finally:
+            db.close()
+
+
+invite_job_queue = InviteJobQueue()
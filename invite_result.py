@@ -0,0 +1,94 @@
+# invite_result.py
+"""
+邀请记录 invites.result 的结构化存储
+原来 crud.create_invite_record / update_invite_expiry 与批量邀请写入的是 str(result)（Python dict 的 repr），
+mark_invite_processed、手动用户接口等再 json.loads，失败就静默包一层 {"original_result": ...}；
+SQL 里也没法按其中的字段筛选（流式清理的 json_set 只能跳过这些记录）。
+现在：
+- 列类型 ResultJSON：所有写入（ORM、Core 批量 INSERT、旧代码传入的 repr 字符串）落库前统一转成紧凑 JSON 对象
+- parse / update：读取、合并更新的唯一入口，旧格式仍能解析
+- field(name)：SQL 中按字段取值（json_extract），例如 processed_reason、sync_date；
+  ix_invites_processed_reason 建索引前由 migrations 把已有的 repr 字符串转换为 JSON（convert_legacy_results）
+- schemas.InviteResultInfo：列表接口返回的类型化摘要，不再返回整段原始字符串
+"""
+
+import ast
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from sqlalchemy import Text, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.types import TypeDecorator
+
+logger = logging.getLogger(__name__)
+
+
+def parse(raw: Any) -> Dict[str, Any]:
+    """result 转成 dict：JSON、旧代码写入的 Python dict 字符串都可以；其他内容放在 original_result 中"""
+    if not raw:
+        return {}
+    if isinstance(raw, dict):
+        return dict(raw)
+    if not isinstance(raw, str):
+        return {"original_result": raw}
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        try:
+            data = ast.literal_eval(raw)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            data = None
+    return data if isinstance(data, dict) else {"original_result": raw}
+
+
+def dumps(data: Optional[Dict[str, Any]]) -> str:
+    """紧凑 JSON（不转义中文、不带空格）"""
+    return json.dumps(data or {}, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def update(invite, **fields) -> Dict[str, Any]:
+    """在记录的 result 上合并字段，返回合并后的 dict"""
+    data = parse(invite.result)
+    data.update(fields)
+    invite.result = dumps(data)
+    return data
+
+
+def field(name: str):
+    """SQL 表达式：result 中的某个顶层字段"""
+    import models
+    return models.Invite.result_field(name)
+
+
+class ResultJSON(TypeDecorator):
+    """以 TEXT 保存的 JSON 对象；绑定参数时把 dict / 旧格式字符串统一成 JSON，读取时仍是字符串"""
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            try:
+                if isinstance(json.loads(value), dict):
+                    return value
+            except ValueError:
+                pass
+        return dumps(parse(value))
+
+
+def convert_legacy_results(connection: Connection) -> None:
+    """把不是合法 JSON 对象的 result（str(dict) 的 repr 等）就地转换为 JSON"""
+    rows = connection.execute(text(
+        "SELECT id, result FROM invites "
+        "WHERE result IS NOT NULL "
+        "AND CASE WHEN json_valid(result) THEN json_type(result) != 'object' ELSE 1 END"
+    )).all()
+    for row in rows:
+        connection.execute(
+            text("UPDATE invites SET result = :result WHERE id = :id"),
+            {"id": row.id, "result": dumps(parse(row.result))},
+        )
+    if rows:
+        logger.info(f"转换旧格式 result: {len(rows)} 条")
@@ -6,9 +6,11 @@
 
 import time
 from enum import Enum
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable
 from sqlalchemy.orm import Session
 import models
+import invite_result
+import invite_events
 
 
 class InviteStatus(Enum):
@@ -94,7 +96,62 @@ class InviteStatusManager:
             .all()
         )
         
-        # 统计真正占用Overleaf名额的最新邀请（排除已清理的）
+        return InviteStatusManager.count_active_latest(latest_invites, now_ts)
+    
+    @staticmethod
+    def active_counts(db: Session, account_ids: Optional[List[int]] = None,
+                      now_ts: Optional[int] = None) -> Dict[int, int]:
+        """
+        一条聚合查询算出各账户的邀请数量（与 calculate_invites_sent 同规则：每个邮箱的最新记录中占用名额的），
+        不把邀请记录加载到内存；没有占用名额记录的账户不在结果中。account_ids 为空表示所有账户
+        """
+        if now_ts is None:
+            now_ts = int(time.time())
+
+        from sqlalchemy import func, and_, or_
+
+        Invite = models.Invite
+        latest = db.query(
+            Invite.account_id,
+            Invite.email,
+            func.max(Invite.created_at).label('latest_created_at')
+        )
+        if account_ids is not None:
+            latest = latest.filter(Invite.account_id.in_(list(account_ids)))
+        latest = latest.group_by(Invite.account_id, Invite.email).subquery()
+
+        rows = (
+            db.query(Invite.account_id, func.count())
+            .join(
+                latest,
+                and_(
+                    Invite.account_id == latest.c.account_id,
+                    Invite.email == latest.c.email,
+                    Invite.created_at == latest.c.latest_created_at
+                )
+            )
+            .filter(
+                Invite.cleaned.isnot(True),
+                or_(
+                    and_(Invite.email_id.isnot(None), Invite.email_id != ""),  # 已接受的成员
+                    Invite.expires_at.is_(None),                               # 手动添加的用户
+                    Invite.expires_at > now_ts                                 # 未接受但未过期的邀请
+                )
+            )
+            .group_by(Invite.account_id)
+        )
+        return {account_id: count for account_id, count in rows}
+
+    @staticmethod
+    def count_active_latest(latest_invites, now_ts: Optional[int] = None) -> int:
+        """
+        统计真正占用Overleaf名额的最新邀请（排除已清理的）
+        latest_invites 为每个邮箱的最新一条记录，只需具备 cleaned / email_id / expires_at 属性，
+        对账引擎用它在内存中预估修复后的计数。
+        """
+        if now_ts is None:
+            now_ts = int(time.time())
+        
         active_count = 0
         for invite in latest_invites:
             # 跳过已清理的记录
@@ -161,17 +218,8 @@ class InviteStatusManager:
         """
         invite.cleaned = True
         # 更新result字段记录处理原因和时间
-        import json
-        try:
-            result_data = json.loads(invite.result) if invite.result else {}
-        except:
-            result_data = {"original_result": invite.result}
-            
-        result_data.update({
-            "processed_at": int(time.time()),
-            "processed_reason": reason
-        })
-        invite.result = json.dumps(result_data, ensure_ascii=False)
+        invite_result.update(invite, processed_at=int(time.time()), processed_reason=reason)
+        invite_events.record(db, invite, invite_events.PROCESSED, detail=reason)
         
         db.add(invite)
         db.commit()
@@ -179,7 +227,8 @@ class InviteStatusManager:
         return invite
     
     @staticmethod
-    def batch_cleanup_expired(db: Session, limit: int = 100, delete_records: bool = True) -> Dict[str, int]:
+    def batch_cleanup_expired(db: Session, limit: int = 100, delete_records: bool = True,
+                              invite_ids: Optional[List[int]] = None) -> Dict[str, int]:
         """
         批量清理过期邀请
         
@@ -187,22 +236,21 @@ class InviteStatusManager:
             db: 数据库会话
             limit: 单次处理的最大数量
             delete_records: 是否真正删除记录（True）还是只标记（False）
+            invite_ids: 只处理其中仍然过期且未处理的记录（执行清理计划时使用，见 cleanup_plan.py）
             
         返回处理统计信息
         """
         now_ts = int(time.time())
         
         # 查找过期且未处理的邀请（排除手动添加的用户）
-        expired_invites = (
-            db.query(models.Invite)
-            .filter(
-                models.Invite.expires_at.isnot(None),
-                models.Invite.expires_at < now_ts,
-                models.Invite.cleaned.is_(False)
-            )
-            .limit(limit)
-            .all()
+        query = db.query(models.Invite).filter(
+            models.Invite.expires_at.isnot(None),
+            models.Invite.expires_at < now_ts,
+            models.Invite.cleaned.is_(False)
         )
+        if invite_ids is not None:
+            query = query.filter(models.Invite.id.in_(list(invite_ids)))
+        expired_invites = query.limit(limit).all()
         
         stats = {
             "total_found": len(expired_invites),
@@ -218,6 +266,7 @@ class InviteStatusManager:
             try:
                 if delete_records:
                     # 真正删除记录
+                    invite_events.record(db, invite, invite_events.REMOVED, detail="expired")
                     db.delete(invite)
                     if invite.email_id:
                         stats["accepted_removed"] += 1
@@ -244,7 +293,128 @@ class InviteStatusManager:
             stats["marked_processed"] = 0
         
         return stats
-    
+
+    @staticmethod
+    def stream_cleanup_expired(
+        db: Session,
+        chunk_size: int = 1000,
+        delete_records: bool = True,
+        progress: Optional[Callable[[int, int, Optional[str]], Any]] = None,
+        now_ts: Optional[int] = None
+    ) -> Dict[str, int]:
+        """
+        流式清理全部过期邀请（停机后积压较多时使用，一次调用处理完）
+
+        按 (expires_at, id) 游标分块：沿 (cleaned, expires_at) 索引顺序读取，不需要每块对剩余积压排序；
+        每块只读取 id / account_id / email_id 等几列，用一条 INSERT ... SELECT 追加事件（见 invite_events.py），
+        再用一条 DELETE（或 UPDATE）... WHERE id IN (...) 处理后立即提交，SQLite 写锁只持有一块的时间；
+        全部处理完后，受影响的账户用一次查询各重新计数一次。
+        progress(已处理, 总数, None) 每块回调一次。
+
+        返回与 batch_cleanup_expired 相同的统计项，另加 chunks / accounts_recounted
+        """
+        from sqlalchemy import delete, update, case, func, tuple_
+        from sync_engine import latest_per_email
+
+        if now_ts is None:
+            now_ts = int(time.time())
+        Invite = models.Invite
+        expired = (
+            Invite.expires_at.isnot(None),
+            Invite.expires_at < now_ts,
+            Invite.cleaned.is_(False),
+        )
+        total = db.query(func.count(Invite.id)).filter(*expired).scalar() or 0
+        stats = {
+            "total_found": 0,
+            "accepted_removed": 0,
+            "pending_revoked": 0,
+            "deleted_records": 0,
+            "marked_processed": 0,
+            "errors": 0,
+            "chunks": 0,
+            "accounts_recounted": 0,
+        }
+        affected = set()
+        cursor = None   # 上一块最后一条的 (expires_at, id)；提交失败的块也会被跳过
+
+        while True:
+            query = db.query(Invite.id, Invite.account_id, Invite.email_id, Invite.expires_at).filter(*expired)
+            if cursor is not None:
+                query = query.filter(tuple_(Invite.expires_at, Invite.id) > cursor)
+            rows = query.order_by(Invite.expires_at, Invite.id).limit(chunk_size).all()
+            if not rows:
+                break
+            cursor = (rows[-1].expires_at, rows[-1].id)
+            ids = [row.id for row in rows]
+            try:
+                if delete_records:
+                    invite_events.record_for_ids(db, ids, invite_events.REMOVED, "expired", at=now_ts)
+                    db.execute(
+                        delete(Invite).where(Invite.id.in_(ids)),
+                        execution_options={"synchronize_session": False}
+                    )
+                else:
+                    # 与 mark_invite_processed 相同：在 result 中记下处理时间与原因（不是 JSON 对象的保持原样）
+                    invite_events.record_for_ids(db, ids, invite_events.PROCESSED, "expired", at=now_ts)
+                    db.execute(
+                        update(Invite).where(Invite.id.in_(ids)).values(
+                            cleaned=True,
+                            result=case(
+                                (func.json_valid(Invite.result) == 1,
+                                 func.json_set(Invite.result, "$.processed_at", now_ts,
+                                               "$.processed_reason", "expired")),
+                                else_=Invite.result
+                            )
+                        ),
+                        execution_options={"synchronize_session": False}
+                    )
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"流式清理第 {stats['chunks'] + 1} 块提交失败: {e}")
+                stats["errors"] += len(ids)
+                continue
+
+            stats["chunks"] += 1
+            stats["total_found"] += len(rows)
+            accepted = sum(1 for row in rows if row.email_id)
+            if delete_records:
+                stats["deleted_records"] += len(rows)
+                stats["accepted_removed"] += accepted
+                stats["pending_revoked"] += len(rows) - accepted
+            else:
+                stats["marked_processed"] += len(rows)
+            affected.update(row.account_id for row in rows)
+            if progress is not None:
+                progress(stats["total_found"] + stats["errors"], total, None)
+
+        # 受影响账户一次性重新计数（与 calculate_invites_sent 同规则）
+        if affected:
+            by_account = {account_id: [] for account_id in affected}
+            for row in (
+                db.query(Invite.account_id, Invite.email, Invite.email_id, Invite.cleaned,
+                         Invite.expires_at, Invite.created_at)
+                .filter(Invite.account_id.in_(list(affected)))
+            ):
+                by_account[row.account_id].append(row)
+            changes = []
+            for account_id, invites_sent in (
+                db.query(models.Account.id, models.Account.invites_sent)
+                .filter(models.Account.id.in_(list(affected)))
+            ):
+                real_count = InviteStatusManager.count_active_latest(
+                    latest_per_email(by_account[account_id]), int(time.time())
+                )
+                if invites_sent != real_count:
+                    changes.append({"id": account_id, "invites_sent": real_count, "updated_at": int(time.time())})
+            if changes:
+                db.execute(update(models.Account), changes)
+            db.commit()
+            stats["accounts_recounted"] = len(affected)
+
+        return stats
+
     @staticmethod
     def validate_data_consistency(db: Session) -> List[Dict[str, Any]]:
         """
@@ -327,6 +497,7 @@ class TransactionManager:
             # 2. 更新数据库状态（在一个事务中）
             if delete_record:
                 # 真正删除记录
+                invite_events.record(db, invite, invite_events.REMOVED, detail="member_removed")
                 db.delete(invite)
             else:
                 # 标记删除（兼容性保留）
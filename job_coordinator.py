@@ -0,0 +1,322 @@
+# job_coordinator.py
+"""
+多 worker / 多进程安全的任务协调
+基于 job_leases 表的租约：抢占用一条带条件的 UPDATE 完成，持有期间心跳续期，
+进程崩溃后租约自然过期，其他 worker 或 cron 脚本即可接管。
+uvicorn --workers N 下的 API 任务和 自动维护目录/ 下的脚本共用同一组 scope。
+"""
+
+import os
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from contextlib import asynccontextmanager, contextmanager
+from collections import defaultdict
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import update, or_
+from sqlalchemy.exc import IntegrityError
+
+import models
+from database import SessionLocal
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+# 约定的 scope
+SCOPE_SYNC      = "sync"       # 与 Overleaf 全量同步（/sync/all、系统整体维护）
+SCOPE_CLEANUP   = "cleanup"    # 过期成员清理（各清理接口、清理过期成员.py）
+SCOPE_EMAIL_IDS = "email_ids"  # email_id 批量更新（/email_ids/update_all、更新邮箱ID.py）
+SCOPE_SESSION_WARMUP = "session_warmup"  # 组长会话预热（session_pool.SessionWarmer）
+SCOPE_ARCHIVE   = "archive"    # 历史记录归档（archive.py、/maintenance/archive）
+SCOPE_INVITE_EVENTS = "invite_events"  # 邀请事件压缩（invite_events.py）
+
+
+def invite_account_scope(account_id: int) -> str:
+    """按组长账号串行 token 刷新 + 发送邀请（见 account_lock）"""
+    return f"invite_account:{account_id}"
+
+
+DEFAULT_TTL = 120  # 秒；心跳间隔为 ttl / 3
+
+
+class LeaseHeldError(Exception):
+    """自定义异常：该 scope 的任务已由其他 worker / 脚本持有"""
+    pass
+
+
+class LeaseLostError(Exception):
+    """自定义异常：执行期间租约丢失（心跳失败，已被其他进程接管），任务已被取消"""
+    pass
+
+
+def _owner_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class JobLease:
+    """单个 scope 的租约句柄。每次数据库操作使用独立的短会话，不干扰调用方的事务。"""
+
+    def __init__(self, scope: str, ttl: int = DEFAULT_TTL):
+        self.scope = scope
+        self.ttl = ttl
+        self.owner = _owner_id()
+        self.held = False
+
+    def _ensure_row(self, db) -> None:
+        if db.get(models.JobLease, self.scope) is None:
+            try:
+                db.add(models.JobLease(scope=self.scope, status="idle"))
+                db.commit()
+            except IntegrityError:
+                # 另一个进程同时插入了同一行
+                db.rollback()
+
+    def _update_owned(self, **values) -> bool:
+        """只在自己仍持有租约时更新，返回是否成功"""
+        now_ts = int(time.time())
+        values.setdefault("heartbeat_at", now_ts)
+        values.setdefault("expires_at", now_ts + self.ttl)
+        db = SessionLocal()
+        try:
+            result = db.execute(
+                update(models.JobLease)
+                .where(models.JobLease.scope == self.scope,
+                       models.JobLease.owner == self.owner)
+                .values(**values)
+            )
+            db.commit()
+            return result.rowcount == 1
+        finally:
+            db.close()
+
+    def acquire(self, total: int = 0, message: Optional[str] = None) -> bool:
+        """尝试抢占租约：空闲、已过期或本来就属于自己时成功"""
+        now_ts = int(time.time())
+        db = SessionLocal()
+        try:
+            self._ensure_row(db)
+            result = db.execute(
+                update(models.JobLease)
+                .where(
+                    models.JobLease.scope == self.scope,
+                    or_(
+                        models.JobLease.owner.is_(None),
+                        models.JobLease.expires_at < now_ts,
+                        models.JobLease.owner == self.owner,
+                    )
+                )
+                .values(
+                    owner=self.owner,
+                    acquired_at=now_ts,
+                    heartbeat_at=now_ts,
+                    expires_at=now_ts + self.ttl,
+                    status="running",
+                    total=total,
+                    completed=0,
+                    current_item=None,
+                    started_at=now_ts,
+                    finished_at=None,
+                    message=message,
+                )
+            )
+            db.commit()
+            self.held = result.rowcount == 1
+            return self.held
+        finally:
+            db.close()
+
+    def heartbeat(self) -> bool:
+        """续期；返回 False 表示租约已丢失（例如长时间卡住后被其他进程接管）"""
+        if not self.held:
+            return False
+        self.held = self._update_owned()
+        if not self.held:
+            logger.warning(f"任务租约 {self.scope} 已丢失")
+        return self.held
+
+    def update_progress(
+        self,
+        completed: Optional[int] = None,
+        total: Optional[int] = None,
+        current_item: Optional[str] = None
+    ) -> bool:
+        """写入共享进度，同时顺带续期"""
+        values: Dict[str, Any] = {"current_item": current_item}
+        if completed is not None:
+            values["completed"] = completed
+        if total is not None:
+            values["total"] = total
+        return self._update_owned(**values)
+
+    async def update_progress_async(
+        self,
+        completed: Optional[int] = None,
+        total: Optional[int] = None,
+        current_item: Optional[str] = None
+    ) -> bool:
+        """异步代码使用的版本：数据库写入放到线程里，不阻塞事件循环；参数顺序与 cleanup_engine 的 progress 回调一致"""
+        return await asyncio.to_thread(self.update_progress, completed, total, current_item)
+
+    def release(self, status: str = "completed", message: Optional[str] = None) -> None:
+        if not self.held:
+            return
+        now_ts = int(time.time())
+        self._update_owned(
+            owner=None,
+            expires_at=0,
+            status=status,
+            current_item=None,
+            finished_at=now_ts,
+            message=message,
+        )
+        self.held = False
+
+    async def acquire_async(self, total: int = 0, message: Optional[str] = None) -> bool:
+        """异步代码使用的 acquire：数据库写入放到线程里"""
+        return await asyncio.to_thread(self.acquire, total, message)
+
+    async def release_async(self, status: str = "completed", message: Optional[str] = None) -> None:
+        """异步代码使用的 release：数据库写入放到线程里"""
+        await asyncio.to_thread(self.release, status, message)
+
+    @asynccontextmanager
+    async def keep_alive(self):
+        """
+        已持有租约时使用：后台心跳，退出时按是否异常释放为 completed / failed。
+        心跳发现租约丢失时取消正在执行的任务并抛出 LeaseLostError，不在没有租约的情况下继续运行
+        """
+        job = asyncio.current_task()
+        lost = False
+
+        async def beat():
+            nonlocal lost
+            while True:
+                await asyncio.sleep(max(1, self.ttl // 3))
+                if not await asyncio.to_thread(self.heartbeat):
+                    lost = True
+                    logger.warning(f"任务租约 {self.scope} 已丢失，取消正在执行的任务")
+                    job.cancel()
+                    return
+
+        task = asyncio.create_task(beat())
+        try:
+            yield self
+        except asyncio.CancelledError:
+            if not lost:
+                await self.release_async("failed", message="CancelledError")
+                raise
+            # 取消来自丢失租约，而不是外部：撤销这次取消请求，改为抛出 LeaseLostError
+            if hasattr(job, "uncancel"):
+                job.uncancel()
+            raise LeaseLostError(f"任务 {self.scope} 的租约已丢失，任务已取消") from None
+        except BaseException as e:
+            await self.release_async("failed", message=str(e) or type(e).__name__)
+            raise
+        else:
+            await self.release_async("completed")
+        finally:
+            task.cancel()
+
+    @asynccontextmanager
+    async def hold(self, total: int = 0):
+        """抢占 + 心跳；抢不到时抛出 LeaseHeldError"""
+        if not await self.acquire_async(total=total):
+            raise LeaseHeldError(f"任务 {self.scope} 正在其他进程中运行")
+        async with self.keep_alive():
+            yield self
+
+    @asynccontextmanager
+    async def hold_waiting(self, timeout: float, poll_interval: float = 0.2):
+        """
+        与 hold 相同，但租约被占用时按 poll_interval 轮询等待，最多 timeout 秒，
+        仍抢不到时抛出 LeaseHeldError；适合作为跨进程的互斥锁使用
+        """
+        deadline = time.monotonic() + timeout
+        while not await self.acquire_async():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LeaseHeldError(f"任务 {self.scope} 正在其他进程中运行")
+            await asyncio.sleep(min(poll_interval, remaining))
+        async with self.keep_alive():
+            yield self
+
+    @contextmanager
+    def hold_sync(self, total: int = 0):
+        """同步代码使用的版本，适合单次短任务（不启动心跳）"""
+        if not self.acquire(total=total):
+            raise LeaseHeldError(f"任务 {self.scope} 正在其他进程中运行")
+        try:
+            yield self
+        except BaseException as e:
+            self.release("failed", message=str(e) or type(e).__name__)
+            raise
+        else:
+            self.release("completed")
+
+
+# 进程内按账号排队的锁，排在 account_lock 的跨进程租约前面
+_account_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+@asynccontextmanager
+async def account_lock(account_id: int, timeout: float = settings.INVITE_ACCOUNT_LOCK_TIMEOUT):
+    """
+    独占一个组长账号的 token 刷新 + Overleaf 操作（同步邀请、异步 worker、批量邀请与会话预热共用）：
+    进程内先用 asyncio.Lock 排队，再在 job_leases 中占用 invite_account:<id> 租约，多个 worker / 进程之间也互斥。
+    两段等待合计超过 timeout 秒时抛出 LeaseHeldError
+    """
+    deadline = time.monotonic() + timeout
+    lock = _account_locks[account_id]
+    try:
+        await asyncio.wait_for(lock.acquire(), timeout)
+    except asyncio.TimeoutError:
+        raise LeaseHeldError(f"账号 {account_id} 正在本进程中使用") from None
+    try:
+        lease = JobLease(invite_account_scope(account_id))
+        async with lease.hold_waiting(max(0.0, deadline - time.monotonic())):
+            yield
+    finally:
+        lock.release()
+
+
+def _lease_to_dict(lease: models.JobLease, now_ts: int) -> Dict[str, Any]:
+    is_running = lease.owner is not None and (lease.expires_at or 0) >= now_ts
+    return {
+        "scope": lease.scope,
+        "is_running": is_running,
+        "status": lease.status if is_running or lease.status != "running" else "stale",
+        "owner": lease.owner if is_running else None,
+        "total": lease.total or 0,
+        "completed": lease.completed or 0,
+        "current_item": lease.current_item if is_running else None,
+        "started_at": lease.started_at,
+        "finished_at": lease.finished_at,
+        "heartbeat_at": lease.heartbeat_at,
+        "expires_at": lease.expires_at,
+        "message": lease.message,
+    }
+
+
+def get_job_status(scope: str) -> Dict[str, Any]:
+    """任意 worker 调用都返回同一份状态"""
+    now_ts = int(time.time())
+    db = SessionLocal()
+    try:
+        lease = db.get(models.JobLease, scope)
+        if lease is None:
+            return _lease_to_dict(models.JobLease(scope=scope, status="idle", total=0, completed=0), now_ts)
+        return _lease_to_dict(lease, now_ts)
+    finally:
+        db.close()
+
+
+def list_job_status() -> List[Dict[str, Any]]:
+    now_ts = int(time.time())
+    db = SessionLocal()
+    try:
+        return [_lease_to_dict(lease, now_ts) for lease in db.query(models.JobLease).all()]
+    finally:
+        db.close()
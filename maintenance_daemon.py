@@ -0,0 +1,337 @@
+# maintenance_daemon.py
+"""
+维护服务
+原来 自动维护目录/ 下的维护脚本由 crontab 每次启动一个新的 Python 进程执行（schedule_maintenance.py 还要再
+subprocess 一层）：每次都重新导入 SQLAlchemy 和模型、新建连接池，需要登录时还要冷启动 Playwright。
+这里把这些定时任务注册为同一个长驻进程里的异步任务：
+- cleanup_expired  每 MAINTENANCE_CLEANUP_INTERVAL 秒，兜底清理过期成员（cleanup_engine）
+- update_email_ids 每 MAINTENANCE_EMAIL_IDS_INTERVAL 秒，回填 email_id（与 /email_ids/update_all 同一实现）
+- daily_maintenance 每天 MAINTENANCE_DAILY_AT，与 Overleaf 全量对账 + 清理过期 + 清理过期幂等记录
+- archive_history  每天 ARCHIVE_DAILY_AT，把已处理的历史记录移到归档表（archive.py）
+- compact_invite_events 每天 INVITE_EVENTS_COMPACT_AT，压缩旧的邀请事件（invite_events.py）
+默认嵌入 API 进程（app.py 启动时 start），与请求共用数据库引擎、浏览器实例和已验证的组长会话；
+也可以单独运行：python maintenance_daemon.py。
+每个任务仍持有与脚本 / API 相同的 job_leases 租约，多个进程同时到点时只有一个执行，其余记为 skipped。
+"""
+
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Callable, Awaitable
+
+from sqlalchemy.orm import Session
+
+import models, crud
+import cleanup_engine
+import idempotency
+from database import SessionLocal
+from job_coordinator import (
+    JobLease, LeaseHeldError, get_job_status,
+    SCOPE_CLEANUP, SCOPE_EMAIL_IDS, SCOPE_SYNC, SCOPE_ARCHIVE, SCOPE_INVITE_EVENTS,
+)
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+STARTUP_DELAY = 60          # 启动后至少等待多少秒才执行第一次（避免每次重启都立刻访问 Overleaf）
+SYNC_ACCOUNT_INTERVAL = 2   # 全量对账时相邻两个账户之间的间隔（秒）
+
+JobFunc = Callable[[Session, JobLease], Awaitable[Dict[str, Any]]]
+
+
+@dataclass
+class MaintenanceJob:
+    """一个定时任务：interval（秒）与 daily_at（"HH:MM"，本地时间）二选一"""
+    name: str
+    scope: str
+    func: JobFunc
+    interval: Optional[int] = None
+    daily_at: Optional[str] = None
+    description: str = ""
+    enabled: bool = True
+    # 运行状态（只在本进程内）
+    next_run_at: Optional[int] = None
+    running: bool = False
+    runs: int = 0
+    failures: int = 0
+    skipped: int = 0
+    last_run: Optional[Dict[str, Any]] = None
+    _trigger: Optional[asyncio.Event] = field(default=None, repr=False)
+
+    def next_after(self, now_ts: float) -> int:
+        if self.daily_at:
+            hour, minute = (int(part) for part in self.daily_at.split(":"))
+            now = datetime.fromtimestamp(now_ts)
+            target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if target <= now:
+                target += timedelta(days=1)
+            return int(target.timestamp())
+        return int(now_ts + self.interval)
+
+    def schedule_text(self) -> str:
+        return f"每天 {self.daily_at}" if self.daily_at else f"每 {self.interval} 秒"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "description": self.description,
+            "scope": self.scope,
+            "schedule": self.schedule_text(),
+            "enabled": self.enabled,
+            "running": self.running,
+            "next_run_at": self.next_run_at,
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "last_run": self.last_run,
+        }
+
+
+class MaintenanceDaemon:
+    """每个任务一个后台协程，到点（或被手动触发）后持租约执行"""
+
+    def __init__(self, session_factory=SessionLocal, startup_delay: int = STARTUP_DELAY):
+        self.session_factory = session_factory
+        self.startup_delay = startup_delay
+        self.jobs: Dict[str, MaintenanceJob] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def register(self, job: MaintenanceJob) -> MaintenanceJob:
+        self.jobs[job.name] = job
+        return job
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    # -------- 执行 --------
+
+    async def run_job(self, name: str) -> Dict[str, Any]:
+        """立即执行一次（持有任务的租约），返回并记录本次结果"""
+        job = self.jobs[name]
+        job.running = True
+        started = time.time()
+        record: Dict[str, Any] = {"started_at": int(started)}
+        try:
+            async with JobLease(job.scope).hold() as lease:
+                db = self.session_factory()
+                try:
+                    record["result"] = await job.func(db, lease)
+                finally:
+                    db.close()
+            record["status"] = "success"
+        except LeaseHeldError as e:
+            record["status"] = "skipped"
+            record["error"] = str(e)
+            job.skipped += 1
+            logger.info(f"维护任务 {name} 跳过: {e}")
+        except Exception as e:
+            record["status"] = "failed"
+            record["error"] = str(e) or type(e).__name__
+            job.failures += 1
+            logger.exception(f"维护任务 {name} 失败: {e}")
+        finally:
+            job.running = False
+        job.runs += 1
+        record["finished_at"] = int(time.time())
+        record["duration"] = round(time.time() - started, 3)
+        job.last_run = record
+        if record["status"] == "success":
+            logger.info(f"维护任务 {name} 完成，用时 {record['duration']}s")
+        return record
+
+    def trigger(self, name: str) -> bool:
+        """让后台协程立刻执行一次；任务正在执行或服务未启动时返回 False"""
+        job = self.jobs[name]
+        if job.running or job._trigger is None:
+            return False
+        job._trigger.set()
+        return True
+
+    def _first_run_at(self, job: MaintenanceJob, now_ts: float) -> int:
+        earliest = int(now_ts + self.startup_delay)
+        if job.daily_at:
+            return max(earliest, job.next_after(now_ts))
+        # 按租约表里上次完成的时间续上（任意进程、脚本或 API 执行的都算），重启不会打乱节奏
+        finished_at = get_job_status(job.scope)["finished_at"]
+        if finished_at:
+            return max(earliest, finished_at + job.interval)
+        return earliest
+
+    async def _job_loop(self, job: MaintenanceJob) -> None:
+        job.next_run_at = await asyncio.to_thread(self._first_run_at, job, time.time())
+        while True:
+            job._trigger.clear()
+            timeout = job.next_run_at - time.time()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(job._trigger.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            started = time.time()
+            await self.run_job(job.name)
+            job.next_run_at = job.next_after(started)
+
+    # -------- 生命周期 --------
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        for job in self.jobs.values():
+            if not job.enabled:
+                continue
+            job._trigger = asyncio.Event()
+            self._tasks[job.name] = asyncio.create_task(self._job_loop(job))
+        logger.info(f"维护服务已启动: {', '.join(f'{j.name}({j.schedule_text()})' for j in self.jobs.values() if j.enabled)}")
+
+    async def stop(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks = {}
+        for job in self.jobs.values():
+            job._trigger = None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "jobs": [job.to_dict() for job in self.jobs.values()],
+        }
+
+
+# -------- 任务实现 --------
+
+def _progress(lease: JobLease):
+    """同步任务（在线程中运行，如归档）使用的进度回调；异步任务直接用 lease.update_progress_async"""
+    return lambda done, total, item: lease.update_progress(completed=done, total=total, current_item=item)
+
+
+async def cleanup_expired_job(db: Session, lease: JobLease) -> Dict[str, Any]:
+    """兜底清理过期成员（到期调度遗漏的、API 未运行期间到期的）"""
+    report = await cleanup_engine.cleanup_expired(db, limit=settings.MAINTENANCE_CLEANUP_LIMIT, progress=lease.update_progress_async)
+    return report.stats()
+
+
+async def update_email_ids_job(db: Session, lease: JobLease) -> Dict[str, Any]:
+    """回填所有组的 email_id，与 POST /api/v1/email_ids/update_all 相同"""
+    import schemas
+    from routers.update_email_id import _update_all_email_ids
+    response = await _update_all_email_ids(schemas.UpdateAllEmailIdsRequest(), db)
+    return {
+        "total_accounts": response.total_accounts,
+        "success_accounts": response.success_accounts,
+        "failed_accounts": response.failed_accounts,
+        "total_updated": response.total_updated,
+    }
+
+
+async def daily_maintenance_job(db: Session, lease: JobLease) -> Dict[str, Any]:
+    """系统整体维护：按优先级与 Overleaf 对账（计数以 Overleaf 为准）、清理过期成员、清理过期幂等记录"""
+    from overleaf_utils import open_group_session, fetch_group_members
+    from sync_engine import CountSource, members_from_overleaf_users, reconcile_account
+    from sync_scheduler import prioritized_account_ids
+
+    account_ids = prioritized_account_ids(db)
+    max_seconds = settings.MAINTENANCE_SYNC_MAX_SECONDS
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    synced, failed, changes = 0, [], 0
+
+    for i, account_id in enumerate(account_ids):
+        if deadline and time.monotonic() >= deadline:
+            logger.info(f"系统维护：同步达到时间上限，剩余 {len(account_ids) - i} 个账户留待下次")
+            break
+        acct = db.get(models.Account, account_id)
+        if acct is None:
+            continue
+        await lease.update_progress_async(completed=i, total=len(account_ids), current_item=acct.email)
+        try:
+            session, new_sess, new_csrf = await open_group_session(acct)
+            users = await asyncio.to_thread(fetch_group_members, session, acct.group_id)
+            crud.update_account_tokens(db, acct, new_csrf, new_sess)
+            change_set = reconcile_account(
+                db, acct, members_from_overleaf_users(users),
+                count_source=CountSource.OVERLEAF,
+                source="daily_sync_maintenance"
+            )
+            synced += 1
+            changes += len(change_set.changes)
+        except Exception as e:
+            db.rollback()
+            failed.append({"account_email": acct.email, "error": str(e)})
+            logger.warning(f"系统维护：同步 {acct.email} 失败: {e}")
+        await asyncio.sleep(SYNC_ACCOUNT_INTERVAL)
+
+    # 清理过期成员：与到期调度 / 清理接口共用 cleanup 租约
+    try:
+        async with JobLease(SCOPE_CLEANUP).hold():
+            cleanup = (await cleanup_engine.cleanup_expired(db, limit=settings.MAINTENANCE_CLEANUP_LIMIT)).stats()
+    except LeaseHeldError as e:
+        cleanup = {"skipped": str(e)}
+
+    purged = await asyncio.to_thread(idempotency.purge_expired)
+    return {
+        "total_accounts": len(account_ids),
+        "synced_accounts": synced,
+        "failed_accounts": failed,
+        "changes": changes,
+        "cleanup": cleanup,
+        "idempotency_purged": purged,
+    }
+
+
+async def archive_history_job(db: Session, lease: JobLease) -> Dict[str, Any]:
+    """已清理且过期超过 ARCHIVE_AFTER_DAYS 天的记录移到 invites_archive"""
+    import archive
+    return await asyncio.to_thread(archive.archive_processed, db, progress=_progress(lease))
+
+
+async def compact_invite_events_job(db: Session, lease: JobLease) -> Dict[str, Any]:
+    """进展类旧事件只留最新一条，已被硬删除的记录的旧事件删除"""
+    import invite_events
+    return await asyncio.to_thread(invite_events.compact, db)
+
+
+maintenance_daemon = MaintenanceDaemon()
+maintenance_daemon.register(MaintenanceJob(
+    name="cleanup_expired", scope=SCOPE_CLEANUP, func=cleanup_expired_job,
+    interval=settings.MAINTENANCE_CLEANUP_INTERVAL, description="清理过期成员（兜底）",
+))
+maintenance_daemon.register(MaintenanceJob(
+    name="update_email_ids", scope=SCOPE_EMAIL_IDS, func=update_email_ids_job,
+    interval=settings.MAINTENANCE_EMAIL_IDS_INTERVAL, description="更新所有组的 email_id",
+))
+maintenance_daemon.register(MaintenanceJob(
+    name="daily_maintenance", scope=SCOPE_SYNC, func=daily_maintenance_job,
+    daily_at=settings.MAINTENANCE_DAILY_AT, description="系统整体维护（全量对账 + 清理）",
+))
+maintenance_daemon.register(MaintenanceJob(
+    name="archive_history", scope=SCOPE_ARCHIVE, func=archive_history_job,
+    daily_at=settings.ARCHIVE_DAILY_AT, description="归档已处理的历史邀请记录",
+))
+maintenance_daemon.register(MaintenanceJob(
+    name="compact_invite_events", scope=SCOPE_INVITE_EVENTS, func=compact_invite_events_job,
+    daily_at=settings.INVITE_EVENTS_COMPACT_AT, description="压缩旧的邀请事件",
+))
+
+
+async def main():
+    """单独运行维护服务（不嵌入 API 进程时使用）"""
+    from playwright_manager import close_browser
+    import migrations
+    migrations.upgrade()
+    maintenance_daemon.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await maintenance_daemon.stop()
+        await close_browser()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
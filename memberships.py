@@ -0,0 +1,105 @@
+# memberships.py
+"""
+按邮箱查询成员关系
+一个邮箱在各组中的邀请记录连同组长账号信息用一条 JOIN 查询取出（走 email_key 索引），
+取代"先查邀请、再逐条 db.get(Account)"的写法。邮箱比较使用 models.normalize_email（去空白、小写）。
+"""
+
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import List, Dict, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import models
+from models import normalize_email
+
+
+@dataclass
+class Membership:
+    """一条邀请记录及其所在组的组长账号"""
+    invite: models.Invite
+    account: models.Account
+
+    @property
+    def account_email(self) -> str:
+        return self.account.email
+
+    def to_dict(self) -> Dict:
+        return {
+            "invite_id": self.invite.id,
+            "email": self.invite.email,
+            "email_id": self.invite.email_id,
+            "account_id": self.account.id,
+            "account_email": self.account.email,
+            "group_id": self.account.group_id,
+            "expires_at": self.invite.expires_at,
+            "created_at": self.invite.created_at,
+            "cleaned": self.invite.cleaned,
+        }
+
+
+def _joined(db: Session):
+    return db.query(models.Invite, models.Account).join(
+        models.Account, models.Account.id == models.Invite.account_id
+    )
+
+
+def find_memberships(db: Session, email: str, active_only: bool = True) -> List[Membership]:
+    """
+    该邮箱的邀请记录（默认只含未清理的），按创建时间从新到旧。
+    active_only=False 时包含已清理的历史记录。
+    """
+    query = _joined(db).filter(models.Invite.email_key == normalize_email(email))
+    if active_only:
+        query = query.filter(models.Invite.cleaned.is_(False))
+    rows = query.order_by(models.Invite.created_at.desc(), models.Invite.id.desc()).all()
+    return [Membership(invite, account) for invite, account in rows]
+
+
+def find_memberships_many(db: Session, emails: List[str], active_only: bool = True) -> Dict[str, List[Membership]]:
+    """
+    多个邮箱的邀请记录，一条查询：{email_key: [Membership, ...]}（每个邮箱内从新到旧）。
+    没有记录的邮箱不出现在结果中。
+    """
+    keys = {normalize_email(email) for email in emails}
+    query = _joined(db).filter(models.Invite.email_key.in_(keys))
+    if active_only:
+        query = query.filter(models.Invite.cleaned.is_(False))
+    rows = query.order_by(
+        models.Invite.email_key, models.Invite.created_at.desc(), models.Invite.id.desc()
+    ).all()
+    result: Dict[str, List[Membership]] = defaultdict(list)
+    for invite, account in rows:
+        result[invite.email_key].append(Membership(invite, account))
+    return dict(result)
+
+
+def cross_group_duplicates(db: Session) -> Dict[str, List[Membership]]:
+    """
+    同一邮箱在多个组中都有未清理记录的情况：{email_key: [Membership, ...]}（每个邮箱内从新到旧）。
+    先用 GROUP BY 在数据库里找出重复的邮箱，再一条 JOIN 取出这些邮箱的记录。
+    """
+    active = models.Invite.cleaned.is_(False)
+    duplicate_keys = (
+        db.query(models.Invite.email_key)
+        .filter(active)
+        .group_by(models.Invite.email_key)
+        .having(func.count(func.distinct(models.Invite.account_id)) > 1)
+    )
+    rows = (
+        _joined(db)
+        .filter(active, models.Invite.email_key.in_(duplicate_keys))
+        .order_by(models.Invite.email_key, models.Invite.created_at.desc(), models.Invite.id.desc())
+        .all()
+    )
+    result: Dict[str, List[Membership]] = defaultdict(list)
+    for invite, account in rows:
+        result[invite.email_key].append(Membership(invite, account))
+    return dict(result)
+
+
+def latest_in_account(memberships: List[Membership], account_id: int) -> Optional[Membership]:
+    """find_memberships 的结果中某个组的最新一条"""
+    return next((m for m in memberships if m.account.id == account_id), None)
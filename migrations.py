@@ -0,0 +1,235 @@
+# migrations.py
+"""
+轻量级结构升级
+Base.metadata.create_all 只会建新表，不会给已有表补列或补索引。
+upgrade() 按模型定义建缺少的表，并给已有表补齐：
+- 缺少的列：ALTER TABLE ... ADD COLUMN（带模型里的标量默认值）
+- 缺少的索引（部分索引建之前要先回填数据，见 INDEX_FIXUPS；需要删除数据才能建的索引只提示，
+  见 INDEX_BLOCKERS 与 `python migrations.py --dedupe-external [--confirm]`）
+升级是显式的一步，导入 models 不会改动数据库：app 启动时执行一次，
+只使用 SessionLocal 的维护脚本在代码更新后先执行 `python migrations.py`（--check 只列出待执行的变更）。
+每项变更都会记日志，所有步骤都是幂等的，重复执行没有副作用。
+"""
+
+import sys
+import json
+import time
+import logging
+from typing import List
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import MetaData, Table, Column
+
+logger = logging.getLogger(__name__)
+
+
+def _column_ddl(connection: Connection, column: Column) -> str:
+    col_type = column.type.compile(dialect=connection.dialect)
+    ddl = f'"{column.name}" {col_type}'
+    default = column.default
+    if default is not None and default.is_scalar:
+        value = default.arg
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, str):
+            value = "'" + value.replace("'", "''") + "'"
+        ddl += f" DEFAULT {value}"
+    return ddl
+
+
+def add_missing_columns(connection: Connection, table: Table, apply: bool = True) -> list:
+    inspector = inspect(connection)
+    existing = {c["name"] for c in inspector.get_columns(table.name)}
+    added = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        if apply:
+            connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {_column_ddl(connection, column)}'))
+        added.append(column.name)
+    if added and apply:
+        logger.info(f"表 {table.name} 新增列: {', '.join(added)}")
+    return added
+
+
+def find_duplicate_external_invites(connection: Connection) -> List[dict]:
+    """
+    uq_invites_external_account_email 要求每个 (account_id, email) 最多一条数据库外用户记录（expires_at IS NULL）；
+    返回多出来的记录（保留 id 最小的一条，keep_id 为保留的记录）
+    """
+    rows = connection.execute(text("""
+        SELECT i.id, i.account_id, i.email, i.email_id, i.created_at, k.keep_id
+        FROM invites i
+        JOIN (
+            SELECT account_id, email, MIN(id) AS keep_id FROM invites
+            WHERE expires_at IS NULL
+            GROUP BY account_id, email
+            HAVING COUNT(*) > 1
+        ) k ON k.account_id = i.account_id AND k.email = i.email
+        WHERE i.expires_at IS NULL AND i.id <> k.keep_id
+        ORDER BY i.account_id, i.email, i.id
+    """)).mappings().all()
+    return [dict(row) for row in rows]
+
+
+def dedupe_external_invites(connection: Connection, confirm: bool = False) -> List[dict]:
+    """
+    合并重复的数据库外用户记录：把其他记录上的 email_id 补到保留的记录上，再删除多出来的记录。
+    confirm=False 时只返回将要删除的记录；升级不会自动执行，见 `python migrations.py --dedupe-external`
+    """
+    duplicates = find_duplicate_external_invites(connection)
+    if not confirm or not duplicates:
+        return duplicates
+    connection.execute(text("""
+        UPDATE invites
+        SET email_id = (
+            SELECT MAX(d.email_id) FROM invites d
+            WHERE d.expires_at IS NULL
+              AND d.account_id = invites.account_id
+              AND d.email = invites.email
+        )
+        WHERE expires_at IS NULL AND email_id IS NULL
+    """))
+    for row in duplicates:
+        connection.execute(text("DELETE FROM invites WHERE id = :id"), {"id": row["id"]})
+        logger.info(f"删除重复的数据库外用户记录 {row['id']}（{row['email']}，账号 {row['account_id']}，保留 {row['keep_id']}）")
+    return duplicates
+
+
+def _external_duplicates_blocker(connection: Connection):
+    duplicates = find_duplicate_external_invites(connection)
+    if duplicates:
+        return (f"存在 {len(duplicates)} 条重复的数据库外用户记录，"
+                f"先执行 `python migrations.py --dedupe-external` 查看并确认合并")
+    return None
+
+
+def backfill_email_keys(connection: Connection) -> None:
+    """建 ix_invites_email_key_cleaned 之前为已有记录填充 email_key（与 models.normalize_email 一致）"""
+    result = connection.execute(text(
+        "UPDATE invites SET email_key = lower(trim(email)) WHERE email_key IS NULL"
+    ))
+    if result.rowcount:
+        logger.info(f"填充 email_key: {result.rowcount} 条")
+
+
+def convert_legacy_results(connection: Connection) -> None:
+    """建 ix_invites_processed_reason（json_extract 表达式索引）之前把 str(dict) 格式的 result 转成 JSON"""
+    import invite_result
+    invite_result.convert_legacy_results(connection)
+
+
+# 建索引前需要先修正数据的索引（新列需要先回填等），只做不丢数据的改写
+INDEX_FIXUPS = {
+    "ix_invites_email_key_cleaned": backfill_email_keys,
+    "ix_invites_processed_reason": convert_legacy_results,
+}
+
+
+# 数据不满足时不建的索引：返回原因的检查函数（需要删除数据才能满足的，由人工确认后执行）
+INDEX_BLOCKERS = {
+    "uq_invites_external_account_email": _external_duplicates_blocker,
+}
+
+
+def existing_index_names(connection: Connection, table: Table) -> set:
+    if connection.dialect.name == "sqlite":
+        # SQLite 的表达式索引不会被反射出来（SQLAlchemy 只给出警告），直接查 sqlite_master
+        return set(connection.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"),
+            {"table": table.name},
+        ).scalars())
+    return {ix["name"] for ix in inspect(connection).get_indexes(table.name)}
+
+
+def create_missing_indexes(connection: Connection, table: Table, apply: bool = True) -> list:
+    existing = existing_index_names(connection, table)
+    created = []
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        blocker = INDEX_BLOCKERS.get(index.name)
+        reason = blocker(connection) if blocker else None
+        if reason:
+            logger.warning(f"跳过索引 {index.name}: {reason}")
+            continue
+        if apply:
+            fixup = INDEX_FIXUPS.get(index.name)
+            if fixup:
+                fixup(connection)
+            index.create(bind=connection)
+        created.append(index.name)
+    if created and apply:
+        logger.info(f"表 {table.name} 新增索引: {', '.join(created)}")
+    return created
+
+
+def upgrade_schema(metadata: MetaData, connection: Connection, apply: bool = True) -> List[str]:
+    """按模型建缺少的表、补齐已存在表的列与索引，返回变更说明；apply=False 时只列出不执行"""
+    tables = set(inspect(connection).get_table_names())
+    changes = []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            if apply:
+                table.create(bind=connection)
+                logger.info(f"新建表 {table.name}")
+            changes.append(f"新建表 {table.name}")
+            continue
+        changes.extend(f"表 {table.name} 新增列 {name}" for name in add_missing_columns(connection, table, apply))
+        changes.extend(f"表 {table.name} 新增索引 {name}" for name in create_missing_indexes(connection, table, apply))
+    return changes
+
+
+def upgrade(engine: Engine = None, apply: bool = True) -> List[str]:
+    """升级默认数据库（或指定引擎）到当前模型，在一个事务中执行"""
+    if engine is None:
+        from database import engine
+    from database import Base
+    import models  # noqa: F401  注册全部模型
+
+    with engine.begin() as connection:
+        return upgrade_schema(Base.metadata, connection, apply)
+
+
+def dedupe_external(engine: Engine = None, confirm: bool = False, backup_path: str = None) -> List[dict]:
+    """
+    显式执行的去重迁移：默认只列出将要删除的记录；confirm=True 时先把这些记录写入 backup_path（JSON），
+    再在一个事务中合并删除
+    """
+    if engine is None:
+        from database import engine
+    with engine.begin() as connection:
+        duplicates = find_duplicate_external_invites(connection)
+        if confirm and duplicates:
+            if backup_path:
+                with open(backup_path, "w", encoding="utf-8") as f:
+                    json.dump(duplicates, f, ensure_ascii=False, indent=2)
+                logger.info(f"将删除的 {len(duplicates)} 条记录已备份到 {backup_path}")
+            dedupe_external_invites(connection, confirm=True)
+    return duplicates
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if "--dedupe-external" in sys.argv[1:]:
+        confirm = "--confirm" in sys.argv[1:]
+        backup = f"dedupe_external_invites_{int(time.time())}.json" if confirm else None
+        rows = dedupe_external(confirm=confirm, backup_path=backup)
+        for row in rows:
+            print(f"  - id={row['id']} account_id={row['account_id']} email={row['email']} "
+                  f"email_id={row['email_id']} 保留 id={row['keep_id']}")
+        if not rows:
+            print("✅ 没有重复的数据库外用户记录")
+        elif confirm:
+            print(f"已删除 {len(rows)} 条（备份: {backup}），再执行 `python migrations.py` 建唯一索引")
+        else:
+            print(f"以上 {len(rows)} 条将被删除，确认后加 --confirm 执行")
+        sys.exit(0)
+
+    check = "--check" in sys.argv[1:]
+    changes = upgrade(apply=not check)
+    if not changes:
+        print("✅ 数据库结构已是最新")
+    else:
+        print(("待执行的变更：" if check else "已执行的变更：") + "".join(f"\n  - {c}" for c in changes))
@@ -1,10 +1,22 @@
 # models.py
 
 from sqlalchemy import (
-    Column, Integer, String, Boolean, ForeignKey
+    Column, Integer, String, Boolean, ForeignKey, Index, func, literal_column
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
 from database import Base
+from invite_result import ResultJSON
+
+
+def normalize_email(email):
+    """邮箱的比较键：去掉首尾空白并转小写"""
+    return email.strip().lower() if email else email
+
+
+def _email_key_default(context):
+    # Core 层的批量 INSERT（对账导入等）不经过 ORM，也能自动填充 email_key
+    return normalize_email(context.get_current_parameters().get("email"))
+
 
 class Account(Base):
     __tablename__ = "accounts"
@@ -18,6 +30,17 @@ class Account(Base):
     invites_sent   = Column(Integer, default=0)
     max_invites    = Column(Integer, default=100)
     updated_at     = Column(Integer, default=0)  # Unix 时间戳
+    last_synced_at = Column(Integer, default=0)  # 上次与 Overleaf 对账的时间，0 表示从未对账
+    last_drift     = Column(Integer, default=0)  # 上次对账发现的变更条数
+    session_validated_at = Column(Integer, default=0)  # 上次确认 session/CSRF 可用的时间，0 表示未知或已失效
+
+    # Overleaf 侧容量（见 group_capacity.py）
+    overleaf_member_count  = Column(Integer, nullable=True)  # 上次拉取成员列表时的成员数（含待接受）
+    overleaf_pending_count = Column(Integer, nullable=True)  # 其中待接受的邀请数
+    member_count_at        = Column(Integer, default=0)      # 上次拉取成员列表的时间
+    group_full_at          = Column(Integer, default=0)      # 最近一次 Overleaf 返回 group_full 的时间
+    group_full_hits        = Column(Integer, default=0)      # 实际撞上 group_full 的次数
+    group_full_avoided     = Column(Integer, default=0)      # 因已知满员而跳过、省下的 group_full 调用次数
 
     invites = relationship("Invite", back_populates="account")
 
@@ -40,12 +63,210 @@ class Invite(Base):
     account_id  = Column(Integer, ForeignKey("accounts.id"), nullable=False)
     card_id     = Column(Integer, ForeignKey("cards.id"), nullable=True)
     email       = Column(String, nullable=False)
+    email_key   = Column(String, nullable=True, default=_email_key_default)  # normalize_email(email)，跨组查询用
     email_id    = Column(String, nullable=True)   # 成员在 Overleaf 上的 user id
     expires_at  = Column(Integer, nullable=True) # Unix 时间戳，NULL表示手动添加的用户
     success     = Column(Boolean, nullable=False)
-    result      = Column(String, nullable=False)
+    result      = Column(ResultJSON, nullable=False)  # JSON 对象，读写见 invite_result.py
     created_at  = Column(Integer, nullable=False) # Unix 时间戳
     cleaned     = Column(Boolean, default=False, nullable=False)  # 是否已被清理过期
 
     account = relationship("Account", back_populates="invites")
     card    = relationship("Card",    back_populates="invites")
+
+    @validates("email")
+    def _sync_email_key(self, key, email):
+        self.email_key = normalize_email(email)
+        return email
+
+    @classmethod
+    def result_field(cls, name: str):
+        # 路径写成字面量，与 ix_invites_processed_reason 的表达式一致时 SQLite 才能用上索引
+        return func.json_extract(cls.result, literal_column(f"'$.{name}'"))
+
+    __table_args__ = (
+        # 按邮箱查活跃成员（跨组检查、删除、重复检测），见 memberships.py
+        Index("ix_invites_email_key_cleaned", "email_key", "cleaned"),
+        # 到期调度加载 / 过期清理：cleaned = 0 AND expires_at 范围查询，不扫全表
+        Index("ix_invites_cleaned_expires_at", "cleaned", "expires_at"),
+        # 按处理原因筛选（清理 / 手动删除等，见 invite_result.py）
+        Index("ix_invites_processed_reason", func.json_extract(result, literal_column("'$.processed_reason'"))),
+        # 同一组里同一邮箱最多一条数据库外/手动用户记录（expires_at 为 NULL）。
+        # 正常邀请会保留历史记录（同一邮箱可有多条），所以唯一约束只覆盖这部分；
+        # 对账导入数据库外用户时以此为 ON CONFLICT 目标，重复同步幂等。
+        Index(
+            "uq_invites_external_account_email", "account_id", "email",
+            unique=True,
+            sqlite_where=expires_at.is_(None),
+            postgresql_where=expires_at.is_(None),
+        ),
+    )
+
+
+class JobLease(Base):
+    """
+    跨进程的任务租约：每个 scope（sync / cleanup / email_ids ...）同一时间只有一个持有者，
+    持有者定期心跳续期，过期后其他 worker 或脚本可以接管；进度也存在这里，任何 worker 读到的状态一致。
+    """
+    __tablename__ = "job_leases"
+
+    scope        = Column(String(64), primary_key=True)
+    owner        = Column(String(128), nullable=True)      # 持有者标识 host:pid:随机串，NULL 表示空闲
+    acquired_at  = Column(Integer, default=0)              # Unix 时间戳
+    heartbeat_at = Column(Integer, default=0)
+    expires_at   = Column(Integer, default=0)              # 租约到期时间，超过即视为失效
+    status       = Column(String(16), default="idle")      # idle / running / completed / failed
+    total        = Column(Integer, default=0)
+    completed    = Column(Integer, default=0)
+    current_item = Column(String, nullable=True)
+    started_at   = Column(Integer, nullable=True)
+    finished_at  = Column(Integer, nullable=True)
+    message      = Column(String, nullable=True)
+
+
+class InviteJob(Base):
+    """
+    异步邀请任务：POST /api/v1/invite?mode=async 校验卡密后写入，立即返回 job id，
+    由 invite_jobs.InviteJobQueue 的 worker 认领执行；进度与结果都落库，任何 worker 都能查询。
+    """
+    __tablename__ = "invite_jobs"
+
+    id               = Column(String(32), primary_key=True)         # uuid4 hex
+    email            = Column(String, nullable=False)
+    card_code        = Column(String, nullable=False, index=True)
+    status           = Column(String(16), default="queued", index=True)  # queued / running / succeeded / failed
+    stage            = Column(String(32), default="queued")          # 细分进度：selecting_account / sending / recording ...
+    send_attempted   = Column(Boolean, default=False)                # 曾进入发送阶段（换账号重试后也不清除），中断后不再重新排队
+    attempt          = Column(Integer, default=0)                    # 当前第几个账号
+    account_email    = Column(String, nullable=True)                 # 正在使用 / 最终成功的组长
+    worker           = Column(String(128), nullable=True)
+    lease_expires_at = Column(Integer, nullable=True)                # worker 崩溃后据此回收
+    response         = Column(String, nullable=True)                 # 成功时的 InviteResponse JSON
+    error            = Column(String, nullable=True)
+    error_status     = Column(Integer, nullable=True)                # 同步模式下会返回的 HTTP 状态码
+    created_at       = Column(Integer, nullable=False)
+    started_at       = Column(Integer, nullable=True)
+    finished_at      = Column(Integer, nullable=True)
+
+
+class IdempotencyRecord(Base):
+    """幂等键记录，见 idempotency.py"""
+    __tablename__ = "idempotency_records"
+
+    key          = Column(String(160), primary_key=True)   # "<接口>:<Idempotency-Key 或派生键>"
+    status       = Column(String(16), nullable=False)      # in_flight / done
+    owner        = Column(String(32), nullable=True)       # 正在执行的请求标识
+    request_hash = Column(String(64), nullable=True)       # 请求内容指纹，防止同一键用于不同请求
+    status_code  = Column(Integer, nullable=True)
+    response     = Column(String, nullable=True)           # 保存的 2xx 响应 JSON
+    created_at   = Column(Integer, nullable=False)
+    expires_at   = Column(Integer, nullable=False, index=True)  # in_flight 时为占位超时，done 时为保留期限
+
+
+
+class WorkItem(Base):
+    """
+    持久化后台工作项，见 work_queue.py。
+    请求路径中不必等待的后续操作（例如重新激活后从原组长删除成员）写入这里，失败按退避重试。
+    """
+    __tablename__ = "work_items"
+    __table_args__ = (
+        Index("ix_work_items_status_next_run", "status", "next_run_at"),
+    )
+
+    id               = Column(String(32), primary_key=True)         # uuid4 hex
+    kind             = Column(String(64), nullable=False)            # 处理函数类型，如 reactivation_cleanup
+    payload          = Column(String, nullable=False)                # JSON 参数
+    status           = Column(String(16), default="pending")         # pending / running / succeeded / failed
+    attempts         = Column(Integer, default=0)
+    max_attempts     = Column(Integer, default=6)
+    next_run_at      = Column(Integer, nullable=False)               # 下一次可执行的时间（退避）
+    last_error       = Column(String, nullable=True)
+    result           = Column(String, nullable=True)                 # 成功时处理函数返回的 JSON
+    worker           = Column(String(128), nullable=True)
+    lease_expires_at = Column(Integer, nullable=True)
+    created_at       = Column(Integer, nullable=False)
+    updated_at       = Column(Integer, nullable=False)
+
+
+class OutboxEntry(Base):
+    """
+    Overleaf 变更意图（outbox），见 outbox.py。
+    删除成员 / 撤销邀请时与本地状态变更（记录标记为已清理）在同一事务中写入，
+    由 dispatcher 按组长账号批量执行；进程崩溃后从这里继续，不需要重新扫描 Overleaf。
+    """
+    __tablename__ = "overleaf_outbox"
+    __table_args__ = (
+        Index("ix_overleaf_outbox_status_next_run", "status", "next_run_at"),
+        Index("ix_overleaf_outbox_account_status", "account_id", "status"),
+    )
+
+    id               = Column(String(32), primary_key=True)         # uuid4 hex
+    op               = Column(String(16), nullable=False)            # remove / revoke
+    account_id       = Column(Integer, ForeignKey("accounts.id"), nullable=False)
+    invite_id        = Column(Integer, nullable=True, index=True)    # 成功后记录会被删除，不建外键
+    email            = Column(String, nullable=False)
+    email_id         = Column(String, nullable=True)                 # remove 使用
+    status           = Column(String(16), default="pending")         # pending / dispatching / done / failed / superseded
+    attempts         = Column(Integer, default=0)
+    max_attempts     = Column(Integer, default=6)
+    next_run_at      = Column(Integer, nullable=False)
+    last_error       = Column(String, nullable=True)
+    result           = Column(String(16), nullable=True)             # removed / revoked / not_found
+    worker           = Column(String(128), nullable=True)            # 认领批次的标识
+    lease_expires_at = Column(Integer, nullable=True)
+    created_at       = Column(Integer, nullable=False)
+    updated_at       = Column(Integer, nullable=False)
+
+
+class InviteArchive(Base):
+    """
+    已处理邀请记录的归档（见 archive.py）。
+    已清理且过期超过 ARCHIVE_AFTER_DAYS 天的记录从 invites 移到这里，热表只保留仍可能影响计数 / 卡密判断的记录；
+    组长邮箱与卡密码冗余保存，账户或卡密删除后仍可按邮箱 / 卡密检索。
+    """
+    __tablename__ = "invites_archive"
+    __table_args__ = (
+        Index("ix_invites_archive_email_key", "email_key"),
+        Index("ix_invites_archive_card_code", "card_code"),
+        Index("ix_invites_archive_card_id", "card_id"),
+    )
+
+    id            = Column(Integer, primary_key=True)   # 原 invites.id
+    account_id    = Column(Integer, nullable=True)      # 账户可能已删除，不建外键
+    account_email = Column(String, nullable=True)
+    card_id       = Column(Integer, nullable=True)
+    card_code     = Column(String, nullable=True)
+    email         = Column(String, nullable=False)
+    email_key     = Column(String, nullable=True)
+    email_id      = Column(String, nullable=True)
+    expires_at    = Column(Integer, nullable=True)
+    success       = Column(Boolean, nullable=False)
+    result        = Column(String, nullable=False)
+    created_at    = Column(Integer, nullable=False)
+    archived_at   = Column(Integer, nullable=False)
+
+
+class InviteEvent(Base):
+    """
+    邀请记录的生命周期事件（只追加，见 invite_events.py）。
+    邀请、续期 / 重新激活、发现 email_id、标记已清理、手动设置过期时间等各写一行，
+    不再反复改写 invites.result；记录被删除或归档后事件仍然保留，由压缩任务定期整理。
+    """
+    __tablename__ = "invite_events"
+    __table_args__ = (
+        Index("ix_invite_events_invite_id", "invite_id", "id"),
+        Index("ix_invite_events_at", "at"),
+    )
+
+    id         = Column(Integer, primary_key=True)
+    invite_id  = Column(Integer, nullable=False)                # 记录可能已删除 / 归档，不建外键
+    account_id = Column(Integer, nullable=True)
+    kind       = Column(String(32), nullable=False)             # invited / renewed / processed ...
+    detail     = Column(String, nullable=True)                  # 主要取值：处理原因、email_id、清理状态等
+    data       = Column(ResultJSON, nullable=True)              # 其他字段（JSON 对象）
+    at         = Column(Integer, nullable=False)                # Unix 时间戳
+
+    # 新记录还没有 id 时随同一次 flush 写入（invite_id 由 ORM 回填）
+    invite = relationship("Invite", primaryjoin="foreign(InviteEvent.invite_id) == Invite.id")
+
@@ -0,0 +1,360 @@
+# outbox.py
+"""
+Overleaf 变更 outbox
+原来删除成员 / 撤销邀请是先调用 Overleaf、再写数据库：两步之间进程崩溃，Overleaf 与数据库就不一致，
+只能靠全量同步 / 一致性检查修复。这里改为：
+1. 请求处理时在同一个事务里把记录标记为已清理、并写入一条 overleaf_outbox 意图（record_remove / record_revoke），
+   提交后立即返回
+2. 每个 API 进程内的 OutboxDispatcher 按组长账号认领一批到期的意图：同一条记录的重复意图合并、
+   记录在此期间又被重新邀请（cleaned 恢复为 False）的意图作废；每个账号认证一次，
+   在同一个 session 上依次执行（cleanup_engine.clean_account）
+3. 结果在一个事务中写回：成功的删除记录，失败的按退避重试，超过次数后放弃并把记录恢复为未清理
+   （成员仍在 Overleaf 上），每个账号只重新计数一次
+认领批次带租约，进程崩溃后租约过期的批次重新变为待执行，重启后从 outbox 继续。
+账户计数在 Overleaf 上真正删除后才更新，期间这个席位仍视为占用。
+"""
+
+import os
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Optional, List, Dict, Any
+
+from sqlalchemy import update, and_, func
+from sqlalchemy.orm import Session
+
+import models, crud
+import invite_events
+import cleanup_engine
+from database import SessionLocal
+from settings import settings
+from tracing import span
+from work_queue import backoff_seconds
+
+logger = logging.getLogger(__name__)
+
+OP_REMOVE = "remove"   # 删除已接受的成员（按 email_id）
+OP_REVOKE = "revoke"   # 撤销未接受的邀请（按邮箱）
+
+PENDING, DISPATCHING, DONE, FAILED, SUPERSEDED = "pending", "dispatching", "done", "failed", "superseded"
+IN_FLIGHT = (PENDING, DISPATCHING)
+
+LEASE_SECONDS = 300
+
+
+def _record(db: Session, op: str, invite: models.Invite) -> models.OutboxEntry:
+    existing = (
+        db.query(models.OutboxEntry)
+        .filter(models.OutboxEntry.invite_id == invite.id,
+                models.OutboxEntry.op == op,
+                models.OutboxEntry.status.in_(IN_FLIGHT))
+        .first()
+    )
+    if existing is not None:
+        return existing
+
+    now_ts = int(time.time())
+    invite.cleaned = True
+    invite_events.record(db, invite, invite_events.PROCESSED, detail=op, at=now_ts)
+    entry = models.OutboxEntry(
+        id=uuid.uuid4().hex,
+        op=op,
+        account_id=invite.account_id,
+        invite_id=invite.id,
+        email=invite.email,
+        email_id=invite.email_id if op == OP_REMOVE else None,
+        status=PENDING,
+        attempts=0,
+        max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+        next_run_at=now_ts,
+        created_at=now_ts,
+        updated_at=now_ts,
+    )
+    db.add(entry)
+    db.flush()  # 同一事务里再次登记时能查到
+    return entry
+
+
+def record_remove(db: Session, invite: models.Invite) -> models.OutboxEntry:
+    """登记删除成员：记录标记为已清理 + 写入意图，由调用方提交（同一事务）；已有未完成的同类意图时直接返回"""
+    return _record(db, OP_REMOVE, invite)
+
+
+def record_revoke(db: Session, invite: models.Invite) -> models.OutboxEntry:
+    """登记撤销邀请，规则同 record_remove"""
+    return _record(db, OP_REVOKE, invite)
+
+
+def in_flight_invite_ids(db: Session, account_id: int) -> set:
+    """该账号还没有在 Overleaf 上执行完的意图涉及的记录（对账时不要把它们恢复为未清理）"""
+    rows = (
+        db.query(models.OutboxEntry.invite_id)
+        .filter(models.OutboxEntry.account_id == account_id,
+                models.OutboxEntry.status.in_(IN_FLIGHT),
+                models.OutboxEntry.invite_id.isnot(None))
+        .all()
+    )
+    return {row.invite_id for row in rows}
+
+
+# -------- 认领 --------
+
+def claim_batch(owner: str, now_ts: Optional[int] = None, limit: int = settings.OUTBOX_BATCH_SIZE,
+                account_id: Optional[int] = None) -> Optional[str]:
+    """
+    认领一个组长账号下到期的一批意图（条件 UPDATE，多进程安全），返回批次标识；没有可认领的返回 None。
+    account_id 为空时选最早到期的意图所在的账号。
+    """
+    if now_ts is None:
+        now_ts = int(time.time())
+    Entry = models.OutboxEntry
+    db = SessionLocal()
+    try:
+        due = and_(Entry.status == PENDING, Entry.next_run_at <= now_ts)
+        for _ in range(5):
+            if account_id is None:
+                head = db.query(Entry.account_id).filter(due).order_by(Entry.next_run_at, Entry.created_at).first()
+                if head is None:
+                    return None
+                target = head.account_id
+            else:
+                target = account_id
+            ids = [
+                row.id for row in
+                db.query(Entry.id).filter(due, Entry.account_id == target)
+                .order_by(Entry.created_at, Entry.id).limit(limit)
+            ]
+            if not ids:
+                return None
+            batch = f"{owner}:{uuid.uuid4().hex[:8]}"
+            claimed = db.execute(
+                update(Entry)
+                .where(Entry.id.in_(ids), Entry.status == PENDING)
+                .values(status=DISPATCHING, worker=batch, lease_expires_at=now_ts + LEASE_SECONDS,
+                        updated_at=now_ts)
+            ).rowcount
+            db.commit()
+            if claimed:
+                return batch
+        return None
+    finally:
+        db.close()
+
+
+def recover_expired(now_ts: Optional[int] = None) -> int:
+    """租约过期的批次（派发中进程崩溃）重新变为待执行"""
+    if now_ts is None:
+        now_ts = int(time.time())
+    db = SessionLocal()
+    try:
+        count = db.execute(
+            update(models.OutboxEntry)
+            .where(and_(models.OutboxEntry.status == DISPATCHING, models.OutboxEntry.lease_expires_at < now_ts))
+            .values(status=PENDING, worker=None, lease_expires_at=None, next_run_at=now_ts)
+        ).rowcount
+        db.commit()
+        if count:
+            logger.warning(f"outbox: {count} 条派发中断的意图重新排队")
+        return count
+    finally:
+        db.close()
+
+
+# -------- 派发 --------
+
+async def dispatch_batch(batch: str, opener=None, base_url: str = cleanup_engine.OVERLEAF_URL,
+                         interval: float = settings.CLEANUP_DELETE_INTERVAL) -> Dict[str, int]:
+    """执行一个已认领的批次，返回各结果的数量"""
+    if opener is None:
+        import overleaf_utils
+        opener = overleaf_utils.open_group_session
+
+    db = SessionLocal()
+    try:
+        entries = (
+            db.query(models.OutboxEntry)
+            .filter(models.OutboxEntry.worker == batch, models.OutboxEntry.status == DISPATCHING)
+            .order_by(models.OutboxEntry.created_at, models.OutboxEntry.id)
+            .all()
+        )
+        if not entries:
+            return {}
+        acct = db.get(models.Account, entries[0].account_id)
+        invite_ids = [e.invite_id for e in entries if e.invite_id is not None]
+        invites = {
+            i.id: i for i in db.query(models.Invite).filter(models.Invite.id.in_(invite_ids)).all()
+        } if invite_ids else {}
+
+        # 合并：同一条记录只执行一次；记录已被重新邀请（不再是已清理）的意图作废
+        to_run: Dict[Any, models.OutboxEntry] = {}
+        duplicates: List[tuple] = []   # (entry, 与之合并执行的 entry)
+        superseded: List[models.OutboxEntry] = []
+        for entry in entries:
+            invite = invites.get(entry.invite_id)
+            if invite is not None and not invite.cleaned:
+                superseded.append(entry)
+                continue
+            key = entry.invite_id if entry.invite_id is not None else (entry.op, entry.email)
+            if key in to_run:
+                duplicates.append((entry, to_run[key]))
+            else:
+                to_run[key] = entry
+
+        report, tokens, outcomes = None, None, {}
+        if acct is not None and to_run:
+            # CleanupItem.invite_id 这里用批内序号（没有对应记录的意图也能区分）
+            items = [
+                cleanup_engine.CleanupItem(pos, entry.email, entry.email_id if entry.op == OP_REMOVE else None)
+                for pos, entry in enumerate(to_run.values())
+            ]
+            with span("outbox_dispatch", account_id=acct.id):
+                report, tokens, outcomes = await cleanup_engine.clean_account(acct, items, opener, base_url, interval)
+        errors = {f["invite_id"]: f["error"] for f in report.failures} if report else {}
+
+        now_ts = int(time.time())
+        counts = defaultdict(int)
+        changed = False
+
+        def finish(entry, pos):
+            nonlocal changed
+            entry.attempts = (entry.attempts or 0) + 1
+            entry.worker = None
+            entry.lease_expires_at = None
+            entry.updated_at = now_ts
+            if pos is not None and pos in outcomes:
+                entry.status, entry.result, entry.last_error = DONE, outcomes[pos], None
+                invite = invites.get(entry.invite_id)
+                if invite is not None and invite.cleaned:
+                    db.delete(invite)
+                changed = True
+                return
+            if acct is None:
+                error = "找不到关联的账户"
+            elif report is not None and report.error:
+                error = report.error
+            else:
+                error = errors.get(pos, "执行失败")
+            entry.last_error = error
+            if entry.attempts >= (entry.max_attempts or settings.OUTBOX_MAX_ATTEMPTS) or acct is None:
+                entry.status = FAILED
+                # 成员仍在 Overleaf 上：记录恢复为未清理，计数随之恢复
+                invite = invites.get(entry.invite_id)
+                if invite is not None:
+                    invite.cleaned = False
+                changed = True
+                logger.error(f"outbox: {entry.op} {entry.email} 放弃（第 {entry.attempts} 次）: {error}")
+            else:
+                entry.status = PENDING
+                entry.next_run_at = now_ts + backoff_seconds(entry.attempts)
+                logger.warning(f"outbox: {entry.op} {entry.email} 失败，{entry.next_run_at - now_ts} 秒后重试: {error}")
+
+        with crud.unit_of_work(db):
+            if tokens is not None:
+                crud.update_account_tokens(db, acct, tokens[1], tokens[0])
+            positions = {entry.id: pos for pos, entry in enumerate(to_run.values())}
+            for entry in to_run.values():
+                finish(entry, positions[entry.id])
+                counts[entry.status] += 1
+            for entry, primary in duplicates:
+                entry.status = SUPERSEDED if primary.status == DONE else primary.status
+                entry.result, entry.last_error = primary.result, primary.last_error
+                entry.attempts, entry.next_run_at = primary.attempts, primary.next_run_at
+                entry.worker, entry.lease_expires_at, entry.updated_at = None, None, now_ts
+                counts[entry.status] += 1
+            for entry in superseded:
+                entry.status, entry.worker, entry.lease_expires_at, entry.updated_at = SUPERSEDED, None, None, now_ts
+                entry.last_error = "记录已被重新邀请"
+                counts[SUPERSEDED] += 1
+            if changed and acct is not None:
+                crud.sync_account_invites_count(db, acct)
+        return dict(counts)
+    finally:
+        db.close()
+
+
+async def dispatch_account(account_id: int, owner: str = "inline", **kwargs) -> Dict[str, int]:
+    """立即派发某个账号下到期的意图（请求里 wait=true 时使用）"""
+    batch = await asyncio.to_thread(claim_batch, owner, None, settings.OUTBOX_BATCH_SIZE, account_id)
+    if batch is None:
+        return {}
+    return await dispatch_batch(batch, **kwargs)
+
+
+def outbox_status(db: Session, recent: int = 20) -> Dict[str, Any]:
+    """各状态的数量、最早待执行意图的等待时间、最近失败的意图"""
+    Entry = models.OutboxEntry
+    counts = dict(db.query(Entry.status, func.count()).group_by(Entry.status).all())
+    oldest = db.query(func.min(Entry.created_at)).filter(Entry.status.in_(IN_FLIGHT)).scalar()
+    failed = (
+        db.query(Entry).filter(Entry.status == FAILED)
+        .order_by(Entry.updated_at.desc()).limit(recent).all()
+    )
+    return {
+        "counts": counts,
+        "oldest_pending_age": int(time.time()) - oldest if oldest else None,
+        "recent_failed": [
+            {"id": e.id, "op": e.op, "email": e.email, "account_id": e.account_id,
+             "attempts": e.attempts, "error": e.last_error, "updated_at": e.updated_at}
+            for e in failed
+        ],
+    }
+
+
+class OutboxDispatcher:
+    """单个进程内的派发 worker：每个 worker 一次处理一个账号的一批意图，账号之间并行"""
+
+    def __init__(self, workers: int = settings.OUTBOX_WORKERS, poll_interval: float = 2.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        recover_expired()
+        self._tasks = [asyncio.create_task(self._worker_loop(i)) for i in range(self.workers)]
+        logger.info(f"outbox 派发已启动: {self.workers} 个 worker ({self.owner})")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run_pending(self, **kwargs) -> int:
+        """把当前到期的意图派发完（脚本与测试使用），返回处理的批次数"""
+        batches = 0
+        while True:
+            batch = await asyncio.to_thread(claim_batch, self.owner)
+            if batch is None:
+                return batches
+            await dispatch_batch(batch, **kwargs)
+            batches += 1
+
+    async def _worker_loop(self, index: int) -> None:
+        while True:
+            batch = await asyncio.to_thread(claim_batch, self.owner)
+            if batch is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    await asyncio.to_thread(recover_expired)
+                continue
+            try:
+                await dispatch_batch(batch)
+            except Exception as e:
+                logger.exception(f"outbox worker {index} 派发批次 {batch} 出错: {e}")
+
+
+outbox_dispatcher = OutboxDispatcher()
@@ -1,11 +1,15 @@
 # overleaf_utils.py
 
 import re
+import json
+import html
+import asyncio
 import requests
 from playwright_manager import new_context
 from yescaptcha.client import Client
 from yescaptcha.task import NoCaptchaTaskProxyless
 from settings import settings
+from tracing import span
 
 async def get_tokens() -> tuple[str, str]:
     """
@@ -87,3 +91,77 @@ def get_new_csrf(session: requests.Session, group_id: str) -> str:
     if not m:
         raise RuntimeError("提取 CSRF 失败")
     return m.group(1)
+
+
+class GroupMembersFetchError(RuntimeError):
+    """获取 Overleaf 群组成员列表失败"""
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+_OL_USERS_PATTERN = re.compile(r'<meta\s+name="ol-users"[^>]*content="([^"]*)"')
+
+
+async def open_group_session(acct) -> tuple[requests.Session, str, str]:
+    """
+    为组长账号准备一个已认证的 session：
+    先尝试复用并刷新已有的 session/CSRF，失败时走完整登录流程。
+    返回 (session, overleaf_session2, csrf)，写回数据库由调用方负责。
+    """
+    session = requests.Session()
+    new_sess = acct.session_cookie
+    new_csrf = acct.csrf_token
+
+    if new_sess and new_csrf:
+        session.cookies.set("overleaf_session2", new_sess,
+                            domain=".overleaf.com", path="/")
+        try:
+            with span("refresh_session"):
+                new_sess = await asyncio.to_thread(refresh_session, session, new_csrf)
+            with span("get_new_csrf"):
+                new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
+        except Exception:
+            new_sess = new_csrf = None
+
+    if not (new_sess and new_csrf):
+        with span("get_tokens"):
+            csrf0, sess0 = await get_tokens()
+        with span("get_captcha_token"):
+            captcha = get_captcha_token()
+        with span("perform_login"):
+            session = await asyncio.to_thread(
+                perform_login, csrf0, sess0,
+                acct.email, acct.password, captcha
+            )
+        with span("login_refresh_session"):
+            new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
+        with span("login_get_new_csrf"):
+            new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
+
+    return session, new_sess, new_csrf
+
+
+def fetch_group_members(session: requests.Session, group_id: str) -> list[dict]:
+    """
+    拉取群组成员页，解析 <meta name="ol-users"> 中的原始成员列表。
+    每项至少包含 email，已接受邀请的成员带有 _id。
+    """
+    resp = session.get(
+        f"https://www.overleaf.com/manage/groups/{group_id}/members",
+        headers={
+            "Accept": "text/html",
+            "Referer": "https://www.overleaf.com/project",
+            "User-Agent": "Mozilla/5.0",
+        }
+    )
+    if resp.status_code != 200:
+        raise GroupMembersFetchError("获取成员列表失败", resp.status_code)
+
+    m = _OL_USERS_PATTERN.search(resp.text)
+    if not m:
+        raise GroupMembersFetchError("未找到 ol-users 元数据标签")
+    try:
+        return json.loads(html.unescape(m.group(1)))
+    except json.JSONDecodeError as e:
+        raise GroupMembersFetchError(f"解析用户数据失败: {e}")
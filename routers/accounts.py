@@ -8,6 +8,7 @@ from typing import List, Optional
 
 import crud, models, schemas
 from database import SessionLocal
+from group_capacity import capacity_stats
 
 router = APIRouter(prefix="/api/v1/accounts", tags=["accounts"])
 
@@ -30,6 +31,11 @@ def list_accounts(
         query = query.filter(models.Account.email == email)
     return query.offset((page-1)*size).limit(size).all()
 
+@router.get("/capacity", response_model=schemas.CapacityStats)
+def get_capacity(db: Session = Depends(get_db)):
+    """各组的 Overleaf 侧容量快照与 group_full 统计"""
+    return capacity_stats(db)
+
 @router.post("/add", response_model=schemas.AccountOut)
 def add_account(
     data: schemas.AccountCreate = Body(...),
@@ -13,6 +13,9 @@ from sqlalchemy import func
 from database import SessionLocal
 from invite_status_manager import InviteStatusManager, InviteStatus
 import models
+import invite_events
+import cleanup_plan
+from job_coordinator import JobLease, LeaseHeldError, SCOPE_CLEANUP
 
 # 创建路由器
 router = APIRouter(prefix="/api/v1/data-consistency", tags=["数据一致性"])
@@ -282,11 +285,12 @@ async def cleanup_expired_invites(
     account_email: Optional[str] = Query(None, description="指定账户，不指定则处理所有账户"),
     db: Session = Depends(get_db)
 ):
-    """清理过期邀请"""
+    """清理过期邀请（只标记为已清理，不访问 Overleaf）；预览时返回按账号的执行计划"""
     import time
     
     now_ts = int(time.time())
     manager = InviteStatusManager()
+    account = None
     
     # 构建查询
     query = db.query(models.Invite).filter(
@@ -310,22 +314,42 @@ async def cleanup_expired_invites(
             "dry_run": dry_run
         }
     
+    if dry_run:
+        # 计划可原样提交给 POST /api/v1/maintenance/cleanup_plan/execute 执行
+        plan = cleanup_plan.build_plan(
+            db, limit=None, mode=cleanup_plan.MODE_MARK_PROCESSED,
+            account_id=account.id if account else None, now_ts=now_ts
+        )
+        return {
+            "message": f"预览 {len(expired_invites)} 个过期邀请",
+            "expired_count": len(expired_invites),
+            "processed_count": 0,
+            "affected_accounts": len(plan.accounts),
+            "dry_run": dry_run,
+            "plan": plan.to_dict()
+        }
+    
     processed_count = 0
     affected_accounts = set()
     
     if not dry_run:
-        for invite in expired_invites:
-            invite.cleaned = True
-            affected_accounts.add(invite.account_id)
-            processed_count += 1
-        
-        # 更新受影响账户的计数
-        for account_id in affected_accounts:
-            account = db.get(models.Account, account_id)
-            if account:
-                account.invites_sent = manager.calculate_invites_sent(db, account)
-        
-        db.commit()
+        try:
+            with JobLease(SCOPE_CLEANUP).hold_sync(total=len(expired_invites)):
+                for invite in expired_invites:
+                    invite.cleaned = True
+                    invite_events.record(db, invite, invite_events.PROCESSED, detail="expired")
+                    affected_accounts.add(invite.account_id)
+                    processed_count += 1
+                
+                # 更新受影响账户的计数
+                for account_id in affected_accounts:
+                    account = db.get(models.Account, account_id)
+                    if account:
+                        account.invites_sent = manager.calculate_invites_sent(db, account)
+                
+                db.commit()
+        except LeaseHeldError:
+            raise HTTPException(status_code=400, detail="清理任务正在进行中，请等待完成")
     
     return {
         "message": f"{'预览' if dry_run else '已处理'} {len(expired_invites)} 个过期邀请",
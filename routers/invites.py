@@ -1,16 +1,31 @@
-import html, json, asyncio, requests
+import html, json, asyncio, inspect, requests
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 import time # 新增：引入 time 模块用于获取当前时间戳
-from fastapi import APIRouter, Depends, HTTPException, Query, Body # 新增：引入 Body
+from fastapi import APIRouter, Depends, HTTPException, Query, Body, Header # 新增：引入 Body
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session # 新增这一行
 import models, crud, schemas
+import invite_jobs
+import idempotency
+import work_queue
+import card_state
+import invite_result
+import invite_events
 from database import SessionLocal
 from overleaf_utils import (
     get_tokens, get_captcha_token,
-    perform_login, refresh_session, get_new_csrf
+    perform_login, refresh_session, get_new_csrf,
+    open_group_session
 )
+from invite_status_manager import InviteStatusManager
+from session_pool import session_warmth, routing_key, HOT
+from group_capacity import is_known_full
+from job_coordinator import LeaseHeldError, account_lock
+from memberships import find_memberships, find_memberships_many, latest_in_account
+from tracing import span, traced, collect, annotate
 
 router = APIRouter(prefix="/api/v1/invite", tags=["invites"])
 
@@ -38,6 +53,17 @@ def get_db():
     finally:
         db.close()
 
+
+# 进度回调：progress(stage, account_email=None, attempt=None)；可以是协程函数（异步任务落库进度），会被 await
+ProgressCallback = Callable[..., Optional[Awaitable[None]]]
+
+
+async def _report(progress: Optional[ProgressCallback], stage: str, **kwargs) -> None:
+    if progress is not None:
+        pending = progress(stage, **kwargs)
+        if inspect.isawaitable(pending):
+            await pending
+
 def send_invite(
     session: requests.Session,
     csrf: str,
@@ -85,6 +111,22 @@ async def try_invite_with_account(acct: models.Account, req_email: str, expires_
     new_sess = None
     new_csrf = None
 
+    # 0. 会话刚验证过：直接用已保存的 token 发送，省去刷新请求；失败再走刷新流程
+    if session_warmth(acct) == HOT:
+        session.cookies.set(
+            "overleaf_session2", acct.session_cookie,
+            domain=".overleaf.com", path="/"
+        )
+        try:
+            with span("hot_send_invite"):
+                result = await asyncio.to_thread(send_invite, session, acct.csrf_token, acct.group_id, req_email, expires_iso)
+            crud.mark_session_validated(db, acct)
+            logger.info(f"账号 {acct.email} 使用热会话直接发送邀请成功。")
+            return result, acct
+        except InviteAttemptFailedError as e:
+            logger.info(f"账号 {acct.email} 热会话发送失败，改为刷新 token: {e}")
+            session = requests.Session()
+
     # 1. 尝试复用并刷新 token
     if acct.session_cookie and acct.csrf_token:
         session.cookies.set(
@@ -92,13 +134,16 @@ async def try_invite_with_account(acct: models.Account, req_email: str, expires_
             domain=".overleaf.com", path="/"
         )
         try:
-            new_sess = await asyncio.to_thread(refresh_session, session, acct.csrf_token)
-            new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
+            with span("refresh_session"):
+                new_sess = await asyncio.to_thread(refresh_session, session, acct.csrf_token)
+            with span("get_new_csrf"):
+                new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
             # 如果成功刷新，立即更新数据库，确保下次能用新 token
             crud.update_account_tokens(db, acct, new_csrf, new_sess)
             logger.info(f"账号 {acct.email} token 刷新成功。")
             # 尝试发送邀请
-            result = await asyncio.to_thread(send_invite, session, new_csrf, acct.group_id, req_email, expires_iso) # 修改为 req_email
+            with span("send_invite"):
+                result = await asyncio.to_thread(send_invite, session, new_csrf, acct.group_id, req_email, expires_iso) # 修改为 req_email
             return result, acct
         except (requests.exceptions.RequestException, RuntimeError, GroupFullError, InviteAttemptFailedError) as e:
             # Token 刷新或使用旧 token 发送邀请失败，记录并尝试完整登录
@@ -106,24 +151,31 @@ async def try_invite_with_account(acct: models.Account, req_email: str, expires_
             # 如果是 GroupFullError，我们还是希望它能被外层捕获并特殊处理
             if isinstance(e, GroupFullError):
                 raise e
-            # 否则，继续尝试完整登录
+            # 否则，继续尝试完整登录（已保存的 token 不再视为热会话）
+            crud.mark_session_cold(db, acct)
 
     # 2. 完整登录流程
     try:
         logger.info(f"账号 {acct.email} 开始完整登录流程...")
-        csrf0, sess0 = await get_tokens()
-        captcha = get_captcha_token()
-        session = await asyncio.to_thread(
-            perform_login, csrf0, sess0, acct.email, acct.password, captcha
-        )
-        new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-        new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
+        with span("get_tokens"):
+            csrf0, sess0 = await get_tokens()
+        with span("get_captcha_token"):
+            captcha = get_captcha_token()
+        with span("perform_login"):
+            session = await asyncio.to_thread(
+                perform_login, csrf0, sess0, acct.email, acct.password, captcha
+            )
+        with span("login_refresh_session"):
+            new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
+        with span("login_get_new_csrf"):
+            new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
         # 完整登录成功后更新数据库 token
         crud.update_account_tokens(db, acct, new_csrf, new_sess)
         logger.info(f"账号 {acct.email} 完整登录成功。")
 
         # 尝试发送邀请
-        result = await asyncio.to_thread(send_invite, session, new_csrf, acct.group_id, req_email, expires_iso)
+        with span("login_send_invite"):
+            result = await asyncio.to_thread(send_invite, session, new_csrf, acct.group_id, req_email, expires_iso)
         return result, acct
     except (requests.exceptions.RequestException, RuntimeError, GroupFullError) as e:
         # 完整登录或发送邀请失败，抛出 InviteAttemptFailedError
@@ -137,31 +189,120 @@ async def try_invite_with_account(acct: models.Account, req_email: str, expires_
         raise InviteAttemptFailedError(f"账号 {acct.email} 邀请尝试中发生意外错误: {e}")
 
 
-@router.post("", response_model=schemas.InviteResponse)
-async def invite(req: schemas.InviteRequest, db: Session = Depends(get_db)):
-    # 1. 验证卡密（支持重新激活检测）
-    card = crud.get_card(db, req.card)
+def validate_invite_card(db: Session, req: schemas.InviteRequest):
+    """
+    验证卡密（支持重新激活检测），返回 (card, is_reactivation, original_invite)；
+    卡密不可用时抛出 400。异步模式在入队前调用，保证无效卡密立即返回错误。
+    """
+    # 发邀请前的校验必须读数据库（max_age=0）；同一事务内已解析过则直接复用
+    state = card_state.resolve(db, req.card, max_age=0)
+    card, bound_invite = card_state.bound_records(db, state)
     is_reactivation = False
     original_invite = None
-    
-    if not card:
-        # 尝试重新激活检测
-        card, status_msg = crud.get_card_for_reactivation(db, req.card, req.email)
-        if not card:
+
+    mode = state.mode()
+    if mode == card_state.MISSING:
+        logger.warning(f"邀请失败：卡密不存在 '{req.card}'")
+        raise HTTPException(400, "卡密不存在")
+    if mode != card_state.NEW:
+        # 尝试重新激活检测：同一邮箱、权益未过期
+        if not state.can_reactivate_for(req.email):
+            status_msg = "卡密已被其他用户使用或权益已过期"
             logger.warning(f"邀请失败：{status_msg} '{req.card}'")
             raise HTTPException(400, status_msg)
-        elif status_msg == "权益期内可重新激活":
-            is_reactivation = True
-            # 查找原始记录
-            original_invite = (
-                db.query(models.Invite)
-                .filter(
-                    models.Invite.card_id == card.id,
-                    models.Invite.email == req.email
-                )
-                .first()
-            )
-            logger.info(f"检测到重新激活请求：{req.email} 使用卡密 {req.card}")
+        is_reactivation = True
+        original_invite = bound_invite
+        logger.info(f"检测到重新激活请求：{req.email} 使用卡密 {req.card}")
+
+    return card, is_reactivation, original_invite
+
+
+@router.post("", response_model=schemas.InviteResponse)
+async def invite(
+    req: schemas.InviteRequest,
+    mode: str = Query("sync", pattern="^(sync|async)$", description="sync: 等待邀请完成；async: 校验卡密后立即返回任务ID"),
+    debug: bool = Query(False, description="在响应的 timings 中返回本次请求各阶段耗时"),
+    idempotency_key: Optional[str] = Header(None, alias=idempotency.IDEMPOTENCY_HEADER),
+    db: Session = Depends(get_db)
+):
+    # 超时重试不会再次选账号、发邀请：未传 Idempotency-Key 时按 卡密 + 邮箱 派生
+    async def handler():
+        if mode == "async":
+            return enqueue_invite_job(req, db)
+        return await run_invite(req, db)
+
+    with collect() as trace:
+        response = await idempotency.run_idempotent(
+            "invite", idempotency_key, idempotency.derive_key(req.card, req.email),
+            req, handler
+        )
+    # 只给本次实际执行的同步邀请附加耗时（幂等重放返回的是已保存的响应）
+    if debug and isinstance(response, schemas.InviteResponse):
+        response.timings = trace.breakdown()
+    return response
+
+
+def enqueue_invite_job(req: schemas.InviteRequest, db: Session) -> JSONResponse:
+    """校验卡密并写入异步任务，返回 202 + 任务状态"""
+    validate_invite_card(db, req)
+    job = invite_jobs.enqueue_invite(db, req.email, req.card)
+    invite_jobs.invite_job_queue.notify()
+    logger.info(f"邀请任务已入队: {job.id} ({req.email})")
+    return JSONResponse(
+        status_code=202,
+        content=invite_jobs.job_to_schema(job).model_dump(mode="json")
+    )
+
+
+@router.get("/jobs/{job_id}", response_model=schemas.InviteJobStatus)
+async def get_invite_job(
+    job_id: str,
+    wait: int = Query(0, ge=0, le=60, description="长轮询秒数：任务未结束时最多等待这么久再返回")
+):
+    """查询异步邀请任务的进度与结果"""
+    if wait:
+        status = await invite_jobs.wait_for_job(job_id, timeout=wait)
+    else:
+        status = await asyncio.to_thread(invite_jobs.get_job_status, job_id)
+    if status is None:
+        raise HTTPException(404, "任务不存在")
+    return status
+
+
+def cross_group_warning(email: str, memberships, acct: models.Account) -> Optional[Dict[str, Any]]:
+    """
+    该邮箱在其他组中还有未清理记录时返回写入 result 的 cross_group_warning（并记日志），否则返回 None。
+    memberships 为 find_memberships(active_only=False) 的结果
+    """
+    other_accounts = [
+        m.account_email for m in memberships
+        if m.account.id != acct.id and not m.invite.cleaned
+    ]
+    if not other_accounts:
+        return None
+    logger.warning(f"⚠️  用户 {email} 已存在于其他群组: {', '.join(other_accounts)}")
+    logger.warning(f"   当前邀请将在新群组 {acct.email} 中创建记录")
+    return {
+        "message": f"用户已存在于其他群组: {', '.join(other_accounts)}",
+        "existing_groups": other_accounts,
+        "current_group": acct.email,
+        "action": "created_new_record_in_current_group"
+    }
+
+
+@traced("invite")
+async def run_invite(
+    req: schemas.InviteRequest,
+    db: Session,
+    progress: Optional[ProgressCallback] = None
+) -> schemas.InviteResponse:
+    """
+    完整的邀请流程（同步接口与异步 worker 共用）：
+    验证卡密 → 选择账号 → 刷新/登录 → 发送邀请（最多换 5 个账号）→ 写数据库。
+    失败时抛出 HTTPException；progress 用于上报阶段进度。
+    """
+    # 1. 验证卡密（支持重新激活检测）
+    card, is_reactivation, original_invite = validate_invite_card(db, req)
 
     # 2. 时间戳处理
     now = datetime.now()
@@ -181,219 +322,154 @@ async def invite(req: schemas.InviteRequest, db: Session = Depends(get_db)):
     max_account_attempts = 5 # 最多尝试 5 个不同的账号
     current_attempt = 0
     successful_acct = None
+    tried_ids = set()      # 本次已尝试失败的账号
+    failure = None
+    cleanup_item = None
     last_error_detail = "未知错误" # 用于存储最后一次失败的详情
-
-    while current_attempt < max_account_attempts:
-        # 3. 获取最不活跃且有可用邀请次数的账号
-        # 重新激活时排除原组长，直接使用新组长
-        if is_reactivation and original_invite:
-            acct = crud.get_available_account_exclude(db, original_invite.account_id)
-            logger.info(f"重新激活：排除原组长 ID: {original_invite.account_id}")
-        else:
-            acct = crud.get_available_account(db)
-
-        if not acct:
-            logger.error("所有账号均无可用邀请次数，无法邀请。")
-            raise HTTPException(400, "无可用账号")
-
-        logger.info(f"第 {current_attempt + 1} 次尝试使用账号: {acct.email} (ID: {acct.id}) 邀请 {req.email}")
-
-        try:
-            result, successful_acct = await try_invite_with_account(acct, req.email, expires_iso, db, card)
-            # 如果成功，跳出循环
-            break
-        except GroupFullError as e:
-            # 明确是组满，记录，并尝试下一个账号
-            logger.warning(f"账号 {acct.email} 邀请失败，原因：组已满。错误: {e}. 尝试切换账号...")
-            last_error_detail = f"账号组 {acct.email} 已满"
-            # 标记该账号为“已尝试且失败”
-            # 注意：此处更新 updated_at 确保在下次 crud.get_available_account 时，该账号会排到列表后面
-            acct.updated_at = int(datetime.now().timestamp())
-            db.add(acct)
-            db.commit()
-            db.refresh(acct)
-            current_attempt += 1 # 增加尝试次数
-        except InviteAttemptFailedError as e:
-            # 其他邀请尝试失败，记录，并尝试下一个账号
-            logger.error(f"账号 {acct.email} 邀请失败，原因：{e}. 尝试切换账号...")
-            last_error_detail = str(e)
-            # 标记该账号为“已尝试且失败”
-            acct.updated_at = int(datetime.now().timestamp())
-            db.add(acct)
-            db.commit()
-            db.refresh(acct)
-            current_attempt += 1 # 增加尝试次数
-        except Exception as e:
-            # 捕获任何未预料的异常
-            logger.critical(f"账号 {acct.email} 邀请过程中发生未预料的错误: {type(e).__name__} - {e}. 尝试切换账号...")
-            last_error_detail = f"未预料的错误: {e}"
-            acct.updated_at = int(datetime.now().timestamp())
-            db.add(acct)
-            db.commit()
-            db.refresh(acct)
-            current_attempt += 1 # 增加尝试次数
-
-
-    if not successful_acct:
-        # 如果循环结束仍未成功
-        logger.error(f"所有可用账号均已尝试，邀请最终失败。最后错误: {last_error_detail}")
-        raise HTTPException(400, f"邀请失败：所有可用账号尝试完毕或无可用账号。详情: {last_error_detail}")
-
-    # 4. 更新数据库（只有在成功发送邀请后才执行）
-    if is_reactivation and original_invite:
-        # 重新激活：不重复标记卡密已使用，只更新记录
-        logger.info(f"重新激活模式：更新现有记录，不重复标记卡密已使用")
-    else:
-        # 新邀请：标记卡密已使用（注意：先标记卡密再创建记录）
-        crud.mark_card_used(db, card)
-
-    # 数据库记录处理：重新激活 vs 新邀请
-    if is_reactivation and original_invite:
-        # 重新激活：直接使用新组长，清理原组长
-        old_account = db.get(models.Account, original_invite.account_id)
-        cleanup_success = False
-        
-        # 如果用户在原组长下已被接受，尝试从原组长删除（清理步骤）
-        if original_invite.email_id and old_account:
-            logger.info(f"重新激活清理：尝试从原组长 {old_account.email} 删除成员 {req.email}")
-            
-            try:
-                # 构造删除函数进行清理
-                async def cleanup_original_member():
-                    import requests
-                    import asyncio
-                    from overleaf_utils import refresh_session, get_new_csrf, get_tokens, perform_login, get_captcha_token
-                    
-                    session = requests.Session()
-                    new_sess = old_account.session_cookie
-                    new_csrf = old_account.csrf_token
-                    
-                    # 尝试复用已有的 session/CSRF
-                    if new_sess and new_csrf:
-                        session.cookies.set("overleaf_session2", new_sess, domain=".overleaf.com", path="/")
-                        try:
-                            new_sess = await asyncio.to_thread(refresh_session, session, new_csrf)
-                            new_csrf = await asyncio.to_thread(get_new_csrf, session, old_account.group_id)
-                        except Exception:
-                            new_sess = new_csrf = None
-                    
-                    # 如果复用失败，完整登录
-                    if not (new_sess and new_csrf):
-                        csrf0, sess0 = await get_tokens()
-                        captcha = get_captcha_token()
-                        session = await asyncio.to_thread(perform_login, csrf0, sess0, old_account.email, old_account.password, captcha)
-                        new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-                        new_csrf = await asyncio.to_thread(get_new_csrf, session, old_account.group_id)
-                    
-                    # 更新数据库中的 token
-                    crud.update_account_tokens(db, old_account, new_csrf, new_sess)
-                    
-                    # 调用 Overleaf API 删除成员
-                    url = f"https://www.overleaf.com/manage/groups/{old_account.group_id}/user/{original_invite.email_id}"
-                    resp = session.delete(url, headers={
-                        "Accept": "application/json",
-                        "x-csrf-token": new_csrf,
-                        "Referer": f"https://www.overleaf.com/manage/groups/{old_account.group_id}/members",
-                        "User-Agent": "Mozilla/5.0"
-                    })
-                    
-                    if resp.status_code in (200, 204):
-                        return {"success": True, "message": "原组长删除成功"}
-                    elif resp.status_code == 404:
-                        return {"success": True, "message": "成员已不存在"}
+    # 选账号、刷新 token、写邀请记录、同步计数在同一个事务中提交（SQLite 上一次 fsync），
+    # 写入在结束前不会 flush，调用 Overleaf 期间不持有数据库写锁
+    with crud.unit_of_work(db):
+        with span("account_loop"):
+            while current_attempt < max_account_attempts:
+                # 3. 获取最不活跃且有可用邀请次数的账号
+                # 重新激活时排除原组长，直接使用新组长
+                await _report(progress, "selecting_account", attempt=current_attempt + 1)
+                with span("select_account"):
+                    if is_reactivation and original_invite:
+                        acct = crud.get_available_account_exclude(db, original_invite.account_id, tried_ids)
+                        logger.info(f"重新激活：排除原组长 ID: {original_invite.account_id}")
                     else:
-                        return {"success": False, "message": f"删除失败: {resp.status_code}"}
-                
-                # 执行清理操作
-                cleanup_result = await cleanup_original_member()
-                cleanup_success = cleanup_result["success"]
-                
-                if cleanup_success:
-                    logger.info(f"原组长 {old_account.email} 清理成功: {cleanup_result['message']}")
-                else:
-                    logger.warning(f"原组长 {old_account.email} 清理失败: {cleanup_result['message']}")
-                    
-            except Exception as e:
-                logger.warning(f"原组长 {old_account.email} 清理过程出现异常：{e}")
-                cleanup_success = False
-        
-        # 记录重新激活信息
-        result["reactivation_info"] = {
-            "type": "reactivation",
-            "original_account_id": original_invite.account_id,
-            "new_account_id": successful_acct.id,
-            "original_account": old_account.email if old_account else "未知",
-            "new_account": successful_acct.email,
-            "inherited_expires_at": expires_ts,
-            "cleanup_attempted": original_invite.email_id is not None,
-            "cleanup_success": cleanup_success,
-            "strategy": "always_use_new_account"
-        }
-        
-        # 更新记录：更换到新组长，保持其他字段不变
-        crud.update_invite_expiry(db, original_invite, expires_ts, result, successful_acct)
+                        acct = crud.get_available_account(db, tried_ids)
+
+                if not acct:
+                    logger.error("所有账号均无可用邀请次数，无法邀请。")
+                    failure = HTTPException(400, "无可用账号")
+                    break
+
+                logger.info(f"第 {current_attempt + 1} 次尝试使用账号: {acct.email} (ID: {acct.id}) 邀请 {req.email}")
+
+                try:
+                    await _report(progress, "sending", account_email=acct.email, attempt=current_attempt + 1)
+                    with span("attempt", account_id=acct.id, attempt=current_attempt + 1):
+                        async with account_lock(acct.id):
+                            result, successful_acct = await try_invite_with_account(acct, req.email, expires_iso, db, card)
+                    # 如果成功，跳出循环
+                    break
+                except LeaseHeldError:
+                    # 该账号正被其他 worker / 进程长时间占用，换下一个账号
+                    logger.warning(f"账号 {acct.email} 正被其他进程使用，尝试切换账号...")
+                    last_error_detail = f"账号 {acct.email} 正被其他进程使用"
+                    tried_ids.add(acct.id)
+                    current_attempt += 1 # 增加尝试次数
+                except GroupFullError as e:
+                    # 明确是组满，记录，并尝试下一个账号
+                    logger.warning(f"账号 {acct.email} 邀请失败，原因：组已满。错误: {e}. 尝试切换账号...")
+                    last_error_detail = f"账号组 {acct.email} 已满"
+                    # 标记该组已满：在成员列表重新确认有空位之前，crud.get_available_account 会跳过它；
+                    # 本次邀请内靠 tried_ids 排除（单次事务模式下要到提交时才落库）
+                    crud.mark_group_full(db, acct)
+                    tried_ids.add(acct.id)
+                    current_attempt += 1 # 增加尝试次数
+                except InviteAttemptFailedError as e:
+                    # 其他邀请尝试失败，记录，并尝试下一个账号
+                    logger.error(f"账号 {acct.email} 邀请失败，原因：{e}. 尝试切换账号...")
+                    last_error_detail = str(e)
+                    # 标记该账号为“已尝试且失败”
+                    crud.touch_account(db, acct)
+                    tried_ids.add(acct.id)
+                    current_attempt += 1 # 增加尝试次数
+                except Exception as e:
+                    # 捕获任何未预料的异常
+                    logger.critical(f"账号 {acct.email} 邀请过程中发生未预料的错误: {type(e).__name__} - {e}. 尝试切换账号...")
+                    last_error_detail = f"未预料的错误: {e}"
+                    crud.touch_account(db, acct)
+                    tried_ids.add(acct.id)
+                    current_attempt += 1 # 增加尝试次数
+
+        if not successful_acct:
+            # 如果循环结束仍未成功（已刷新的 token 与失败账号的 updated_at 仍随本事务提交）
+            if failure is None:
+                logger.error(f"所有可用账号均已尝试，邀请最终失败。最后错误: {last_error_detail}")
+                failure = HTTPException(400, f"邀请失败：所有可用账号尝试完毕或无可用账号。详情: {last_error_detail}")
+        else:
+            # 4. 更新数据库（只有在成功发送邀请后才执行）
+            await _report(progress, "recording", account_email=successful_acct.email)
+            if is_reactivation and original_invite:
+                # 重新激活：不重复标记卡密已使用，只更新记录
+                logger.info(f"重新激活模式：更新现有记录，不重复标记卡密已使用")
+            else:
+                # 新邀请：标记卡密已使用（注意：先标记卡密再创建记录）
+                crud.mark_card_used(db, card)
+
+            # 数据库记录处理：重新激活 vs 新邀请
+            if is_reactivation and original_invite:
+                # 重新激活：直接使用新组长，清理原组长
+                old_account = db.get(models.Account, original_invite.account_id)
+
+                # 如果用户在原组长下已被接受，登记后台清理（从原组长删除成员），不在请求内等待
+                if original_invite.email_id and old_account:
+                    cleanup_item = work_queue.enqueue(db, invite_events.REACTIVATION_CLEANUP, {
+                        "invite_id": original_invite.id,
+                        "account_id": old_account.id,
+                        "email": req.email,
+                        "email_id": original_invite.email_id,
+                    }, commit=False)
+                    logger.info(f"重新激活清理：已登记后台任务从原组长 {old_account.email} 删除成员 {req.email}")
+
+                # 记录重新激活信息
+                result["reactivation_info"] = {
+                    "type": "reactivation",
+                    "original_account_id": original_invite.account_id,
+                    "new_account_id": successful_acct.id,
+                    "original_account": old_account.email if old_account else "未知",
+                    "new_account": successful_acct.email,
+                    "inherited_expires_at": expires_ts,
+                    "cleanup_attempted": cleanup_item is not None,
+                    "cleanup_status": "queued" if cleanup_item else "skipped",
+                    "cleanup_success": None,
+                    "cleanup_work_item_id": cleanup_item.id if cleanup_item else None,
+                    "strategy": "always_use_new_account"
+                }
         
-        logger.info(f"重新激活成功：{req.email} 从组长 {result['reactivation_info']['original_account']} 转移到 {successful_acct.email}")
+                # 更新记录：更换到新组长，保持其他字段不变（与清理工作项在同一次提交中落库）
+                crud.update_invite_expiry(db, original_invite, expires_ts, result, successful_acct)
         
-        # 同步账户计数
-        if old_account:
-            crud.sync_account_invites_count(db, old_account)
-        crud.sync_account_invites_count(db, successful_acct)
+                logger.info(f"重新激活成功：{req.email} 从组长 {result['reactivation_info']['original_account']} 转移到 {successful_acct.email}")
         
-    else:
-        # 新邀请：检查跨群组问题并处理
-        current_account_record = (
-            db.query(models.Invite)
-              .filter(
-                  models.Invite.email == req.email,
-                  models.Invite.account_id == successful_acct.id
-              )
-              .order_by(models.Invite.created_at.desc())
-              .first()
-        )
+                # 同步账户计数
+                if old_account:
+                    crud.sync_account_invites_count(db, old_account)
+                crud.sync_account_invites_count(db, successful_acct)
         
-        # 检查该邮箱是否存在于其他账户中（跨群组检查）
-        other_account_records = (
-            db.query(models.Invite)
-              .filter(
-                  models.Invite.email == req.email,
-                  models.Invite.account_id != successful_acct.id,
-                  models.Invite.cleaned.is_(False)  # 只检查未清理的记录
-              )
-              .all()
-        )
+            else:
+                # 新邀请：检查跨群组问题并处理（该邮箱在各组的记录连同组长账号一次查出）
+                memberships = find_memberships(db, req.email, active_only=False)
+                current_membership = latest_in_account(memberships, successful_acct.id)
+                current_account_record = current_membership.invite if current_membership else None
         
-        # 如果存在其他群组的活跃记录，记录警告但继续处理
-        if other_account_records:
-            other_accounts = []
-            for record in other_account_records:
-                other_acct = db.get(models.Account, record.account_id)
-                other_accounts.append(other_acct.email)
-            
-            logger.warning(f"⚠️  用户 {req.email} 已存在于其他群组: {', '.join(other_accounts)}")
-            logger.warning(f"   当前邀请将在新群组 {successful_acct.email} 中创建记录")
-            
-            # 在result中记录这个重要信息
-            result["cross_group_warning"] = {
-                "message": f"用户已存在于其他群组: {', '.join(other_accounts)}",
-                "existing_groups": other_accounts,
-                "current_group": successful_acct.email,
-                "action": "created_new_record_in_current_group"
-            }
+                # 如果存在其他群组的活跃记录，记录警告但继续处理
+                warning = cross_group_warning(req.email, memberships, successful_acct)
+                if warning:
+                    result["cross_group_warning"] = warning
         
-        # 根据当前账户是否有记录决定操作
-        if current_account_record:
-            # 更新当前账户的记录
-            crud.update_invite_expiry(db, current_account_record, expires_ts, result, successful_acct)
-            logger.info(f"更新了 {req.email} 在账户 {successful_acct.email} 中的记录")
-        else:
-            # 在当前账户创建新记录（即使用户在其他群组中存在）
-            crud.create_invite_record(db, successful_acct, req.email, expires_ts, True, result, card)
-            logger.info(f"为 {req.email} 在账户 {successful_acct.email} 中创建了新记录")
+                # 根据当前账户是否有记录决定操作
+                if current_account_record:
+                    # 更新当前账户的记录
+                    crud.update_invite_expiry(db, current_account_record, expires_ts, result, successful_acct)
+                    logger.info(f"更新了 {req.email} 在账户 {successful_acct.email} 中的记录")
+                else:
+                    # 在当前账户创建新记录（即使用户在其他群组中存在）
+                    crud.create_invite_record(db, successful_acct, req.email, expires_ts, True, result, card)
+                    logger.info(f"为 {req.email} 在账户 {successful_acct.email} 中创建了新记录")
             
-        # 5. 新邀请完成后，同步计数（修复计数时序问题）
-        crud.sync_account_invites_count(db, successful_acct)
-        logger.info(f"已同步账户 {successful_acct.email} 的邀请计数")
+                # 5. 新邀请完成后，同步计数（修复计数时序问题）
+                crud.sync_account_invites_count(db, successful_acct)
+                logger.info(f"已同步账户 {successful_acct.email} 的邀请计数")
+
+    if failure is not None:
+        raise failure
+    if cleanup_item:
+        work_queue.work_queue.notify()
 
     logger.info(f"成功邀请 {req.email} 使用账号 {successful_acct.email}。")
 
@@ -405,16 +481,321 @@ async def invite(req: schemas.InviteRequest, db: Session = Depends(get_db)):
     )
 
 
+
+# -------- 重新激活后的原组清理（后台工作项，类型为 invite_events.REACTIVATION_CLEANUP） --------
+
+@traced("reactivation_cleanup")
+async def cleanup_original_member(db: Session, payload: dict) -> dict:
+    """从原组长删除已接受的成员；成员已不存在（404）同样视为成功，所以可以安全重试"""
+    old_account = db.get(models.Account, payload["account_id"])
+    if old_account is None:
+        raise work_queue.PermanentError(f"原组长账号 {payload['account_id']} 不存在")
+    annotate(account_id=old_account.id)
+
+    session, new_sess, new_csrf = await open_group_session(old_account)
+    crud.update_account_tokens(db, old_account, new_csrf, new_sess)
+
+    url = f"https://www.overleaf.com/manage/groups/{old_account.group_id}/user/{payload['email_id']}"
+    with span("overleaf_delete"):
+        resp = await asyncio.to_thread(session.delete, url, headers={
+            "Accept": "application/json",
+            "x-csrf-token": new_csrf,
+            "Referer": f"https://www.overleaf.com/manage/groups/{old_account.group_id}/members",
+            "User-Agent": "Mozilla/5.0"
+        }, timeout=30)
+
+    if resp.status_code in (200, 204):
+        message = "原组长删除成功"
+    elif resp.status_code == 404:
+        message = "成员已不存在"
+    else:
+        raise RuntimeError(f"删除失败: {resp.status_code}")
+
+    logger.info(f"原组长 {old_account.email} 清理 {payload['email']} 成功: {message}")
+    return {"success": True, "message": message}
+
+
+def report_reactivation_cleanup(db: Session, payload: dict, outcome: dict) -> None:
+    """
+    清理进展：reactivation_info 中的 cleanup_* 字段保存当前状态（记录列表直接可见），
+    每次进展另追加一条 reactivation_cleanup 事件保留历史
+    """
+    invite = db.get(models.Invite, payload["invite_id"])
+    if invite is None:
+        return
+    if outcome["status"] == "succeeded":
+        fields = {"message": outcome["result"]["message"]}
+    elif outcome["status"] == "failed":
+        fields = {"message": outcome["error"]}
+    else:
+        fields = {"message": outcome["error"], "next_retry_at": outcome["next_run_at"]}
+    invite_events.record(db, invite, invite_events.REACTIVATION_CLEANUP, detail=outcome["status"],
+                         attempts=outcome["attempts"], **fields)
+
+    data = invite_result.parse(invite.result)
+    info = data.get("reactivation_info")
+    if not isinstance(info, dict):
+        return
+    info["cleanup_status"] = outcome["status"]
+    info["cleanup_attempts"] = outcome["attempts"]
+    info["cleanup_message"] = fields["message"]
+    if outcome["status"] in ("succeeded", "failed"):
+        info["cleanup_success"] = outcome["status"] == "succeeded"
+        info["cleanup_finished_at"] = int(time.time())
+        info.pop("cleanup_next_retry_at", None)
+    else:
+        info["cleanup_next_retry_at"] = outcome["next_run_at"]
+    invite_result.update(invite, reactivation_info=info)
+
+
+work_queue.register(invite_events.REACTIVATION_CLEANUP, cleanup_original_member, report=report_reactivation_cleanup)
+
+
+# -------- 批量邀请 --------
+
+BATCH_MAX_ROUNDS = 3  # 失败条目最多换账号重试的轮数
+
+
+def load_account_capacity(db: Session) -> Dict[int, int]:
+    """
+    一次聚合查询算出所有账号的剩余名额（InviteStatusManager.active_counts，与 calculate_invites_sent 同规则），
+    避免逐账号查询，也不把邀请记录加载到内存
+    """
+    now_ts = int(time.time())
+    counts = InviteStatusManager.active_counts(db, now_ts=now_ts)
+    spare = {
+        acct: (acct.max_invites or 0) - counts.get(acct.id, 0)
+        for acct in db.query(models.Account).all()
+    }
+
+    capacity = {}
+    # 与 crud.get_available_account 相同的顺序：热会话优先，再按剩余名额多少、最久未使用
+    for acct in sorted(spare, key=lambda a: routing_key(a, now_ts, spare[a])):
+        seats = max(0, spare[acct])
+        if seats and is_known_full(acct, now_ts):
+            # Overleaf 上已知满员：不分配（计数随本批次的写库一起提交）
+            acct.group_full_avoided = (acct.group_full_avoided or 0) + 1
+            seats = 0
+        capacity[acct.id] = seats
+    return capacity
+
+
+def allocate_seats(
+    capacity: Dict[int, int],
+    item_ids: List[int],
+    excluded: Dict[int, set]
+):
+    """
+    一次规划：每个条目分给剩余名额最多、且该条目还没试过的账号（同分按 capacity 的插入顺序，
+    即 routing_key：热会话优先、再按剩余名额、最久未使用），使负载尽量均匀。返回 ({account_id: [item_id]}, [无法分配的 item_id])
+    """
+    remaining = dict(capacity)
+    order = {account_id: i for i, account_id in enumerate(capacity)}
+    allocation: Dict[int, List[int]] = defaultdict(list)
+    unplaced = []
+    for item_id in item_ids:
+        candidates = [
+            account_id for account_id, seats in remaining.items()
+            if seats > 0 and account_id not in excluded.get(item_id, ())
+        ]
+        if not candidates:
+            unplaced.append(item_id)
+            continue
+        best = min(candidates, key=lambda a: (-remaining[a], order[a]))
+        allocation[best].append(item_id)
+        remaining[best] -= 1
+    return dict(allocation), unplaced
+
+
+async def send_account_batch(
+    acct: models.Account,
+    batch: List[tuple],
+    semaphore: asyncio.Semaphore
+):
+    """
+    用同一个已认证 session 依次发送该账号的全部邀请。
+    batch: [(item_id, email, expires_iso)]。
+    返回 (tokens, sent, retry, group_full)：tokens 为 (session_cookie, csrf) 或 None，
+    sent: {item_id: result}，retry: {item_id: 错误信息}
+    """
+    async with semaphore:
+        try:
+            async with account_lock(acct.id):
+                return await _send_account_batch(acct, batch)
+        except LeaseHeldError:
+            logger.warning(f"批量邀请：账号 {acct.email} 正被其他进程使用，条目改用其他账号")
+            return None, {}, {item_id: f"账号 {acct.email} 正被其他进程使用" for item_id, _, _ in batch}, False
+
+
+async def _send_account_batch(acct: models.Account, batch: List[tuple]):
+    sent, retry = {}, {}
+    try:
+        with span("batch_open_session", account_id=acct.id):
+            session, new_sess, new_csrf = await open_group_session(acct)
+    except Exception as e:
+        logger.error(f"批量邀请：账号 {acct.email} 登录失败: {e}")
+        return None, sent, {item_id: f"账号 {acct.email} 登录失败: {e}" for item_id, _, _ in batch}, False
+
+    for pos, (item_id, email, expires_iso) in enumerate(batch):
+        try:
+            with span("batch_send_invite", account_id=acct.id):
+                sent[item_id] = await asyncio.to_thread(
+                    send_invite, session, new_csrf, acct.group_id, email, expires_iso
+                )
+        except GroupFullError:
+            logger.warning(f"批量邀请：账号组 {acct.email} 已满，剩余 {len(batch) - pos} 个条目改用其他账号")
+            for rest_id, _, _ in batch[pos:]:
+                retry[rest_id] = f"账号组 {acct.email} 已满"
+            return (new_sess, new_csrf), sent, retry, True
+        except InviteAttemptFailedError as e:
+            retry[item_id] = str(e)
+    return (new_sess, new_csrf), sent, retry, False
+
+
+@router.post("/batch", response_model=schemas.BatchInviteResponse)
+async def batch_invite(body: schemas.BatchInviteRequest, db: Session = Depends(get_db)):
+    """
+    批量邀请（只处理未使用的新卡密；重新激活请使用 /reactivate）：
+    1. 一次查询校验全部卡密
+    2. 一次规划把条目分配到各组长账号
+    3. 每个账号复用一个已认证 session 顺序发送，账号之间按 concurrency 并行
+    4. 失败条目换其他账号重试（最多 BATCH_MAX_ROUNDS 轮），返回逐条结果
+    """
+    items = body.items
+    results = [
+        schemas.BatchInviteItemResult(email=item.email, card=item.card, success=False)
+        for item in items
+    ]
+
+    # 1. 校验卡密
+    codes = {item.card for item in items}
+    cards = {c.code: c for c in db.query(models.Card).filter(models.Card.code.in_(codes)).all()}
+    pending, seen_codes, seen_emails = [], set(), set()
+    for item_id, item in enumerate(items):
+        card = cards.get(item.card)
+        email_key = models.normalize_email(item.email)
+        if not card:
+            results[item_id].error = "卡密不存在"
+        elif card.used:
+            results[item_id].error = "卡密已使用（重新激活请使用 /api/v1/invite/reactivate）"
+        elif item.card in seen_codes:
+            results[item_id].error = "同一卡密在本批次中重复"
+        elif email_key in seen_emails:
+            results[item_id].error = "同一邮箱在本批次中重复"
+        else:
+            seen_codes.add(item.card)
+            seen_emails.add(email_key)
+            pending.append(item_id)
+
+    now = datetime.now()
+    expires = {
+        item_id: now + timedelta(days=cards[items[item_id].card].days)
+        for item_id in pending
+    }
+
+    # 2. 规划
+    capacity = load_account_capacity(db)
+    accounts = {a.id: a for a in db.query(models.Account).filter(models.Account.id.in_(capacity)).all()}
+    tried: Dict[int, set] = defaultdict(set)
+    semaphore = asyncio.Semaphore(body.concurrency)
+    touched_accounts = set()
+
+    for round_no in range(1, BATCH_MAX_ROUNDS + 1):
+        if not pending:
+            break
+        allocation, unplaced = allocate_seats(capacity, pending, tried)
+        for item_id in unplaced:
+            results[item_id].error = results[item_id].error or "无可用账号"
+        logger.info(f"批量邀请第 {round_no} 轮：{len(pending) - len(unplaced)} 个条目分配到 {len(allocation)} 个账号")
+
+        account_ids = list(allocation)
+        outcomes = await asyncio.gather(*(
+            send_account_batch(
+                accounts[account_id],
+                [(item_id, items[item_id].email, expires[item_id].isoformat()) for item_id in allocation[account_id]],
+                semaphore
+            )
+            for account_id in account_ids
+        ))
+
+        # 3. 写库：每轮一个事务，与单条邀请共用 crud 的写函数
+        pending = []
+        sent_emails = [items[item_id].email for outcome in outcomes for item_id in outcome[1]]
+        # 已发送邮箱在各组的记录一次查出（按 email_key 比较）：复用本组的最新记录、检查跨群组
+        memberships = find_memberships_many(db, sent_emails, active_only=False) if sent_emails else {}
+
+        with crud.unit_of_work(db):
+            for account_id, (tokens, sent, retry, group_full) in zip(account_ids, outcomes):
+                acct = accounts[account_id]
+                crud.touch_account(db, acct)
+                if tokens:
+                    session_cookie, csrf_token = tokens
+                    crud.update_account_tokens(db, acct, csrf_token, session_cookie)
+                if group_full:
+                    crud.mark_group_full(db, acct)
+                touched_accounts.add(account_id)
+                capacity[account_id] = 0 if group_full else capacity[account_id] - len(sent)
+
+                for item_id, result in sent.items():
+                    item = items[item_id]
+                    card = cards[item.card]
+                    expires_ts = int(expires[item_id].timestamp())
+                    crud.mark_card_used(db, card)
+                    email_memberships = memberships.get(models.normalize_email(item.email), [])
+                    warning = cross_group_warning(item.email, email_memberships, acct)
+                    if warning:
+                        result["cross_group_warning"] = warning
+                    current = latest_in_account(email_memberships, account_id)
+                    if current:
+                        crud.update_invite_expiry(db, current.invite, expires_ts, result)
+                        current.invite.card_id = card.id
+                    else:
+                        crud.create_invite_record(db, acct, item.email, expires_ts, True, result, card)
+                    tried[item_id].add(account_id)
+                    results[item_id] = schemas.BatchInviteItemResult(
+                        email=item.email, card=item.card, success=True,
+                        account_email=acct.email, expires_ts=expires_ts,
+                        attempts=len(tried[item_id]),
+                        warning=warning["message"] if warning else None
+                    )
+
+                for item_id, error in retry.items():
+                    tried[item_id].add(account_id)
+                    results[item_id].attempts = len(tried[item_id])
+                    results[item_id].error = error
+                    pending.append(item_id)
+
+    # 4. 同步涉及账号的计数（一次聚合查询）
+    if touched_accounts:
+        counts = InviteStatusManager.active_counts(db, list(touched_accounts))
+        for account_id in touched_accounts:
+            accounts[account_id].invites_sent = counts.get(account_id, 0)
+        db.commit()
+
+    success_count = sum(1 for r in results if r.success)
+    logger.info(f"批量邀请完成：成功 {success_count}/{len(items)}")
+    return schemas.BatchInviteResponse(
+        total=len(items),
+        success_count=success_count,
+        failed_count=len(items) - success_count,
+        accounts_used=len({r.account_email for r in results if r.success}),
+        results=results
+    )
+
+
 @router.get("/records", response_model=List[schemas.InviteRecord])
 def list_invites(
     page: int = Query(1, ge=1),
     size: int = Query(50, ge=1),
     email: Optional[str] = Query(None),
+    processed_reason: Optional[str] = Query(None, description="按 result 中的处理原因筛选，如 expired"),
     db: Session = Depends(get_db)
 ):
     q = db.query(models.Invite)
     if email:
         q = q.filter(models.Invite.email == email)
+    if processed_reason:
+        q = q.filter(invite_result.field("processed_reason") == processed_reason)
     return (
         q.order_by(models.Invite.created_at.desc())
          .offset((page - 1) * size)
@@ -422,6 +803,12 @@ def list_invites(
          .all()
     )
 
+
+@router.get("/records/{invite_id}/events", response_model=List[schemas.InviteEventRecord])
+def list_invite_events(invite_id: int, db: Session = Depends(get_db)):
+    """记录的生命周期事件（记录已删除或归档后仍可查询）"""
+    return invite_events.history(db, invite_id)
+
 # -------- 新增：修改邀请过期时间的接口 --------
 @router.post("/update_expiration", response_model=schemas.UpdateExpirationResponse)
 async def update_invite_expiration(
@@ -466,34 +853,26 @@ def detect_card_status(
 ):
     """
     检测卡密状态，判断是新邀请还是重新激活模式
+    （只读判断，可以使用 card_state 的短期缓存）
     """
-    import time
-    
-    # 查找卡密
-    card_obj = db.query(models.Card).filter(models.Card.code == card).first()
-    
-    if not card_obj:
+    state = card_state.resolve(db, card)
+    mode = state.mode()
+
+    if mode == card_state.MISSING:
         return schemas.CardDetectResponse(
             mode="normal",
             can_reactivate=False,
             message="卡密不存在"
         )
     
-    if not card_obj.used:
+    if mode == card_state.NEW:
         return schemas.CardDetectResponse(
             mode="normal",
             can_reactivate=False,
             message="新卡密，请输入邮箱进行首次邀请"
         )
     
-    # 查找该卡密关联的邀请记录
-    invite_record = (
-        db.query(models.Invite)
-        .filter(models.Invite.card_id == card_obj.id)
-        .first()
-    )
-    
-    if not invite_record:
+    if mode == card_state.UNBOUND:
         return schemas.CardDetectResponse(
             mode="normal",
             can_reactivate=False,
@@ -501,8 +880,7 @@ def detect_card_status(
         )
     
     # 检查权益是否有效
-    now_ts = int(time.time())
-    if invite_record.expires_at <= now_ts:
+    if mode == card_state.EXPIRED:
         return schemas.CardDetectResponse(
             mode="normal",
             can_reactivate=False,
@@ -510,16 +888,15 @@ def detect_card_status(
         )
     
     # 计算剩余天数
-    remaining_seconds = invite_record.expires_at - now_ts
-    remaining_days = max(1, int(remaining_seconds / 86400))
+    remaining_days = state.remaining_days()
     
     return schemas.CardDetectResponse(
         mode="reactivate",
-        email=invite_record.email,
+        email=state.email,
         remaining_days=remaining_days,
-        expires_at=invite_record.expires_at,
+        expires_at=state.expires_at,
         can_reactivate=True,
-        message=f"检测到绑定邮箱：{invite_record.email}，剩余{remaining_days}天权益"
+        message=f"检测到绑定邮箱：{state.email}，剩余{remaining_days}天权益"
     )
 
 
@@ -527,47 +904,50 @@ def detect_card_status(
 @router.post("/reactivate", response_model=schemas.InviteResponse)
 async def reactivate_by_card_only(
     req: schemas.ReactivateRequest,
+    mode: str = Query("sync", pattern="^(sync|async)$", description="sync: 等待完成；async: 立即返回任务ID"),
+    idempotency_key: Optional[str] = Header(None, alias=idempotency.IDEMPOTENCY_HEADER),
     db: Session = Depends(get_db)
 ):
     """
     通过卡密一键重新激活，自动识别绑定的邮箱
     """
-    import time
-    
-    # 1. 验证卡密和查找关联邮箱
-    card = db.query(models.Card).filter(models.Card.code == req.card).first()
-    if not card:
+    # 只在客户端传 Idempotency-Key 时去重：同一卡密之后再次重新激活是正当的新请求
+    return await idempotency.run_idempotent(
+        "reactivate", idempotency_key, None,
+        req, lambda: _reactivate(req, mode, db)
+    )
+
+
+async def _reactivate(req: schemas.ReactivateRequest, mode: str, db: Session):
+    # 1~3. 验证卡密、查找关联邮箱、验证权益（找绑定邮箱可以用短期缓存，
+    # 真正发邀请前 validate_invite_card 会在同一事务内重新读一次数据库）
+    state = card_state.resolve(db, req.card)
+    card_mode = state.mode()
+    if card_mode == card_state.MISSING:
         logger.warning(f"重新激活失败：卡密不存在 '{req.card}'")
         raise HTTPException(400, "卡密不存在")
     
-    if not card.used:
+    if card_mode == card_state.NEW:
         logger.warning(f"重新激活失败：卡密尚未使用过 '{req.card}'")
         raise HTTPException(400, "该卡密尚未使用过，请使用正常邀请流程")
     
-    # 2. 查找该卡密关联的邮箱
-    invite_record = (
-        db.query(models.Invite)
-        .filter(models.Invite.card_id == card.id)
-        .first()
-    )
-    
-    if not invite_record:
+    if card_mode == card_state.UNBOUND:
         logger.warning(f"重新激活失败：找不到卡密关联的邀请记录 '{req.card}'")
         raise HTTPException(400, "找不到该卡密的使用记录")
     
-    # 3. 验证权益是否还有效
-    now_ts = int(time.time())
-    if invite_record.expires_at <= now_ts:
-        logger.warning(f"重新激活失败：权益已过期 '{req.card}' for {invite_record.email}")
+    if card_mode == card_state.EXPIRED:
+        logger.warning(f"重新激活失败：权益已过期 '{req.card}' for {state.email}")
         raise HTTPException(400, "权益已过期，请购买新卡密")
     
-    logger.info(f"检测到一键重新激活请求：卡密 {req.card} → 邮箱 {invite_record.email}")
+    logger.info(f"检测到一键重新激活请求：卡密 {req.card} → 邮箱 {state.email}")
     
     # 4. 构造邀请请求并调用原有逻辑
     fake_request = schemas.InviteRequest(
-        email=invite_record.email,
+        email=state.email,
         card=req.card
     )
     
     # 调用原有的邀请逻辑（会自动检测为重新激活）
-    return await invite(fake_request, db)
\ No newline at end of file
+    if mode == "async":
+        return enqueue_invite_job(fake_request, db)
+    return await run_invite(fake_request, db)
\ No newline at end of file
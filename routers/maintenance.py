@@ -1,9 +1,20 @@
-from fastapi import APIRouter, Depends, Query
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi.responses import PlainTextResponse
 from sqlalchemy.orm import Session
 
 import crud, schemas
 from database import SessionLocal
 from invite_status_manager import InviteStatusManager
+from job_coordinator import JobLease, LeaseHeldError, SCOPE_CLEANUP, SCOPE_ARCHIVE, list_job_status
+import tracing
+from expiry_scheduler import expiry_scheduler
+import outbox
+import archive
+import cleanup_plan
+from maintenance_daemon import maintenance_daemon
+from settings import settings
 
 router = APIRouter(
     prefix="/api/v1/maintenance",
@@ -21,6 +32,9 @@ def get_db():
 def cleanup_expired(
     delete_records: bool = Query(True, description="是否真正删除记录（默认True）"),
     limit: int = Query(100, description="单次处理的最大数量"),
+    stream: bool = Query(False, description="流式清理全部积压（忽略 limit）"),
+    chunk_size: int = Query(1000, ge=1, le=10000, description="流式清理每块的记录数"),
+    dry_run: bool = Query(False, description="只生成执行计划，不处理"),
     db: Session = Depends(get_db)
 ):
     """
@@ -28,8 +42,26 @@ def cleanup_expired(
     
     - delete_records=True: 真正删除记录（推荐）
     - delete_records=False: 只标记为已清理（兼容旧模式）
+    - stream=True: 按 (expires_at, id) 游标分块处理全部过期记录，每块一条语句并提交，最后对受影响账户各重新计数一次；
+      进度见 GET /api/v1/maintenance/jobs 的 cleanup 任务
+    - dry_run=True: 返回按账号的执行计划（plan），可原样提交给 POST /cleanup_plan/execute 执行
     """
-    stats = InviteStatusManager.batch_cleanup_expired(db, limit=limit, delete_records=delete_records)
+    if dry_run:
+        mode = cleanup_plan.MODE_DELETE_RECORDS if delete_records else cleanup_plan.MODE_MARK_PROCESSED
+        plan = cleanup_plan.build_plan(db, limit=None if stream else limit, mode=mode)
+        return {"cleaned": 0, "stats": {"total_found": len(plan.invite_ids)}, "plan": plan.to_dict()}
+
+    try:
+        with JobLease(SCOPE_CLEANUP).hold_sync() as lease:
+            if stream:
+                stats = InviteStatusManager.stream_cleanup_expired(
+                    db, chunk_size=chunk_size, delete_records=delete_records,
+                    progress=lambda done, total, item: lease.update_progress(completed=done, total=total)
+                )
+            else:
+                stats = InviteStatusManager.batch_cleanup_expired(db, limit=limit, delete_records=delete_records)
+    except LeaseHeldError:
+        raise HTTPException(status_code=400, detail="清理任务正在进行中，请等待完成")
     
     # 兼容旧的响应格式
     cleaned = stats["deleted_records"] + stats["marked_processed"]
@@ -38,3 +70,123 @@ def cleanup_expired(
         "cleaned": cleaned,
         "stats": stats
     }
+
+
+@router.post("/cleanup_plan/execute", response_model=schemas.CleanupResponse)
+async def execute_cleanup_plan(plan: schemas.CleanupPlan, db: Session = Depends(get_db)):
+    """
+    执行各清理接口 dry_run 返回的计划（见 cleanup_plan.py）：只处理计划中仍然过期且未清理的记录，
+    期间已续期或已被清理的计入 stats.skipped；持有 cleanup 租约
+    """
+    lease = JobLease(SCOPE_CLEANUP)
+    try:
+        async with lease.hold():
+            result = await cleanup_plan.execute_plan(
+                db, cleanup_plan.CleanupPlan.from_dict(plan.model_dump()),
+                progress=lease.update_progress_async
+            )
+    except LeaseHeldError:
+        raise HTTPException(status_code=400, detail="清理任务正在进行中，请等待完成")
+    return result
+
+
+@router.get("/jobs")
+def list_jobs():
+    """
+    查看所有后台任务租约（sync / cleanup / email_ids ...）的持有者与进度，
+    数据来自 job_leases 表，任意 worker 返回一致
+    """
+    return {"jobs": list_job_status()}
+
+
+@router.get("/expiry_schedule")
+def expiry_schedule():
+    """
+    到期调度状态：本进程登记了多少条待到期记录、下一次触发时间、上一批的清理结果
+    """
+    return expiry_scheduler.status()
+
+
+@router.get("/outbox")
+def outbox_summary(db: Session = Depends(get_db)):
+    """
+    Overleaf 变更 outbox：各状态（pending / dispatching / done / failed / superseded）的意图数量、
+    最早未完成意图已等待的秒数、最近放弃的意图
+    """
+    return outbox.outbox_status(db)
+
+
+@router.get("/daemon")
+def daemon_status():
+    """
+    维护服务中各定时任务的计划、下一次执行时间与上一次执行结果（本进程）
+    """
+    return maintenance_daemon.status()
+
+
+@router.post("/daemon/{name}/run")
+def run_daemon_job(name: str):
+    """
+    立即执行一次某个定时任务（后台执行，结果见 GET /daemon 的 last_run）；
+    同一租约的任务正在其他进程执行时，本次记为 skipped
+    """
+    if name not in maintenance_daemon.jobs:
+        raise HTTPException(status_code=404, detail=f"未知的维护任务: {name}")
+    if not maintenance_daemon.trigger(name):
+        raise HTTPException(status_code=400, detail="任务正在执行中或维护服务未启动")
+    return {"name": name, "status": "triggered"}
+
+
+@router.post("/archive")
+def archive_history(
+    older_than_days: int = Query(settings.ARCHIVE_AFTER_DAYS, ge=1, description="已清理且过期超过多少天的记录"),
+    dry_run: bool = Query(False, description="只统计可归档的数量"),
+    db: Session = Depends(get_db)
+):
+    """
+    把已处理的历史邀请记录从 invites 移到 invites_archive（分块 INSERT ... SELECT + DELETE），
+    不需要备份整个数据库；不会改变账户计数与卡密判断
+    """
+    try:
+        with JobLease(SCOPE_ARCHIVE).hold_sync() as lease:
+            return archive.archive_processed(
+                db, older_than_days=older_than_days, dry_run=dry_run,
+                progress=lambda done, total, item: lease.update_progress(completed=done, total=total)
+            )
+    except LeaseHeldError:
+        raise HTTPException(status_code=400, detail="归档任务正在进行中，请等待完成")
+
+
+@router.get("/archive")
+def search_archive(
+    email: Optional[str] = Query(None, description="被邀请邮箱"),
+    card: Optional[str] = Query(None, description="卡密"),
+    account_email: Optional[str] = Query(None, description="组长邮箱"),
+    page: int = Query(1, ge=1),
+    size: int = Query(50, ge=1, le=500),
+    db: Session = Depends(get_db)
+):
+    """按邮箱 / 卡密 / 组长邮箱检索已归档的邀请记录，按创建时间倒序"""
+    if not (email or card or account_email):
+        raise HTTPException(status_code=400, detail="请至少提供 email、card、account_email 之一")
+    return archive.search_archive(db, email=email, card=card, account_email=account_email,
+                                  limit=size, offset=(page - 1) * size)
+
+
+@router.get("/archive/stats")
+def archive_stats(db: Session = Depends(get_db)):
+    """热表行数、其中已清理的行数、当前可归档的行数与归档表规模"""
+    return archive.archive_status(db)
+
+
+@router.get("/metrics")
+def stage_metrics(
+    format: str = Query("json", pattern="^(json|prometheus)$", description="json 或 prometheus 文本格式")
+):
+    """
+    邀请 / 删除流程各阶段（get_tokens、验证码、登录、刷新 token、发送、删除……）的耗时直方图，
+    按 span 路径分组（如 invite.account_loop.attempt.perform_login）；统计的是本进程自启动以来的数据
+    """
+    if format == "prometheus":
+        return PlainTextResponse(tracing.metrics.render_prometheus())
+    return {"buckets": list(tracing.BUCKETS), "stages": tracing.metrics.snapshot()}
@@ -3,7 +3,6 @@
 手动用户管理API路由 - 管理expires_at=NULL的手动添加用户
 """
 
-import json
 import time
 from datetime import datetime, timedelta
 from typing import List, Optional, Dict
@@ -15,6 +14,8 @@ from sqlalchemy import and_
 from database import SessionLocal
 from invite_status_manager import InviteStatusManager
 import models
+import invite_result
+import invite_events
 
 # 创建路由器
 router = APIRouter(prefix="/api/v1/manual-users", tags=["手动用户管理"])
@@ -92,12 +93,7 @@ async def list_manual_users(
     manual_users = []
     for invite in invites:
         # 解析result中的额外信息
-        result_data = {}
-        if invite.result:
-            try:
-                result_data = json.loads(invite.result)
-            except:
-                pass
+        result_data = invite_result.parse(invite.result)
         
         manual_users.append(ManualUser(
             id=invite.id,
@@ -185,25 +181,9 @@ async def set_user_expiry(
     if request.card_id:
         invite.card_id = request.card_id
     
-    # 更新result信息
-    result_data = {}
-    if invite.result:
-        try:
-            result_data = json.loads(invite.result)
-        except:
-            pass
-    
-    result_data.update({
-        "expiry_set_date": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        "expires_at": expiry_date.strftime('%Y-%m-%d %H:%M:%S'),
-        "expiry_days": request.days,
-        "card_id_assigned": request.card_id,
-        "status": "active_with_expiry",
-        "note": request.note or result_data.get('note', ''),
-        "warning": "现在有过期时间，到期会被正常清理删除"
-    })
-    
-    invite.result = json.dumps(result_data, ensure_ascii=False)
+    # 记录事件（result 保留导入时的信息，不再改写）
+    invite_events.record(db, invite, invite_events.EXPIRY_SET, expires_at=expires_at,
+                         days=request.days, card_id=request.card_id, note=request.note)
     
     # 重新计算账户邀请计数
     manager = InviteStatusManager()
@@ -254,26 +234,9 @@ async def bulk_set_expiry(
         if request.card_id:
             invite.card_id = request.card_id
         
-        # 更新result信息
-        result_data = {}
-        if invite.result:
-            try:
-                result_data = json.loads(invite.result)
-            except:
-                pass
-        
-        result_data.update({
-            "expiry_set_date": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            "expires_at": expiry_date.strftime('%Y-%m-%d %H:%M:%S'),
-            "expiry_days": request.days,
-            "card_id_assigned": request.card_id,
-            "status": "active_with_expiry",
-            "note": request.note or result_data.get('note', ''),
-            "warning": "现在有过期时间，到期会被正常清理删除",
-            "bulk_operation": True
-        })
-        
-        invite.result = json.dumps(result_data, ensure_ascii=False)
+        # 记录事件（result 保留导入时的信息，不再改写）
+        invite_events.record(db, invite, invite_events.EXPIRY_SET, expires_at=expires_at,
+                             days=request.days, card_id=request.card_id, note=request.note, bulk=True)
         
         updated_users.append({
             "email": invite.email,
@@ -323,22 +286,9 @@ async def delete_manual_user(
     # 标记为已清理
     invite.cleaned = True
     
-    # 更新result信息
-    result_data = {}
-    if invite.result:
-        try:
-            result_data = json.loads(invite.result)
-        except:
-            pass
-    
-    result_data.update({
-        "deleted_date": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        "delete_reason": reason,
-        "status": "manually_deleted",
-        "note": f"手动删除: {reason}"
-    })
-    
-    invite.result = json.dumps(result_data, ensure_ascii=False)
+    # 处理原因写入 result（当前状态），删除说明记为事件
+    invite_result.update(invite, processed_at=int(time.time()), processed_reason="manually_deleted")
+    invite_events.record(db, invite, invite_events.PROCESSED, detail="manually_deleted", note=reason)
     
     # 重新计算账户邀请计数
     manager = InviteStatusManager()
@@ -370,12 +320,7 @@ async def get_manual_user_details(
         raise HTTPException(status_code=404, detail="用户不存在")
     
     # 解析result数据
-    result_data = {}
-    if invite.result:
-        try:
-            result_data = json.loads(invite.result)
-        except:
-            pass
+    result_data = invite_result.parse(invite.result)
     
     return {
         "id": invite.id,
@@ -390,5 +335,6 @@ async def get_manual_user_details(
         "created_at": datetime.fromtimestamp(invite.created_at).strftime('%Y-%m-%d %H:%M:%S'),
         "success": invite.success,
         "result_data": result_data,
+        "events": [invite_events.to_dict(e) for e in invite_events.history(db, invite.id)],
         "status": InviteStatusManager.get_invite_status(invite).value
     }
\ No newline at end of file
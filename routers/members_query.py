@@ -8,6 +8,7 @@ from sqlalchemy.orm import Session
 
 import models, schemas # 引入 models 和 schemas
 from database import SessionLocal # 引入 SessionLocal
+from memberships import find_memberships
 
 router = APIRouter(prefix="/api/v1/members_query", tags=["members_query"]) # 修改了 prefix 和 tags
 
@@ -77,4 +78,23 @@ def get_leader_group_members(
         total_members_in_db=total_members_in_db,
         active_members=active_members_list,
         expired_members_count=expired_members_count
-    )
\ No newline at end of file
+    )
+
+
+@router.get("/memberships/{email}", response_model=schemas.MembershipsResponse)
+def get_memberships(
+    email: str,
+    include_cleaned: bool = Query(False, description="是否包含已清理的历史记录"),
+    db: Session = Depends(get_db)
+):
+    """
+    查询某个邮箱在各组中的邀请记录（连同组长账号），用于跨组检查。
+    """
+    memberships = find_memberships(db, email, active_only=not include_cleaned)
+    active_accounts = {m.account.id for m in memberships if not m.invite.cleaned}
+    return {
+        "email": email,
+        "total": len(memberships),
+        "cross_group": len(active_accounts) > 1,
+        "memberships": [m.to_dict() for m in memberships],
+    }
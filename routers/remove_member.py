@@ -1,23 +1,25 @@
 import logging
-import requests
 import asyncio
-import json  # 新增：用于处理 JSON 响应
-from fastapi import APIRouter, Depends, HTTPException
+from collections import OrderedDict
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Header, Query
 from sqlalchemy.orm import Session
 
-import models, schemas, crud
+import models, schemas
 from database import SessionLocal
-from invite_status_manager import InviteStatusManager, TransactionManager
-from overleaf_utils import (
-    get_tokens,
-    get_captcha_token,
-    perform_login,
-    refresh_session,
-    get_new_csrf
-)
+from invite_status_manager import InviteStatusManager
+from job_coordinator import JobLease, LeaseHeldError, SCOPE_CLEANUP
+import idempotency
+import cleanup_engine
+import cleanup_plan
+import outbox
+from memberships import find_memberships, find_memberships_many
+from tracing import traced, collect, annotate
 
 router = APIRouter(prefix="/api/v1/member", tags=["members"])
 
+WAIT_POLL_TIMES = 120  # wait=true 且意图已被后台 worker 认领时，最多等待约 60 秒
+
 # 定义一个日志器 (如果此文件还没有)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)  # 可以根据需要调整日志级别
@@ -36,47 +38,51 @@ def get_db():
 
 
 @router.post("/remove", response_model=schemas.RemoveMemberResponse)
-async def remove_member(
+async def remove_member_endpoint(
         body: schemas.MemberEmailRequest,
+        debug: bool = Query(False, description="在响应的 timings 中返回本次请求各阶段耗时"),
+        wait: bool = Query(False, description="等待 Overleaf 上执行完成再返回（默认登记后立即返回）"),
+        idempotency_key: Optional[str] = Header(None, alias=idempotency.IDEMPOTENCY_HEADER),
         db: Session = Depends(get_db)
+):
+    """
+    删除成员；传 Idempotency-Key 时超时重试直接返回第一次的结果。
+    未传时不去重：删除 → 重新邀请 → 再删除同一邮箱是正当的新操作
+    """
+    with collect() as trace:
+        response = await idempotency.run_idempotent(
+            "remove", idempotency_key, None,
+            body, lambda: remove_member(body, db, wait)
+        )
+    if debug and isinstance(response, schemas.RemoveMemberResponse):
+        response.timings = trace.breakdown()
+    return response
+
+
+@traced("remove")
+async def remove_member(
+        body: schemas.MemberEmailRequest,
+        db: Session,
+        wait: bool = False
 ):
     """
     通过 email_id 从 Overleaf 组中移除已接受邀请的成员。
     使用新的状态管理和事务处理逻辑。
     """
-    # 1. 查找最新的可删除邀请记录（只查找未清理的活跃记录）
-    invite = (
-        db.query(models.Invite)
-        .filter(
-            models.Invite.email == body.email,
-            models.Invite.cleaned.is_(False)  # 只查找未清理的记录
-        )
-        .order_by(models.Invite.created_at.desc())
-        .first()
-    )
+    # 1. 查找最新的可删除邀请记录（只查找未清理的活跃记录，连同组长账号一次查出）
+    memberships = find_memberships(db, body.email)
     
     # 检查是否存在跨群组的重复用户
-    all_active_records = (
-        db.query(models.Invite)
-        .filter(
-            models.Invite.email == body.email,
-            models.Invite.cleaned.is_(False)
-        )
-        .all()
-    )
-    
-    if len(all_active_records) > 1:
+    if len(memberships) > 1:
         # 如果存在多个活跃记录，记录警告
-        account_emails = []
-        for record in all_active_records:
-            acct = db.get(models.Account, record.account_id)
-            account_emails.append(acct.email)
-        
+        account_emails = [m.account_email for m in memberships]
         logger.warning(f"⚠️  用户 {body.email} 存在于多个群组中: {', '.join(account_emails)}")
         logger.warning(f"   将删除最新记录，其他群组中的记录需要手动处理")
     
-    if not invite:
+    if not memberships:
         raise HTTPException(status_code=404, detail="未找到邀请记录")
+    invite, acct = memberships[0].invite, memberships[0].account
+    annotate(account_id=acct.id)
     
     # 2. 使用状态管理器检查是否可删除
     if not InviteStatusManager.is_removable(invite):
@@ -86,271 +92,179 @@ async def remove_member(
             detail=f"邀请不可删除，当前状态: {status.value}"
         )
 
-    # 3. 获取账户信息
-    acct = db.get(models.Account, invite.account_id)
-    if not acct:
-        raise HTTPException(status_code=500, detail="找不到邀请账户信息")
-
-    # 4. 定义删除操作函数
-    async def perform_overleaf_deletion():
-        session = requests.Session()
-        new_sess = acct.session_cookie
-        new_csrf = acct.csrf_token
-
-        # 尝试复用已有的 session/CSRF
-        if new_sess and new_csrf:
-            session.cookies.set(
-                "overleaf_session2", new_sess,
-                domain=".overleaf.com", path="/"
-            )
-            try:
-                new_sess = await asyncio.to_thread(refresh_session, session, new_csrf)
-                new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
-            except Exception as e:
-                logger.warning(f"账号 {acct.email} session/CSRF 刷新失败: {e}. 将尝试完整登录。")
-                new_sess = new_csrf = None
-
-        # 如复用失败，完整登录流程
-        if not (new_sess and new_csrf):
-            csrf0, sess0 = await get_tokens()
-            captcha = get_captcha_token()
-            session = await asyncio.to_thread(
-                perform_login, csrf0, sess0,
-                acct.email, acct.password, captcha
-            )
-            new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-            new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
-
-        # 更新数据库中的 token
-        crud.update_account_tokens(db, acct, new_csrf, new_sess)
-
-        # 调用 Overleaf API 删除组员
-        url = f"https://www.overleaf.com/manage/groups/{acct.group_id}/user/{invite.email_id}"
-        
-        logger.info(f"尝试从 Overleaf 删除成员: {url} (email_id: {invite.email_id})")
-
-        resp = session.delete(url, headers={
-            "Accept": "application/json",
-            "x-csrf-token": new_csrf,
-            "Referer": f"https://www.overleaf.com/manage/groups/{acct.group_id}/members",
-            "User-Agent": "Mozilla/5.0"
-        })
-
-        # 处理不同的响应状态
-        if resp.status_code in (200, 204):
-            logger.info(f"成功从 Overleaf 删除成员: {body.email}")
-            return {"success": True, "message": "删除成功"}
-        elif resp.status_code == 404:
-            logger.warning(f"成员已不存在: {body.email}，标记为已处理")
-            return {"success": True, "message": "成员已不存在"}
-        else:
-            # 其他错误抛出异常，让事务管理器处理
-            try:
-                error_data = resp.json()
-                error_detail = error_data.get('error', {}).get('message', resp.text)
-            except json.JSONDecodeError:
-                error_detail = resp.text
-            raise Exception(f"Overleaf API错误 {resp.status_code}: {error_detail}")
-
-    # 5. 使用事务管理器执行删除操作（真正删除记录）
-    result = await TransactionManager.safe_remove_member(db, invite, perform_overleaf_deletion, delete_record=True)
-    
-    if not result["success"]:
-        raise HTTPException(status_code=500, detail=result["message"])
+    # 3. 同一事务：记录标记为已清理 + 登记 outbox 意图；Overleaf 上的删除由 dispatcher 执行
+    entry = outbox.record_remove(db, invite)
+    db.commit()
+    return await _outbox_response(db, entry.id, acct.id, wait, "成员删除")
+
+
+async def _outbox_response(db: Session, entry_id: str, account_id: int, wait: bool,
+                           action: str) -> schemas.RemoveMemberResponse:
+    """wait=False 时登记后立即返回；wait=True 时立即派发该账号的意图并返回 Overleaf 上的执行结果"""
+    if not wait:
+        outbox.outbox_dispatcher.notify()
+        return schemas.RemoveMemberResponse(
+            status="queued",
+            detail=f"{action}已登记，后台正在 Overleaf 上执行",
+            outbox_id=entry_id
+        )
 
-    return schemas.RemoveMemberResponse(
-        status="success",
-        detail=result["message"]
-    )
+    await outbox.dispatch_account(account_id)
+    entry = db.get(models.OutboxEntry, entry_id)
+    # 已被后台 worker 认领时等它执行完
+    for _ in range(WAIT_POLL_TIMES):
+        db.refresh(entry)
+        if entry.status != outbox.DISPATCHING:
+            break
+        await asyncio.sleep(0.5)
+    if entry.status in (outbox.DONE, outbox.SUPERSEDED):
+        detail = "成员已不存在" if entry.result == cleanup_engine.NOT_FOUND else f"{action}成功"
+        return schemas.RemoveMemberResponse(status="success", detail=detail, outbox_id=entry_id)
+    retry = "，已安排重试" if entry.status == outbox.PENDING else ""
+    raise HTTPException(status_code=500, detail=f"{action}失败: {entry.last_error}{retry}")
 
 
 # -------- 新增接口：通过邮箱撤销未接受的邀请 --------
 @router.post("/revoke_unaccepted", response_model=schemas.RemoveMemberResponse)
-async def revoke_unaccepted_invite(
+async def revoke_unaccepted_endpoint(
         body: schemas.MemberEmailRequest,
+        debug: bool = Query(False, description="在响应的 timings 中返回本次请求各阶段耗时"),
+        wait: bool = Query(False, description="等待 Overleaf 上执行完成再返回（默认登记后立即返回）"),
+        idempotency_key: Optional[str] = Header(None, alias=idempotency.IDEMPOTENCY_HEADER),
         db: Session = Depends(get_db)
+):
+    """撤销未接受的邀请；幂等规则同 /remove"""
+    with collect() as trace:
+        response = await idempotency.run_idempotent(
+            "revoke", idempotency_key, None,
+            body, lambda: revoke_unaccepted_invite(body, db, wait)
+        )
+    if debug and isinstance(response, schemas.RemoveMemberResponse):
+        response.timings = trace.breakdown()
+    return response
+
+
+@traced("revoke")
+async def revoke_unaccepted_invite(
+        body: schemas.MemberEmailRequest,
+        db: Session,
+        wait: bool = False
 ):
     """
     通过邮箱撤销 Overleaf 组中尚未接受的邀请 (email_id 可能为 None)。
     """
-    # 1. 查找最新未清理的邀请记录 (不要求 email_id 存在)
-    invite = (
-        db.query(models.Invite)
-        .filter(
-            models.Invite.email == body.email,
-            models.Invite.cleaned.is_(False)  # 只处理未清理的邀请记录
-        )
-        .order_by(models.Invite.created_at.desc())  # 查找最新的记录
-        .first()
-    )
-    if not invite:
+    # 1. 查找最新未清理的邀请记录 (不要求 email_id 存在)，连同邀请所用账号一次查出
+    memberships = find_memberships(db, body.email)
+    if not memberships:
         raise HTTPException(status_code=404, detail=f"未找到邮箱 '{body.email}' 的未接受邀请记录")
+    invite, acct = memberships[0].invite, memberships[0].account
+    annotate(account_id=acct.id)
 
-    # 2. 加载邀请所用账号 (与 remove_member 相同)
-    acct = db.get(models.Account, invite.account_id)
-    if not acct:
-        # 这种情况通常不应该发生，除非账号被删除
-        raise HTTPException(status_code=500, detail="找不到邀请账户信息")
-
-    session = requests.Session()
-    new_sess = acct.session_cookie
-    new_csrf = acct.csrf_token
-
-    # 3. 尝试复用已有的 session/CSRF (与 remove_member 相同)
-    if new_sess and new_csrf:
-        session.cookies.set(
-            "overleaf_session2", new_sess,
-            domain=".overleaf.com", path="/"
-        )
-        try:
-            new_sess = await asyncio.to_thread(refresh_session, session, new_csrf)
-            new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
-        except Exception as e:
-            logger.warning(f"账号 {acct.email} session/CSRF 刷新失败: {e}. 将尝试完整登录。")
-            new_sess = new_csrf = None
-
-    # 4. 如复用失败，完整登录流程 (与 remove_member 相同)
-    if not (new_sess and new_csrf):
-        try:
-            csrf0, sess0 = await get_tokens()
-            captcha = get_captcha_token()
-            session = await asyncio.to_thread(
-                perform_login, csrf0, sess0,
-                acct.email, acct.password, captcha
-            )
-            new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-            new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
-        except Exception as e:
-            logger.error(f"账号 {acct.email} 完整登录失败: {e}")
-            raise HTTPException(status_code=500, detail=f"登录 Overleaf 失败，无法撤销邀请: {e}")
-
-    # 5. 更新数据库中的 token (与 remove_member 相同)
-    crud.update_account_tokens(db, acct, new_csrf, new_sess)
-
-    # 6. 调用 Overleaf API 撤销邀请 (关键改变：使用 email 而非 email_id)
-    # 邮箱需要 URL 编码，以防特殊字符 (例如 @)
-    encoded_email = requests.utils.quote(body.email, safe='')
-    url = f"https://www.overleaf.com/manage/groups/{acct.group_id}/invites/{encoded_email}"
-
-    logger.info(f"尝试撤销 Overleaf 邀请: {url} for email: {body.email}")
-
-    resp = session.delete(url, headers={
-        "Accept": "application/json",
-        "x-csrf-token": new_csrf,
-        "Referer": f"https://www.overleaf.com/manage/groups/{acct.group_id}/members",
-        "User-Agent": "Mozilla/5.0"
-    })
-
-    # 统一错误处理
-    if resp.status_code not in (200, 204):
-        logger.error(f"撤销邀请失败: {resp.status_code} {resp.text}")
-        try:
-            error_data = resp.json()
-            error_detail = error_data.get('error', {}).get('message', resp.text)
-        except json.JSONDecodeError:
-            error_detail = resp.text
-        raise HTTPException(status_code=resp.status_code, detail=f"撤销邀请失败: {error_detail}")
-
-    logger.info(f"成功撤销 Overleaf 邀请: {body.email}")
-
-    # 7. 更新本地数据库 (真正删除记录)
-    db.delete(invite)
+    # 2. 同一事务：记录标记为已清理 + 登记 outbox 意图（按邮箱撤销，不需要 email_id）
+    entry = outbox.record_revoke(db, invite)
     db.commit()
-    
-    # 8. 重新计算账户的邀请计数
-    InviteStatusManager.sync_account_invites_count(db, acct)
+    return await _outbox_response(db, entry.id, acct.id, wait, "撤销邀请")
+
+
+@router.post("/revoke_batch", response_model=schemas.RevokeBatchResponse)
+@traced("revoke_batch")
+async def revoke_batch(
+        body: schemas.RevokeBatchRequest,
+        db: Session = Depends(get_db)
+):
+    """
+    批量撤销未接受的邀请：
+    1. 一条查询取出所有邮箱的未清理记录与组长账号，只处理还没有 email_id 的（未接受的）记录
+    2. 按组长账号分组，每个账号认证一次、在同一个 session 上依次撤销，账号之间按 concurrency 并行
+    3. 一个事务删除撤销成功的记录，每个涉及的账号只重新计数一次
+    已接受的成员不会被撤销（请使用 /remove）；重复提交是安全的，已撤销的邮箱第二次返回 no_record。
+    """
+    emails = list(OrderedDict((models.normalize_email(e), e) for e in body.emails).values())
+    found = find_memberships_many(db, emails)
+
+    results, targets = {}, {}
+    grouped: "OrderedDict[int, list]" = OrderedDict()
+    for email in emails:
+        memberships = found.get(models.normalize_email(email), [])
+        pending = [m for m in memberships if not m.invite.email_id]
+        if not memberships:
+            results[email] = schemas.RevokeBatchItemResult(
+                email=email, success=False, status="no_record", error="未找到未清理的邀请记录")
+        elif not pending:
+            results[email] = schemas.RevokeBatchItemResult(
+                email=email, success=False, status="accepted",
+                account_emails=[m.account_email for m in memberships],
+                error="成员已接受邀请，请使用 /api/v1/member/remove 删除")
+        else:
+            targets[email] = pending
+            for m in pending:
+                grouped.setdefault(m.account.id, []).append(m.invite)
+
+    report = await cleanup_engine.clean_groups(db, grouped, concurrency=body.concurrency)
+
+    account_errors = {a.account_id: a.error for a in report.accounts if a.error}
+    item_errors = {f["invite_id"]: f["error"] for a in report.accounts for f in a.failures}
+    for email, pending in targets.items():
+        errors = [
+            item_errors.get(m.invite.id) or account_errors.get(m.account.id) or "撤销失败"
+            for m in pending if m.invite.id not in report.outcomes
+        ]
+        outcomes = {report.outcomes.get(m.invite.id) for m in pending}
+        results[email] = schemas.RevokeBatchItemResult(
+            email=email,
+            success=not errors,
+            status="failed" if errors else (
+                "revoked" if cleanup_engine.REVOKED in outcomes else "not_found"),
+            account_emails=[m.account_email for m in pending],
+            error="; ".join(errors) if errors else None
+        )
 
-    return schemas.RemoveMemberResponse(
-        status="success",
-        detail="未接受的邀请已撤销"
+    ordered = [results[email] for email in emails]
+    revoked = sum(1 for r in ordered if r.success)
+    logger.info(f"批量撤销完成：成功 {revoked}/{len(ordered)}，涉及 {len(report.accounts)} 个账号")
+    return schemas.RevokeBatchResponse(
+        total=len(ordered),
+        revoked_count=revoked,
+        failed_count=len(ordered) - revoked,
+        accounts_used=sum(1 for a in report.accounts if a.authenticated),
+        results=ordered,
+        accounts=[a.to_dict() for a in report.accounts]
     )
 
 
 # -------- 新增接口：批量清理过期成员 --------
 @router.post("/cleanup_expired", response_model=schemas.CleanupResponse)
 async def cleanup_expired_members(
+        dry_run: bool = Query(False, description="只生成执行计划（请求数、冷登录、预计耗时），不访问 Overleaf"),
         db: Session = Depends(get_db)
 ):
     """
     批量清理所有过期的邀请记录，使用新的状态管理逻辑。
+    与其他 worker / 定时脚本共用 cleanup 租约，同一时间只运行一个清理任务。
+    dry_run=true 返回的 plan 可原样提交给 POST /api/v1/maintenance/cleanup_plan/execute 执行。
     """
-    import time
-    
-    now_ts = int(time.time())
-    
-    # 查找所有过期且未清理的邀请记录（排除手动添加的用户）
-    expired_invites = (
-        db.query(models.Invite)
-        .filter(
-            models.Invite.expires_at.isnot(None),
-            models.Invite.expires_at < now_ts,
-            models.Invite.cleaned.is_(False)
-        )
-        .limit(100)  # 限制批量处理数量
-        .all()
+    if dry_run:
+        plan = cleanup_plan.build_plan(db, limit=100)
+        return schemas.CleanupResponse(cleaned=0, stats={"total_found": len(plan.invite_ids)}, plan=plan.to_dict())
+
+    lease = JobLease(SCOPE_CLEANUP)
+    try:
+        async with lease.hold():
+            return await _cleanup_expired_members(db, lease)
+    except LeaseHeldError:
+        raise HTTPException(status_code=400, detail="清理任务正在进行中，请等待完成")
+
+
+async def _cleanup_expired_members(db: Session, lease: JobLease) -> schemas.CleanupResponse:
+    # 按组长账号分组：每个账号认证一次，在同一个 session 上删除该组的过期成员，账号之间并行
+    report = await cleanup_engine.cleanup_expired(
+        db, limit=100,
+        progress=lease.update_progress_async
     )
-    
-    if not expired_invites:
-        return schemas.CleanupResponse(
-            status="success",
-            detail="没有需要清理的过期邀请",
-            processed_count=0,
-            success_count=0,
-            error_count=0
-        )
-    
-    success_count = 0
-    error_count = 0
-    
-    for invite in expired_invites:
-        try:
-            status = InviteStatusManager.get_invite_status(invite)
-            
-            if status == InviteStatusManager.InviteStatus.ACCEPTED:
-                # 已接受的邀请，需要调用删除成员接口
-                body = schemas.MemberEmailRequest(email=invite.email)
-                result = await remove_member(body, db)
-                success_count += 1
-                logger.info(f"清理过期成员成功: {invite.email} (ID: {invite.id})")
-                
-            elif status == InviteStatusManager.InviteStatus.PENDING:
-                # 未接受的邀请，直接标记为已处理
-                InviteStatusManager.mark_invite_processed(db, invite, "expired_pending")
-                success_count += 1
-                logger.info(f"清理过期邀请成功: {invite.email} (ID: {invite.id})")
-                
-            else:
-                # 其他状态，直接标记为已处理
-                InviteStatusManager.mark_invite_processed(db, invite, "expired_other")
-                success_count += 1
-                logger.info(f"标记过期邀请为已处理: {invite.email} (ID: {invite.id})")
-                
-        except HTTPException as e:
-            if e.status_code == 404:
-                # 404错误：直接标记为已处理
-                InviteStatusManager.mark_invite_processed(db, invite, "not_found")
-                success_count += 1
-                logger.warning(f"过期邀请成员不存在，已标记为已处理: {invite.email} (ID: {invite.id})")
-            else:
-                error_count += 1
-                logger.error(f"清理过期邀请失败: {invite.email} (ID: {invite.id}) - {e.detail}")
-        except Exception as e:
-            error_count += 1
-            logger.error(f"清理过期邀请异常: {invite.email} (ID: {invite.id}) - {str(e)}")
-    
-    # 同步所有相关账户的计数
-    affected_accounts = set(invite.account_id for invite in expired_invites)
-    for account_id in affected_accounts:
-        account = db.get(models.Account, account_id)
-        if account:
-            InviteStatusManager.sync_account_invites_count(db, account)
-    
     return schemas.CleanupResponse(
-        status="success",
-        detail=f"清理完成：成功 {success_count} 个，失败 {error_count} 个",
-        processed_count=len(expired_invites),
-        success_count=success_count,
-        error_count=error_count
+        cleaned=report.cleaned,
+        stats=report.stats(),
+        accounts=[a.to_dict() for a in report.accounts]
     )
 
 
@@ -6,19 +6,17 @@
 import asyncio
 import time
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 from fastapi import APIRouter, HTTPException, BackgroundTasks, Query, Depends
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 
 from database import SessionLocal
-from invite_status_manager import InviteStatusManager
-import models
-from overleaf_utils import get_tokens, get_captcha_token, perform_login, refresh_session, get_new_csrf
-import requests
-import json
-import re
-import html
+import models, crud
+from sync_engine import ChangeAction, members_from_overleaf_users, reconcile_account
+from job_coordinator import JobLease, SCOPE_SYNC, get_job_status
+from sync_scheduler import rank_accounts, prioritized_account_ids
+from overleaf_utils import open_group_session, fetch_group_members
 
 # 创建路由器
 router = APIRouter(prefix="/api/v1/sync", tags=["同步管理"])
@@ -45,6 +43,8 @@ class SyncResult(BaseModel):
     success: bool
     error_message: Optional[str] = None
     sync_time: str
+    dry_run: bool = False
+    change_set: Optional[Dict] = None  # 对账引擎输出的完整变更集
 
 class BatchSyncResult(BaseModel):
     """批量同步结果"""
@@ -66,17 +66,6 @@ class SyncStatus(BaseModel):
     start_time: Optional[str] = None
     estimated_remaining: Optional[str] = None
 
-# 全局状态管理
-class SyncManager:
-    def __init__(self):
-        self.is_running = False
-        self.current_account = None
-        self.start_time = None
-        self.total_accounts = 0
-        self.completed_accounts = 0
-
-sync_manager = SyncManager()
-
 class OverleafSyncer:
     """Overleaf数据同步器"""
     
@@ -84,218 +73,58 @@ class OverleafSyncer:
         self.db = db
         
     async def get_group_members(self, account: models.Account):
-        """获取Overleaf群组的真实成员数据"""
-        session = requests.Session()
-        
-        # 1. 尝试使用现有token
-        if account.session_cookie and account.csrf_token:
-            session.cookies.set(
-                "overleaf_session2", account.session_cookie,
-                domain=".overleaf.com", path="/"
-            )
-            csrf_token = account.csrf_token
-        else:
-            # 2. 重新登录获取token
-            csrf0, sess0 = await get_tokens()
-            captcha = get_captcha_token()
-            session = await asyncio.to_thread(
-                perform_login, csrf0, sess0,
-                account.email, account.password, captcha
-            )
-            new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-            csrf_token = await asyncio.to_thread(get_new_csrf, session, account.group_id)
-            
-            # 更新数据库中的token
-            account.session_cookie = new_sess
-            account.csrf_token = csrf_token
-            self.db.commit()
-        
-        # 3. 获取群组成员页面
-        members_url = f"https://www.overleaf.com/manage/groups/{account.group_id}/members"
-        resp = session.get(members_url, headers={
-            "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
-            "accept-language": "zh-CN,zh;q=0.9",
-            "cache-control": "max-age=0",
-            "priority": "u=0, i",
-            "sec-ch-ua": '"Google Chrome";v="137", "Chromium";v="137", "Not/A)Brand";v="24"',
-            "sec-ch-ua-mobile": "?0",
-            "sec-ch-ua-platform": '"macOS"',
-            "sec-fetch-dest": "document",
-            "sec-fetch-mode": "navigate",
-            "sec-fetch-site": "same-origin",
-            "sec-fetch-user": "?1",
-            "upgrade-insecure-requests": "1",
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36"
-        })
-        
-        if resp.status_code != 200:
-            raise Exception(f"获取成员数据失败: {resp.status_code} {resp.text}")
-        
-        # 4. 解析HTML中的ol-users meta标签
-        html_content = resp.text
+        """获取Overleaf群组的真实成员数据（认证与成员页解析复用 overleaf_utils）"""
+        session, new_sess, new_csrf = await open_group_session(account)
+        # 写回刷新后的token
+        crud.update_account_tokens(self.db, account, new_csrf, new_sess)
         
-        # 查找 <meta name="ol-users" data-type="json" content="...">
-        meta_pattern = r'<meta\s+name="ol-users"[^>]*content="([^"]*)"'
-        match = re.search(meta_pattern, html_content)
-        
-        if not match:
-            raise Exception("未找到ol-users meta标签")
-        
-        # 解码content内容（可能是HTML实体编码）
-        users_content = html.unescape(match.group(1))
-        
-        # 解析JSON数据
-        try:
-            users_data = json.loads(users_content)
-        except json.JSONDecodeError as e:
-            raise Exception(f"解析用户数据失败: {e}")
-        
-        # 转换为统一格式
-        members = []
-        for user in users_data:
-            # 根据实际数据结构调整字段映射
-            members.append({
-                "email": user.get("email"),
-                "user_id": user.get("_id"),
-                "status": "accepted" if user.get("_id") else "pending"
-            })
+        users_data = await asyncio.to_thread(fetch_group_members, session, account.group_id)
+        members = members_from_overleaf_users(users_data)
         
         return {
             "members": members,
             "total_count": len(members)
         }
     
-    async def sync_account(self, account: models.Account) -> SyncResult:
-        """同步单个账户的数据"""
+    async def sync_account(self, account: models.Account, dry_run: bool = False) -> SyncResult:
+        """同步单个账户的数据（dry_run=True 时只返回变更集预览）"""
         sync_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
         try:
             # 1. 获取Overleaf真实数据
             overleaf_data = await self.get_group_members(account)
             overleaf_count = overleaf_data["total_count"]
-            overleaf_members = overleaf_data["members"]
             
-            # 2. 分析数据库中的邀请记录
-            db_invites = (
-                self.db.query(models.Invite)
-                .filter(models.Invite.account_id == account.id)
-                .all()
+            # 2. 生成变更集并在单个事务中批量应用
+            change_set = reconcile_account(
+                self.db, account, overleaf_data["members"],
+                dry_run=dry_run,
+                source="manual_sync_from_overleaf"
             )
             
-            # 3. 创建邮箱到Overleaf状态的映射
-            overleaf_status = {}
-            for member in overleaf_members:
-                overleaf_status[member["email"]] = {
-                    "user_id": member["user_id"],
-                    "status": member["status"]
-                }
-            
-            # 4. 检查数据库外用户（只在Overleaf中存在）
-            db_emails = {invite.email for invite in db_invites}
-            database_external_users = []
-            
-            for email, ol_data in overleaf_status.items():
-                if email not in db_emails:
-                    database_external_users.append({
-                        "email": email,
-                        "user_id": ol_data["user_id"],
-                        "status": ol_data["status"]
-                    })
-            
-            # 5. 分析需要修复的记录
-            updates = []
-            for invite in db_invites:
-                if invite.email in overleaf_status:
-                    # 在Overleaf中存在
-                    ol_data = overleaf_status[invite.email]
-                    
-                    if ol_data["status"] == "accepted" and not invite.email_id:
-                        # 数据库显示未接受，但Overleaf显示已接受
-                        updates.append({
-                            "invite_id": invite.id,
-                            "action": "update_email_id",
-                            "new_email_id": ol_data["user_id"],
-                            "reason": "Overleaf显示已接受，但数据库未更新email_id"
-                        })
-                    
-                    if invite.cleaned:
-                        # 数据库显示已清理，但Overleaf中还存在
-                        updates.append({
-                            "invite_id": invite.id,
-                            "action": "unmark_cleaned",
-                            "reason": "数据库标记为已清理，但Overleaf中仍存在"
-                        })
-                        
-                else:
-                    # 在Overleaf中不存在
-                    if not invite.cleaned:
-                        # 数据库显示未清理，但Overleaf中不存在
-                        updates.append({
-                            "invite_id": invite.id,
-                            "action": "mark_cleaned",
-                            "reason": "Overleaf中不存在，应标记为已清理"
-                        })
-            
-            # 6. 执行修复
-            updates_applied = []
-            
-            # 修复现有记录
-            for update in updates:
-                invite = self.db.get(models.Invite, update["invite_id"])
-                if update["action"] == "update_email_id":
-                    invite.email_id = update["new_email_id"]
-                elif update["action"] == "unmark_cleaned":
-                    invite.cleaned = False
-                elif update["action"] == "mark_cleaned":
-                    invite.cleaned = True
-                updates_applied.append(update)
-            
-            # 创建数据库外用户记录
-            external_users_created = []
-            if database_external_users:
-                for user in database_external_users:
-                    # 创建更完整的result信息
-                    result_info = {
-                        "source": "manual_sync_from_overleaf",
-                        "sync_date": sync_time,
-                        "account_manager": account.email,
-                        "overleaf_status": user['status'],
-                        "overleaf_user_id": user['user_id'],
-                        "note": "手动添加的用户，需要联系客户确认过期时间和卡密信息",
-                        "action_required": "请设置过期时间并关联正确的卡密",
-                        "warning": "设置过期时间后，到期会被正常清理删除"
-                    }
-                    
-                    new_invite = models.Invite(
-                        account_id=account.id,
-                        card_id=None,  # 手动添加的用户没有卡密，需要后续关联
-                        email=user['email'],
-                        email_id=user['user_id'] if user['status'] == 'accepted' else None,
-                        expires_at=None,  # 关键：不设置过期时间，标记为手动添加
-                        success=True,  # 已经在Overleaf中存在
-                        result=json.dumps(result_info, ensure_ascii=False),
-                        created_at=int(time.time()),
-                        cleaned=False
-                    )
-                    self.db.add(new_invite)
-                    external_users_created.append(user)
-            
-            # 7. 修正账户计数（基于数据库重新计算）
-            manager = InviteStatusManager()
-            account.invites_sent = manager.calculate_invites_sent(self.db, account)
-            self.db.commit()
+            external_users = [
+                {"email": c.email, "user_id": c.email_id, "status": c.overleaf_status}
+                for c in change_set.of(ChangeAction.CREATE_EXTERNAL)
+            ]
+            updates = [
+                c.to_dict() for c in change_set.changes
+                if c.action not in (ChangeAction.CREATE_EXTERNAL, ChangeAction.FIX_COUNT)
+            ]
+            db_count = account.invites_sent
             
             return SyncResult(
                 account_email=account.email,
                 account_id=account.id,
                 group_id=account.group_id,
-                db_count=account.invites_sent,
+                db_count=db_count,
                 overleaf_count=overleaf_count,
-                difference=account.invites_sent - overleaf_count,
-                database_external_users=external_users_created,
-                updates_applied=updates_applied,
+                difference=db_count - overleaf_count,
+                database_external_users=external_users,
+                updates_applied=updates,
                 success=True,
-                sync_time=sync_time
+                sync_time=sync_time,
+                dry_run=dry_run,
+                change_set=change_set.to_dict()
             )
             
         except Exception as e:
@@ -315,50 +144,53 @@ class OverleafSyncer:
 
 @router.get("/status", response_model=SyncStatus)
 async def get_sync_status():
-    """获取当前同步状态"""
+    """获取当前同步状态（读取 job_leases，多 worker 下任意进程返回一致）"""
+    job = get_job_status(SCOPE_SYNC)
+    total, completed = job["total"], job["completed"]
     estimated_remaining = None
-    if sync_manager.is_running and sync_manager.total_accounts > 0:
-        progress_pct = sync_manager.completed_accounts / sync_manager.total_accounts
-        if progress_pct > 0 and sync_manager.start_time:
-            elapsed = time.time() - sync_manager.start_time
+    if job["is_running"] and total > 0:
+        progress_pct = completed / total
+        if progress_pct > 0 and job["started_at"]:
+            elapsed = time.time() - job["started_at"]
             total_estimated = elapsed / progress_pct
             estimated_remaining = f"{int((total_estimated - elapsed) / 60)}分钟"
     
     return SyncStatus(
-        is_running=sync_manager.is_running,
-        current_account=sync_manager.current_account,
-        progress=f"{sync_manager.completed_accounts}/{sync_manager.total_accounts}" if sync_manager.total_accounts > 0 else "0/0",
-        start_time=datetime.fromtimestamp(sync_manager.start_time).strftime('%Y-%m-%d %H:%M:%S') if sync_manager.start_time else None,
+        is_running=job["is_running"],
+        current_account=job["current_item"],
+        progress=f"{completed}/{total}" if total > 0 else "0/0",
+        start_time=datetime.fromtimestamp(job["started_at"]).strftime('%Y-%m-%d %H:%M:%S') if job["started_at"] else None,
         estimated_remaining=estimated_remaining
     )
 
-@router.post("/all", response_model=Dict[str, str])
+@router.post("/all", response_model=Dict[str, Any])
 async def start_sync_all_accounts(
     background_tasks: BackgroundTasks,
+    limit: Optional[int] = Query(None, ge=1, description="最多同步的账户数，按优先级取前 N 个"),
+    max_seconds: Optional[int] = Query(None, ge=1, description="运行时间上限（秒），超时后停止处理剩余账户"),
     db: Session = Depends(get_db)
 ):
-    """启动所有账户的同步任务（后台异步执行）"""
-    if sync_manager.is_running:
-        raise HTTPException(status_code=400, detail="同步任务正在进行中，请等待完成")
+    """启动所有账户的同步任务（后台异步执行，按 sync_scheduler 优先级从高到低）"""
+    account_ids = prioritized_account_ids(db, limit=limit)
     
-    accounts = db.query(models.Account).all()
-    sync_manager.total_accounts = len(accounts)
-    sync_manager.completed_accounts = 0
-    sync_manager.is_running = True
-    sync_manager.start_time = time.time()
+    # 抢占 sync 租约：其他 worker 或维护脚本正在同步时直接拒绝
+    lease = JobLease(SCOPE_SYNC)
+    if not await lease.acquire_async(total=len(account_ids)):
+        raise HTTPException(status_code=400, detail="同步任务正在进行中，请等待完成")
     
     # 添加后台任务
-    background_tasks.add_task(run_batch_sync, accounts)
+    background_tasks.add_task(run_batch_sync, lease, account_ids, max_seconds)
     
     return {
-        "message": f"已启动 {len(accounts)} 个账户的同步任务",
+        "message": f"已启动 {len(account_ids)} 个账户的同步任务",
         "status": "running",
-        "total_accounts": len(accounts)
+        "total_accounts": len(account_ids)
     }
 
 @router.post("/account/{email}", response_model=SyncResult)
 async def sync_single_account(
     email: str,
+    dry_run: bool = Query(False, description="只预览变更集，不写数据库"),
     db: Session = Depends(get_db)
 ):
     """同步指定账户"""
@@ -367,46 +199,71 @@ async def sync_single_account(
         raise HTTPException(status_code=404, detail=f"账户 {email} 不存在")
     
     syncer = OverleafSyncer(db)
-    result = await syncer.sync_account(account)
+    result = await syncer.sync_account(account, dry_run=dry_run)
     
     return result
 
-async def run_batch_sync(accounts: List[models.Account]):
-    """后台执行批量同步"""
+async def run_batch_sync(lease: JobLease, account_ids: List[int], max_seconds: Optional[int] = None):
+    """
+    后台执行批量同步；租约已在请求中抢到，这里负责心跳、进度与释放。
+    account_ids 已按优先级排序，设置了 max_seconds 时到点即停，剩余账户留给下一轮。
+    """
     db = SessionLocal()
+    deadline = time.monotonic() + max_seconds if max_seconds else None
     try:
-        syncer = OverleafSyncer(db)
-        results = []
-        
-        for i, account in enumerate(accounts, 1):
-            sync_manager.current_account = account.email
-            sync_manager.completed_accounts = i - 1
+        async with lease.keep_alive():
+            syncer = OverleafSyncer(db)
+            completed = 0
             
-            result = await syncer.sync_account(account)
-            results.append(result)
+            for i, account_id in enumerate(account_ids, 1):
+                if deadline and time.monotonic() >= deadline:
+                    print(f"批量同步达到时间上限，剩余 {len(account_ids) - completed} 个账户留待下一轮")
+                    break
+                account = db.get(models.Account, account_id)
+                if account is None:
+                    continue
+                await lease.update_progress_async(completed=i - 1, current_item=account.email)
+                
+                await syncer.sync_account(account)
+                completed = i
+                
+                # 避免请求过快
+                await asyncio.sleep(2)
             
-            # 避免请求过快
-            await asyncio.sleep(2)
-        
-        sync_manager.completed_accounts = len(accounts)
+            await lease.update_progress_async(completed=completed)
         
     except Exception as e:
         print(f"批量同步错误: {e}")
     finally:
-        sync_manager.is_running = False
-        sync_manager.current_account = None
         db.close()
 
+@router.get("/queue")
+async def get_sync_queue(
+    limit: int = Query(50, ge=1, description="返回前 N 个账户"),
+    db: Session = Depends(get_db)
+):
+    """查看同步优先级队列：/sync/all 与维护脚本按此顺序处理账户"""
+    return {
+        "accounts": [p.to_dict() for p in rank_accounts(db, limit=limit)]
+    }
+
 @router.get("/results", response_model=Dict[str, str])
 async def get_last_sync_results():
     """获取最后一次同步的结果摘要"""
-    if sync_manager.is_running:
+    job = get_job_status(SCOPE_SYNC)
+    if job["is_running"]:
         return {
             "status": "running",
             "message": "同步正在进行中"
         }
+    elif job["status"] == "idle":
+        return {
+            "status": "idle",
+            "message": "尚未执行过全量同步"
+        }
     else:
         return {
-            "status": "completed",
-            "message": f"上次同步已完成，共处理 {sync_manager.total_accounts} 个账户"
-        }
\ No newline at end of file
+            "status": job["status"],
+            "message": f"上次同步已结束，共处理 {job['completed']}/{job['total']} 个账户"
+                       + (f"，错误: {job['message']}" if job["message"] else "")
+        }
@@ -1,22 +1,24 @@
 # routers/update_email_id.py
 
-import re
-import json
-import html
-import requests
+import time
 import asyncio
-from fastapi import APIRouter, Depends, HTTPException
+from collections import defaultdict
+from fastapi import APIRouter, Depends, HTTPException, Body
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 
 import models, schemas, crud
+import invite_events
 from database import SessionLocal
 from overleaf_utils import (
-    get_tokens,
-    get_captcha_token,
-    perform_login,
-    refresh_session,
-    get_new_csrf
+    GroupMembersFetchError,
+    open_group_session,
+    fetch_group_members
 )
+from sync_scheduler import rank_accounts
+from sync_engine import members_from_overleaf_users
+from group_capacity import membership_values
+from job_coordinator import JobLease, LeaseHeldError, SCOPE_EMAIL_IDS
 
 router = APIRouter(prefix="/api/v1/email_ids", tags=["members"])
 
@@ -27,6 +29,51 @@ def get_db():
     finally:
         db.close()
 
+
+def reconcile_email_ids(db: Session, acct: models.Account, users: list[dict]) -> int:
+    """
+    把 Overleaf 成员列表中的 _id 写回该组长名下的 Invite 记录，同时记录容量快照。
+    一次性加载该账号的全部邀请到内存字典，再用一条 executemany 的 UPDATE 批量写入；
+    不提交事务，由调用方统一 commit。返回更新的记录数。
+    """
+    for key, value in membership_values(members_from_overleaf_users(users), acct.max_invites).items():
+        setattr(acct, key, value)
+
+    rows = (
+        db.query(models.Invite.id, models.Invite.email, models.Invite.email_id)
+        .filter(models.Invite.account_id == acct.id)
+        .all()
+    )
+    by_email = defaultdict(list)
+    for row in rows:
+        by_email[row.email].append(row)
+
+    changes = []
+    for u in users:
+        email = u.get("email")
+        uid   = u.get("_id")
+        if not email or not uid:
+            continue
+        for row in by_email.get(email, ()):
+            if row.email_id != uid:
+                changes.append({"id": row.id, "email_id": uid})
+
+    if changes:
+        db.execute(update(models.Invite), changes)
+        invite_events.record_rows(db, [
+            {"invite_id": c["id"], "account_id": acct.id, "kind": invite_events.EMAIL_ID, "detail": c["email_id"]}
+            for c in changes
+        ])
+    return len(changes)
+
+
+async def _fetch_account_members(acct: models.Account) -> tuple[list[dict], str, str]:
+    """登录（或复用 token）并拉取成员列表，返回 (users, session_cookie, csrf)"""
+    session, new_sess, new_csrf = await open_group_session(acct)
+    users = await asyncio.to_thread(fetch_group_members, session, acct.group_id)
+    return users, new_sess, new_csrf
+
+
 @router.post("/update", response_model=schemas.UpdateEmailIdsResponse)
 async def update_email_ids(
     body: schemas.LeaderEmailRequest,
@@ -37,71 +84,91 @@ async def update_email_ids(
     if not acct:
         raise HTTPException(status_code=404, detail="组长账号不存在")
 
-    session = requests.Session()
-    new_sess = acct.session_cookie
-    new_csrf = acct.csrf_token
-
-    # 2. 尝试复用并刷新（如果已有 token）
-    if new_sess and new_csrf:
-        session.cookies.set("overleaf_session2", new_sess,
-                            domain=".overleaf.com", path="/")
-        try:
-            new_sess = await asyncio.to_thread(refresh_session, session, new_csrf)
-            new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
-        except Exception:
-            new_sess = new_csrf = None
-
-    # 3. 如复用失败，执行完整登录流程
-    if not (new_sess and new_csrf):
-        csrf0, sess0 = await get_tokens()
-        captcha = get_captcha_token()
-        session = await asyncio.to_thread(
-            perform_login, csrf0, sess0,
-            acct.email, acct.password, captcha
-        )
-        new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-        new_csrf = await asyncio.to_thread(get_new_csrf, session, acct.group_id)
-
-    # 4. 更新数据库里的最新 token
-    crud.update_account_tokens(db, acct, new_csrf, new_sess)
+    # 2. 登录并拉取 Overleaf 成员列表
+    try:
+        users, new_sess, new_csrf = await _fetch_account_members(acct)
+    except GroupMembersFetchError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
-    # 5. 拉取 Overleaf 成员列表页
-    url = f"https://www.overleaf.com/manage/groups/{acct.group_id}/members"
-    resp = session.get(url, headers={
-        "Accept": "text/html",
-        "Referer": "https://www.overleaf.com/project",
-        "User-Agent": "Mozilla/5.0",
-    })
-    if resp.status_code != 200:
-        raise HTTPException(status_code=resp.status_code, detail="获取成员列表失败")
-
-    # 6. 从页面 <meta name="ol-users"> 中解析 JSON
-    m = re.search(r'<meta\s+name="ol-users"\s+data-type="json"\s+content="([^"]+)"', resp.text)
-    if not m:
-        raise HTTPException(status_code=500, detail="未找到 ol-users 元数据标签")
-    users = json.loads(html.unescape(m.group(1)))
-
-    # 7. 更新本地 Invite 记录中的 email_id
-    updated = 0
-    for u in users:
-        email = u.get("email")
-        uid   = u.get("_id")
-        if not email or not uid:
-            continue
-        # **关键修改：增加过滤条件，只更新属于当前组长（acct）的邀请记录**
-        # 确保 inv.account_id 与当前处理的组长账号的 id 匹配
-        for inv in db.query(models.Invite).filter(
-            models.Invite.email == email,
-            models.Invite.account_id == acct.id # <<< 新增此行
-        ).all():
-            if inv.email_id != uid:
-                inv.email_id = uid
-                updated += 1
+    # 3. 更新数据库里的最新 token
+    crud.update_account_tokens(db, acct, new_csrf, new_sess)
 
+    # 4. 批量更新本地 Invite 记录中的 email_id（只更新属于当前组长的记录）
+    updated = reconcile_email_ids(db, acct, users)
     db.commit()
 
     return schemas.UpdateEmailIdsResponse(
         leader_email=body.leader_email,
         total_members=len(users),
         updated_invites=updated
-    )
\ No newline at end of file
+    )
+
+
+@router.post("/update_all", response_model=schemas.UpdateAllEmailIdsResponse)
+async def update_all_email_ids(
+    body: schemas.UpdateAllEmailIdsRequest = Body(default_factory=schemas.UpdateAllEmailIdsRequest),
+    db: Session = Depends(get_db)
+):
+    """
+    一次调用对账所有组（或指定的组长列表）。
+    Overleaf 请求按 concurrency 限制并发，数据库写入在事件循环中串行完成。
+    与 更新邮箱ID.py 共用 email_ids 租约，避免两处同时批量登录同一批账号。
+    """
+    try:
+        async with JobLease(SCOPE_EMAIL_IDS).hold():
+            return await _update_all_email_ids(body, db)
+    except LeaseHeldError:
+        raise HTTPException(status_code=400, detail="email_id 批量更新正在进行中，请等待完成")
+
+
+async def _update_all_email_ids(
+    body: schemas.UpdateAllEmailIdsRequest,
+    db: Session
+) -> schemas.UpdateAllEmailIdsResponse:
+    query = db.query(models.Account)
+    if body.leader_emails:
+        query = query.filter(models.Account.email.in_(body.leader_emails))
+    by_id = {acct.id: acct for acct in query.all()}
+    # 按同步优先级排列，信号量先放行最可能过期的组
+    accounts = [by_id[p.account_id] for p in rank_accounts(db, account_ids=by_id)]
+
+    semaphore = asyncio.Semaphore(body.concurrency)
+
+    async def fetch(acct: models.Account):
+        async with semaphore:
+            return await _fetch_account_members(acct)
+
+    fetched = await asyncio.gather(*(fetch(a) for a in accounts), return_exceptions=True)
+
+    results = []
+    for acct, outcome in zip(accounts, fetched):
+        if isinstance(outcome, Exception):
+            results.append(schemas.UpdateEmailIdsResult(
+                leader_email=acct.email,
+                success=False,
+                error=str(outcome)
+            ))
+            continue
+
+        users, new_sess, new_csrf = outcome
+        acct.session_cookie = new_sess
+        acct.csrf_token     = new_csrf
+        acct.updated_at     = int(time.time())
+        updated = reconcile_email_ids(db, acct, users)
+        results.append(schemas.UpdateEmailIdsResult(
+            leader_email=acct.email,
+            success=True,
+            total_members=len(users),
+            updated_invites=updated
+        ))
+
+    db.commit()
+
+    success_accounts = sum(1 for r in results if r.success)
+    return schemas.UpdateAllEmailIdsResponse(
+        total_accounts=len(accounts),
+        success_accounts=success_accounts,
+        failed_accounts=len(accounts) - success_accounts,
+        total_updated=sum(r.updated_invites for r in results),
+        results=results
+    )
@@ -1,7 +1,9 @@
 # schemas.py
 
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List, Dict, Any
+from pydantic import BaseModel, EmailStr, Field, validator
+from typing import Optional, List, Dict, Any, Literal
+
+import invite_result
 
 
 # -------- 通用请求模型 --------
@@ -37,6 +39,28 @@ class AccountOut(BaseModel):
         from_attributes = True
 
 
+class GroupCapacity(BaseModel):
+    account_id: int
+    email: str
+    max_invites: int
+    invites_sent: int
+    overleaf_member_count: Optional[int] = None
+    overleaf_pending_count: Optional[int] = None
+    member_count_at: Optional[int] = None
+    group_full_at: Optional[int] = None
+    known_full: bool
+    group_full_hits: int
+    group_full_avoided: int
+
+
+class CapacityStats(BaseModel):
+    total_accounts: int
+    known_full: int           # 当前已知满员、选账号时会跳过的组
+    group_full_hits: int      # 实际撞上 group_full 的次数
+    group_full_avoided: int   # 因已知满员跳过而省下的 group_full 调用次数
+    groups: List[GroupCapacity]
+
+
 # -------- Cards 相关 --------
 
 class CardCreate(BaseModel):
@@ -67,6 +91,7 @@ class InviteResponse(BaseModel):
     result: Dict[str, Any]
     sent_ts: Optional[int]
     expires_ts: Optional[int]
+    timings: Optional[Dict[str, Any]] = None  # debug=true 时返回各阶段耗时明细
 
 class CardDetectResponse(BaseModel):
     mode: str  # "normal" 或 "reactivate"
@@ -76,6 +101,18 @@ class CardDetectResponse(BaseModel):
     can_reactivate: bool
     message: str
 
+class InviteResultInfo(BaseModel):
+    """invites.result 中常用的字段（见 invite_result.py）；Overleaf 原始响应等其他内容不在列表中返回"""
+    status: Optional[str] = None
+    source: Optional[str] = None
+    sync_date: Optional[str] = None
+    overleaf_status: Optional[str] = None
+    note: Optional[str] = None
+    processed_at: Optional[int] = None
+    processed_reason: Optional[str] = None
+    reactivation_info: Optional[Dict[str, Any]] = None
+    cross_group_warning: Optional[Dict[str, Any]] = None
+
 class InviteRecord(BaseModel):
     id: int
     account_id: int
@@ -84,9 +121,30 @@ class InviteRecord(BaseModel):
     email_id: Optional[str]
     expires_at: Optional[int]  # Unix 时间戳，NULL表示手动添加的用户
     success: bool
-    result: str
+    result: InviteResultInfo
     created_at: int
 
+    @validator("result", pre=True)
+    def _parse_result(cls, value):
+        return invite_result.parse(value)
+
+    class Config:
+        from_attributes = True
+
+class InviteEventRecord(BaseModel):
+    """邀请记录的一条生命周期事件（见 invite_events.py）"""
+    id: int
+    invite_id: int
+    account_id: Optional[int]
+    kind: str
+    detail: Optional[str]
+    data: Optional[Dict[str, Any]]
+    at: int
+
+    @validator("data", pre=True)
+    def _parse_data(cls, value):
+        return invite_result.parse(value) if value else None
+
     class Config:
         from_attributes = True
 
@@ -101,6 +159,24 @@ class UpdateEmailIdsResponse(BaseModel):
     total_members: int
     updated_invites: int
 
+class UpdateAllEmailIdsRequest(BaseModel):
+    leader_emails: Optional[List[EmailStr]] = None  # 为空表示对账所有组长
+    concurrency: int = Field(4, ge=1, le=16)        # 同时访问 Overleaf 的组长数
+
+class UpdateEmailIdsResult(BaseModel):
+    leader_email: EmailStr
+    success: bool
+    total_members: int = 0
+    updated_invites: int = 0
+    error: Optional[str] = None
+
+class UpdateAllEmailIdsResponse(BaseModel):
+    total_accounts: int
+    success_accounts: int
+    failed_accounts: int
+    total_updated: int
+    results: List[UpdateEmailIdsResult]
+
 
 # -------- 删除组员 --------
 
@@ -110,10 +186,60 @@ class MemberEmailRequest(BaseModel):
 class RemoveMemberResponse(BaseModel):
     status: str
     detail: str
+    timings: Optional[Dict[str, Any]] = None  # debug=true 时返回各阶段耗时明细
+    outbox_id: Optional[str] = None  # 登记的 Overleaf 变更意图（outbox.py）
+
+class CleanupPlanAccount(BaseModel):
+    account_id: int
+    account_email: Optional[str] = None
+    group_id: Optional[str] = None
+    session: Optional[str] = None  # hot / warm / cold
+    needs_login: bool = False
+    invite_ids: List[int]
+    removals: int = 0  # 已接受，按 email_id 删除
+    revokes: int = 0   # 未接受，按邮箱撤销
+    auth_calls: int = 0
+    delete_calls: int = 0
+    estimated_calls: int = 0
+    auth_seconds: float = 0.0
+    delete_seconds: float = 0.0
+    estimated_seconds: float = 0.0
+    error: Optional[str] = None
+
+class CleanupPlan(BaseModel):
+    mode: Literal["overleaf", "delete_records", "mark_processed"] = "overleaf"
+    created_at: int = 0
+    concurrency: int = Field(4, ge=1, le=16)
+    interval: float = Field(0.2, ge=0)
+    totals: Optional[Dict[str, Any]] = None
+    accounts: List[CleanupPlanAccount]
+    latency: Optional[Dict[str, Dict[str, Any]]] = None  # 估算使用的各阶段平均耗时及来源
 
 class CleanupResponse(BaseModel):
     cleaned: int  # 兼容旧格式：总清理数量
     stats: Optional[Dict[str, int]] = None  # 详细统计信息
+    accounts: Optional[List[Dict[str, Any]]] = None  # 按组长账号的清理报告（cleanup_engine）
+    plan: Optional[CleanupPlan] = None  # dry_run=true 时返回的执行计划（cleanup_plan.py）
+
+
+class RevokeBatchRequest(BaseModel):
+    emails: List[EmailStr] = Field(..., min_length=1, max_length=500)
+    concurrency: int = Field(4, ge=1, le=16)  # 同时处理的组长账号数
+
+class RevokeBatchItemResult(BaseModel):
+    email: EmailStr
+    success: bool
+    status: str  # revoked / not_found（Overleaf 上已不存在）/ accepted / no_record / failed
+    account_emails: List[str] = []  # 撤销涉及的组长账号
+    error: Optional[str] = None
+
+class RevokeBatchResponse(BaseModel):
+    total: int
+    revoked_count: int
+    failed_count: int
+    accounts_used: int
+    results: List[RevokeBatchItemResult]
+    accounts: Optional[List[Dict[str, Any]]] = None  # 按组长账号的报告（认证耗时、失败明细）
 
 
 class GroupMemberInfo(BaseModel):
@@ -128,6 +254,23 @@ class LeaderGroupMembersResponse(BaseModel):
     active_members: List[GroupMemberInfo] # 未过期的组员列表
     expired_members_count: int # 数据库中已过期且未清理的组员数量
 
+class MembershipInfo(BaseModel):
+    invite_id: int
+    email: str
+    email_id: Optional[str] = None
+    account_id: int
+    account_email: str
+    group_id: str
+    expires_at: Optional[int] = None
+    created_at: int
+    cleaned: bool
+
+class MembershipsResponse(BaseModel):
+    email: str
+    total: int
+    cross_group: bool # 是否在多个组中都有未清理记录
+    memberships: List[MembershipInfo] # 从新到旧
+
 # -------- 新增：更新邀请过期时间相关 --------
 
 class InviteUpdateExpirationRequest(BaseModel):
@@ -138,4 +281,43 @@ class UpdateExpirationResponse(BaseModel):
     message: str
     updated_email: EmailStr
     new_expires_at: int
-    invite_id: Optional[int] = None # 可选：返回更新的邀请记录ID
\ No newline at end of file
+    invite_id: Optional[int] = None # 可选：返回更新的邀请记录ID
+
+# -------- 异步邀请任务 --------
+
+class InviteJobStatus(BaseModel):
+    job_id: str
+    status: str                        # queued / running / succeeded / failed
+    stage: str                         # 细分进度
+    email: EmailStr
+    attempt: int = 0                   # 当前第几个账号
+    account_email: Optional[str] = None
+    result: Optional[InviteResponse] = None  # 成功时与同步模式的响应相同
+    error: Optional[str] = None
+    error_status: Optional[int] = None       # 同步模式下会返回的 HTTP 状态码
+    created_at: int
+    started_at: Optional[int] = None
+    finished_at: Optional[int] = None
+
+# -------- 批量邀请 --------
+
+class BatchInviteRequest(BaseModel):
+    items: List[InviteRequest] = Field(..., min_length=1, max_length=500)
+    concurrency: int = Field(4, ge=1, le=16)  # 同时处理的组长账号数
+
+class BatchInviteItemResult(BaseModel):
+    email: EmailStr
+    card: str
+    success: bool
+    account_email: Optional[str] = None
+    expires_ts: Optional[int] = None
+    attempts: int = 0                 # 尝试过的组长账号数
+    error: Optional[str] = None
+    warning: Optional[str] = None     # 跨群组警告（该邮箱在其他组还有未清理记录）
+
+class BatchInviteResponse(BaseModel):
+    total: int
+    success_count: int
+    failed_count: int
+    accounts_used: int
+    results: List[BatchInviteItemResult]
@@ -0,0 +1,153 @@
+# session_pool.py
+"""
+组长会话热度
+冷账号邀请要走 Playwright 登录 + 验证码，热账号只需要一次 send_invite。
+- hot：session 在 SESSION_REUSE_SECONDS 内验证过，邀请时直接用已保存的 cookie/CSRF 发送，失败再刷新
+- warm：在 SESSION_WARM_SECONDS 内验证过，刷新 token 即可
+- cold：没有 token 或很久没验证，大概率需要完整登录
+选账号时热账号优先（同热度内剩余名额多的优先，再按 updated_at 轮换），
+SessionWarmer 在后台提前给有剩余名额、即将变冷的账号刷新会话，邀请请求不再承担完整登录。
+"""
+
+import time
+import asyncio
+import logging
+from typing import Optional, List
+
+import models
+from database import SessionLocal
+from settings import settings
+from invite_status_manager import InviteStatusManager
+from job_coordinator import JobLease, LeaseHeldError, SCOPE_SESSION_WARMUP, account_lock
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+HOT, WARM, COLD = "hot", "warm", "cold"
+_RANK = {HOT: 0, WARM: 1, COLD: 2}
+
+
+def session_warmth(acct: models.Account, now_ts: Optional[int] = None) -> str:
+    if now_ts is None:
+        now_ts = int(time.time())
+    if not (acct.session_cookie and acct.csrf_token):
+        return COLD
+    age = now_ts - (acct.session_validated_at or 0)
+    if age <= settings.SESSION_REUSE_SECONDS:
+        return HOT
+    if age <= settings.SESSION_WARM_SECONDS:
+        return WARM
+    return COLD
+
+
+def routing_key(acct: models.Account, now_ts: Optional[int] = None, spare: int = 0) -> tuple:
+    """
+    选账号的排序键：先按会话热度，再按剩余名额 spare（max_invites - 实际邀请数，多的优先），
+    最后按 updated_at（最久未使用优先）
+    """
+    return (_RANK[session_warmth(acct, now_ts)], -spare, acct.updated_at or 0)
+
+
+def accounts_to_warm(db, now_ts: Optional[int] = None, limit: int = settings.SESSION_WARMER_BATCH) -> List[models.Account]:
+    """
+    需要预热的账号：有剩余名额，且会话已冷或验证时间超过 SESSION_WARM_SECONDS 的一半（趁还能刷新时续上）。
+    按 updated_at 升序，也就是下一批最可能被选中的账号优先。
+    """
+    if now_ts is None:
+        now_ts = int(time.time())
+    threshold = now_ts - settings.SESSION_WARM_SECONDS // 2
+    candidates = (
+        db.query(models.Account)
+        .filter(models.Account.session_validated_at.is_(None) |
+                (models.Account.session_validated_at < threshold))
+        .order_by(models.Account.updated_at.asc())
+        .all()
+    )
+    selected = []
+    for acct in candidates:
+        if InviteStatusManager.calculate_invites_sent(db, acct) < (acct.max_invites or 0):
+            selected.append(acct)
+            if len(selected) >= limit:
+                break
+    return selected
+
+
+async def warm_account(db, acct: models.Account) -> bool:
+    """
+    刷新（必要时完整登录）一个账号的会话并写回数据库。
+    与邀请共用 account_lock，不会和正在进行的邀请同时刷新 token；账号正被使用时跳过
+    """
+    import crud
+    from overleaf_utils import open_group_session
+
+    try:
+        async with account_lock(acct.id, timeout=settings.SESSION_WARMER_LOCK_TIMEOUT):
+            # 等锁期间可能已被邀请刷新过，读取最新的 token
+            db.refresh(acct)
+            if session_warmth(acct) == HOT:
+                return False
+            try:
+                with span("session_warmup", account_id=acct.id):
+                    _, new_sess, new_csrf = await open_group_session(acct)
+            except Exception as e:
+                logger.warning(f"预热账号 {acct.email} 会话失败: {type(e).__name__} - {e}")
+                crud.mark_session_cold(db, acct)
+                return False
+            crud.update_account_tokens(db, acct, new_csrf, new_sess)
+    except LeaseHeldError:
+        logger.info(f"账号 {acct.email} 正在使用中，跳过预热")
+        return False
+    logger.info(f"已预热账号 {acct.email} 的会话")
+    return True
+
+
+async def warm_cold_accounts(limit: int = settings.SESSION_WARMER_BATCH) -> int:
+    """预热一批账号；多进程下靠租约保证同一时间只有一个预热者（登录要消耗验证码）"""
+    lease = JobLease(SCOPE_SESSION_WARMUP)
+    try:
+        async with lease.hold():
+            db = SessionLocal()
+            try:
+                targets = accounts_to_warm(db, limit=limit)
+                await lease.update_progress_async(0, total=len(targets))
+                warmed = 0
+                for i, acct in enumerate(targets):
+                    await lease.update_progress_async(i, current_item=acct.email)
+                    if await warm_account(db, acct):
+                        warmed += 1
+                await lease.update_progress_async(len(targets))
+                return warmed
+            finally:
+                db.close()
+    except LeaseHeldError:
+        return 0
+
+
+class SessionWarmer:
+    """每隔 interval 秒预热一批账号"""
+
+    def __init__(self, interval: int = settings.SESSION_WARMER_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._loop())
+            logger.info(f"会话预热已启动: 每 {self.interval} 秒")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await warm_cold_accounts()
+            except Exception as e:
+                logger.exception(f"会话预热出错: {e}")
+            await asyncio.sleep(self.interval)
+
+
+session_warmer = SessionWarmer()
@@ -8,6 +8,79 @@ class Settings:
     YESCAPTCHA_KEY = "1a41fe89a169c17ebc4285ba9b4b8056678fb2a546600"
     SITE_KEY       = "6LebiTwUAAAAAMuPyjA4pDA4jxPxPe2K9_ndL74Q"
 
+    # 系统整体维护中同步步骤的时间上限（秒），None 表示同步全部账户；
+    # 账户按 sync_scheduler 优先级处理，到点后剩余账户留给下一次维护
+    MAINTENANCE_SYNC_MAX_SECONDS = None
+
+    # 异步邀请任务的 worker 数（每个 API 进程）
+    INVITE_JOB_WORKERS = 4
+
+    # 同一组长账号的 token 刷新 + 发送在所有 worker / 进程间串行（job_coordinator.account_lock），
+    # 等待该账号最多 INVITE_ACCOUNT_LOCK_TIMEOUT 秒，超时则换下一个账号
+    INVITE_ACCOUNT_LOCK_TIMEOUT = 90
+
+    # 后台工作项（重新激活后的原组清理等）的 worker 数（每个 API 进程）
+    WORK_QUEUE_WORKERS = 2
+
+    # 组长会话热度（见 session_pool.py）：
+    # 验证后 SESSION_REUSE_SECONDS 内直接用已保存的 token 发邀请，不再刷新；
+    # SESSION_WARM_SECONDS 内视为热会话，选账号时优先
+    SESSION_REUSE_SECONDS = 600
+    SESSION_WARM_SECONDS  = 6 * 3600
+    # 后台预热：每隔多少秒预热一批即将变冷、仍有名额的账号（0 表示关闭），每批最多几个
+    SESSION_WARMER_INTERVAL = 300
+    SESSION_WARMER_BATCH    = 2
+    # 预热只等待账号锁几秒，账号正被邀请使用时跳过（邀请本身会刷新会话）
+    SESSION_WARMER_LOCK_TIMEOUT = 5
+
+    # 组已知满员（撞上 group_full 或成员列表已满）后，多久内不再向它发邀请；
+    # 期间同步/更新 email_id 拉取到有空位的成员列表会提前解除
+    GROUP_FULL_RECHECK_SECONDS = 6 * 3600
+
+    # 卡密状态（card_state.py）跨请求缓存的秒数，只用于 /detect 等只读判断；0 表示不缓存
+    CARD_STATE_CACHE_SECONDS = 30
+
+    # 过期成员清理（cleanup_engine.py）：最多几个组长账号同时清理；
+    # 同一账号的相邻两次删除请求之间间隔多少秒（避免请求过快）
+    CLEANUP_ACCOUNT_CONCURRENCY = 4
+    CLEANUP_DELETE_INTERVAL     = 0.2
+
+    # 到期调度（expiry_scheduler.py）：按 expires_at 精确触发清理，代替 30 分钟轮询。
+    # 到期后 EXPIRY_FIRE_DELAY 秒触发（同一时刻附近到期的合并为一批），每批最多 EXPIRY_BATCH_SIZE 条；
+    # 清理失败的 EXPIRY_RETRY_SECONDS 秒后重试；每 EXPIRY_RESYNC_SECONDS 秒按索引重新加载一次
+    # （兜底其他进程 / 脚本写入的到期时间）；EXPIRY_SCHEDULER_ENABLED=False 时只靠定时脚本
+    EXPIRY_SCHEDULER_ENABLED = True
+    EXPIRY_FIRE_DELAY        = 5
+    EXPIRY_BATCH_SIZE        = 20
+    EXPIRY_RETRY_SECONDS     = 300
+    EXPIRY_RESYNC_SECONDS    = 3600
+
+    # Overleaf 变更 outbox（outbox.py）：每个 API 进程同时派发几个组长账号的批次、每批最多几条、最多尝试几次
+    OUTBOX_WORKERS      = 2
+    OUTBOX_BATCH_SIZE   = 50
+    OUTBOX_MAX_ATTEMPTS = 6
+
+    # 维护服务（maintenance_daemon.py）：清理过期成员 / 更新 email_id / 系统整体维护作为异步任务
+    # 跑在一个长驻进程里（默认嵌入 API 进程），不再由 cron 每次启动新的 Python 进程；
+    # 多个进程同时到点时靠 job_leases 租约只执行一个。MAINTENANCE_DAEMON_ENABLED=False 时改用 crontab
+    MAINTENANCE_DAEMON_ENABLED     = True
+    MAINTENANCE_CLEANUP_INTERVAL   = 6 * 3600
+    MAINTENANCE_EMAIL_IDS_INTERVAL = 3600
+    MAINTENANCE_DAILY_AT           = "02:00"   # 本地时间
+    MAINTENANCE_CLEANUP_LIMIT      = 50
+
+    # 历史归档（archive.py）：已清理且过期超过 ARCHIVE_AFTER_DAYS 天的邀请记录移到 invites_archive，
+    # 每块 ARCHIVE_CHUNK_SIZE 条；维护服务每天 ARCHIVE_DAILY_AT 执行一次
+    ARCHIVE_AFTER_DAYS  = 30
+    ARCHIVE_CHUNK_SIZE  = 1000
+    ARCHIVE_DAILY_AT    = "03:30"
+
+    # 邀请事件（invite_events.py）压缩：早于 INVITE_EVENTS_COMPACT_AFTER_DAYS 天的事件中，
+    # 进展类事件每条记录只保留最新一条，已被硬删除（不在热表也不在归档表）的记录的事件删除；
+    # 维护服务每天 INVITE_EVENTS_COMPACT_AT 执行一次
+    INVITE_EVENTS_COMPACT_AFTER_DAYS = 30
+    INVITE_EVENTS_COMPACT_AT         = "04:00"
+
     # SQLite 数据库路径
     SQLALCHEMY_DATABASE_URL = "sqlite:///./overleaf_inviter.db"
 
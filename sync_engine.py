@@ -0,0 +1,461 @@
+# sync_engine.py
+"""
+Overleaf 对账引擎
+输入 (数据库邀请记录, Overleaf 成员列表)，输出带类型、可序列化的变更集 ChangeSet，
+再在单个事务中批量应用。API 同步（routers/sync.py）与各维护脚本共用这一套逻辑，
+dry-run 预览就是只生成变更集、不应用。
+"""
+
+import json
+import time
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from enum import Enum
+from types import SimpleNamespace
+from typing import Optional, List, Dict, Any, Iterable
+
+from sqlalchemy import insert, update, func, case, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+import models
+import migrations
+import invite_result
+import invite_events
+from invite_status_manager import InviteStatusManager
+from outbox import in_flight_invite_ids
+
+
+class ChangeAction(str, Enum):
+    """变更类型"""
+    SET_EMAIL_ID    = "set_email_id"     # Overleaf 显示已接受，但数据库没有 email_id
+    MARK_CLEANED    = "mark_cleaned"     # Overleaf 中不存在，但数据库未清理
+    UNMARK_CLEANED  = "unmark_cleaned"   # 数据库已清理，但 Overleaf 中仍存在
+    CREATE_EXTERNAL = "create_external"  # 只在 Overleaf 中存在的数据库外用户
+    FIX_COUNT       = "fix_count"        # 修正账户 invites_sent
+
+
+class CountSource(str, Enum):
+    """fix_count 的计数依据"""
+    DATABASE = "db"        # 按修复后的数据库记录重新计算（与 calculate_invites_sent 同规则）
+    OVERLEAF = "overleaf"  # 直接采用 Overleaf 成员数
+
+
+# 数据库外用户 result 里的说明文字，按来源区分
+EXTERNAL_NOTES = {
+    "manual_sync_from_overleaf": "手动添加的用户，需要联系客户确认过期时间和卡密信息",
+    "daily_sync_maintenance": "系统自动检测的数据库外用户，需要联系客户确认",
+}
+
+
+@dataclass
+class Change:
+    """单条变更"""
+    action: ChangeAction
+    reason: str
+    invite_id: Optional[int] = None
+    email: Optional[str] = None
+    email_id: Optional[str] = None
+    overleaf_status: Optional[str] = None
+    old_count: Optional[int] = None
+    new_count: Optional[int] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {k: v for k, v in asdict(self).items() if v is not None}
+        data["action"] = self.action.value
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Change":
+        return cls(**{**data, "action": ChangeAction(data["action"])})
+
+
+@dataclass
+class ChangeSet:
+    """一个账户的完整变更集"""
+    account_id: int
+    account_email: str
+    group_id: str
+    overleaf_count: int
+    db_count: int
+    source: str = "manual_sync_from_overleaf"
+    overleaf_pending: int = 0  # Overleaf 成员中待接受的邀请数
+    sync_date: str = field(default_factory=lambda: datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    changes: List[Change] = field(default_factory=list)
+    applied: bool = False
+
+    def of(self, action: ChangeAction) -> List[Change]:
+        return [c for c in self.changes if c.action == action]
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.changes
+
+    def summary(self) -> Dict[str, int]:
+        counts = {action.value: 0 for action in ChangeAction}
+        for change in self.changes:
+            counts[change.action.value] += 1
+        return counts
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "account_id": self.account_id,
+            "account_email": self.account_email,
+            "group_id": self.group_id,
+            "overleaf_count": self.overleaf_count,
+            "db_count": self.db_count,
+            "overleaf_pending": self.overleaf_pending,
+            "source": self.source,
+            "sync_date": self.sync_date,
+            "applied": self.applied,
+            "summary": self.summary(),
+            "changes": [c.to_dict() for c in self.changes],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ChangeSet":
+        return cls(
+            account_id=data["account_id"],
+            account_email=data["account_email"],
+            group_id=data["group_id"],
+            overleaf_count=data["overleaf_count"],
+            db_count=data["db_count"],
+            source=data.get("source", "manual_sync_from_overleaf"),
+            overleaf_pending=data.get("overleaf_pending", 0),
+            sync_date=data["sync_date"],
+            changes=[Change.from_dict(c) for c in data.get("changes", [])],
+            applied=data.get("applied", False),
+        )
+
+
+def members_from_overleaf_users(users: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """把 ol-users 原始数据转换为统一格式 {email, user_id, status}"""
+    return [
+        {
+            "email": user.get("email"),
+            "user_id": user.get("_id"),
+            "status": "accepted" if user.get("_id") else "pending"
+        }
+        for user in users
+    ]
+
+
+def plan_changes(
+    account: models.Account,
+    db_invites: Iterable,
+    overleaf_members: List[Dict[str, Any]],
+    count_source: CountSource = CountSource.DATABASE,
+    source: str = "manual_sync_from_overleaf",
+    now_ts: Optional[int] = None,
+    in_flight: Iterable[int] = ()
+) -> ChangeSet:
+    """
+    纯计算：根据该账户的全部邀请记录和 Overleaf 成员列表生成变更集，不访问数据库。
+    db_invites 需要具备 id / email / email_id / cleaned / expires_at / created_at 属性，
+    ORM 对象或查询出的行均可。
+    in_flight 为 outbox 中还没在 Overleaf 上执行完的删除 / 撤销所涉及的记录 id，
+    这些记录已清理但成员暂时仍在 Overleaf 上，不恢复为未清理。
+    """
+    if now_ts is None:
+        now_ts = int(time.time())
+    db_invites = list(db_invites)
+    in_flight = set(in_flight)
+
+    overleaf_status = {}
+    for member in overleaf_members:
+        if member.get("email"):
+            overleaf_status[member["email"]] = member
+
+    change_set = ChangeSet(
+        account_id=account.id,
+        account_email=account.email,
+        group_id=account.group_id,
+        overleaf_count=len(overleaf_members),
+        db_count=account.invites_sent or 0,
+        source=source,
+        overleaf_pending=sum(1 for m in overleaf_members if m.get("status") == "pending"),
+    )
+    changes = change_set.changes
+
+    # 模拟修复后的状态，用于预估 fix_count
+    simulated = []
+
+    for invite in db_invites:
+        email_id = invite.email_id
+        cleaned = invite.cleaned
+        ol_data = overleaf_status.get(invite.email)
+
+        if ol_data is not None:
+            if ol_data["status"] == "accepted" and not invite.email_id:
+                email_id = ol_data["user_id"]
+                changes.append(Change(
+                    action=ChangeAction.SET_EMAIL_ID,
+                    invite_id=invite.id,
+                    email=invite.email,
+                    email_id=email_id,
+                    reason="Overleaf显示已接受，但数据库未更新email_id"
+                ))
+            if invite.cleaned and invite.id not in in_flight:
+                cleaned = False
+                changes.append(Change(
+                    action=ChangeAction.UNMARK_CLEANED,
+                    invite_id=invite.id,
+                    email=invite.email,
+                    reason="数据库标记为已清理，但Overleaf中仍存在"
+                ))
+        elif not invite.cleaned:
+            cleaned = True
+            changes.append(Change(
+                action=ChangeAction.MARK_CLEANED,
+                invite_id=invite.id,
+                email=invite.email,
+                reason="Overleaf中不存在，应标记为已清理"
+            ))
+
+        simulated.append(SimpleNamespace(
+            email=invite.email,
+            created_at=invite.created_at,
+            email_id=email_id,
+            cleaned=cleaned,
+            expires_at=invite.expires_at,
+        ))
+
+    db_emails = {invite.email for invite in db_invites}
+    for email, ol_data in overleaf_status.items():
+        if email in db_emails:
+            continue
+        changes.append(Change(
+            action=ChangeAction.CREATE_EXTERNAL,
+            email=email,
+            email_id=ol_data["user_id"] if ol_data["status"] == "accepted" else None,
+            overleaf_status=ol_data["status"],
+            reason="只在Overleaf中存在的数据库外用户"
+        ))
+        simulated.append(SimpleNamespace(
+            email=email,
+            created_at=now_ts,
+            email_id=ol_data["user_id"],
+            cleaned=False,
+            expires_at=None,
+        ))
+
+    if count_source == CountSource.OVERLEAF:
+        new_count = change_set.overleaf_count
+    else:
+        new_count = InviteStatusManager.count_active_latest(latest_per_email(simulated), now_ts)
+
+    if new_count != change_set.db_count:
+        changes.append(Change(
+            action=ChangeAction.FIX_COUNT,
+            old_count=change_set.db_count,
+            new_count=new_count,
+            reason=f"账户计数应为 {new_count}（依据: {count_source.value}）"
+        ))
+
+    return change_set
+
+
+def latest_per_email(invites: List) -> List:
+    """与 calculate_invites_sent 相同的取法：每个邮箱 created_at 最大的记录（并列时都保留）"""
+    latest_ts = {}
+    for invite in invites:
+        if invite.email not in latest_ts or invite.created_at > latest_ts[invite.email]:
+            latest_ts[invite.email] = invite.created_at
+    return [i for i in invites if i.created_at == latest_ts[i.email]]
+
+
+def _external_result(change_set: ChangeSet, change: Change) -> str:
+    result_info = {
+        "source": change_set.source,
+        "sync_date": change_set.sync_date,
+        "account_manager": change_set.account_email,
+        "overleaf_status": change.overleaf_status,
+        "overleaf_user_id": change.email_id,
+        "note": EXTERNAL_NOTES.get(change_set.source, EXTERNAL_NOTES["manual_sync_from_overleaf"]),
+        "action_required": "请设置过期时间并关联正确的卡密",
+        "warning": "设置过期时间后，到期会被正常清理删除"
+    }
+    return invite_result.dumps(result_info)
+
+
+EXTERNAL_INDEX = "uq_invites_external_account_email"
+
+
+def _external_upsert(db: Session):
+    """
+    数据库外用户的批量写入语句。
+    SQLite / PostgreSQL 使用 INSERT ... ON CONFLICT，冲突目标是部分唯一索引
+    uq_invites_external_account_email（expires_at IS NULL 的 (account_id, email)）：
+    并发或重复同步时不会插入重复记录，只补上缺失的 email_id。
+    其他数据库，或索引不存在（已有重复数据时 migrations 跳过建索引，见 INDEX_BLOCKERS）时返回 None，
+    由 _write_external_rows 先查已有记录再写入。
+    """
+    dialect_insert = {
+        "sqlite": sqlite.insert,
+        "postgresql": postgresql.insert,
+    }.get(db.get_bind().dialect.name)
+    if dialect_insert is None:
+        return None
+    if EXTERNAL_INDEX not in migrations.existing_index_names(db.connection(), models.Invite.__table__):
+        return None
+
+    stmt = dialect_insert(models.Invite)
+    return stmt.on_conflict_do_update(
+        index_elements=[models.Invite.account_id, models.Invite.email],
+        index_where=models.Invite.expires_at.is_(None),
+        set_={
+            "email_id": func.coalesce(models.Invite.email_id, stmt.excluded.email_id),
+            "cleaned": False,
+        }
+    )
+
+
+def _write_external_rows(db: Session, account_id: int, rows: List[Dict[str, Any]]) -> None:
+    """写入数据库外用户；没有可用的 ON CONFLICT 时与 upsert 效果相同：已有记录补 email_id 并恢复，其余批量 INSERT"""
+    stmt = _external_upsert(db)
+    if stmt is not None:
+        db.execute(stmt, rows)
+        return
+
+    existing = (
+        db.query(models.Invite.id, models.Invite.email)
+        .filter(models.Invite.account_id == account_id,
+                models.Invite.expires_at.is_(None),
+                models.Invite.email.in_([row["email"] for row in rows]))
+        .all()
+    )
+    by_email = {row["email"]: row for row in rows}
+    if existing:
+        invites = models.Invite.__table__
+        db.execute(
+            update(invites)
+            .where(invites.c.id == bindparam("invite_id"))
+            .values(email_id=func.coalesce(invites.c.email_id, bindparam("new_email_id")), cleaned=False),
+            [{"invite_id": invite_id, "new_email_id": by_email[email]["email_id"]} for invite_id, email in existing]
+        )
+    existing_emails = {email for _, email in existing}
+    new_rows = [row for row in rows if row["email"] not in existing_emails]
+    if new_rows:
+        db.execute(insert(models.Invite), new_rows)
+
+
+def apply_change_set(db: Session, change_set: ChangeSet, dry_run: bool = False) -> ChangeSet:
+    """
+    在单个事务中批量应用变更集：
+    - 现有记录的 email_id / cleaned 修复按列分组，每组一条 executemany UPDATE
+    - 对应的邀请事件（见 invite_events.py）一条 executemany INSERT
+    - 数据库外用户一条批量 INSERT ... ON CONFLICT（见 _external_upsert / _write_external_rows）
+    - 账户计数、对账快照（last_synced_at / last_drift，供 sync_scheduler 排序）与容量快照一条 UPDATE
+    dry_run=True 时原样返回，不触碰数据库。
+    """
+    if dry_run:
+        return change_set
+
+    row_updates: Dict[int, Dict[str, Any]] = {}
+    events: List[Dict[str, Any]] = []
+    for change in change_set.changes:
+        if change.invite_id is None:
+            continue
+        row = row_updates.setdefault(change.invite_id, {"id": change.invite_id})
+        event = {"invite_id": change.invite_id, "account_id": change_set.account_id, "detail": None}
+        if change.action == ChangeAction.SET_EMAIL_ID:
+            row["email_id"] = change.email_id
+            events.append({**event, "kind": invite_events.EMAIL_ID, "detail": change.email_id})
+        elif change.action == ChangeAction.UNMARK_CLEANED:
+            row["cleaned"] = False
+            events.append({**event, "kind": invite_events.RESTORED})
+        elif change.action == ChangeAction.MARK_CLEANED:
+            row["cleaned"] = True
+            events.append({**event, "kind": invite_events.PROCESSED, "detail": "missing_on_overleaf"})
+
+    now_ts = int(time.time())
+    external_rows = [
+        {
+            "account_id": change_set.account_id,
+            "card_id": None,  # 手动添加的用户没有卡密，需要后续关联
+            "email": change.email,
+            "email_id": change.email_id,
+            "expires_at": None,  # 关键：不设置过期时间，标记为手动添加
+            "success": True,  # 已经在Overleaf中存在
+            "result": _external_result(change_set, change),
+            "created_at": now_ts,
+            "cleaned": False,
+        }
+        for change in change_set.of(ChangeAction.CREATE_EXTERNAL)
+    ]
+
+    try:
+        # 按更新的列分组，每组一条 executemany（混在一起会被拆成逐行语句）
+        groups: Dict[tuple, List[Dict[str, Any]]] = {}
+        for row in row_updates.values():
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for rows in groups.values():
+            db.execute(update(models.Invite), rows)
+        invite_events.record_rows(db, events, at=now_ts)
+        if external_rows:
+            _write_external_rows(db, change_set.account_id, external_rows)
+        account_values = {
+            "last_synced_at": now_ts,
+            "last_drift": len(change_set.changes),
+            # 容量快照：拉到有空位的成员列表即解除 group_full 标记（见 group_capacity.is_known_full）
+            "overleaf_member_count": change_set.overleaf_count,
+            "overleaf_pending_count": change_set.overleaf_pending,
+            "member_count_at": now_ts,
+            "group_full_at": case(
+                (models.Account.max_invites > change_set.overleaf_count, 0),
+                else_=models.Account.group_full_at,
+            ),
+        }
+        for change in change_set.of(ChangeAction.FIX_COUNT):
+            account_values["invites_sent"] = change.new_count
+        db.execute(
+            update(models.Account)
+            .where(models.Account.id == change_set.account_id)
+            .values(**account_values)
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    change_set.applied = True
+    return change_set
+
+
+def load_account_invites(db: Session, account: models.Account) -> List:
+    """只取对账需要的列，避免为上万条记录构造 ORM 对象"""
+    return (
+        db.query(
+            models.Invite.id,
+            models.Invite.email,
+            models.Invite.email_id,
+            models.Invite.cleaned,
+            models.Invite.expires_at,
+            models.Invite.created_at,
+        )
+        .filter(models.Invite.account_id == account.id)
+        .all()
+    )
+
+
+def reconcile_account(
+    db: Session,
+    account: models.Account,
+    overleaf_members: List[Dict[str, Any]],
+    dry_run: bool = False,
+    count_source: CountSource = CountSource.DATABASE,
+    source: str = "manual_sync_from_overleaf"
+) -> ChangeSet:
+    """加载 → 规划 → 应用 的便捷入口"""
+    change_set = plan_changes(
+        account,
+        load_account_invites(db, account),
+        overleaf_members,
+        count_source=count_source,
+        source=source,
+        in_flight=in_flight_invite_ids(db, account.id),
+    )
+    return apply_change_set(db, change_set, dry_run=dry_run)
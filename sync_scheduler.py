@@ -0,0 +1,172 @@
+# sync_scheduler.py
+"""
+同步优先级队列
+按"这个账户现在最可能和 Overleaf 不一致的程度"给账户打分，批量同步与 email_id 更新按分数从高到低处理，
+有时间上限的运行会先覆盖最可能过期的账户，而不是按表顺序。
+
+评分依据（一条聚合 SQL 取出，不逐账户查询）：
+- 待接受邀请：成功发出、未清理、还没有 email_id
+- 即将到期：24 小时内到期且未清理
+- 上次对账后新发出的邀请
+- 上次对账后账户计数发生过变化（删除成员、清理等都会刷新 updated_at）
+- 距上次对账的时间，从未对账的账户排在最前
+- 上次对账发现的变更条数
+"""
+
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Optional, List, Dict, Any, Iterable
+
+from sqlalchemy import func, case, and_
+from sqlalchemy.orm import Session
+
+import models
+
+# 各项权重
+WEIGHT_PENDING        = 3.0   # 每条待接受邀请
+WEIGHT_EXPIRING       = 2.0   # 每条 24 小时内到期的邀请
+WEIGHT_RECENT_INVITE  = 2.0   # 每条上次对账后新发的邀请
+WEIGHT_RECENT_CHANGE  = 5.0   # 上次对账后账户有过计数变化
+WEIGHT_STALE_PER_DAY  = 4.0   # 距上次对账每 1 天
+WEIGHT_DRIFT          = 1.0   # 上次对账每条变更
+NEVER_SYNCED_BONUS    = 1000.0
+
+EXPIRING_WINDOW = 24 * 3600
+MAX_STALE_DAYS  = 14     # 超过后不再继续加分，避免长期无人使用的组压过有活动的组
+MAX_DRIFT       = 50
+
+
+@dataclass
+class AccountPriority:
+    """单个账户的同步优先级"""
+    account_id: int
+    email: str
+    score: float
+    pending: int = 0
+    expiring_soon: int = 0
+    recent_invites: int = 0
+    changed_since_sync: bool = False
+    stale_days: float = 0.0
+    last_drift: int = 0
+    never_synced: bool = False
+    reasons: Dict[str, float] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data["score"] = round(self.score, 2)
+        data["stale_days"] = round(self.stale_days, 2)
+        data["reasons"] = {k: round(v, 2) for k, v in self.reasons.items()}
+        return data
+
+
+def score_account(
+    account_id: int,
+    email: str,
+    last_synced_at: int,
+    last_drift: int,
+    updated_at: int,
+    pending: int,
+    expiring_soon: int,
+    recent_invites: int,
+    now_ts: int
+) -> AccountPriority:
+    """纯计算：按各项指标给一个账户打分"""
+    never_synced = not last_synced_at
+    stale_days = 0.0 if never_synced else max(0, now_ts - last_synced_at) / 86400
+    changed = not never_synced and (updated_at or 0) > last_synced_at
+    drift = min(last_drift or 0, MAX_DRIFT)
+
+    reasons = {
+        "pending": pending * WEIGHT_PENDING,
+        "expiring_soon": expiring_soon * WEIGHT_EXPIRING,
+        "recent_invites": recent_invites * WEIGHT_RECENT_INVITE,
+        "changed_since_sync": WEIGHT_RECENT_CHANGE if changed else 0.0,
+        "staleness": min(stale_days, MAX_STALE_DAYS) * WEIGHT_STALE_PER_DAY,
+        "last_drift": drift * WEIGHT_DRIFT,
+        "never_synced": NEVER_SYNCED_BONUS if never_synced else 0.0,
+    }
+    reasons = {k: v for k, v in reasons.items() if v}
+
+    return AccountPriority(
+        account_id=account_id,
+        email=email,
+        score=sum(reasons.values()),
+        pending=pending,
+        expiring_soon=expiring_soon,
+        recent_invites=recent_invites,
+        changed_since_sync=changed,
+        stale_days=stale_days,
+        last_drift=last_drift or 0,
+        never_synced=never_synced,
+        reasons=reasons,
+    )
+
+
+def rank_accounts(
+    db: Session,
+    now_ts: Optional[int] = None,
+    account_ids: Optional[Iterable[int]] = None,
+    limit: Optional[int] = None
+) -> List[AccountPriority]:
+    """返回按优先级从高到低排序的账户列表"""
+    if now_ts is None:
+        now_ts = int(time.time())
+
+    Invite, Account = models.Invite, models.Account
+    active = Invite.cleaned.is_(False)
+
+    stats = (
+        db.query(
+            Invite.account_id.label("account_id"),
+            func.sum(case(
+                (and_(active, Invite.success.is_(True), Invite.email_id.is_(None),
+                      Invite.expires_at.isnot(None)), 1),
+                else_=0
+            )).label("pending"),
+            func.sum(case(
+                (and_(active, Invite.expires_at >= now_ts,
+                      Invite.expires_at < now_ts + EXPIRING_WINDOW), 1),
+                else_=0
+            )).label("expiring_soon"),
+            func.sum(case(
+                (Invite.created_at > func.coalesce(Account.last_synced_at, 0), 1),
+                else_=0
+            )).label("recent_invites"),
+        )
+        .join(Account, Account.id == Invite.account_id)
+        .group_by(Invite.account_id)
+        .subquery()
+    )
+
+    query = (
+        db.query(
+            Account.id, Account.email, Account.last_synced_at,
+            Account.last_drift, Account.updated_at,
+            stats.c.pending, stats.c.expiring_soon, stats.c.recent_invites,
+        )
+        .outerjoin(stats, stats.c.account_id == Account.id)
+    )
+    if account_ids is not None:
+        query = query.filter(Account.id.in_(list(account_ids)))
+
+    ranked = [
+        score_account(
+            account_id=row.id,
+            email=row.email,
+            last_synced_at=row.last_synced_at or 0,
+            last_drift=row.last_drift or 0,
+            updated_at=row.updated_at or 0,
+            pending=row.pending or 0,
+            expiring_soon=row.expiring_soon or 0,
+            recent_invites=row.recent_invites or 0,
+            now_ts=now_ts,
+        )
+        for row in query.all()
+    ]
+    # 同分时按 id，保证顺序稳定
+    ranked.sort(key=lambda p: (-p.score, p.account_id))
+    return ranked[:limit] if limit else ranked
+
+
+def prioritized_account_ids(db: Session, limit: Optional[int] = None) -> List[int]:
+    return [p.account_id for p in rank_accounts(db, limit=limit)]
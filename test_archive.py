@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+测试历史归档：只归档已清理且足够旧的记录、同邮箱仍有未清理记录 / 卡密仍有活跃记录 / outbox 未完成时保留、
+计数不变、按邮箱和卡密检索、归档后卡密仍判断为已过期、dry_run 只统计
+使用内存数据库
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+
+import models
+import card_state
+import archive
+
+DAY = 86400
+
+
+def seed(db, now):
+    acct = models.Account(email="leader@x.com", password="p", group_id="g", max_invites=50, invites_sent=1)
+    db.add(acct)
+    db.flush()
+    cards = {code: models.Card(code=code, days=7, used=True) for code in ("OLD", "MIXED", "PENDING")}
+    db.add_all(cards.values())
+    db.flush()
+
+    def add(email, card=None, cleaned=True, expires_at=now - 60 * DAY):
+        invite = models.Invite(account_id=acct.id, email=email, card_id=cards[card].id if card else None,
+                               expires_at=expires_at, success=True, result="{}",
+                               created_at=now - 70 * DAY, cleaned=cleaned)
+        db.add(invite)
+        db.flush()
+        return invite
+
+    add("Old.User@x.com", card="OLD")                         # 归档
+    add("again@x.com")                                        # 同邮箱还有未清理记录：保留
+    add("again@x.com", cleaned=False, expires_at=now + DAY)
+    add("mixed@x.com", card="MIXED")                          # 卡密还有未过期记录：保留
+    add("mixed2@x.com", card="MIXED", expires_at=now - DAY)
+    pending = add("pending@x.com", card="PENDING")            # outbox 未完成：保留
+    db.add(models.OutboxEntry(id="e1", op="remove", account_id=acct.id, invite_id=pending.id,
+                              email="pending@x.com", status="pending", next_run_at=now,
+                              created_at=now, updated_at=now))
+    add("manual@x.com", expires_at=None)                      # 手动用户按创建时间：归档
+    db.commit()
+    return acct.id
+
+
+def test_archive_moves_only_safe_rows(db):
+    now = int(time.time())
+    acct_id = seed(db, now)
+
+    preview = archive.archive_processed(db, older_than_days=30, dry_run=True, now_ts=now)
+    assert preview["candidates"] == 2 and preview["archived"] == 0
+    assert db.query(models.InviteArchive).count() == 0
+
+    calls = []
+    stats = archive.archive_processed(db, older_than_days=30, chunk_size=1, now_ts=now,
+                                      progress=lambda done, total, item: calls.append((done, total)))
+    assert (stats["archived"], stats["chunks"]) == (2, 2)
+    assert calls == [(1, 2), (2, 2)]
+
+    hot = sorted(i.email for i in db.query(models.Invite))
+    assert hot == ["again@x.com", "again@x.com", "mixed2@x.com", "mixed@x.com", "pending@x.com"]
+    rows = db.query(models.InviteArchive).order_by(models.InviteArchive.id).all()
+    assert [r.email for r in rows] == ["Old.User@x.com", "manual@x.com"]
+    assert rows[0].account_email == "leader@x.com" and rows[0].card_code == "OLD"
+    assert rows[0].archived_at == now
+    assert db.get(models.Account, acct_id).invites_sent == 1
+
+    # 再跑一次没有新的可归档记录
+    assert archive.archive_processed(db, older_than_days=30, now_ts=now)["candidates"] == 0
+
+
+def test_search_and_card_state_after_archive(db):
+    now = int(time.time())
+    seed(db, now)
+    archive.archive_processed(db, older_than_days=30, now_ts=now)
+
+    found = archive.search_archive(db, email="  old.user@X.com ")
+    assert found["total"] == 1 and found["records"][0]["card_code"] == "OLD"
+    assert archive.search_archive(db, card="OLD")["records"][0]["email"] == "Old.User@x.com"
+    assert archive.search_archive(db, account_email="leader@x.com")["total"] == 2
+    assert archive.search_archive(db, card="MIXED")["total"] == 0
+
+    card_state.cache.clear()
+    state = card_state.resolve(db, "OLD", max_age=0)
+    assert state.archived and state.invite_id is None
+    assert state.mode() == card_state.EXPIRED and state.email == "Old.User@x.com"
+    assert card_state.resolve(db, "MIXED", max_age=0).mode() == card_state.EXPIRED
+
+    status = archive.archive_status(db)
+    assert status["archived_rows"] == 2 and status["hot_rows"] == 5
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 历史归档测试通过")
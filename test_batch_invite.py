@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+测试批量邀请：名额规划、每账号复用一个 session、组满后换账号重试、
+同一邮箱去重、跨群组警告、按 email_key 续期已有记录
+使用内存数据库，Overleaf 登录与发送均替换为假实现
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+
+import models, schemas
+import invite_result
+import invite_events
+import routers.invites as invites
+
+
+def test_allocate_seats_spreads_load():
+    capacity = {1: 3, 2: 1, 3: 0}
+    allocation, unplaced = invites.allocate_seats(capacity, [10, 11, 12, 13, 14], {11: {1}})
+    assert allocation == {1: [10, 12, 13], 2: [11]}
+    assert unplaced == [14]
+
+
+def test_batch_invite_retries_on_other_account(db):
+    full = models.Account(email="full@x.com", password="p", group_id="g-full", max_invites=10, updated_at=1)
+    spare = models.Account(email="spare@x.com", password="p", group_id="g-spare", max_invites=10, updated_at=2)
+    db.add_all([full, spare])
+    db.add_all([models.Card(code=f"C{i}", days=7) for i in range(4)])
+    db.add(models.Card(code="USED", days=7, used=True))
+    db.commit()
+
+    logins, sends = [], []
+
+    async def fake_open(acct):
+        logins.append(acct.email)
+        return object(), f"sess-{acct.email}", f"csrf-{acct.email}"
+
+    def fake_send(session, csrf, group_id, email, expires_iso):
+        sends.append((group_id, email))
+        if group_id == "g-full" and email != "u0@x.com":
+            raise invites.GroupFullError("full")
+        return {"email": email}
+
+    originals = invites.open_group_session, invites.send_invite
+    invites.open_group_session, invites.send_invite = fake_open, fake_send
+    body = schemas.BatchInviteRequest(items=[
+        schemas.InviteRequest(email=f"u{i}@x.com", card=f"C{i}") for i in range(4)
+    ] + [
+        schemas.InviteRequest(email="dup@x.com", card="C0"),
+        schemas.InviteRequest(email="old@x.com", card="USED"),
+    ])
+    try:
+        resp = asyncio.run(invites.batch_invite(body, db))
+    finally:
+        invites.open_group_session, invites.send_invite = originals
+
+    assert resp.success_count == 4 and resp.failed_count == 2
+    by_email = {r.email: r for r in resp.results}
+    assert by_email["dup@x.com"].error == "同一卡密在本批次中重复"
+    assert by_email["old@x.com"].error.startswith("卡密已使用")
+    # 组满之后剩余条目不再发往该账号，而是转到另一个账号
+    assert sum(1 for g, _ in sends if g == "g-full") == 2
+    assert {r.account_email for r in resp.results if r.success} == {"full@x.com", "spare@x.com"}
+    assert any(r.attempts == 2 for r in resp.results if r.success)
+    # 每个账号每轮只登录一次
+    assert logins.count("spare@x.com") <= 2 and logins.count("full@x.com") == 1
+
+    db.expire_all()
+    assert db.query(models.Invite).count() == 4
+    assert db.query(models.Card).filter_by(used=True).count() == 5
+    assert db.get(models.Account, spare.id).csrf_token == "csrf-spare@x.com"
+    assert db.get(models.Account, spare.id).session_validated_at > 0
+    # 组满经 crud.mark_group_full 记录，选账号时会跳过该组
+    assert db.get(models.Account, full.id).group_full_hits == 1 and db.get(models.Account, full.id).group_full_at
+    assert db.get(models.Account, full.id).invites_sent + db.get(models.Account, spare.id).invites_sent == 4
+
+
+def test_batch_dedupes_emails_and_warns_cross_group(db, monkeypatch):
+    now = int(time.time())
+    # other 组只有 1 个名额且已被 Cross@X.com 占用；target 组里已有 Again@X.com 的旧记录
+    other = models.Account(email="other@x.com", password="p", group_id="g-other", max_invites=1, updated_at=1)
+    target = models.Account(email="target@x.com", password="p", group_id="g-target", max_invites=10, updated_at=2)
+    db.add_all([other, target])
+    db.flush()
+    db.add(models.Invite(account_id=other.id, email="Cross@X.com", email_id="uid-c", expires_at=now + 86400,
+                         success=True, result="{}", created_at=now - 10))
+    db.add(models.Invite(account_id=target.id, email="Again@X.com", expires_at=now - 10, success=True,
+                         result="{}", created_at=now - 100, cleaned=True))
+    db.add_all([models.Card(code=f"C{i}", days=7) for i in range(4)])
+    db.commit()
+
+    async def fake_open(acct):
+        return object(), "sess", "csrf"
+
+    monkeypatch.setattr(invites, "open_group_session", fake_open)
+    monkeypatch.setattr(invites, "send_invite", lambda session, csrf, group_id, email, expires_iso: {"email": email})
+    body = schemas.BatchInviteRequest(items=[
+        schemas.InviteRequest(email="cross@x.com", card="C0"),
+        schemas.InviteRequest(email="again@x.com", card="C1"),
+        schemas.InviteRequest(email="CROSS@x.com", card="C2"),
+        schemas.InviteRequest(email="new@x.com", card="C3"),
+    ])
+    resp = asyncio.run(invites.batch_invite(body, db))
+
+    by_card = {r.card: r for r in resp.results}
+    assert by_card["C2"].error == "同一邮箱在本批次中重复" and not by_card["C2"].success
+    assert resp.success_count == 3 and {r.account_email for r in resp.results if r.success} == {"target@x.com"}
+    assert by_card["C0"].warning == "用户已存在于其他群组: other@x.com"
+    assert by_card["C1"].warning is None and by_card["C3"].warning is None
+
+    db.expire_all()
+    cross = db.query(models.Invite).filter_by(account_id=target.id, email_key="cross@x.com").one()
+    assert invite_result.parse(cross.result)["cross_group_warning"]["existing_groups"] == ["other@x.com"]
+    # 大小写不同的旧记录被续期，而不是新建一条
+    again = db.query(models.Invite).filter_by(email_key="again@x.com").one()
+    assert again.email == "Again@X.com" and not again.cleaned and again.expires_at > now
+    assert again.card_id == db.query(models.Card).filter_by(code="C1").one().id
+    assert [e.kind for e in invite_events.history(db, again.id)] == [invite_events.RENEWED]
+    assert db.get(models.Account, target.id).invites_sent == 3
+    assert db.query(models.Card).filter_by(used=True).count() == 3
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 批量邀请测试通过")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+测试卡密状态解析：一条查询得出模式、事务内复用与跨请求缓存、写入后失效
+使用内存数据库，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import pytest
+from sqlalchemy import event, update
+
+import models, schemas
+import card_state
+from routers import invites
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            self.count += 1
+
+
+@pytest.fixture(autouse=True)
+def clear_card_cache():
+    card_state.cache.clear()
+
+
+def seed(db, used=True, expires_in=30 * 86400, email="user@x.com"):
+    acct = models.Account(email="leader@x.com", password="p", group_id="g", max_invites=10, invites_sent=1)
+    card = models.Card(code="C1", days=30, used=used)
+    db.add_all([acct, card])
+    db.commit()
+    if used:
+        now = int(time.time())
+        db.add(models.Invite(account_id=acct.id, card_id=card.id, email=email, expires_at=now + expires_in,
+                             success=True, result="{}", created_at=now))
+        db.commit()
+    return card
+
+
+def test_missing_and_new_modes(db, session_factory):
+    assert card_state.resolve(db, "NOPE").mode() == card_state.MISSING
+
+    seed(db, used=False)
+    assert card_state.resolve(session_factory(), "C1", max_age=0).mode() == card_state.NEW
+
+
+def test_expired_mode(db):
+    seed(db, expires_in=-10)
+    assert card_state.resolve(db, "C1").mode() == card_state.EXPIRED
+
+
+def test_reactivate_mode(db):
+    seed(db)
+    state = card_state.resolve(db, "C1")
+    assert state.mode() == card_state.REACTIVATE and state.email == "user@x.com"
+    assert state.can_reactivate_for(" User@X.com") and not state.can_reactivate_for("other@x.com")
+
+
+def test_detect_then_reactivate_costs_two_queries(engine, session_factory):
+    seed(session_factory())
+    counter = QueryCounter(engine)
+
+    # /detect：一条查询，结果进入跨请求缓存
+    detected = invites.detect_card_status(card="C1", db=session_factory())
+    assert detected.mode == "reactivate"
+    assert counter.count == 1
+
+    # /reactivate 的另一个请求：绑定邮箱来自缓存，发邀请前的校验读一次数据库，之后取 ORM 对象不再查询
+    db = session_factory()
+    state = card_state.resolve(db, "C1")
+    assert counter.count == 1
+    card, is_reactivation, original = invites.validate_invite_card(
+        db, schemas.InviteRequest(email=state.email, card="C1")
+    )
+    assert is_reactivation and original.email == "user@x.com" and card.code == "C1"
+    assert counter.count == 2
+    # 同一事务内再次校验直接复用
+    invites.validate_invite_card(db, schemas.InviteRequest(email=state.email, card="C1"))
+    assert counter.count == 2
+
+
+def test_writes_invalidate_cached_state(session_factory):
+    seed(session_factory(), used=False)
+    assert card_state.resolve(session_factory(), "C1").mode() == card_state.NEW
+
+    # ORM 写入：卡密被使用
+    db = session_factory()
+    card = db.query(models.Card).filter_by(code="C1").one()
+    card.used = True
+    db.commit()
+    card_id = card.id
+    assert card_state.resolve(session_factory(), "C1").mode() == card_state.UNBOUND
+
+    # 邀请记录绑定到卡密
+    db = session_factory()
+    db.add(models.Invite(account_id=1, card_id=card_id, email="u@x.com", expires_at=int(time.time()) + 86400,
+                         success=True, result="{}", created_at=int(time.time())))
+    db.commit()
+    assert card_state.resolve(session_factory(), "C1").mode() == card_state.REACTIVATE
+
+    # 批量 UPDATE 不经过 flush，同样失效
+    db = session_factory()
+    db.execute(update(models.Invite).values(expires_at=1))
+    db.commit()
+    assert card_state.resolve(session_factory(), "C1").mode() == card_state.EXPIRED
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 卡密状态解析测试通过")
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+测试过期成员清理引擎：每个账号只认证一次、404 视为已清理、失败保留记录、登录失败跳过账号、账号间并行
+使用内存数据库与假的 Overleaf session，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+
+import models
+import cleanup_engine
+
+
+def seed(db, leaders, per_account, accepted=True):
+    """每个组长账号 per_account 条已过期记录；accepted 时带 email_id"""
+    now = int(time.time())
+    accounts = []
+    for i, email in enumerate(leaders):
+        acct = models.Account(email=email, password="p", group_id=f"g{i}", max_invites=100,
+                              invites_sent=per_account)
+        db.add(acct)
+        db.flush()
+        for j in range(per_account):
+            db.add(models.Invite(account_id=acct.id, email=f"u{i}-{j}@x.com",
+                                 email_id=f"id{i}-{j}" if accepted else None,
+                                 expires_at=now - 100 + j, success=True, result="{}", created_at=now - 86400))
+        accounts.append(acct)
+    db.commit()
+    return accounts
+
+
+def test_one_authentication_per_account(db, fake_overleaf):
+    acct, = seed(db, ["leader@x.com"], 40)
+    opener = fake_overleaf()
+
+    report = asyncio.run(cleanup_engine.cleanup_expired(db, opener=opener, interval=0))
+
+    assert opener.calls == ["leader@x.com"]
+    assert len(opener.sessions["leader@x.com"].deleted) == 40
+    assert report.cleaned == 40 and report.stats()["accepted_removed"] == 40
+    assert db.query(models.Invite).count() == 0
+    db.refresh(acct)
+    assert acct.invites_sent == 0
+    assert acct.session_cookie == f"sess-{acct.id}" and acct.csrf_token == f"csrf-{acct.id}"
+
+
+def test_pending_revoked_not_found_and_errors(db, fake_overleaf):
+    acct, = seed(db, ["leader@x.com"], 3, accepted=False)
+    # 第二条 Overleaf 上已不存在，第三条服务端报错
+    opener = fake_overleaf(statuses={"u0-1@x.com": 404, "u0-2@x.com": 500})
+
+    report = asyncio.run(cleanup_engine.cleanup_expired(db, opener=opener, interval=0))
+
+    account = report.accounts[0]
+    assert (account.revoked, account.not_found, account.errors) == (1, 1, 1)
+    assert "/invites/u0-0%40x.com" in opener.sessions["leader@x.com"].deleted[0]
+    remaining = db.query(models.Invite).all()
+    assert [i.email for i in remaining] == ["u0-2@x.com"]
+    assert account.failures[0]["email"] == "u0-2@x.com"
+
+
+def test_login_failure_skips_only_that_account(db, fake_overleaf):
+    seed(db, ["bad@x.com", "good@x.com"], 2)
+    opener = fake_overleaf(fail=["bad@x.com"])
+
+    report = asyncio.run(cleanup_engine.cleanup_expired(db, opener=opener, interval=0))
+
+    by_email = {a.account_email: a for a in report.accounts}
+    assert by_email["bad@x.com"].error and by_email["bad@x.com"].errors == 2
+    assert by_email["good@x.com"].cleaned == 2
+    assert report.stats()["authenticated_accounts"] == 1
+    assert {i.email for i in db.query(models.Invite).all()} == {"u0-0@x.com", "u0-1@x.com"}
+
+
+def test_accounts_run_in_parallel_with_bounded_concurrency(db, fake_overleaf):
+    seed(db, [f"l{i}@x.com" for i in range(6)], 1)
+    opener = fake_overleaf(latency=0.05)
+    progress = []
+
+    report = asyncio.run(cleanup_engine.cleanup_expired(
+        db, opener=opener, concurrency=3, interval=0,
+        progress=lambda done, total, item: progress.append((done, total))
+    ))
+
+    assert report.cleaned == 6
+    assert opener.max_active == 3
+    assert progress[-1] == (6, 6)
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 过期成员清理引擎测试通过")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+测试过期成员清理计划：按账号区分删除 / 撤销与会话热度、用最近的分阶段耗时估算请求数与耗时、
+计划序列化后原样执行（期间续期的记录跳过）、数据库清理方式的计划与 data-consistency 预览
+使用内存数据库与假的 Overleaf session，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import time
+import asyncio
+
+import models
+import cleanup_plan
+import schemas
+from routers.data_consistency import cleanup_expired_invites
+
+DAY = 86400
+
+
+def seed(db, now):
+    hot = models.Account(email="hot@leader.com", password="p", group_id="g1", max_invites=10,
+                         session_cookie="s", csrf_token="c", session_validated_at=now - 60)
+    cold = models.Account(email="cold@leader.com", password="p", group_id="g2", max_invites=10)
+    db.add_all([hot, cold])
+    db.flush()
+    for i in range(3):
+        db.add(models.Invite(account_id=hot.id, email=f"h{i}@x.com", email_id=f"uid-{i}" if i else None,
+                             expires_at=now - 100 + i, success=True, result="{}", created_at=now - DAY))
+    db.add(models.Invite(account_id=cold.id, email="c0@x.com", expires_at=now - 50, success=True,
+                         result="{}", created_at=now - DAY))
+    db.add(models.Invite(account_id=cold.id, email="future@x.com", expires_at=now + DAY, success=True,
+                         result="{}", created_at=now - DAY))
+    db.commit()
+    return hot, cold
+
+
+def test_plan_estimates_calls_and_time_per_account(db):
+    now = int(time.time())
+    hot, cold = seed(db, now)
+    snapshot = {
+        "cleanup.overleaf_delete": {"count": 2, "sum_seconds": 1.0},
+        "revoke_batch.cleanup.overleaf_delete": {"count": 2, "sum_seconds": 3.0},
+        "cleanup.refresh_session": {"count": 1, "sum_seconds": 0.5},
+        "invite.attempt.login_refresh_session": {"count": 0, "sum_seconds": 0.0},
+    }
+    latency = cleanup_plan.stage_latency(snapshot)
+    # 同一阶段不同嵌套路径的样本合并；login_refresh_session 不计入 refresh_session
+    assert latency["overleaf_delete"] == {"avg_seconds": 1.0, "samples": 4, "source": "metrics"}
+    assert latency["refresh_session"]["avg_seconds"] == 0.5
+    assert latency["login_refresh_session"]["source"] == "default"
+
+    plan = cleanup_plan.build_plan(db, limit=100, concurrency=1, interval=0.5, now_ts=now, latency=latency)
+    by_email = {a.account_email: a for a in plan.accounts}
+    h, c = by_email["hot@leader.com"], by_email["cold@leader.com"]
+    assert (h.removals, h.revokes, h.session, h.needs_login) == (2, 1, "hot", False)
+    assert (h.auth_calls, h.delete_calls, h.estimated_calls) == (2, 3, 5)
+    assert h.delete_seconds == 3 * 1.0 + 2 * 0.5
+    assert (c.removals, c.revokes, c.session, c.needs_login) == (0, 1, "cold", True)
+    assert c.estimated_calls == cleanup_plan.LOGIN_CALLS + 1
+    assert c.auth_seconds == round(sum(cleanup_plan.DEFAULT_LATENCY[s] for s in cleanup_plan.LOGIN_STAGES), 3)
+    assert plan.totals()["cold_logins"] == 1
+    assert plan.estimated_seconds == round(h.estimated_seconds + c.estimated_seconds, 3)
+
+    parallel = cleanup_plan.build_plan(db, concurrency=2, now_ts=now, latency=latency)
+    assert parallel.estimated_seconds == max(a.estimated_seconds for a in parallel.accounts)
+
+
+def test_plan_round_trips_and_executes(db, fake_overleaf):
+    now = int(time.time())
+    hot, cold = seed(db, now)
+    plan = cleanup_plan.build_plan(db, limit=100, interval=0)
+    assert len(plan.invite_ids) == 4
+    # 经过 JSON 与接口请求模型后仍可执行
+    body = schemas.CleanupPlan.model_validate(json.loads(json.dumps(plan.to_dict())))
+    restored = cleanup_plan.CleanupPlan.from_dict(body.model_dump())
+    assert restored.invite_ids == plan.invite_ids and restored.interval == 0
+
+    # 生成计划后其中一条被续期
+    renewed = db.query(models.Invite).filter_by(email="h0@x.com").one()
+    renewed.expires_at = now + DAY
+    db.commit()
+
+    opener = fake_overleaf()
+    result = asyncio.run(cleanup_plan.execute_plan(db, restored, opener=opener))
+    assert result["cleaned"] == 3 and result["stats"]["skipped"] == 1
+    assert sorted(opener.calls) == ["cold@leader.com", "hot@leader.com"]
+    assert {i.email for i in db.query(models.Invite)} == {"h0@x.com", "future@x.com"}
+    # 再执行一次全部跳过，不再访问 Overleaf
+    again = asyncio.run(cleanup_plan.execute_plan(db, restored, opener=opener))
+    assert (again["cleaned"], again["stats"]["skipped"], len(opener.calls)) == (0, 4, 2)
+
+
+def test_database_modes_and_data_consistency_preview(db):
+    now = int(time.time())
+    hot, cold = seed(db, now)
+
+    preview = asyncio.run(cleanup_expired_invites(dry_run=True, account_email="hot@leader.com", db=db))
+    assert preview["expired_count"] == 3 and preview["processed_count"] == 0
+    plan = preview["plan"]
+    assert plan["mode"] == cleanup_plan.MODE_MARK_PROCESSED
+    assert plan["totals"]["estimated_calls"] == 0 and plan["totals"]["accounts"] == 1
+    assert db.query(models.Invite).filter(models.Invite.cleaned.is_(True)).count() == 0
+
+    result = asyncio.run(cleanup_plan.execute_plan(db, cleanup_plan.CleanupPlan.from_dict(plan)))
+    assert result["cleaned"] == 3 and result["stats"]["skipped"] == 0
+    cleaned = {i.email for i in db.query(models.Invite).filter(models.Invite.cleaned.is_(True))}
+    assert cleaned == {"h0@x.com", "h1@x.com", "h2@x.com"}
+
+    delete_plan = cleanup_plan.build_plan(db, limit=None, mode=cleanup_plan.MODE_DELETE_RECORDS)
+    assert [a.account_email for a in delete_plan.accounts] == ["cold@leader.com"]
+    assert delete_plan.accounts[0].estimated_calls == 0 and delete_plan.latency == {}
+    result = asyncio.run(cleanup_plan.execute_plan(db, delete_plan))
+    assert result["stats"]["deleted_records"] == 1
+    assert db.query(models.Invite).filter_by(email="c0@x.com").count() == 0
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 清理计划测试通过")
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+测试到期调度：小顶堆的登记 / 续期 / 取消、按批弹出、提交事件更新堆、到期后触发清理、失败重试
+使用内存数据库与假的 Overleaf session，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+import pytest
+
+import models
+import overleaf_utils
+import expiry_scheduler as es
+
+
+def seed_account(db):
+    acct = models.Account(email="leader@x.com", password="p", group_id="g", max_invites=10, invites_sent=0)
+    db.add(acct)
+    db.commit()
+    return acct
+
+
+def add_invite(db, acct, email, expires_at, email_id="uid"):
+    invite = models.Invite(account_id=acct.id, email=email, email_id=email_id, expires_at=expires_at,
+                           success=True, result="{}", created_at=int(time.time()))
+    db.add(invite)
+    db.commit()
+    return invite
+
+
+def test_heap_schedule_extend_discard_and_batches():
+    scheduler = es.ExpiryScheduler(fire_delay=0, batch_size=2)
+    scheduler.schedule(1, 100)
+    scheduler.schedule(2, 50)
+    scheduler.schedule(3, 70)
+    scheduler.schedule(2, 500)      # 续期：旧条目作废
+    scheduler.discard(3)            # 删除 / 已清理
+    scheduler.schedule(4, None)     # 手动用户不调度
+    assert scheduler.next_due() == 100 and len(scheduler) == 2
+
+    scheduler.schedule(5, 90)
+    scheduler.schedule(6, 95)
+    assert scheduler.pop_due(now_ts=200) == [5, 6]   # 每批最多 batch_size 条，最早到期优先
+    assert scheduler.pop_due(now_ts=200) == [1]
+    assert scheduler.pop_due(now_ts=200) == []
+    assert scheduler.next_due() == 500
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_load_only_active_records_with_expiry(session_factory):
+    db = session_factory()
+    acct = seed_account(db)
+    now = int(time.time())
+    add_invite(db, acct, "a@x.com", now + 100)
+    cleaned = add_invite(db, acct, "b@x.com", now - 100)
+    cleaned.cleaned = True
+    db.commit()
+    add_invite(db, acct, "manual@x.com", None)
+
+    scheduler = es.ExpiryScheduler(session_factory=session_factory)
+    assert scheduler.load(session_factory()) == 1
+    assert scheduler.next_due() == now + 100
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_commits_update_heap_and_due_records_are_cleaned(session_factory, fake_overleaf):
+    db = session_factory()
+    acct = seed_account(db)
+    now = int(time.time())
+    later = add_invite(db, acct, "later@x.com", now + 3600)
+
+    fake = fake_overleaf(patch=overleaf_utils)
+
+    scheduler = es.expiry_scheduler
+    saved = (scheduler.session_factory, scheduler.fire_delay, scheduler.resync_interval)
+    scheduler.session_factory, scheduler.fire_delay, scheduler.resync_interval = session_factory, 0, 3600
+    scheduler.last_run = None
+
+    async def scenario():
+        scheduler.start()
+        try:
+            for _ in range(50):
+                if len(scheduler):
+                    break
+                await asyncio.sleep(0.02)
+            assert scheduler.next_due() == now + 3600
+
+            # 续期、新建：提交后更新堆
+            s = session_factory()
+            record = s.get(models.Invite, later.id)
+            record.expires_at = now + 7200
+            s.commit()
+            assert scheduler.next_due() == now + 7200
+            s = session_factory()
+            expired_id = add_invite(s, acct, "expired@x.com", now - 1, email_id="uid-expired").id
+
+            # 到期记录被唤醒的后台任务清理（释放租约后才记录 last_run）
+            for _ in range(100):
+                if scheduler.status()["last_run"] is not None:
+                    break
+                await asyncio.sleep(0.02)
+            assert session_factory().get(models.Invite, expired_id) is None
+            assert fake.deleted[0].endswith("/manage/groups/g/user/uid-expired")
+            assert scheduler.status()["last_run"]["cleaned"] == 1
+
+            # 删除：取消调度
+            s = session_factory()
+            s.delete(s.get(models.Invite, later.id))
+            s.commit()
+            assert scheduler.next_due() is None
+        finally:
+            await scheduler.stop()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        scheduler.session_factory, scheduler.fire_delay, scheduler.resync_interval = saved
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_failed_cleanup_is_retried_later(session_factory, fake_overleaf):
+    db = session_factory()
+    acct = seed_account(db)
+    now = int(time.time())
+    invite = add_invite(db, acct, "a@x.com", now - 10)
+
+    scheduler = es.ExpiryScheduler(fire_delay=0, retry_delay=300, session_factory=session_factory)
+    scheduler.load(session_factory())
+    report = asyncio.run(scheduler.run_due(opener=fake_overleaf(status=500), interval=0))
+
+    assert report.invite_ids == [invite.id] and report.cleaned_ids == []
+    assert session_factory().get(models.Invite, invite.id) is not None
+    assert scheduler.next_due() >= now + 290   # 推迟到 retry_delay 之后
+    assert scheduler.pop_due(now_ts=now + 1) == []
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 到期调度测试通过")
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+测试 Overleaf 侧组容量：group_full 标记、成员列表重新确认、选账号跳过已知满员的组与统计
+使用内存数据库，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+
+import models, crud
+from settings import settings
+from group_capacity import is_known_full, capacity_stats
+from sync_engine import reconcile_account
+
+
+def add_account(db, email, updated_at, max_invites=3):
+    acct = models.Account(email=email, password="p", group_id="g-" + email,
+                          updated_at=updated_at, max_invites=max_invites, invites_sent=0)
+    db.add(acct)
+    db.commit()
+    return acct
+
+
+def members(n, pending=0):
+    return [
+        {"email": f"m{i}@x.com", "user_id": None if i < pending else f"uid-{i}",
+         "status": "pending" if i < pending else "accepted"}
+        for i in range(n)
+    ]
+
+
+def test_group_full_until_membership_reverified(db):
+    acct = add_account(db, "leader@x.com", 0)
+    assert not is_known_full(acct)
+
+    crud.mark_group_full(db, acct)
+    assert is_known_full(acct) and acct.group_full_hits == 1
+
+    # 重新拉取成员列表：仍然满员 -> 继续跳过
+    reconcile_account(db, acct, members(3, pending=1))
+    db.refresh(acct)
+    assert acct.overleaf_member_count == 3 and acct.overleaf_pending_count == 1
+    assert is_known_full(acct)
+
+    # 有人离开 -> 有空位，解除
+    reconcile_account(db, acct, members(2))
+    db.refresh(acct)
+    assert not is_known_full(acct)
+
+
+def test_group_full_expires_after_recheck_window(db):
+    acct = add_account(db, "leader@x.com", 0)
+    crud.mark_group_full(db, acct)
+    later = int(time.time()) + settings.GROUP_FULL_RECHECK_SECONDS + 1
+    assert not is_known_full(acct, later)
+
+
+def test_allocator_skips_known_full_groups_and_counts_avoided(db):
+    full = add_account(db, "full@x.com", updated_at=1)
+    add_account(db, "open@x.com", updated_at=2)
+    # 本地计数还有名额（例如 Overleaf 上有手动添加、尚未同步的成员），但上次邀请撞上了 group_full
+    crud.mark_group_full(db, full)
+    full.updated_at = 1
+    db.commit()
+
+    assert crud.get_available_account(db).email == "open@x.com"
+    assert crud.get_available_account(db).email == "open@x.com"
+
+    stats = capacity_stats(db)
+    assert stats["known_full"] == 1
+    assert stats["group_full_hits"] == 1
+    assert stats["group_full_avoided"] == 2
+    by_email = {g["email"]: g for g in stats["groups"]}
+    assert by_email["full@x.com"]["known_full"] and not by_email["open@x.com"]["known_full"]
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 组容量测试通过")
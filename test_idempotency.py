@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+测试幂等键：并发重复请求只执行一次、失败不保存、同一键用于不同请求时报错、
+没有键时不去重、等待第一次完成有超时
+使用内存数据库，不影响 overleaf_inviter.db
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import asyncio
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+import schemas
+import idempotency
+
+
+@pytest.fixture(autouse=True)
+def idempotency_sessions(file_session_factory, monkeypatch):
+    # worker 通过 asyncio.to_thread 在多个线程中各自开会话，
+    # 共享单连接的 StaticPool 会互相干扰，这里用临时文件数据库
+    monkeypatch.setattr(idempotency, "SessionLocal", file_session_factory)
+
+
+def test_concurrent_duplicates_run_once():
+    calls = []
+    req = schemas.InviteRequest(email="a@x.com", card="CARD1")
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.3)
+        return schemas.InviteResponse(success=True, result={"n": len(calls)}, sent_ts=1, expires_ts=2)
+
+    async def run():
+        derived = idempotency.derive_key(req.card, req.email)
+        first, second = await asyncio.gather(
+            idempotency.run_idempotent("invite", None, derived, req, handler),
+            idempotency.run_idempotent("invite", None, derived, req, handler),
+        )
+        # 完成之后的重试同样直接返回保存的响应
+        third = await idempotency.run_idempotent("invite", None, derived, req, handler)
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert len(calls) == 1
+    replays = [r for r in (first, second, third) if isinstance(r, JSONResponse)]
+    assert len(replays) == 2
+    for replay in replays:
+        assert replay.headers[idempotency.REPLAYED_HEADER] == "true"
+        assert json.loads(replay.body)["result"] == {"n": 1}
+
+
+def test_failures_are_not_stored():
+    calls = []
+    body = schemas.MemberEmailRequest(email="a@x.com")
+
+    async def failing():
+        calls.append(1)
+        raise HTTPException(404, "未找到")
+
+    async def run():
+        for _ in range(2):
+            try:
+                await idempotency.run_idempotent("remove", "k1", "", body, failing)
+            except HTTPException:
+                pass
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_explicit_key_reused_for_other_request():
+
+    async def ok():
+        return {"status": "success"}
+
+    async def run():
+        await idempotency.run_idempotent("remove", "k2", "", schemas.MemberEmailRequest(email="a@x.com"), ok)
+        try:
+            await idempotency.run_idempotent("remove", "k2", "", schemas.MemberEmailRequest(email="b@x.com"), ok)
+        except HTTPException as e:
+            return e.status_code
+
+    assert asyncio.run(run()) == 422
+
+
+def test_without_key_runs_every_time():
+    calls = []
+    body = schemas.MemberEmailRequest(email="a@x.com")
+
+    async def ok():
+        calls.append(1)
+        return {"status": "success"}
+
+    async def run():
+        # 删除 → 重新邀请 → 再删除：没有客户端键时第二次删除同样执行
+        for _ in range(2):
+            result = await idempotency.run_idempotent("remove", None, None, body, ok)
+            assert not isinstance(result, JSONResponse)
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_waiting_duplicate_times_out():
+    req = schemas.InviteRequest(email="a@x.com", card="CARD1")
+    derived = idempotency.derive_key(req.card, req.email)
+
+    async def slow():
+        await asyncio.sleep(0.6)
+        return {"status": "success"}
+
+    async def run():
+        first = asyncio.create_task(idempotency.run_idempotent("invite", None, derived, req, slow))
+        await asyncio.sleep(0.05)
+        try:
+            await idempotency.run_idempotent("invite", None, derived, req, slow)
+        except HTTPException as e:
+            status = e.status_code
+        await first
+        return status
+
+    original = idempotency.WAIT_TIMEOUT
+    idempotency.WAIT_TIMEOUT = 0.2
+    try:
+        assert asyncio.run(run()) == 409
+    finally:
+        idempotency.WAIT_TIMEOUT = original
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 幂等键测试通过")
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+测试邀请事件：生命周期各步追加事件而不改写 result、批量路径一条语句写入、
+记录删除后事件仍可查询、压缩任务（进展类只留最新一条、硬删除记录的旧事件删除、归档记录保留）
+使用内存数据库
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import time
+
+import models
+import crud
+import schemas
+import invite_events
+from invite_status_manager import InviteStatusManager
+from routers.invites import list_invite_events
+from routers.update_email_id import reconcile_email_ids
+
+DAY = 86400
+
+
+def add_accounts(db):
+    a = models.Account(email="a@leader.com", password="p", group_id="ga", max_invites=10)
+    b = models.Account(email="b@leader.com", password="p", group_id="gb", max_invites=10)
+    db.add_all([a, b])
+    db.commit()
+    return a, b
+
+
+def kinds(db, invite_id):
+    return [(e.kind, e.detail) for e in invite_events.history(db, invite_id)]
+
+
+def test_lifecycle_appends_events_without_rewriting_result(db):
+    a, b = add_accounts(db)
+    now = int(time.time())
+
+    invite = crud.create_invite_record(db, a, "u@x.com", now + 7 * DAY, True, {"invite": {"email": "u@x.com"}})
+    invite_id = invite.id
+    crud.update_invite_expiry(db, invite, now + 14 * DAY, {"invite": {"email": "u@x.com"}})
+    crud.update_invite_expiry(db, invite, now + 21 * DAY, {"invite": {"email": "u@x.com"}}, new_account=b)
+    result_before = db.get(models.Invite, invite_id).result
+
+    assert reconcile_email_ids(db, b, [{"email": "u@x.com", "_id": "uid-1"}]) == 1
+    db.commit()
+    InviteStatusManager.mark_invite_processed(db, db.get(models.Invite, invite_id), "member_removed")
+
+    assert kinds(db, invite_id) == [
+        ("invited", None), ("renewed", None), ("reactivated", None),
+        ("email_id", "uid-1"), ("processed", "member_removed"),
+    ]
+    moved = invite_events.latest(db, invite_id, invite_events.REACTIVATED)
+    assert (moved.account_id, json.loads(moved.data)["from_account_id"]) == (b.id, a.id)
+    # 发现 email_id 不改写 result；标记处理只记下当前的处理原因
+    result = json.loads(db.get(models.Invite, invite_id).result)
+    assert result == {**json.loads(result_before), "processed_at": result["processed_at"],
+                      "processed_reason": "member_removed"}
+
+    records = [schemas.InviteEventRecord.model_validate(e) for e in list_invite_events(invite_id, db=db)]
+    assert records[0].kind == "invited" and records[0].data == {"expires_at": now + 7 * DAY}
+
+
+def test_stream_cleanup_records_events_per_chunk(db):
+    a, _ = add_accounts(db)
+    now = int(time.time())
+    for i in range(5):
+        db.add(models.Invite(account_id=a.id, email=f"e{i}@x.com", expires_at=now - 10, success=True,
+                             result="{}", created_at=now - DAY))
+    db.commit()
+    ids = [i.id for i in db.query(models.Invite).order_by(models.Invite.id)]
+
+    stats = InviteStatusManager.stream_cleanup_expired(db, chunk_size=2, delete_records=True)
+    assert stats["deleted_records"] == 5 and db.query(models.Invite).count() == 0
+    # 记录删除后事件仍可查询
+    assert [kinds(db, i) for i in ids] == [[("removed", "expired")]] * 5
+
+
+def test_compact_collapses_progress_and_drops_orphans(db):
+    a, _ = add_accounts(db)
+    now = int(time.time())
+    old = now - 40 * DAY
+    live = models.Invite(account_id=a.id, email="live@x.com", expires_at=now + DAY, success=True,
+                         result="{}", created_at=old)
+    db.add(live)
+    db.flush()
+    db.add(models.InviteArchive(id=9001, account_id=a.id, email="arch@x.com", success=True, result="{}",
+                                created_at=old, archived_at=now))
+    invite_events.record_rows(db, [
+        {"invite_id": live.id, "kind": invite_events.INVITED, "at": old},
+        {"invite_id": live.id, "kind": invite_events.REACTIVATION_CLEANUP, "detail": "retrying", "at": old},
+        {"invite_id": live.id, "kind": invite_events.REACTIVATION_CLEANUP, "detail": "retrying", "at": old + 1},
+        {"invite_id": live.id, "kind": invite_events.REACTIVATION_CLEANUP, "detail": "succeeded", "at": old + 2},
+        {"invite_id": 9001, "kind": invite_events.PROCESSED, "detail": "expired", "at": old},   # 已归档：保留
+        {"invite_id": 9002, "kind": invite_events.REMOVED, "detail": "removed", "at": old},     # 已硬删除：删除
+        {"invite_id": 9003, "kind": invite_events.REMOVED, "detail": "removed", "at": now},     # 还不够旧：保留
+    ])
+    db.commit()
+
+    stats = invite_events.compact(db, older_than_days=30, now_ts=now)
+    assert (stats["collapsed"], stats["orphaned"], stats["remaining"]) == (2, 1, 4)
+    assert kinds(db, live.id) == [("invited", None), ("reactivation_cleanup", "succeeded")]
+    assert kinds(db, 9001) == [("processed", "expired")]
+    assert kinds(db, 9002) == [] and kinds(db, 9003) == [("removed", "removed")]
+    assert invite_events.compact(db, older_than_days=30, now_ts=now)["collapsed"] == 0
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 邀请事件测试通过")
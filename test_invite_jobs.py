@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+测试异步邀请任务队列：入队去重、worker 执行、失败记录、中断任务回收
+使用内存数据库与假的邀请处理函数，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+import pytest
+from fastapi import HTTPException
+
+import models, schemas
+import invite_jobs
+from invite_jobs import InviteJobQueue, enqueue_invite, wait_for_job, recover_interrupted_jobs
+
+
+@pytest.fixture(autouse=True)
+def invite_jobs_sessions(file_session_factory, monkeypatch):
+    # worker 通过 asyncio.to_thread 在多个线程中各自开会话，
+    # 共享单连接的 StaticPool 会互相干扰，这里用临时文件数据库
+    monkeypatch.setattr(invite_jobs, "SessionLocal", file_session_factory)
+
+
+async def fake_invite(req, db, progress=None):
+    await progress("selecting_account", attempt=1)
+    await progress("sending", account_email="leader@x.com", attempt=1)
+    await asyncio.sleep(0.01)
+    if req.card == "BAD":
+        raise HTTPException(400, "无可用账号")
+    await progress("recording", account_email="leader@x.com")
+    return schemas.InviteResponse(success=True, result={"ok": req.email}, sent_ts=1, expires_ts=2)
+
+
+def test_queue_runs_jobs(file_db):
+    db = file_db
+    ok = enqueue_invite(db, "a@x.com", "CARD1")
+    # 同一卡密 + 邮箱重复提交返回同一个任务
+    assert enqueue_invite(db, "a@x.com", "CARD1").id == ok.id
+    bad = enqueue_invite(db, "b@x.com", "BAD")
+
+    async def run():
+        queue = InviteJobQueue(workers=2, poll_interval=0.05)
+        queue.start(fake_invite)
+        try:
+            done = await wait_for_job(ok.id, timeout=5, poll_interval=0.02)
+            failed = await wait_for_job(bad.id, timeout=5, poll_interval=0.02)
+        finally:
+            await queue.stop()
+        return done, failed
+
+    done, failed = asyncio.run(run())
+    assert done.status == "succeeded" and done.stage == "done"
+    assert done.account_email == "leader@x.com" and done.attempt == 1
+    assert done.result.result == {"ok": "a@x.com"}
+    assert failed.status == "failed" and failed.error_status == 400
+    assert failed.error == "无可用账号"
+
+
+def test_recover_interrupted_jobs(file_db):
+    db = file_db
+    now_ts = int(time.time())
+    for job_id, stage in [("before_send", "selecting_account"), ("mid_send", "sending")]:
+        db.add(models.InviteJob(
+            id=job_id, email=f"{job_id}@x.com", card_code=job_id,
+            status="running", stage=stage, worker="dead-worker",
+            lease_expires_at=now_ts - 1, created_at=now_ts - 60
+        ))
+    db.commit()
+
+    assert recover_interrupted_jobs(now_ts) == 2
+    db.expire_all()
+    # 还没触达 Overleaf 的任务重新排队；发送阶段中断的不重试，避免重复邀请
+    assert db.get(models.InviteJob, "before_send").status == "queued"
+    assert db.get(models.InviteJob, "mid_send").status == "failed"
+
+
+def test_job_that_started_sending_is_not_requeued_after_retry(file_db):
+    db = file_db
+    job = enqueue_invite(db, "c@x.com", "CARD2")
+    reached_retry = asyncio.Event()
+
+    async def crash_on_retry(req, db, progress=None):
+        await progress("selecting_account", attempt=1)
+        await progress("sending", account_email="first@x.com", attempt=1)
+        # 第一个账号超时（Overleaf 可能已收到邀请），换下一个账号时 worker 崩溃
+        await progress("selecting_account", attempt=2)
+        reached_retry.set()
+        await asyncio.sleep(60)
+
+    async def run():
+        queue = InviteJobQueue(workers=1, poll_interval=0.05)
+        queue.start(crash_on_retry)
+        try:
+            await asyncio.wait_for(reached_retry.wait(), timeout=5)
+        finally:
+            await queue.stop()
+
+    asyncio.run(run())
+    db.expire_all()
+    row = db.get(models.InviteJob, job.id)
+    assert (row.status, row.stage, row.send_attempted) == ("running", "selecting_account", True)
+
+    assert recover_interrupted_jobs(int(time.time()) + invite_jobs.JOB_LEASE_SECONDS + 1) == 1
+    db.expire_all()
+    assert db.get(models.InviteJob, job.id).status == "failed"
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 异步邀请任务测试通过")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+测试 invites.result 的结构化存储：旧格式解析、写入时统一为 JSON、旧数据迁移后建表达式索引、
+按字段筛选、列表接口返回类型化摘要
+使用内存数据库
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import json
+from sqlalchemy import text
+
+import models
+import migrations
+import invite_result
+import schemas
+from database import Base
+from routers.invites import list_invites
+
+
+def test_parse_legacy_formats():
+    assert invite_result.parse(None) == {}
+    assert invite_result.parse('{"a": 1}') == {"a": 1}
+    assert invite_result.parse(str({"invite": {"email": "u@x.com"}, "ok": True})) == {"invite": {"email": "u@x.com"}, "ok": True}
+    assert invite_result.parse("自动清理") == {"original_result": "自动清理"}
+    assert invite_result.parse("[1, 2]") == {"original_result": "[1, 2]"}
+    assert invite_result.dumps({"note": "中文"}) == '{"note":"中文"}'
+
+
+def test_writes_are_normalized_to_json(db):
+    acct = models.Account(email="leader@x.com", password="p", group_id="g")
+    db.add(acct)
+    db.flush()
+    # 旧代码的 str(dict) 与纯文本都会转成 JSON 对象
+    db.add(models.Invite(account_id=acct.id, email="a@x.com", success=True, created_at=1,
+                         result=str({"ok": True, "note": None})))
+    db.add(models.Invite(account_id=acct.id, email="b@x.com", success=True, created_at=1, result="not json"))
+    db.commit()
+    db.execute(models.Invite.__table__.insert(), [
+        {"account_id": acct.id, "email": "c@x.com", "success": True, "created_at": 1, "result": {"source": "sync"}},
+    ])
+    db.commit()
+
+    raw = dict(db.execute(text("SELECT email, result FROM invites")).all())
+    assert json.loads(raw["a@x.com"]) == {"ok": True, "note": None}
+    assert json.loads(raw["b@x.com"]) == {"original_result": "not json"}
+    assert json.loads(raw["c@x.com"]) == {"source": "sync"}
+
+    invite = db.query(models.Invite).filter_by(email="a@x.com").one()
+    invite_result.update(invite, processed_reason="expired", processed_at=5)
+    db.commit()
+    assert db.query(models.Invite.email).filter(invite_result.field("processed_reason") == "expired").all() == [("a@x.com",)]
+
+
+def test_migration_converts_repr_before_index(engine):
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_invites_processed_reason"))
+        conn.execute(text(
+            "INSERT INTO accounts (email, password, group_id, max_invites, invites_sent) "
+            "VALUES ('leader@x.com', 'p', 'g', 10, 0)"
+        ))
+        conn.execute(text(
+            "INSERT INTO invites (account_id, email, success, result, created_at, cleaned) VALUES "
+            "(1, 'a@x.com', 1, :repr, 1, 1), (1, 'b@x.com', 1, '{\"sync_date\": \"2024-05-01\"}', 1, 0), "
+            "(1, 'c@x.com', 1, '自动清理', 1, 1)"
+        ), {"repr": str({"processed_reason": "expired", "ok": True})})
+        migrations.upgrade_schema(Base.metadata, conn)
+
+        rows = dict(conn.execute(text("SELECT email, result FROM invites")).all())
+        assert json.loads(rows["a@x.com"]) == {"processed_reason": "expired", "ok": True}
+        assert json.loads(rows["b@x.com"]) == {"sync_date": "2024-05-01"}
+        assert json.loads(rows["c@x.com"]) == {"original_result": "自动清理"}
+        indexes = {row[1] for row in conn.execute(text("PRAGMA index_list('invites')"))}
+        assert "ix_invites_processed_reason" in indexes
+
+        # 再次执行没有副作用；按处理原因筛选走表达式索引
+        migrations.upgrade_schema(Base.metadata, conn)
+        query = models.Invite.__table__.select().where(invite_result.field("processed_reason") == "expired")
+        plan = " ".join(str(row) for row in conn.execute(text(
+            "EXPLAIN QUERY PLAN " + str(query.compile(conn, compile_kwargs={"literal_binds": True}))
+        )))
+        assert "ix_invites_processed_reason" in plan
+
+
+def test_records_endpoint_returns_typed_result(db):
+    acct = models.Account(email="leader@x.com", password="p", group_id="g")
+    db.add(acct)
+    db.flush()
+    big = {"invite": {"email": "a@x.com", "token": "x" * 500}, "processed_reason": "expired", "processed_at": 7,
+           "reactivation_info": {"type": "reactivation"}}
+    db.add(models.Invite(account_id=acct.id, email="a@x.com", success=True, created_at=2, result=str(big)))
+    db.add(models.Invite(account_id=acct.id, email="b@x.com", success=True, created_at=1, result="{}"))
+    db.commit()
+
+    records = [schemas.InviteRecord.model_validate(r) for r in list_invites(page=1, size=50, email=None,
+                                                                          processed_reason="expired", db=db)]
+    assert [r.email for r in records] == ["a@x.com"]
+    result = records[0].result
+    assert (result.processed_reason, result.processed_at) == ("expired", 7)
+    assert result.reactivation_info == {"type": "reactivation"}
+    assert "invite" not in result.model_dump()
+
+    records = list_invites(page=1, size=50, email=None, processed_reason=None, db=db)
+    assert len(records) == 2
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 邀请结果结构化存储测试通过")
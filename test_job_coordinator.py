@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+测试任务租约：互斥、过期接管、进度共享与释放
+使用内存数据库，不影响 overleaf_inviter.db
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+import threading
+import pytest
+from sqlalchemy import update
+
+import models
+import job_coordinator
+from job_coordinator import JobLease, LeaseHeldError, LeaseLostError, get_job_status
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_mutual_exclusion_and_release():
+    first, second = JobLease("sync"), JobLease("sync")
+
+    assert first.acquire(total=3)
+    assert not second.acquire()
+    # 其他 scope 不受影响
+    assert JobLease("cleanup").acquire()
+
+    assert first.update_progress(completed=1, current_item="a@x.com")
+    status = get_job_status("sync")
+    assert status["is_running"] and status["owner"] == first.owner
+    assert status["completed"] == 1 and status["total"] == 3
+    assert status["current_item"] == "a@x.com"
+
+    first.release("completed")
+    status = get_job_status("sync")
+    assert not status["is_running"] and status["status"] == "completed"
+    assert second.acquire()
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_expired_lease_is_taken_over():
+    stale, fresh = JobLease("cleanup"), JobLease("cleanup")
+    assert stale.acquire()
+
+    # 模拟持有者崩溃：租约到期
+    db = job_coordinator.SessionLocal()
+    db.execute(update(models.JobLease).values(expires_at=int(time.time()) - 1))
+    db.commit()
+    db.close()
+    assert get_job_status("cleanup")["status"] == "stale"
+
+    assert fresh.acquire()
+    # 旧持有者的心跳 / 进度不能覆盖新持有者
+    assert not stale.heartbeat()
+    assert not stale.update_progress(completed=99)
+    assert get_job_status("cleanup")["owner"] == fresh.owner
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_async_hold_marks_failure():
+
+    async def run():
+        async with JobLease("email_ids").hold():
+            try:
+                async with JobLease("email_ids").hold():
+                    pass
+            except LeaseHeldError:
+                pass
+            else:
+                raise AssertionError("同一 scope 不应被重复持有")
+            raise RuntimeError("boom")
+
+    try:
+        asyncio.run(run())
+    except RuntimeError:
+        pass
+    status = get_job_status("email_ids")
+    assert status["status"] == "failed" and status["message"] == "boom"
+    assert not status["is_running"]
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_lost_lease_cancels_running_job():
+    steps = []
+
+    async def run():
+        lease = JobLease("cleanup", ttl=3)  # 每秒心跳一次
+        try:
+            async with lease.hold():
+                assert await lease.update_progress_async(1, total=5, current_item="a@x.com")
+                # 长时间卡住期间被其他进程接管
+                db = job_coordinator.SessionLocal()
+                db.execute(update(models.JobLease).values(owner="other-worker"))
+                db.commit()
+                db.close()
+                await asyncio.sleep(10)
+                steps.append("继续执行")
+        except LeaseLostError:
+            steps.append("已取消")
+        # 取消请求已撤销，任务本身可以继续
+        await asyncio.sleep(0)
+        return time.monotonic()
+
+    started = time.monotonic()
+    finished = asyncio.run(run())
+    assert steps == ["已取消"]
+    assert finished - started < 5
+    # 不覆盖新持有者的租约
+    status = get_job_status("cleanup")
+    assert status["owner"] == "other-worker" and status["completed"] == 1
+
+
+def test_hold_waiting_serializes_account_scope(file_session_factory, monkeypatch):
+    # 多个线程同时抢租约：使用文件数据库，每个会话独立连接（与生产环境一致）
+    monkeypatch.setattr(job_coordinator, "SessionLocal", file_session_factory)
+    scope = job_coordinator.invite_account_scope(7)
+    order = []
+
+    async def worker(name, hold_for):
+        async with JobLease(scope).hold_waiting(timeout=5, poll_interval=0.05):
+            order.append(f"{name} 开始")
+            await asyncio.sleep(hold_for)
+            order.append(f"{name} 结束")
+
+    async def run():
+        await asyncio.gather(worker("a", 0.3), worker("b", 0))
+
+    asyncio.run(run())
+    # 先抢到的一方释放后，另一方才进入（谁先抢到不确定）
+    first, second = order[0].split()[0], order[2].split()[0]
+    assert order == [f"{first} 开始", f"{first} 结束", f"{second} 开始", f"{second} 结束"]
+    assert {first, second} == {"a", "b"}
+    assert get_job_status(scope)["status"] == "completed"
+
+    # 其他进程一直占用：等待超时后抛出 LeaseHeldError
+    holder = JobLease(scope)
+    assert holder.acquire()
+
+    async def blocked():
+        async with JobLease(scope).hold_waiting(timeout=0.2, poll_interval=0.05):
+            pass
+
+    with pytest.raises(LeaseHeldError):
+        asyncio.run(blocked())
+    assert get_job_status(scope)["owner"] == holder.owner
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_async_hold_writes_off_the_event_loop(monkeypatch):
+    threads = []
+    acquire, release = JobLease.acquire, JobLease.release
+
+    def record_acquire(self, *args, **kwargs):
+        threads.append(("acquire", threading.get_ident()))
+        return acquire(self, *args, **kwargs)
+
+    def record_release(self, *args, **kwargs):
+        threads.append(("release", threading.get_ident()))
+        return release(self, *args, **kwargs)
+
+    monkeypatch.setattr(JobLease, "acquire", record_acquire)
+    monkeypatch.setattr(JobLease, "release", record_release)
+
+    async def run():
+        async with JobLease("sync").hold(total=1):
+            pass
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+    assert [name for name, _ in threads] == ["acquire", "release"]
+    assert all(ident != loop_thread for _, ident in threads)
+    assert get_job_status("sync")["status"] == "completed"
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_sync_script_apply_shares_sync_lease(sync_script, monkeypatch):
+    runs = []
+
+    async def fake_sync_all(self, dry_run=True, lease=None):
+        runs.append((dry_run, lease is not None))
+
+    monkeypatch.setattr(sync_script.OverleafSyncer, "sync_all_accounts", fake_sync_all)
+
+    # /sync/all 或系统整体维护正在运行：--apply 跳过，预览照常执行
+    other = JobLease(job_coordinator.SCOPE_SYNC)
+    assert other.acquire()
+    monkeypatch.setattr(sys, "argv", ["sync_with_overleaf.py", "sync", "--apply"])
+    asyncio.run(sync_script.main())
+    monkeypatch.setattr(sys, "argv", ["sync_with_overleaf.py", "sync"])
+    asyncio.run(sync_script.main())
+    assert runs == [(True, False)]
+
+    other.release()
+    monkeypatch.setattr(sys, "argv", ["sync_with_overleaf.py", "sync", "--apply"])
+    asyncio.run(sync_script.main())
+    assert runs[-1] == (False, True)
+    assert get_job_status(job_coordinator.SCOPE_SYNC)["status"] == "completed"
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 任务租约测试通过")
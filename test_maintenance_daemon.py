@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+测试维护服务：计划时间计算、持租约执行与结果记录、租约被占用时跳过、失败记录、手动触发、按租约表续上节奏
+使用内存数据库，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+import pytest
+from datetime import datetime
+
+import job_coordinator
+from job_coordinator import JobLease
+from maintenance_daemon import MaintenanceDaemon, MaintenanceJob, maintenance_daemon
+
+
+def make_daemon(session_factory, func, **job_kwargs):
+    daemon = MaintenanceDaemon(session_factory=session_factory, startup_delay=0)
+    job_kwargs.setdefault("interval", 3600)
+    daemon.register(MaintenanceJob(name="job", scope="test_scope", func=func, **job_kwargs))
+    return daemon
+
+
+def test_schedule_times():
+    job = MaintenanceJob(name="d", scope="s", func=None, daily_at="02:00")
+    now = datetime(2024, 5, 1, 1, 30).timestamp()
+    assert datetime.fromtimestamp(job.next_after(now)) == datetime(2024, 5, 1, 2, 0)
+    now = datetime(2024, 5, 1, 2, 0).timestamp()
+    assert datetime.fromtimestamp(job.next_after(now)) == datetime(2024, 5, 2, 2, 0)
+    assert MaintenanceJob(name="i", scope="s", func=None, interval=600).next_after(1000) == 1600
+    assert {j.name for j in maintenance_daemon.jobs.values()} == {"cleanup_expired", "update_email_ids", "daily_maintenance", "archive_history", "compact_invite_events"}
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_run_records_result_skip_and_failure(session_factory):
+    seen = []
+
+    async def job(db, lease):
+        seen.append((db.bind is not None, lease.held))
+        return {"cleaned": 3}
+
+    daemon = make_daemon(session_factory, job)
+    record = asyncio.run(daemon.run_job("job"))
+    assert record["status"] == "success" and record["result"] == {"cleaned": 3}
+    assert seen == [(True, True)]
+    assert job_coordinator.get_job_status("test_scope")["status"] == "completed"
+
+    # 其他进程持有同一租约：跳过，不执行
+    other = JobLease("test_scope")
+    assert other.acquire()
+    record = asyncio.run(daemon.run_job("job"))
+    assert record["status"] == "skipped" and len(seen) == 1
+    other.release()
+
+    async def broken(db, lease):
+        raise RuntimeError("登录失败")
+
+    daemon.jobs["job"].func = broken
+    record = asyncio.run(daemon.run_job("job"))
+    assert record["status"] == "failed" and record["error"] == "登录失败"
+    status = daemon.status()["jobs"][0]
+    assert (status["runs"], status["skipped"], status["failures"]) == (3, 1, 1)
+    assert job_coordinator.get_job_status("test_scope")["status"] == "failed"
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_trigger_runs_in_background_and_first_run_follows_lease_table(session_factory):
+    calls = []
+
+    async def job(db, lease):
+        calls.append(time.time())
+        return {}
+
+    # 上次（任意进程）完成于 10 分钟前，间隔 1 小时：下一次在 50 分钟后
+    lease = JobLease("test_scope")
+    lease.acquire()
+    lease.release()
+    finished_at = job_coordinator.get_job_status("test_scope")["finished_at"]
+
+    daemon = make_daemon(session_factory, job)
+    assert daemon._first_run_at(daemon.jobs["job"], finished_at + 600) == finished_at + 3600
+
+    async def scenario():
+        daemon.start()
+        try:
+            for _ in range(50):
+                if daemon.jobs["job"].next_run_at:
+                    break
+                await asyncio.sleep(0.01)
+            assert daemon.jobs["job"].next_run_at >= int(time.time()) + 3000
+            assert daemon.trigger("job")
+            for _ in range(100):
+                if calls and not daemon.jobs["job"].running:
+                    break
+                await asyncio.sleep(0.01)
+            assert len(calls) == 1
+            assert daemon.jobs["job"].last_run["status"] == "success"
+            assert daemon.jobs["job"].next_run_at >= int(calls[0]) + 3600
+        finally:
+            await daemon.stop()
+        assert not daemon.running and not daemon.trigger("job")
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 维护服务测试通过")
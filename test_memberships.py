@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+测试按邮箱查询成员关系：email_key 归一化与回填、连同组长账号一次查出、跨组重复检测
+使用内存数据库，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+from sqlalchemy import insert, text
+
+import models
+import migrations
+from database import Base
+from memberships import find_memberships, cross_group_duplicates, latest_in_account
+
+
+def add_account(db, email):
+    acct = models.Account(email=email, password="p", group_id="g-" + email, max_invites=10, invites_sent=0)
+    db.add(acct)
+    db.commit()
+    return acct
+
+
+def add_invite(db, acct, email, created_at, cleaned=False):
+    inv = models.Invite(account_id=acct.id, email=email, expires_at=created_at + 3600,
+                        success=True, result="{}", created_at=created_at, cleaned=cleaned)
+    db.add(inv)
+    db.commit()
+    return inv
+
+
+def test_email_key_normalized_for_orm_and_core_inserts(db):
+    acct = add_account(db, "leader@x.com")
+
+    inv = add_invite(db, acct, " User@X.com ", 1)
+    assert inv.email_key == "user@x.com"
+    inv.email = "Other@X.com"
+    assert inv.email_key == "other@x.com"
+
+    # 对账导入等 Core 批量 INSERT 不经过 ORM 校验器
+    db.execute(insert(models.Invite), [
+        {"account_id": acct.id, "email": "Bulk@X.com", "success": True, "result": "{}", "created_at": 2, "cleaned": False},
+    ])
+    db.commit()
+    bulk = db.query(models.Invite).filter_by(email="Bulk@X.com").one()
+    assert bulk.email_key == "bulk@x.com"
+
+
+def test_migration_backfills_email_key_before_index(engine):
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_invites_email_key_cleaned"))
+        conn.execute(text(
+            "INSERT INTO accounts (email, password, group_id, max_invites, invites_sent) "
+            "VALUES ('leader@x.com', 'p', 'g', 10, 0)"
+        ))
+        conn.execute(text(
+            "INSERT INTO invites (account_id, email, success, result, created_at, cleaned) "
+            "VALUES (1, ' Old@X.com', 1, '{}', 1, 0)"
+        ))
+        migrations.upgrade_schema(Base.metadata, conn)
+        assert conn.execute(text("SELECT email_key FROM invites")).scalar() == "old@x.com"
+        indexes = {row[1] for row in conn.execute(text("PRAGMA index_list('invites')"))}
+        assert "ix_invites_email_key_cleaned" in indexes
+
+
+def test_find_memberships_returns_accounts_newest_first(db):
+    a = add_account(db, "a@x.com")
+    b = add_account(db, "b@x.com")
+    now = int(time.time())
+    add_invite(db, a, "u@x.com", now - 100)
+    add_invite(db, b, "U@x.com", now - 10)
+    add_invite(db, a, "u@x.com", now - 1000, cleaned=True)
+
+    active = find_memberships(db, "u@X.com ")
+    assert [m.account_email for m in active] == ["b@x.com", "a@x.com"]
+    assert all(not m.invite.cleaned for m in active)
+
+    history = find_memberships(db, "u@x.com", active_only=False)
+    assert len(history) == 3
+    assert latest_in_account(history, a.id).invite.created_at == now - 100
+    assert latest_in_account(history, 999) is None
+
+
+def test_cross_group_duplicates(db):
+    a = add_account(db, "a@x.com")
+    b = add_account(db, "b@x.com")
+    add_invite(db, a, "dup@x.com", 1)
+    add_invite(db, b, "Dup@x.com", 2)
+    # 同组内的多条历史记录、已清理的记录不算跨组重复
+    add_invite(db, a, "same@x.com", 1)
+    add_invite(db, a, "same@x.com", 2)
+    add_invite(db, a, "gone@x.com", 1)
+    add_invite(db, b, "gone@x.com", 2, cleaned=True)
+
+    duplicates = cross_group_duplicates(db)
+    assert list(duplicates) == ["dup@x.com"]
+    assert [m.account_email for m in duplicates["dup@x.com"]] == ["b@x.com", "a@x.com"]
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 成员关系查询测试通过")
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+测试 Overleaf 变更 outbox：意图与本地状态同一事务、按账号批量派发、合并与作废、失败重试与放弃、崩溃后重放
+使用内存数据库与假的 Overleaf session，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+import pytest
+from sqlalchemy import update
+
+import models, schemas
+import outbox
+import overleaf_utils
+from invite_status_manager import InviteStatusManager
+from routers import remove_member
+from sync_engine import plan_changes, ChangeAction
+
+
+@pytest.fixture(autouse=True)
+def outbox_sessions(session_factory, monkeypatch):
+    # 派发器在自己的会话里读写 outbox
+    monkeypatch.setattr(outbox, "SessionLocal", session_factory)
+
+
+def seed(db, n=3):
+    now = int(time.time())
+    acct = models.Account(email="leader@x.com", password="p", group_id="g", max_invites=10, invites_sent=0)
+    db.add(acct)
+    db.flush()
+    for i in range(n):
+        db.add(models.Invite(account_id=acct.id, email=f"u{i}@x.com", email_id=f"uid{i}", expires_at=now + 86400,
+                             success=True, result="{}", created_at=now))
+    db.add(models.Invite(account_id=acct.id, email="pending@x.com", email_id=None, expires_at=now + 86400,
+                         success=True, result="{}", created_at=now))
+    db.commit()
+    InviteStatusManager.sync_account_invites_count(db, acct)
+    return acct
+
+
+def test_intent_is_recorded_with_local_change_in_one_transaction(db):
+    acct = seed(db)
+    invite = db.query(models.Invite).filter_by(email="u0@x.com").one()
+
+    outbox.record_remove(db, invite)
+    db.rollback()
+    assert db.query(models.OutboxEntry).count() == 0
+    assert db.query(models.Invite).filter_by(email="u0@x.com").one().cleaned is False
+
+    entry = outbox.record_remove(db, invite)
+    assert outbox.record_remove(db, invite) is entry
+    db.commit()
+    assert db.query(models.OutboxEntry).count() == 1
+    assert db.get(models.Invite, invite.id).cleaned is True
+    # 计数在 Overleaf 上真正删除后才更新
+    assert db.get(models.Account, acct.id).invites_sent == 4
+
+
+def test_endpoints_queue_and_dispatcher_batches_per_account(session_factory, db, fake_overleaf):
+    acct = seed(db)
+    fake = fake_overleaf()
+
+    for email in ("u0@x.com", "u1@x.com"):
+        response = asyncio.run(remove_member.remove_member(schemas.MemberEmailRequest(email=email), db))
+        assert response.status == "queued" and response.outbox_id
+    response = asyncio.run(remove_member.revoke_unaccepted_invite(schemas.MemberEmailRequest(email="pending@x.com"), db))
+    assert response.status == "queued"
+    assert fake.deleted == []
+
+    dispatcher = outbox.OutboxDispatcher(workers=1)
+    assert asyncio.run(dispatcher.run_pending(opener=fake, interval=0)) == 1
+
+    assert fake.calls == ["leader@x.com"]
+    assert sorted(url.split("/manage/groups/g/", 1)[1] for url in fake.deleted) == [
+        "invites/pending%40x.com", "user/uid0", "user/uid1"]
+    db = session_factory()
+    assert {i.email for i in db.query(models.Invite).all()} == {"u2@x.com"}
+    assert db.get(models.Account, acct.id).invites_sent == 1
+    assert db.get(models.Account, acct.id).session_cookie == f"sess-{acct.id}"
+    assert {e.status for e in db.query(models.OutboxEntry).all()} == {outbox.DONE}
+
+
+def test_wait_returns_overleaf_result(session_factory, db, fake_overleaf):
+    seed(db)
+    fake_overleaf(patch=overleaf_utils, status=404)
+    response = asyncio.run(remove_member.remove_member(schemas.MemberEmailRequest(email="u0@x.com"), db, wait=True))
+    assert response.status == "success" and response.detail == "成员已不存在"
+    assert session_factory().query(models.Invite).filter_by(email="u0@x.com").count() == 0
+
+
+def test_reinvited_record_supersedes_and_duplicates_coalesce(session_factory, db, fake_overleaf):
+    seed(db)
+    u0 = db.query(models.Invite).filter_by(email="u0@x.com").one()
+    u1 = db.query(models.Invite).filter_by(email="u1@x.com").one()
+    outbox.record_remove(db, u0)
+    outbox.record_remove(db, u1)
+    db.commit()
+    # 第二条同一记录的意图（例如另一个进程重复登记）
+    db.add(models.OutboxEntry(id="dup", op=outbox.OP_REMOVE, account_id=u1.account_id, invite_id=u1.id,
+                              email=u1.email, email_id=u1.email_id, status=outbox.PENDING, attempts=0,
+                              max_attempts=6, next_run_at=0, created_at=int(time.time()) + 1, updated_at=0))
+    # u0 在派发前被重新邀请
+    u0.cleaned = False
+    db.commit()
+
+    fake = fake_overleaf()
+    asyncio.run(outbox.OutboxDispatcher(workers=1).run_pending(opener=fake, interval=0))
+
+    assert len(fake.deleted) == 1 and fake.deleted[0].endswith("/uid1")
+    statuses = {e.email: e.status for e in session_factory().query(models.OutboxEntry).filter(models.OutboxEntry.id != "dup")}
+    assert statuses == {"u0@x.com": outbox.SUPERSEDED, "u1@x.com": outbox.DONE}
+    assert session_factory().get(models.OutboxEntry, "dup").status == outbox.SUPERSEDED
+    assert session_factory().query(models.Invite).filter_by(email="u0@x.com").one().cleaned is False
+
+
+def test_failures_retry_then_give_up_and_restore_record(session_factory, db, fake_overleaf):
+    acct_id = seed(db).id
+    invite = db.query(models.Invite).filter_by(email="u0@x.com").one()
+    entry = outbox.record_remove(db, invite)
+    entry.max_attempts = 2
+    db.commit()
+    entry_id, invite_id = entry.id, invite.id
+    fake = fake_overleaf(status=500)
+    dispatcher = outbox.OutboxDispatcher(workers=1)
+
+    asyncio.run(dispatcher.run_pending(opener=fake, interval=0))
+    db = session_factory()
+    entry = db.get(models.OutboxEntry, entry_id)
+    assert entry.status == outbox.PENDING and entry.attempts == 1 and "500" in entry.last_error
+    assert entry.next_run_at > int(time.time())
+    assert db.get(models.Invite, invite_id).cleaned is True
+
+    db.execute(update(models.OutboxEntry).values(next_run_at=0))
+    db.commit()
+    asyncio.run(dispatcher.run_pending(opener=fake, interval=0))
+    db = session_factory()
+    assert db.get(models.OutboxEntry, entry_id).status == outbox.FAILED
+    assert db.get(models.Invite, invite_id).cleaned is False
+    assert db.get(models.Account, acct_id).invites_sent == 4
+
+
+def test_crashed_batch_is_replayed_and_sync_keeps_in_flight_records_cleaned(session_factory, db, fake_overleaf):
+    acct = seed(db)
+    invite = db.query(models.Invite).filter_by(email="u0@x.com").one()
+    outbox.record_remove(db, invite)
+    db.commit()
+
+    # 认领后进程崩溃：批次停在 dispatching
+    assert outbox.claim_batch("dead-worker") is not None
+    assert outbox.claim_batch("other") is None
+    # 崩溃期间对账：成员仍在 Overleaf 上，但记录不会被恢复为未清理
+    members = [{"email": f"u{i}@x.com", "user_id": f"uid{i}", "status": "accepted"} for i in range(3)]
+    change_set = plan_changes(acct, db.query(models.Invite).all(), members,
+                              in_flight=outbox.in_flight_invite_ids(db, acct.id))
+    assert not change_set.of(ChangeAction.UNMARK_CLEANED)
+
+    assert outbox.recover_expired() == 0
+    db.execute(update(models.OutboxEntry).values(lease_expires_at=int(time.time()) - 1))
+    db.commit()
+    assert outbox.recover_expired() == 1
+    fake = fake_overleaf()
+    asyncio.run(outbox.OutboxDispatcher(workers=1).run_pending(opener=fake, interval=0))
+    assert fake.deleted and session_factory().query(models.Invite).filter_by(email="u0@x.com").count() == 0
+
+
+def test_sync_script_apply_keeps_in_flight_records_cleaned(session_factory, db, sync_script, monkeypatch, fake_overleaf):
+    acct = seed(db)
+    invite = db.query(models.Invite).filter_by(email="u0@x.com").one()
+    outbox.record_remove(db, invite)
+    db.commit()
+
+    # 派发前运行 sync_with_overleaf.py --apply：成员仍在 Overleaf 上
+    syncer = sync_script.OverleafSyncer()
+    members = [{"email": f"u{i}@x.com", "user_id": f"uid{i}", "status": "accepted"} for i in range(3)]
+
+    async def fake_members(account):
+        return {"members": members, "total_count": len(members)}
+
+    monkeypatch.setattr(syncer, "get_group_members", fake_members)
+    result = asyncio.run(syncer.sync_account(syncer.db.get(models.Account, acct.id), dry_run=False))
+    syncer.db.close()
+    assert result["success"]
+    assert not [c for c in result["change_set"]["changes"] if c["action"] == ChangeAction.UNMARK_CLEANED.value]
+
+    # 记录仍为已清理，意图不会被作废，派发后成员在 Overleaf 上被删除
+    db.expire_all()
+    assert db.get(models.Invite, invite.id).cleaned is True
+    fake = fake_overleaf()
+    asyncio.run(outbox.OutboxDispatcher(workers=1).run_pending(opener=fake, interval=0))
+    assert len(fake.deleted) == 1 and fake.deleted[0].endswith("/uid0")
+    assert session_factory().query(models.OutboxEntry).one().status == outbox.DONE
+
+
+def test_consistency_checker_reports_from_change_set(db, load_script, monkeypatch):
+    acct = seed(db)
+    u0 = db.query(models.Invite).filter_by(email="u0@x.com").one()
+    u1 = db.query(models.Invite).filter_by(email="u1@x.com").one()
+    outbox.record_remove(db, u0)   # 删除意图还没派发
+    u1.cleaned = True              # 真正的错误清理标记
+    db.commit()
+
+    checker_module = load_script(os.path.join("自动维护目录", "检测数据不一致.py"))
+    checker = checker_module.DataConsistencyChecker()
+    members = [{"email": f"u{i}@x.com", "user_id": f"uid{i}", "status": "accepted"} for i in range(3)]
+    members.append({"email": "manual@x.com", "user_id": None, "status": "pending"})
+
+    async def fake_members(account):
+        return members
+
+    monkeypatch.setattr(checker, "get_overleaf_members", fake_members)
+    result = asyncio.run(checker.check_account_consistency(checker.db.get(models.Account, acct.id)))
+    checker.db.close()
+
+    assert result["wrongly_cleaned"] == ["u1@x.com"]
+    assert result["truly_manual"] == ["manual@x.com"]
+    assert result["db_orphans"] == ["pending@x.com"]
+    assert sorted(result["need_delete"]) == ["manual@x.com", "u1@x.com"]
+    assert result["db_active_count"] == 2 and result["inconsistent"]
+    # 只预览，不写数据库
+    db.expire_all()
+    assert db.get(models.Invite, u1.id).cleaned is True
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ outbox 测试通过")
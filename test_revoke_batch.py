@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+测试批量撤销未接受的邀请：一次查询解析邮箱、每个账号认证一次、批量删除记录、每个账号只计数一次
+使用内存数据库与假的 Overleaf session，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+from sqlalchemy import event
+
+import models, schemas
+import overleaf_utils
+from invite_status_manager import InviteStatusManager
+from routers import remove_member
+
+
+def seed(db):
+    now = int(time.time())
+    a = models.Account(email="a@leader.com", password="p", group_id="ga", max_invites=50, invites_sent=0)
+    b = models.Account(email="b@leader.com", password="p", group_id="gb", max_invites=50, invites_sent=0)
+    db.add_all([a, b])
+    db.flush()
+    rows = [(a, f"pa{i}@x.com", None) for i in range(10)] + [(b, f"pb{i}@x.com", None) for i in range(5)]
+    rows.append((a, "accepted@x.com", "uid-accepted"))
+    for acct, email, email_id in rows:
+        db.add(models.Invite(account_id=acct.id, email=email, email_id=email_id, expires_at=now + 86400,
+                             success=True, result="{}", created_at=now))
+    db.commit()
+    for acct in (a, b):
+        InviteStatusManager.sync_account_invites_count(db, acct)
+    return a, b
+
+
+def run_batch(db, fake_overleaf, emails, statuses=None):
+    fake = fake_overleaf(patch=overleaf_utils, statuses=statuses)
+    response = asyncio.run(remove_member.revoke_batch(schemas.RevokeBatchRequest(emails=emails), db))
+    return response, fake.calls, fake.sessions
+
+
+def test_revokes_per_account_with_one_session_and_one_recount(engine, db, fake_overleaf):
+    a, b = seed(db)
+    assert a.invites_sent == 11 and b.invites_sent == 5
+
+    statements = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, stmt, *args: statements.append(stmt))
+    emails = [f"pa{i}@x.com" for i in range(10)] + [f"PB{i}@x.com" for i in range(5)]
+    response, calls, sessions = run_batch(db, fake_overleaf, emails + ["pa0@x.com"])
+
+    assert response.total == 15 and response.revoked_count == 15
+    assert sorted(calls) == ["a@leader.com", "b@leader.com"]
+    assert len(sessions["a@leader.com"].deleted) == 10
+    assert "/manage/groups/gb/invites/pb0%40x.com" in sessions["b@leader.com"].deleted[0]
+    # 邮箱解析只用一条 JOIN 查询
+    assert sum(1 for s in statements if "FROM invites JOIN accounts" in s) == 1
+
+    db.expire_all()
+    assert db.query(models.Invite).count() == 1
+    assert db.get(models.Account, a.id).invites_sent == 1
+    assert db.get(models.Account, b.id).invites_sent == 0
+    assert db.get(models.Account, b.id).session_cookie == f"sess-{b.id}"
+
+
+def test_accepted_missing_and_failed_are_reported(db, fake_overleaf):
+    seed(db)
+    response, calls, _ = run_batch(
+        db, fake_overleaf, ["accepted@x.com", "nobody@x.com", "pa1@x.com", "pa2@x.com", "pb0@x.com"],
+        statuses={"pa1@x.com": 404, "pa2@x.com": 500}
+    )
+
+    by_email = {r.email: r for r in response.results}
+    assert by_email["accepted@x.com"].status == "accepted" and not by_email["accepted@x.com"].success
+    assert by_email["nobody@x.com"].status == "no_record"
+    assert by_email["pa1@x.com"].status == "not_found" and by_email["pa1@x.com"].success
+    assert by_email["pa2@x.com"].status == "failed" and "500" in by_email["pa2@x.com"].error
+    assert by_email["pb0@x.com"].status == "revoked"
+    assert response.revoked_count == 2 and response.failed_count == 3
+    # 已接受成员的记录与撤销失败的记录都保留
+    remaining = {i.email for i in db.query(models.Invite).all()}
+    assert {"accepted@x.com", "pa2@x.com"} <= remaining and "pa1@x.com" not in remaining
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 批量撤销测试通过")
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+测试组长会话热度：热度判断、选账号时热会话优先、热会话直接发送、后台预热
+使用内存数据库与假的 Overleaf 调用，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+import pytest
+
+import models, crud
+import session_pool
+import overleaf_utils
+from settings import settings
+from invite_status_manager import InviteStatusManager
+from job_coordinator import JobLease, invite_account_scope
+from routers import invites
+from session_pool import session_warmth, HOT, WARM, COLD
+
+
+def add_account(db, email, validated_at, updated_at, with_tokens=True):
+    acct = models.Account(
+        email=email, password="p", group_id="g-" + email, updated_at=updated_at,
+        session_validated_at=validated_at, max_invites=10, invites_sent=0,
+        session_cookie="sess" if with_tokens else None,
+        csrf_token="csrf" if with_tokens else None,
+    )
+    db.add(acct)
+    db.commit()
+    return acct
+
+
+def test_warmth_levels(db):
+    now_ts = int(time.time())
+    hot = add_account(db, "hot@x.com", now_ts - 60, 0)
+    warm = add_account(db, "warm@x.com", now_ts - settings.SESSION_REUSE_SECONDS - 60, 0)
+    stale = add_account(db, "stale@x.com", now_ts - settings.SESSION_WARM_SECONDS - 60, 0)
+    no_tokens = add_account(db, "none@x.com", now_ts, 0, with_tokens=False)
+    assert session_warmth(hot, now_ts) == HOT
+    assert session_warmth(warm, now_ts) == WARM
+    assert session_warmth(stale, now_ts) == COLD
+    assert session_warmth(no_tokens, now_ts) == COLD
+
+
+def test_allocator_prefers_warm_sessions(db):
+    now_ts = int(time.time())
+    # 冷账号最久未使用，按原来的排序会被选中
+    add_account(db, "cold@x.com", 0, updated_at=1)
+    add_account(db, "warm@x.com", now_ts - 3600, updated_at=now_ts)
+    assert crud.get_available_account(db).email == "warm@x.com"
+    # 热账号都没有名额时才用冷账号
+    warm = db.query(models.Account).filter_by(email="warm@x.com").one()
+    assert crud.get_available_account(db, exclude_ids={warm.id}).email == "cold@x.com"
+
+
+def test_allocator_prefers_spare_capacity_within_warmth(db):
+    now_ts = int(time.time())
+    # 同为热会话：最久未使用的账号只剩 1 个名额，较新的账号还有 9 个
+    busy = add_account(db, "busy@x.com", now_ts - 60, updated_at=1)
+    idle = add_account(db, "idle@x.com", now_ts - 60, updated_at=2)
+    for i in range(9):
+        db.add(models.Invite(account_id=busy.id, email=f"b{i}@x.com", email_id=f"uid-{i}",
+                             expires_at=now_ts + 86400, success=True, result="{}", created_at=now_ts))
+    db.add(models.Invite(account_id=idle.id, email="i0@x.com", expires_at=now_ts + 86400,
+                         success=True, result="{}", created_at=now_ts))
+    db.commit()
+    assert crud.get_available_account(db).email == "idle@x.com"
+    # 批量邀请的规划使用同一个排序
+    assert list(invites.load_account_capacity(db).items()) == [(idle.id, 9), (busy.id, 1)]
+    # 剩余名额相同时仍按最久未使用
+    db.add(models.Invite(account_id=idle.id, email="i1@x.com", expires_at=now_ts + 86400,
+                         success=True, result="{}", created_at=now_ts))
+    for i in range(7):
+        db.query(models.Invite).filter_by(email=f"b{i}@x.com").delete()
+    db.commit()
+    assert crud.get_available_account(db).email == "busy@x.com"
+
+
+def test_active_counts_match_calculate_invites_sent(db):
+    now_ts = int(time.time())
+    a = add_account(db, "a@x.com", 0, updated_at=0)
+    b = add_account(db, "b@x.com", 0, updated_at=0)
+    add_account(db, "empty@x.com", 0, updated_at=0)
+
+    def add(acct, email, created_at, **kwargs):
+        kwargs.setdefault("expires_at", now_ts + 86400)
+        db.add(models.Invite(account_id=acct.id, email=email, success=True, result="{}",
+                             created_at=created_at, **kwargs))
+
+    add(a, "accepted@x.com", 1, email_id="uid", expires_at=now_ts - 10)  # 已接受，过期仍在组里
+    add(a, "pending@x.com", 1)                                           # 未接受未过期
+    add(a, "expired@x.com", 1, expires_at=now_ts - 10)                    # 未接受已过期
+    add(a, "manual@x.com", 1, expires_at=None)                            # 手动添加
+    add(a, "blank@x.com", 1, email_id="", expires_at=now_ts - 10)         # 空 email_id 视为未接受
+    add(a, "renewed@x.com", 1, cleaned=True)                              # 旧记录已清理，最新一条有效
+    add(a, "renewed@x.com", 2)
+    add(a, "gone@x.com", 1)                                               # 最新一条已清理
+    add(a, "gone@x.com", 2, cleaned=True)
+    add(b, "pending@x.com", 1)
+    db.commit()
+
+    counts = InviteStatusManager.active_counts(db, now_ts=now_ts)
+    assert counts == {a.id: 4, b.id: 1}
+    for acct in db.query(models.Account):
+        assert counts.get(acct.id, 0) == InviteStatusManager.calculate_invites_sent(db, acct)
+    assert InviteStatusManager.active_counts(db, [b.id], now_ts) == {b.id: 1}
+
+
+def test_hot_session_sends_without_refresh(db):
+    acct = add_account(db, "hot@x.com", int(time.time()) - 10, 0)
+    calls = []
+
+    def fake_send(session, csrf, group_id, email, expires_iso):
+        calls.append(("send", csrf))
+        return {"ok": True}
+
+    def fake_refresh(*args):
+        calls.append(("refresh",))
+        raise AssertionError("热会话不应刷新")
+
+    originals = invites.send_invite, invites.refresh_session
+    invites.send_invite, invites.refresh_session = fake_send, fake_refresh
+    try:
+        result, used = asyncio.run(invites.try_invite_with_account(acct, "u@x.com", "2030-01-01", db, None))
+    finally:
+        invites.send_invite, invites.refresh_session = originals
+    assert result == {"ok": True} and used.id == acct.id
+    assert calls == [("send", "csrf")]
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_warmer_refreshes_cold_accounts_with_quota(session_factory, db, monkeypatch):
+    now_ts = int(time.time())
+    add_account(db, "cold@x.com", 0, updated_at=1)
+    add_account(db, "fresh@x.com", now_ts, updated_at=2)
+    full = add_account(db, "full@x.com", 0, updated_at=3)
+    full.max_invites = 0
+    db.commit()
+
+    opened = []
+
+    async def fake_open(acct):
+        opened.append(acct.email)
+        return None, "new-sess", "new-csrf"
+
+    monkeypatch.setattr(session_pool, "SessionLocal", session_factory)
+    monkeypatch.setattr(overleaf_utils, "open_group_session", fake_open)
+    warmed = asyncio.run(session_pool.warm_cold_accounts(limit=5))
+
+    # 刚验证过的和没有名额的账号不预热
+    assert warmed == 1 and opened == ["cold@x.com"]
+    db.expire_all()
+    cold = db.query(models.Account).filter_by(email="cold@x.com").one()
+    assert cold.session_cookie == "new-sess" and session_warmth(cold) == HOT
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_warmer_skips_account_in_use(db, monkeypatch):
+    acct = add_account(db, "busy@x.com", 0, updated_at=1)
+    db.commit()
+    opened = []
+
+    async def fake_open(account):
+        opened.append(account.email)
+        return None, "new-sess", "new-csrf"
+
+    monkeypatch.setattr(overleaf_utils, "open_group_session", fake_open)
+    monkeypatch.setattr(settings, "SESSION_WARMER_LOCK_TIMEOUT", 0.2)
+    # 其他进程正在用该账号邀请（持有 invite_account 租约）
+    inviter = JobLease(invite_account_scope(acct.id))
+    assert inviter.acquire()
+
+    started = time.monotonic()
+    assert asyncio.run(session_pool.warm_account(db, acct)) is False
+    assert time.monotonic() - started < 2
+    assert opened == [] and db.get(models.Account, acct.id).session_cookie != "new-sess"
+
+    # 释放后正常预热
+    inviter.release()
+    assert asyncio.run(session_pool.warm_account(db, acct)) is True
+    assert opened == ["busy@x.com"] and session_warmth(db.get(models.Account, acct.id)) == HOT
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 会话热度测试通过")
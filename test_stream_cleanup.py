@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+测试流式清理过期邀请：按 (expires_at, id) 游标分块、每块一条语句、只处理过期未清理的记录、结束后重新计数、进度回调
+使用内存数据库
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import time
+from sqlalchemy import event
+
+import models
+from invite_status_manager import InviteStatusManager
+
+
+def seed(db):
+    now = int(time.time())
+    a = models.Account(email="a@leader.com", password="p", group_id="ga", max_invites=50, invites_sent=0)
+    b = models.Account(email="b@leader.com", password="p", group_id="gb", max_invites=50, invites_sent=0)
+    db.add_all([a, b])
+    db.flush()
+    rows = []
+    for i in range(7):   # a: 7 条过期（4 条已接受），b: 3 条过期
+        rows.append((a, f"a{i}@x.com", f"uid{i}" if i < 4 else None, now - 100 - i))
+    for i in range(3):
+        rows.append((b, f"b{i}@x.com", None, now - 50))
+    rows.append((a, "active@x.com", None, now + 86400))
+    rows.append((b, "manual@x.com", "uid-manual", None))
+    for acct, email, email_id, expires_at in rows:
+        db.add(models.Invite(account_id=acct.id, email=email, email_id=email_id, expires_at=expires_at,
+                             success=True, result="{}", created_at=now - 1000))
+    # 已清理的不再处理
+    db.add(models.Invite(account_id=b.id, email="old@x.com", expires_at=now - 10, success=True,
+                         result="{}", created_at=now - 1000, cleaned=True))
+    db.commit()
+    return a, b
+
+
+def test_stream_deletes_all_chunks_and_recounts_once(engine, db):
+    a, b = seed(db)
+    # 缓存计数是旧值：已接受的过期成员也算在内
+    a.invites_sent, b.invites_sent = 8, 4
+    db.commit()
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, stmt, *args: statements.append(stmt))
+    calls = []
+    stats = InviteStatusManager.stream_cleanup_expired(
+        db, chunk_size=3, progress=lambda done, total, item: calls.append((done, total))
+    )
+
+    assert stats["total_found"] == 10 and stats["deleted_records"] == 10
+    assert stats["accepted_removed"] == 4 and stats["pending_revoked"] == 6
+    assert stats["chunks"] == 4 and stats["accounts_recounted"] == 2 and stats["errors"] == 0
+    assert calls == [(3, 10), (6, 10), (9, 10), (10, 10)]
+    # 每块一条 DELETE，不逐条删除
+    assert sum(1 for s in statements if s.startswith("DELETE FROM invites")) == 4
+
+    db.expire_all()
+    assert {i.email for i in db.query(models.Invite).all()} == {"active@x.com", "manual@x.com", "old@x.com"}
+    assert db.get(models.Account, a.id).invites_sent == 1
+    assert db.get(models.Account, b.id).invites_sent == 1
+
+
+def test_stream_mark_mode_annotates_result(db):
+    a, _ = seed(db)
+    odd = db.query(models.Invite).filter_by(email="a0@x.com").one()
+    odd.result = "not json"
+    db.commit()
+
+    stats = InviteStatusManager.stream_cleanup_expired(db, chunk_size=4, delete_records=False)
+    assert stats["marked_processed"] == 10 and stats["deleted_records"] == 0
+
+    db.expire_all()
+    assert db.query(models.Invite).filter(models.Invite.cleaned.is_(False)).count() == 2
+    marked = json.loads(db.query(models.Invite).filter_by(email="a5@x.com").one().result)
+    assert marked["processed_reason"] == "expired" and marked["processed_at"] > 0
+    # 不是 JSON 的内容写入时已包成 {"original_result": ...}，同样会记下处理原因
+    odd = json.loads(db.query(models.Invite).filter_by(email="a0@x.com").one().result)
+    assert odd["original_result"] == "not json" and odd["processed_reason"] == "expired"
+    assert InviteStatusManager.stream_cleanup_expired(db)["total_found"] == 0
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 流式清理测试通过")
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+测试对账引擎：变更集生成、序列化、dry-run 与批量应用
+使用内存数据库，不影响 overleaf_inviter.db
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import time
+from sqlalchemy import text
+
+import models
+import migrations
+from database import Base
+from sync_engine import (
+    ChangeAction, ChangeSet, CountSource,
+    plan_changes, apply_change_set, reconcile_account
+)
+
+
+def seed(db):
+    """
+    a@x: 数据库未接受，Overleaf 已接受 -> set_email_id
+    b@x: 数据库已清理，Overleaf 仍存在   -> unmark_cleaned
+    c@x: 数据库活跃，Overleaf 不存在     -> mark_cleaned
+    d@x: 两边一致                         -> 无变更
+    e@x: 只在 Overleaf                    -> create_external
+    """
+    now_ts = int(time.time())
+    acct = models.Account(email="leader@x.com", password="p", group_id="g1", invites_sent=0)
+    db.add(acct)
+    db.commit()
+    for email, email_id, cleaned in [
+        ("a@x.com", None, False),
+        ("b@x.com", "uid-b", True),
+        ("c@x.com", None, False),
+        ("d@x.com", "uid-d", False),
+    ]:
+        db.add(models.Invite(
+            account_id=acct.id, email=email, email_id=email_id,
+            expires_at=now_ts + 86400, success=True, result="{}",
+            created_at=now_ts, cleaned=cleaned
+        ))
+    db.commit()
+    members = [
+        {"email": "a@x.com", "user_id": "uid-a", "status": "accepted"},
+        {"email": "b@x.com", "user_id": "uid-b", "status": "accepted"},
+        {"email": "d@x.com", "user_id": "uid-d", "status": "accepted"},
+        {"email": "e@x.com", "user_id": None, "status": "pending"},
+    ]
+    return acct, members
+
+
+def test_plan_changes_types(db):
+    acct, members = seed(db)
+    invites = db.query(models.Invite).all()
+
+    change_set = plan_changes(acct, invites, members)
+    summary = change_set.summary()
+
+    assert summary["set_email_id"] == 1
+    assert summary["unmark_cleaned"] == 1
+    assert summary["mark_cleaned"] == 1
+    assert summary["create_external"] == 1
+    # a, b, d, e 活跃 -> 4
+    fix = change_set.of(ChangeAction.FIX_COUNT)
+    assert len(fix) == 1 and fix[0].new_count == 4
+
+    # 可序列化并可还原
+    restored = ChangeSet.from_dict(change_set.to_dict())
+    assert restored.summary() == summary
+    assert restored.changes[0].action == change_set.changes[0].action
+
+
+def test_dry_run_does_not_write(db):
+    acct, members = seed(db)
+
+    change_set = reconcile_account(db, acct, members, dry_run=True)
+    assert not change_set.applied
+    assert db.query(models.Invite).count() == 4
+    assert db.query(models.Invite).filter_by(email="a@x.com").one().email_id is None
+
+
+def test_apply_in_one_transaction(db):
+    acct, members = seed(db)
+
+    change_set = reconcile_account(db, acct, members)
+    assert change_set.applied
+
+    rows = {i.email: i for i in db.query(models.Invite).all()}
+    assert rows["a@x.com"].email_id == "uid-a"
+    assert rows["b@x.com"].cleaned is False
+    assert rows["c@x.com"].cleaned is True
+    assert rows["e@x.com"].expires_at is None
+    assert db.get(models.Account, acct.id).invites_sent == 4
+
+    # 再次对账不应产生任何变更
+    again = reconcile_account(db, acct, members, dry_run=True)
+    assert again.is_empty
+
+
+def test_replayed_change_set_is_idempotent(db):
+    acct, members = seed(db)
+
+    # 两个 worker 基于同一快照规划出相同的变更集，先后应用
+    first = plan_changes(acct, db.query(models.Invite).all(), members)
+    second = ChangeSet.from_dict(first.to_dict())
+    apply_change_set(db, first)
+    apply_change_set(db, second)
+
+    assert db.query(models.Invite).filter_by(email="e@x.com").count() == 1
+    assert db.query(models.Invite).count() == 5
+
+
+def test_external_dedupe_is_explicit_and_confirmed(engine, tmp_path):
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX uq_invites_external_account_email"))
+        conn.execute(text(
+            "INSERT INTO accounts (email, password, group_id, max_invites, invites_sent) "
+            "VALUES ('leader@x.com', 'p', 'g', 10, 0)"
+        ))
+        conn.execute(text(
+            "INSERT INTO invites (account_id, email, email_id, success, result, created_at, cleaned) VALUES "
+            "(1, 'e@x.com', NULL, 1, '{}', 1, 0), (1, 'e@x.com', 'uid-e', 1, '{}', 2, 0), (1, 'f@x.com', NULL, 1, '{}', 3, 0)"
+        ))
+        # 升级不删除数据：有重复时跳过唯一索引
+        migrations.upgrade_schema(Base.metadata, conn)
+        indexes = {row[1] for row in conn.execute(text("PRAGMA index_list('invites')"))}
+        assert "uq_invites_external_account_email" not in indexes
+        assert conn.execute(text("SELECT COUNT(*) FROM invites")).scalar() == 3
+
+    # 不确认只列出将要删除的记录
+    rows = migrations.dedupe_external(engine)
+    assert [(r["id"], r["keep_id"], r["email_id"]) for r in rows] == [(2, 1, "uid-e")]
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM invites")).scalar() == 3
+
+    backup = str(tmp_path / "dedupe.json")
+    migrations.dedupe_external(engine, confirm=True, backup_path=backup)
+    with open(backup, encoding="utf-8") as f:
+        assert [r["id"] for r in json.load(f)] == [2]
+    with engine.begin() as conn:
+        assert conn.execute(text("SELECT id, email_id FROM invites WHERE email = 'e@x.com'")).all() == [(1, "uid-e")]
+        assert "表 invites 新增索引 uq_invites_external_account_email" in migrations.upgrade_schema(Base.metadata, conn)
+
+
+def test_count_from_overleaf(db):
+    acct, members = seed(db)
+    invites = db.query(models.Invite).all()
+
+    change_set = plan_changes(acct, invites, members, count_source=CountSource.OVERLEAF)
+    apply_change_set(db, change_set)
+    assert db.get(models.Account, acct.id).invites_sent == len(members)
+
+
+def test_external_rows_without_unique_index(db):
+    # 有重复的数据库外用户时 migrations 跳过唯一索引，ON CONFLICT 没有冲突目标
+    db.execute(text("DROP INDEX uq_invites_external_account_email"))
+    acct, members = seed(db)
+    now = int(time.time())
+    for created_at in (now - 2, now - 1):
+        db.add(models.Invite(account_id=acct.id, email="dup@x.com", email_id=None, expires_at=None,
+                             success=True, result="{}", created_at=created_at, cleaned=True))
+    db.commit()
+    external = [m for m in members if m["email"] == "e@x.com"]
+    external.append({"email": "dup@x.com", "user_id": "uid-dup", "status": "accepted"})
+
+    # 两个 worker 基于同一（还没有这两条记录的）快照规划，先后应用：不报错、不插入重复记录
+    first = plan_changes(acct, [], external)
+    second = ChangeSet.from_dict(first.to_dict())
+    apply_change_set(db, first)
+    apply_change_set(db, second)
+
+    rows = db.query(models.Invite).filter(models.Invite.expires_at.is_(None)).all()
+    assert sorted(i.email for i in rows) == ["dup@x.com", "dup@x.com", "e@x.com"]
+    assert {(i.email_id, i.cleaned) for i in rows if i.email == "dup@x.com"} == {("uid-dup", False)}
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 对账引擎测试通过")
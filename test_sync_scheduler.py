@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+测试同步优先级队列：评分排序与对账后快照回写
+使用内存数据库，不影响 overleaf_inviter.db
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+
+import models
+from sync_engine import reconcile_account
+from sync_scheduler import rank_accounts
+
+
+def add_invite(db, acct, email, email_id=None, expires_in=7 * 86400, created_at=None):
+    now_ts = int(time.time())
+    db.add(models.Invite(
+        account_id=acct.id, email=email, email_id=email_id,
+        expires_at=now_ts + expires_in, success=True, result="{}",
+        created_at=created_at or now_ts - 3600, cleaned=False
+    ))
+
+
+def test_rank_by_pending_work(db):
+    now_ts = int(time.time())
+    quiet = models.Account(email="quiet@x.com", password="p", group_id="g1",
+                           last_synced_at=now_ts - 600, updated_at=0)
+    busy = models.Account(email="busy@x.com", password="p", group_id="g2",
+                          last_synced_at=now_ts - 600, updated_at=0)
+    never = models.Account(email="never@x.com", password="p", group_id="g3")
+    db.add_all([quiet, busy, never])
+    db.commit()
+
+    add_invite(db, quiet, "q@x.com", email_id="uid-q", created_at=now_ts - 7200)
+    add_invite(db, busy, "b1@x.com", created_at=now_ts - 60)                    # 待接受 + 对账后新发
+    add_invite(db, busy, "b2@x.com", expires_in=3600, created_at=now_ts - 60)   # 待接受 + 即将到期 + 对账后新发
+    db.commit()
+
+    ranked = rank_accounts(db, now_ts=now_ts)
+    assert [p.email for p in ranked] == ["never@x.com", "busy@x.com", "quiet@x.com"]
+
+    busy_p = ranked[1]
+    assert busy_p.pending == 2 and busy_p.expiring_soon == 1 and busy_p.recent_invites == 2
+    assert ranked[2].recent_invites == 0
+    assert ranked[2].score < busy_p.score
+
+    assert [p.email for p in rank_accounts(db, now_ts=now_ts, limit=1)] == ["never@x.com"]
+
+
+def test_reconcile_records_snapshot(db):
+    acct = models.Account(email="leader@x.com", password="p", group_id="g1", invites_sent=0)
+    db.add(acct)
+    db.commit()
+    add_invite(db, acct, "a@x.com")
+    db.commit()
+
+    members = [{"email": "a@x.com", "user_id": "uid-a", "status": "accepted"}]
+    change_set = reconcile_account(db, acct, members)
+    acct = db.get(models.Account, acct.id)
+    assert acct.last_synced_at > 0
+    assert acct.last_drift == len(change_set.changes) == 2  # set_email_id + fix_count
+
+    # 没有变更也刷新快照，漂移归零
+    reconcile_account(db, acct, members)
+    assert db.get(models.Account, acct.id).last_drift == 0
+    assert not rank_accounts(db)[0].never_synced
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 同步优先级测试通过")
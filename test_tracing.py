@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+测试分阶段耗时：span 嵌套与属性继承、错误计数、直方图导出、请求内耗时明细
+使用内存数据库与假的 Overleaf 调用，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+
+import models, schemas
+import tracing
+from routers import invites
+from tracing import span, collect, annotate
+
+
+def test_nested_spans_inherit_attributes_and_feed_histograms():
+    tracing.metrics.reset()
+    with collect() as trace:
+        with span("invite"):
+            with span("attempt", account_id=7, attempt=2):
+                with span("send_invite"):
+                    pass
+                try:
+                    with span("perform_login"):
+                        raise RuntimeError("boom")
+                except RuntimeError:
+                    pass
+
+    stages = tracing.metrics.snapshot()
+    assert set(stages) == {
+        "invite", "invite.attempt", "invite.attempt.send_invite", "invite.attempt.perform_login"
+    }
+    assert stages["invite.attempt.perform_login"]["errors"] == 1
+    assert stages["invite.attempt.send_invite"]["buckets"]["+Inf"] == 1
+
+    breakdown = trace.breakdown()
+    spans = {s["stage"]: s for s in breakdown["spans"]}
+    assert spans["invite.attempt.send_invite"]["account_id"] == 7
+    assert spans["invite.attempt.send_invite"]["attempt"] == 2
+    assert spans["invite.attempt.perform_login"]["error"] == "RuntimeError"
+    assert "account_id" not in spans["invite"]
+    # 明细按开始时间排序：根 span 在前
+    assert breakdown["spans"][0]["stage"] == "invite"
+
+    text = tracing.metrics.render_prometheus()
+    assert 'overleaf_stage_duration_seconds_count{stage="invite.attempt.send_invite"} 1' in text
+
+
+def test_spans_in_threads_and_annotations_are_collected():
+    tracing.metrics.reset()
+
+    def blocking():
+        with span("in_thread"):
+            time.sleep(0.01)
+
+    async def pipeline():
+        with span("remove"):
+            annotate(account_id=3)
+            await asyncio.to_thread(blocking)
+
+    with collect() as trace:
+        asyncio.run(pipeline())
+
+    spans = {s["stage"]: s for s in trace.breakdown()["spans"]}
+    assert spans["remove.in_thread"]["account_id"] == 3
+    assert spans["remove.in_thread"]["ms"] >= 10
+    assert trace.breakdown()["stages"]["remove"]["count"] == 1
+
+
+def test_invite_attempt_stages_carry_account_and_attempt(db):
+    acct = models.Account(email="hot@x.com", password="p", group_id="g", updated_at=0,
+                          session_validated_at=int(time.time()), max_invites=10, invites_sent=0,
+                          session_cookie="sess", csrf_token="csrf")
+    db.add_all([acct, models.Card(code="C1", days=30, used=False)])
+    db.commit()
+
+    original = invites.send_invite
+    invites.send_invite = lambda *args: {"ok": True}
+    tracing.metrics.reset()
+    try:
+        with collect() as trace:
+            response = asyncio.run(invites.run_invite(schemas.InviteRequest(email="u@x.com", card="C1"), db))
+    finally:
+        invites.send_invite = original
+
+    assert response.success
+    spans = {s["stage"]: s for s in trace.breakdown()["spans"]}
+    send = spans["invite.account_loop.attempt.hot_send_invite"]
+    assert send["account_id"] == acct.id and send["attempt"] == 1
+    assert "invite.account_loop.select_account" in spans
+    assert "invite.account_loop.attempt.hot_send_invite" in tracing.metrics.snapshot()
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 分阶段耗时测试通过")
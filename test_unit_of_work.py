@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+测试邀请写路径的单次事务模式：统计每次邀请产生的数据库写事务数。
+SQLite 每提交一个写事务都要 fsync（journal 与数据库文件），写事务数即 fsync 轮数。
+使用临时文件数据库与假的 Overleaf 邀请函数，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import event
+
+import models, schemas, crud
+from routers import invites
+from routers.invites import InviteAttemptFailedError, run_invite
+
+
+class WriteCounter:
+    """commits: 所有 COMMIT；write_commits: 含 INSERT/UPDATE/DELETE 的提交（每个都是一轮 fsync）"""
+
+    def __init__(self, engine):
+        self.commits = 0
+        self.write_commits = 0
+        self._pending_write = False
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+        event.listen(engine, "commit", self._on_commit)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split(" ", 1)[0].upper() in ("INSERT", "UPDATE", "DELETE"):
+            self._pending_write = True
+
+    def _on_commit(self, conn):
+        self.commits += 1
+        if self._pending_write:
+            self.write_commits += 1
+        self._pending_write = False
+
+    def reset(self):
+        self.commits = self.write_commits = 0
+
+
+@pytest.fixture
+def seeded(file_engine, file_db):
+    file_db.add_all([
+        models.Account(email="bad@x.com", password="p", group_id="g1", updated_at=1, invites_sent=0),
+        models.Account(email="good@x.com", password="p", group_id="g2", updated_at=2, invites_sent=3),
+        models.Card(code="CARD1", days=7, used=False),
+    ])
+    file_db.commit()
+    return file_db, WriteCounter(file_engine)
+
+
+async def fake_try_invite(acct, email, expires_iso, db, card):
+    # 与真实流程一样先写回刷新后的 token，再发送邀请
+    crud.update_account_tokens(db, acct, "csrf-" + acct.email, "sess-" + acct.email)
+    if acct.email.startswith("bad"):
+        raise InviteAttemptFailedError("邀请失败")
+    return {"ok": True}, acct
+
+
+def run(db, email="u@x.com", card="CARD1"):
+    original = invites.try_invite_with_account
+    invites.try_invite_with_account = fake_try_invite
+    try:
+        return asyncio.run(run_invite(schemas.InviteRequest(email=email, card=card), db))
+    finally:
+        invites.try_invite_with_account = original
+
+
+def test_legacy_sequence_commits_per_step(seeded):
+    """改造前的写路径：每个 crud 调用各自提交（失败账号 1 次 + token 2 次 + 卡密 + 记录 + 计数）"""
+    db, counter = seeded
+    bad = db.query(models.Account).filter_by(email="bad@x.com").one()
+    good = db.query(models.Account).filter_by(email="good@x.com").one()
+    card = db.query(models.Card).filter_by(code="CARD1").one()
+
+    counter.reset()
+    crud.update_account_tokens(db, bad, "c", "s")
+    crud.touch_account(db, bad)
+    crud.update_account_tokens(db, good, "c", "s")
+    crud.mark_card_used(db, card)
+    crud.create_invite_record(db, good, "u@x.com", int(time.time()) + 86400, True, {"ok": True}, card)
+    crud.sync_account_invites_count(db, good)
+    assert counter.commits == 6
+    # 同一秒内 touch_account 没有实际变化时不产生 UPDATE
+    assert counter.write_commits >= 5
+    print(f"逐步提交: {counter.write_commits} 个写事务")
+
+
+def test_invite_is_one_transaction(seeded):
+    db, counter = seeded
+    counter.reset()
+    response = run(db)
+    assert response.success
+    # 第一个账号失败、第二个账号成功，仍然只有一个写事务
+    assert counter.write_commits == 1, counter.write_commits
+    print(f"单次事务: {counter.write_commits} 个写事务（共 {counter.commits} 次 COMMIT）")
+
+    db.expire_all()
+    bad = db.query(models.Account).filter_by(email="bad@x.com").one()
+    good = db.query(models.Account).filter_by(email="good@x.com").one()
+    assert bad.csrf_token == "csrf-bad@x.com" and bad.updated_at > 2
+    assert good.session_cookie == "sess-good@x.com"
+    assert good.invites_sent == 1
+    assert db.query(models.Card).filter_by(code="CARD1").one().used
+    invite = db.query(models.Invite).filter_by(email="u@x.com").one()
+    assert invite.account_id == good.id and invite.success
+
+
+def test_failed_invite_still_keeps_refreshed_tokens(seeded):
+    db, counter = seeded
+    db.query(models.Account).filter_by(email="good@x.com").delete()
+    db.commit()
+
+    counter.reset()
+    try:
+        run(db)
+        assert False, "应当失败"
+    except HTTPException as e:
+        assert e.status_code == 400
+    assert counter.write_commits == 1
+
+    db.expire_all()
+    bad = db.query(models.Account).filter_by(email="bad@x.com").one()
+    assert bad.csrf_token == "csrf-bad@x.com"
+    assert not db.query(models.Card).filter_by(code="CARD1").one().used
+    assert db.query(models.Invite).count() == 0
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 单次事务测试通过")
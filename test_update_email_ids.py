@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+测试 email_id 回填：reconcile_email_ids 批量写回本组记录并追加事件、/update_all 一次提交所有成功的组、
+单个组登录或拉取失败不影响其他组；以及同步器复用 overleaf_utils 的认证与成员页解析
+使用内存数据库，Overleaf 调用替换为假实现
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import time
+import asyncio
+import pytest
+
+import models, schemas
+import invite_events
+from routers import update_email_id, sync
+
+
+def add_account(db, email, max_invites=10):
+    acct = models.Account(email=email, password="p", group_id="g-" + email, max_invites=max_invites,
+                          updated_at=0, session_cookie="old-sess", csrf_token="old-csrf")
+    db.add(acct)
+    db.flush()
+    return acct
+
+
+def add_invite(db, acct, email, email_id=None):
+    invite = models.Invite(account_id=acct.id, email=email, email_id=email_id, success=True, result="{}",
+                           expires_at=int(time.time()) + 86400, created_at=int(time.time()))
+    db.add(invite)
+    db.flush()
+    return invite
+
+
+def test_reconcile_updates_only_changed_rows_of_the_account(db):
+    a = add_account(db, "a@leader.com", max_invites=5)
+    b = add_account(db, "b@leader.com")
+    stale = add_invite(db, a, "u1@x.com", email_id="old-id")
+    fresh = add_invite(db, a, "u2@x.com")
+    same = add_invite(db, a, "u3@x.com", email_id="id-3")
+    other = add_invite(db, b, "u1@x.com")
+    db.commit()
+
+    users = [
+        {"email": "u1@x.com", "_id": "id-1"},
+        {"email": "u2@x.com", "_id": "id-2"},
+        {"email": "u3@x.com", "_id": "id-3"},   # 已一致，不重复写
+        {"email": "pending@x.com"},              # 未接受，没有 _id
+    ]
+    assert update_email_id.reconcile_email_ids(db, a, users) == 2
+    db.commit()
+
+    db.expire_all()
+    assert db.get(models.Invite, stale.id).email_id == "id-1"
+    assert db.get(models.Invite, fresh.id).email_id == "id-2"
+    assert db.get(models.Invite, same.id).email_id == "id-3"
+    # 其他组长名下的同一邮箱不受影响
+    assert db.get(models.Invite, other.id).email_id is None
+    events = db.query(models.InviteEvent).filter_by(kind=invite_events.EMAIL_ID).all()
+    assert sorted((e.invite_id, e.detail) for e in events) == [(stale.id, "id-1"), (fresh.id, "id-2")]
+    # 顺带记录容量快照
+    acct = db.get(models.Account, a.id)
+    assert (acct.overleaf_member_count, acct.overleaf_pending_count) == (4, 1)
+
+
+@pytest.mark.usefixtures("job_leases")
+def test_update_all_isolates_failed_accounts(db, monkeypatch):
+    ok = add_account(db, "ok@leader.com")
+    broken = add_account(db, "broken@leader.com")
+    add_invite(db, ok, "m1@x.com")
+    add_invite(db, ok, "m2@x.com")
+    untouched = add_invite(db, broken, "m3@x.com")
+    db.commit()
+
+    async def fake_fetch(acct):
+        if acct.email == "broken@leader.com":
+            raise RuntimeError("登录失败")
+        users = [{"email": "m1@x.com", "_id": "id-m1"}, {"email": "m2@x.com", "_id": "id-m2"}]
+        return users, "new-sess", "new-csrf"
+
+    monkeypatch.setattr(update_email_id, "_fetch_account_members", fake_fetch)
+    response = asyncio.run(update_email_id.update_all_email_ids(schemas.UpdateAllEmailIdsRequest(), db))
+
+    assert (response.total_accounts, response.success_accounts, response.failed_accounts) == (2, 1, 1)
+    assert response.total_updated == 2
+    results = {r.leader_email: r for r in response.results}
+    assert results["ok@leader.com"].success and results["ok@leader.com"].updated_invites == 2
+    assert not results["broken@leader.com"].success and results["broken@leader.com"].error == "登录失败"
+
+    db.expire_all()
+    assert {i.email: i.email_id for i in db.query(models.Invite).filter_by(account_id=ok.id)} == {
+        "m1@x.com": "id-m1", "m2@x.com": "id-m2"
+    }
+    assert db.get(models.Invite, untouched.id).email_id is None
+    # 只有成功的组写回新 token
+    assert db.get(models.Account, ok.id).session_cookie == "new-sess"
+    assert db.get(models.Account, broken.id).session_cookie == "old-sess"
+
+    # 只对指定的组长对账
+    response = asyncio.run(update_email_id.update_all_email_ids(
+        schemas.UpdateAllEmailIdsRequest(leader_emails=["ok@leader.com"]), db
+    ))
+    assert response.total_accounts == 1 and response.total_updated == 0
+
+
+def test_syncer_reuses_overleaf_utils(db, monkeypatch):
+    acct = add_account(db, "s@leader.com")
+    db.commit()
+    calls = []
+
+    async def fake_open(account):
+        calls.append(("open", account.email))
+        return "session", "new-sess", "new-csrf"
+
+    def fake_fetch(session, group_id):
+        calls.append(("fetch", session, group_id))
+        return [{"email": "a@x.com", "_id": "id-a"}, {"email": "b@x.com"}]
+
+    monkeypatch.setattr(sync, "open_group_session", fake_open)
+    monkeypatch.setattr(sync, "fetch_group_members", fake_fetch)
+    data = asyncio.run(sync.OverleafSyncer(db).get_group_members(acct))
+
+    assert calls == [("open", "s@leader.com"), ("fetch", "session", "g-s@leader.com")]
+    assert data["total_count"] == 2
+    assert [(m["email"], m["status"]) for m in data["members"]] == [("a@x.com", "accepted"), ("b@x.com", "pending")]
+    db.expire_all()
+    assert db.get(models.Account, acct.id).csrf_token == "new-csrf"
+
+
+@pytest.mark.parametrize("path, cls, method", [
+    (os.path.join("脚本目录", "sync_with_overleaf.py"), "OverleafSyncer", "get_group_members"),
+    (os.path.join("脚本目录", "auto_maintenance.py"), "AutoMaintenanceManager", "_get_overleaf_members"),
+    (os.path.join("自动维护目录", "系统整体维护.py"), "SystemMaintenance", "get_overleaf_members"),
+    (os.path.join("自动维护目录", "检测数据不一致.py"), "DataConsistencyChecker", "get_overleaf_members"),
+    (os.path.join("自动维护目录", "更新邮箱ID.py"), "EmailIdUpdater", "get_overleaf_members"),
+])
+def test_scripts_reuse_overleaf_utils(db, load_script, monkeypatch, path, cls, method):
+    script = load_script(path)
+    acct = add_account(db, "s@leader.com")
+    db.commit()
+    calls = []
+
+    async def fake_open(account):
+        calls.append(("open", account.email))
+        return "session", "new-sess", "new-csrf"
+
+    def fake_fetch(session, group_id):
+        calls.append(("fetch", session, group_id))
+        return [{"email": "a@x.com", "_id": "id-a"}, {"email": "b@x.com"}]
+
+    monkeypatch.setattr(script, "open_group_session", fake_open)
+    monkeypatch.setattr(script, "fetch_group_members", fake_fetch)
+    runner = getattr(script, cls)()
+    try:
+        data = asyncio.run(getattr(runner, method)(runner.db.get(models.Account, acct.id)))
+    finally:
+        runner.db.close()
+
+    members = data["members"] if isinstance(data, dict) else data
+    assert calls == [("open", "s@leader.com"), ("fetch", "session", "g-s@leader.com")]
+    assert [(m["email"], m["user_id"], m["status"]) for m in members] == [
+        ("a@x.com", "id-a", "accepted"), ("b@x.com", None, "pending")
+    ]
+    db.expire_all()
+    assert db.get(models.Account, acct.id).csrf_token == "new-csrf"
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ email_id 回填测试通过")
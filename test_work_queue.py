@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+测试后台工作项：重新激活后的原组清理
+失败按退避重试、当前状态写回 reactivation_info 并追加事件、超过次数后放弃
+使用内存数据库与假的 Overleaf session，不访问 Overleaf
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import time
+import asyncio
+import pytest
+
+import models
+import work_queue
+import invite_events
+from routers import invites
+
+
+@pytest.fixture(autouse=True)
+def work_queue_sessions(file_session_factory, monkeypatch):
+    # worker 通过 asyncio.to_thread 在多个线程中各自开会话，
+    # 共享单连接的 StaticPool 会互相干扰，这里用临时文件数据库
+    monkeypatch.setattr(work_queue, "SessionLocal", file_session_factory)
+
+
+def seed(db):
+    old = models.Account(email="old@x.com", password="p", group_id="g-old", updated_at=0)
+    new = models.Account(email="new@x.com", password="p", group_id="g-new", updated_at=0)
+    db.add_all([old, new])
+    db.flush()
+    # 重新激活写入的 result 带登记时的 reactivation_info，之后的清理进展更新其中的 cleanup_* 并追加事件
+    result = {"ok": True, "reactivation_info": {"type": "reactivation", "cleanup_status": "queued"}}
+    invite = models.Invite(
+        account_id=new.id, email="u@x.com", email_id="uid-1", expires_at=int(time.time()) + 86400,
+        success=True, result=json.dumps(result), created_at=int(time.time()), cleaned=False,
+    )
+    db.add(invite)
+    db.flush()
+    item = work_queue.enqueue(db, invite_events.REACTIVATION_CLEANUP, {
+        "invite_id": invite.id, "account_id": old.id, "email": "u@x.com", "email_id": "uid-1",
+    }, commit=False)
+    db.commit()
+    return invite.id, item.id
+
+
+def run_with(fake_overleaf, statuses):
+    fake = fake_overleaf(patch=invites, statuses=list(statuses))
+    queue = work_queue.WorkQueue(workers=1)
+    return asyncio.run(queue.run_pending()), fake
+
+
+def reactivation_info(db, invite_id):
+    db.expire_all()
+    return json.loads(db.get(models.Invite, invite_id).result)["reactivation_info"]
+
+
+def cleanup_event(db, invite_id):
+    db.expire_all()
+    return invite_events.to_dict(invite_events.latest(db, invite_id, invite_events.REACTIVATION_CLEANUP))
+
+
+def test_cleanup_retries_then_succeeds(file_db, fake_overleaf):
+    db = file_db
+    invite_id, item_id = seed(db)
+
+    processed, fake = run_with(fake_overleaf, [500])
+    assert processed == 1 and len(fake.deleted) == 1
+    assert fake.deleted[0].endswith("/manage/groups/g-old/user/uid-1")
+
+    db.expire_all()
+    item = db.get(models.WorkItem, item_id)
+    assert item.status == "pending" and item.attempts == 1
+    assert item.next_run_at > time.time()          # 退避期内不会再被认领
+    event = cleanup_event(db, invite_id)
+    assert event["detail"] == "retrying" and "500" in event["data"]["message"]
+    info = reactivation_info(db, invite_id)
+    assert info["cleanup_status"] == "retrying" and info["cleanup_attempts"] == 1
+    assert "500" in info["cleanup_message"] and info["cleanup_next_retry_at"] > time.time()
+
+    processed, _ = run_with(fake_overleaf, [])
+    assert processed == 0
+
+    item.next_run_at = 0
+    db.commit()
+    processed, _ = run_with(fake_overleaf, [404])                 # 成员已不存在同样视为成功
+    assert processed == 1
+    db.expire_all()
+    item = db.get(models.WorkItem, item_id)
+    assert item.status == "succeeded" and item.attempts == 2
+    event = cleanup_event(db, invite_id)
+    assert event["detail"] == "succeeded" and event["data"]["attempts"] == 2
+    assert [e.detail for e in invite_events.history(db, invite_id)] == ["retrying", "succeeded"]
+    info = reactivation_info(db, invite_id)
+    assert info["cleanup_status"] == "succeeded" and info["cleanup_success"] is True
+    assert info["cleanup_attempts"] == 2 and info["cleanup_message"] == "成员已不存在"
+    assert "cleanup_next_retry_at" not in info and info["type"] == "reactivation"
+
+    old = db.query(models.Account).filter_by(email="old@x.com").one()
+    assert old.session_cookie == f"sess-{old.id}" and old.csrf_token == f"csrf-{old.id}"
+
+
+def test_cleanup_gives_up_after_max_attempts(file_db, fake_overleaf):
+    db = file_db
+    invite_id, item_id = seed(db)
+    item = db.get(models.WorkItem, item_id)
+    item.max_attempts = 2
+    db.commit()
+
+    for _ in range(2):
+        run_with(fake_overleaf, [403])
+        db.expire_all()
+        item = db.get(models.WorkItem, item_id)
+        item.next_run_at = 0
+        db.commit()
+
+    db.expire_all()
+    item = db.get(models.WorkItem, item_id)
+    assert item.status == "failed" and item.attempts == 2
+    event = cleanup_event(db, invite_id)
+    assert event["detail"] == "failed" and "403" in event["data"]["message"]
+    info = reactivation_info(db, invite_id)
+    assert info["cleanup_status"] == "failed" and info["cleanup_success"] is False
+
+
+def test_expired_lease_is_recovered(file_db):
+    db = file_db
+    _, item_id = seed(db)
+    assert work_queue.claim_due("w1") == item_id
+    assert work_queue.claim_due("w2") is None
+    later = int(time.time()) + work_queue.LEASE_SECONDS + 1
+    assert work_queue.recover_expired(now_ts=later) == 1
+    assert work_queue.claim_due("w2", now_ts=later) == item_id
+
+
+if __name__ == "__main__":
+    # 在子进程中运行 pytest，保证 conftest.py 先于 database 导入（使用数据库临时副本）
+    import subprocess
+    if subprocess.call([sys.executable, "-m", "pytest", __file__, "-q"]) == 0:
+        print("✅ 后台工作项测试通过")
@@ -0,0 +1,188 @@
+# tracing.py
+"""
+邀请 / 删除流程的分阶段耗时
+用 span("阶段名", account_id=..., attempt=...) 包住每个阶段（get_tokens、验证码、登录、刷新 token、发送等）：
+- span 可以嵌套，阶段名按嵌套路径拼接（如 invite.attempt.refresh_session），子 span 继承父 span 的属性
+- 每个 span 结束时计入按阶段名分组的耗时直方图（本进程内存，见 GET /api/v1/maintenance/metrics）
+- 在 collect() 内执行的请求还会收集本次请求的全部 span，用于 debug=true 时在响应中返回耗时明细
+"""
+
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, List, Iterator
+
+# 直方图桶上限（秒）：从一次 HTTP 请求到 Playwright 登录 + 验证码
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Span:
+    __slots__ = ("stage", "attrs", "started_at", "duration", "error")
+
+    def __init__(self, stage: str, attrs: Dict[str, Any]):
+        self.stage = stage
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def set(self, **attrs) -> None:
+        """补充属性（例如执行中才知道的账号）"""
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {"stage": self.stage, "ms": round((self.duration or 0) * 1000, 1)}
+        data.update(self.attrs)
+        if self.error:
+            data["error"] = self.error
+        return data
+
+
+class StageHistogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float, error: bool) -> None:
+        for i, upper in enumerate(BUCKETS):
+            if seconds <= upper:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.errors += int(error)
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        cumulative, buckets = 0, {}
+        for upper, n in zip(BUCKETS, self.bucket_counts):
+            cumulative += n
+            buckets[str(upper)] = cumulative
+        buckets["+Inf"] = self.count
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "sum_seconds": round(self.total, 3),
+            "avg_seconds": round(self.total / self.count, 3) if self.count else 0.0,
+            "max_seconds": round(self.max, 3),
+            "buckets": buckets,
+        }
+
+
+class StageMetrics:
+    """按阶段名汇总的耗时直方图（线程安全：span 也可能在 to_thread 的线程里结束）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, StageHistogram] = {}
+
+    def observe(self, stage: str, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            hist = self._stages.get(stage)
+            if hist is None:
+                hist = self._stages[stage] = StageHistogram()
+            hist.observe(seconds, error)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {stage: hist.snapshot() for stage, hist in sorted(self._stages.items())}
+
+    def render_prometheus(self) -> str:
+        """Prometheus 文本格式，指标名 overleaf_stage_duration_seconds，label 为 stage"""
+        name = "overleaf_stage_duration_seconds"
+        lines = [f"# HELP {name} 邀请/删除流程各阶段耗时", f"# TYPE {name} histogram"]
+        for stage, snap in self.snapshot().items():
+            for upper, n in snap["buckets"].items():
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{upper}"}} {n}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {snap["sum_seconds"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {snap["count"]}')
+            lines.append(f'overleaf_stage_errors_total{{stage="{stage}"}} {snap["errors"]}')
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stages.clear()
+
+
+class Trace:
+    """一次请求内结束的全部 span"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: List[Span] = []
+
+    def breakdown(self) -> Dict[str, Any]:
+        stages: Dict[str, Dict[str, Any]] = {}
+        for s in self.spans:
+            entry = stages.setdefault(s.stage, {"count": 0, "ms": 0.0})
+            entry["count"] += 1
+            entry["ms"] = round(entry["ms"] + (s.duration or 0) * 1000, 1)
+        return {
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "stages": stages,
+            "spans": [s.to_dict() for s in sorted(self.spans, key=lambda s: s.started_at)],
+        }
+
+
+metrics = StageMetrics()
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("tracing_span", default=None)
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("tracing_trace", default=None)
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Span]:
+    """计时一个阶段；异常照常抛出，并记为该阶段的一次错误"""
+    parent = _current_span.get()
+    if parent is not None:
+        current = Span(f"{parent.stage}.{name}", {**parent.attrs, **attrs})
+    else:
+        current = Span(name, dict(attrs))
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        metrics.observe(current.stage, current.duration, current.error is not None)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append(current)
+
+
+def annotate(**attrs) -> None:
+    """给当前 span 补充属性（例如查出记录后才知道的账号）；之后开始的子 span 会继承"""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attrs)
+
+
+def traced(name: str):
+    """把整个协程函数作为一个 span（流程的根 span，如 invite / remove）"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def collect() -> Iterator[Trace]:
+    """收集本次请求（当前上下文及其子任务、to_thread 线程）内的所有 span"""
+    trace = Trace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
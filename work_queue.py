@@ -0,0 +1,244 @@
+# work_queue.py
+"""
+通用的持久化后台工作项
+请求路径里不必等待的 Overleaf 操作（例如重新激活后从原组长删除成员）写入 work_items，
+由每个 API 进程内的 WorkQueue 认领执行：失败按指数退避重试，超过次数后放弃；
+每次成功、安排重试、放弃时都会调用该类型注册的 report 回调，把进展写回业务记录。
+处理函数必须是幂等的：worker 崩溃后租约过期的工作项会被重新执行。
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import socket
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Optional, Callable, Awaitable, Dict, Any, List
+
+from sqlalchemy import update, and_
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS    = 300
+BACKOFF_BASE     = 30         # 第一次重试前等待的秒数，之后每次翻倍
+BACKOFF_MAX      = 30 * 60
+DEFAULT_ATTEMPTS = 6
+
+
+class PermanentError(Exception):
+    """自定义异常：重试也不会成功的错误，直接放弃"""
+    pass
+
+
+# handler(db, payload) -> result dict；report(db, payload, outcome)
+Handler = Callable[[Session, Dict[str, Any]], Awaitable[Dict[str, Any]]]
+Reporter = Callable[[Session, Dict[str, Any], Dict[str, Any]], None]
+
+
+@dataclass
+class WorkKind:
+    handler: Handler
+    report: Optional[Reporter] = None
+    max_attempts: int = DEFAULT_ATTEMPTS
+
+
+_registry: Dict[str, WorkKind] = {}
+
+
+def register(kind: str, handler: Handler, report: Optional[Reporter] = None,
+             max_attempts: int = DEFAULT_ATTEMPTS) -> None:
+    _registry[kind] = WorkKind(handler=handler, report=report, max_attempts=max_attempts)
+
+
+def backoff_seconds(attempts: int) -> int:
+    """第 attempts 次失败后的等待时间（带 10% 抖动）"""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+    return int(delay * random.uniform(0.9, 1.1))
+
+
+def enqueue(db: Session, kind: str, payload: Dict[str, Any], delay: int = 0,
+            commit: bool = True) -> models.WorkItem:
+    """
+    写入工作项。commit=False 时只加入会话，由调用方与业务写入一起提交，
+    保证"业务记录已落库"与"后续工作已登记"同时成立。
+    """
+    now_ts = int(time.time())
+    item = models.WorkItem(
+        id=uuid.uuid4().hex,
+        kind=kind,
+        payload=json.dumps(payload, ensure_ascii=False),
+        status="pending",
+        attempts=0,
+        max_attempts=_registry[kind].max_attempts if kind in _registry else DEFAULT_ATTEMPTS,
+        next_run_at=now_ts + delay,
+        created_at=now_ts,
+        updated_at=now_ts,
+    )
+    db.add(item)
+    if commit:
+        db.commit()
+        db.refresh(item)
+    return item
+
+
+def claim_due(owner: str, now_ts: Optional[int] = None) -> Optional[str]:
+    """认领一个到期的工作项（条件 UPDATE，多进程安全）"""
+    if now_ts is None:
+        now_ts = int(time.time())
+    db = SessionLocal()
+    try:
+        for _ in range(5):
+            candidate = (
+                db.query(models.WorkItem.id)
+                .filter(
+                    models.WorkItem.status == "pending",
+                    models.WorkItem.next_run_at <= now_ts,
+                    models.WorkItem.kind.in_(list(_registry)),
+                )
+                .order_by(models.WorkItem.next_run_at, models.WorkItem.created_at)
+                .first()
+            )
+            if candidate is None:
+                return None
+            claimed = db.execute(
+                update(models.WorkItem)
+                .where(models.WorkItem.id == candidate.id, models.WorkItem.status == "pending")
+                .values(status="running", worker=owner, lease_expires_at=now_ts + LEASE_SECONDS,
+                        updated_at=now_ts)
+            ).rowcount
+            db.commit()
+            if claimed:
+                return candidate.id
+        return None
+    finally:
+        db.close()
+
+
+def recover_expired(now_ts: Optional[int] = None) -> int:
+    """租约过期的运行中工作项重新变为待执行"""
+    if now_ts is None:
+        now_ts = int(time.time())
+    db = SessionLocal()
+    try:
+        count = db.execute(
+            update(models.WorkItem)
+            .where(and_(models.WorkItem.status == "running", models.WorkItem.lease_expires_at < now_ts))
+            .values(status="pending", worker=None, lease_expires_at=None, next_run_at=now_ts)
+        ).rowcount
+        db.commit()
+        return count
+    finally:
+        db.close()
+
+
+async def run_item(item_id: str) -> str:
+    """执行一个已认领的工作项，返回最终状态 succeeded / pending（已安排重试）/ failed"""
+    db = SessionLocal()
+    try:
+        item = db.get(models.WorkItem, item_id)
+        kind = _registry[item.kind]
+        payload = json.loads(item.payload)
+        attempts = (item.attempts or 0) + 1
+
+        try:
+            result = await kind.handler(db, payload)
+            outcome = {"status": "succeeded", "attempts": attempts, "result": result}
+            item.status = "succeeded"
+            item.result = json.dumps(result, ensure_ascii=False)
+            item.last_error = None
+        except Exception as e:
+            db.rollback()
+            item = db.get(models.WorkItem, item_id)
+            error = f"{type(e).__name__}: {e}"
+            give_up = isinstance(e, PermanentError) or attempts >= item.max_attempts
+            if give_up:
+                item.status = "failed"
+                outcome = {"status": "failed", "attempts": attempts, "error": error}
+                logger.error(f"工作项 {item.kind} {item_id} 放弃（第 {attempts} 次）: {error}")
+            else:
+                delay = backoff_seconds(attempts)
+                item.status = "pending"
+                item.next_run_at = int(time.time()) + delay
+                outcome = {"status": "retrying", "attempts": attempts, "error": error,
+                           "next_run_at": item.next_run_at}
+                logger.warning(f"工作项 {item.kind} {item_id} 失败，{delay} 秒后重试: {error}")
+            item.last_error = error
+
+        item.attempts = attempts
+        item.worker = None
+        item.lease_expires_at = None
+        item.updated_at = int(time.time())
+        if kind.report:
+            try:
+                kind.report(db, payload, outcome)
+            except Exception as e:
+                logger.error(f"工作项 {item.kind} {item_id} 回写结果失败: {e}")
+        db.commit()
+        return item.status
+    finally:
+        db.close()
+
+
+class WorkQueue:
+    """单个进程内的工作项 worker 池"""
+
+    def __init__(self, workers: int = settings.WORK_QUEUE_WORKERS, poll_interval: float = 2.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        recover_expired()
+        self._tasks = [asyncio.create_task(self._worker_loop(i)) for i in range(self.workers)]
+        logger.info(f"后台工作项队列已启动: {self.workers} 个 worker ({self.owner})")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run_pending(self) -> int:
+        """把当前到期的工作项执行完（脚本与测试使用），返回处理数量"""
+        processed = 0
+        while True:
+            item_id = await asyncio.to_thread(claim_due, self.owner)
+            if item_id is None:
+                return processed
+            await run_item(item_id)
+            processed += 1
+
+    async def _worker_loop(self, index: int) -> None:
+        while True:
+            item_id = await asyncio.to_thread(claim_due, self.owner)
+            if item_id is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    await asyncio.to_thread(recover_expired)
+                continue
+            try:
+                await run_item(item_id)
+            except Exception as e:
+                logger.exception(f"worker {index} 执行工作项 {item_id} 出错: {e}")
+
+
+work_queue = WorkQueue()
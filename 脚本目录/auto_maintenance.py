@@ -6,7 +6,6 @@
 
 import asyncio
 import time
-import json
 import logging
 import argparse
 from datetime import datetime, timedelta
@@ -19,11 +18,9 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from database import SessionLocal
 from invite_status_manager import InviteStatusManager
-import models
-from overleaf_utils import get_tokens, get_captcha_token, perform_login, refresh_session, get_new_csrf
-import requests
-import re
-import html
+import models, crud
+from sync_engine import members_from_overleaf_users
+from overleaf_utils import open_group_session, fetch_group_members
 
 # 配置日志 - 只输出到控制台，不生成日志文件
 logging.basicConfig(
@@ -139,63 +136,13 @@ class AutoMaintenanceManager:
             }
     
     async def _get_overleaf_members(self, account: models.Account) -> List[Dict]:
-        """获取Overleaf群组成员"""
-        session = requests.Session()
-        
-        # 使用现有token或重新登录
-        if account.session_cookie and account.csrf_token:
-            session.cookies.set(
-                "overleaf_session2", account.session_cookie,
-                domain=".overleaf.com", path="/"
-            )
-        else:
-            # 重新登录
-            csrf0, sess0 = await get_tokens()
-            captcha = get_captcha_token()
-            session = await asyncio.to_thread(
-                perform_login, csrf0, sess0,
-                account.email, account.password, captcha
-            )
-            new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-            csrf_token = await asyncio.to_thread(get_new_csrf, session, account.group_id)
-            
-            # 更新数据库中的token
-            account.session_cookie = new_sess
-            account.csrf_token = csrf_token
-            self.db.commit()
-        
-        # 获取群组成员页面
-        members_url = f"https://www.overleaf.com/manage/groups/{account.group_id}/members"
-        resp = session.get(members_url, headers={
-            "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            "accept-language": "zh-CN,zh;q=0.9",
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
-        })
-        
-        if resp.status_code != 200:
-            raise Exception(f"获取成员数据失败: {resp.status_code}")
-        
-        # 解析HTML中的ol-users meta标签
-        html_content = resp.text
-        meta_pattern = r'<meta\s+name="ol-users"[^>]*content="([^"]*)"'
-        match = re.search(meta_pattern, html_content)
-        
-        if not match:
-            raise Exception("未找到ol-users meta标签")
-        
-        users_content = html.unescape(match.group(1))
-        users_data = json.loads(users_content)
-        
-        # 转换为统一格式
-        members = []
-        for user in users_data:
-            members.append({
-                "email": user.get("email"),
-                "user_id": user.get("_id"),
-                "status": "accepted" if user.get("_id") else "pending"
-            })
+        """获取Overleaf群组成员（认证与成员页解析复用 overleaf_utils）"""
+        session, new_sess, new_csrf = await open_group_session(account)
+        # 写回刷新后的token
+        crud.update_account_tokens(self.db, account, new_csrf, new_sess)
         
-        return members
+        users_data = await asyncio.to_thread(fetch_group_members, session, account.group_id)
+        return members_from_overleaf_users(users_data)
     
     def cleanup_expired_invites(self, dry_run: bool = False) -> Dict:
         """清理过期邀请"""
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 """
 清理历史垃圾记录脚本 - 彻底删除已标记为清理的记录
+
+注意：已处理的记录现在由维护服务每天移到 invites_archive 归档表（见 archive.py、
+POST /api/v1/maintenance/archive），可按邮箱 / 卡密检索，不需要再整库备份后硬删除；
+本脚本只在需要彻底丢弃历史时使用。
 """
 
 import sqlite3
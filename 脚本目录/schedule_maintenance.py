@@ -2,6 +2,9 @@
 """
 定时维护调度器 - 使用schedule库实现定时任务
 pip install schedule
+
+--run 现在直接启动进程内的维护服务（项目根目录的 maintenance_daemon.py），
+不再每个任务 subprocess 一个新的 Python 进程；API 进程已嵌入维护服务时无需再运行。
 """
 
 import schedule
@@ -151,14 +154,14 @@ if __name__ == "__main__":
         scheduler.health_check()
         
     elif args.run:
-        # 运行调度器
+        # 运行进程内的维护服务（共用数据库连接池、浏览器与组长会话）
+        import asyncio
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from maintenance_daemon import main as run_daemon
         try:
-            import schedule
-        except ImportError:
-            print("请安装schedule库: pip install schedule")
-            sys.exit(1)
-            
-        run_scheduler()
+            asyncio.run(run_daemon())
+        except KeyboardInterrupt:
+            logger.info("👋 维护服务已停止")
         
     else:
         parser.print_help()
\ No newline at end of file
@@ -7,7 +7,6 @@
 import sys
 import os
 import asyncio
-import json
 import time
 from datetime import datetime
 
@@ -15,10 +14,11 @@ from datetime import datetime
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from database import SessionLocal
-from invite_status_manager import InviteStatusManager
-import models
-from overleaf_utils import get_tokens, get_captcha_token, perform_login, refresh_session, get_new_csrf
-import requests
+import models, crud
+from sync_engine import ChangeAction, apply_change_set, load_account_invites, members_from_overleaf_users, plan_changes
+from outbox import in_flight_invite_ids
+from job_coordinator import JobLease, LeaseHeldError, SCOPE_SYNC
+from overleaf_utils import open_group_session, fetch_group_members
 
 
 class OverleafSyncer:
@@ -32,84 +32,13 @@ class OverleafSyncer:
             self.db.close()
     
     async def get_group_members(self, account: models.Account):
-        """获取Overleaf群组的真实成员数据"""
-        session = requests.Session()
+        """获取Overleaf群组的真实成员数据（认证与成员页解析复用 overleaf_utils）"""
+        session, new_sess, new_csrf = await open_group_session(account)
+        # 写回刷新后的token
+        crud.update_account_tokens(self.db, account, new_csrf, new_sess)
         
-        # 1. 尝试使用现有token
-        if account.session_cookie and account.csrf_token:
-            session.cookies.set(
-                "overleaf_session2", account.session_cookie,
-                domain=".overleaf.com", path="/"
-            )
-            csrf_token = account.csrf_token
-        else:
-            # 2. 重新登录获取token
-            print(f"账户 {account.email} 需要重新登录...")
-            csrf0, sess0 = await get_tokens()
-            captcha = get_captcha_token()
-            session = await asyncio.to_thread(
-                perform_login, csrf0, sess0,
-                account.email, account.password, captcha
-            )
-            new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-            csrf_token = await asyncio.to_thread(get_new_csrf, session, account.group_id)
-            
-            # 更新数据库中的token
-            account.session_cookie = new_sess
-            account.csrf_token = csrf_token
-            self.db.commit()
-        
-        # 3. 获取群组成员页面
-        members_url = f"https://www.overleaf.com/manage/groups/{account.group_id}/members"
-        resp = session.get(members_url, headers={
-            "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
-            "accept-language": "zh-CN,zh;q=0.9",
-            "cache-control": "max-age=0",
-            "priority": "u=0, i",
-            "sec-ch-ua": '"Google Chrome";v="137", "Chromium";v="137", "Not/A)Brand";v="24"',
-            "sec-ch-ua-mobile": "?0",
-            "sec-ch-ua-platform": '"macOS"',
-            "sec-fetch-dest": "document",
-            "sec-fetch-mode": "navigate",
-            "sec-fetch-site": "same-origin",
-            "sec-fetch-user": "?1",
-            "upgrade-insecure-requests": "1",
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36"
-        })
-        
-        if resp.status_code != 200:
-            raise Exception(f"获取成员数据失败: {resp.status_code} {resp.text}")
-        
-        # 4. 解析HTML中的ol-users meta标签
-        import re
-        import html
-        html_content = resp.text
-        
-        # 查找 <meta name="ol-users" data-type="json" content="...">
-        meta_pattern = r'<meta\s+name="ol-users"[^>]*content="([^"]*)"'
-        match = re.search(meta_pattern, html_content)
-        
-        if not match:
-            raise Exception("未找到ol-users meta标签")
-        
-        # 解码content内容（可能是HTML实体编码）
-        users_content = html.unescape(match.group(1))
-        
-        # 解析JSON数据
-        try:
-            users_data = json.loads(users_content)
-        except json.JSONDecodeError as e:
-            raise Exception(f"解析用户数据失败: {e}")
-        
-        # 转换为统一格式
-        members = []
-        for user in users_data:
-            # 根据实际数据结构调整字段映射
-            members.append({
-                "email": user.get("email"),
-                "user_id": user.get("_id"),
-                "status": "accepted" if user.get("_id") else "pending"
-            })
+        users_data = await asyncio.to_thread(fetch_group_members, session, account.group_id)
+        members = members_from_overleaf_users(users_data)
         
         return {
             "members": members,
@@ -132,144 +61,38 @@ class OverleafSyncer:
             print(f"Overleaf实际计数: {overleaf_count}")
             print(f"差值: {account.invites_sent - overleaf_count}")
             
-            # 2. 分析数据库中的邀请记录
-            db_invites = (
-                self.db.query(models.Invite)
-                .filter(models.Invite.account_id == account.id)
-                .all()
-            )
-            
+            # 2. 由对账引擎生成变更集
+            db_invites = load_account_invites(self.db, account)
             print(f"数据库邀请记录总数: {len(db_invites)}")
+            # outbox 中还没在 Overleaf 上执行完的删除 / 撤销，对应记录不恢复为未清理
+            change_set = plan_changes(
+                account, db_invites, overleaf_members,
+                in_flight=in_flight_invite_ids(self.db, account.id)
+            )
             
-            # 3. 创建邮箱到Overleaf状态的映射
-            overleaf_status = {}
-            for member in overleaf_members:
-                overleaf_status[member["email"]] = {
-                    "user_id": member["user_id"],
-                    "status": member["status"]
-                }
-            
-            # 4. 检查数据库外用户（只在Overleaf中存在）
-            db_emails = {invite.email for invite in db_invites}
-            database_external_users = []
-            
-            for email, ol_data in overleaf_status.items():
-                if email not in db_emails:
-                    database_external_users.append({
-                        "email": email,
-                        "user_id": ol_data["user_id"],
-                        "status": ol_data["status"]
-                    })
-            
-            # 5. 分析需要修复的记录
-            updates = []
-            for invite in db_invites:
-                current_status = {
-                    "email": invite.email,
-                    "db_email_id": invite.email_id,
-                    "db_cleaned": invite.cleaned,
-                    "overleaf_status": overleaf_status.get(invite.email)
-                }
-                
-                if invite.email in overleaf_status:
-                    # 在Overleaf中存在
-                    ol_data = overleaf_status[invite.email]
-                    
-                    if ol_data["status"] == "accepted" and not invite.email_id:
-                        # 数据库显示未接受，但Overleaf显示已接受
-                        updates.append({
-                            "invite_id": invite.id,
-                            "action": "update_email_id",
-                            "new_email_id": ol_data["user_id"],
-                            "reason": "Overleaf显示已接受，但数据库未更新email_id"
-                        })
-                    
-                    if invite.cleaned:
-                        # 数据库显示已清理，但Overleaf中还存在
-                        updates.append({
-                            "invite_id": invite.id,
-                            "action": "unmark_cleaned",
-                            "reason": "数据库标记为已清理，但Overleaf中仍存在"
-                        })
-                        
-                else:
-                    # 在Overleaf中不存在
-                    if not invite.cleaned:
-                        # 数据库显示未清理，但Overleaf中不存在
-                        updates.append({
-                            "invite_id": invite.id,
-                            "action": "mark_cleaned",
-                            "reason": "Overleaf中不存在，应标记为已清理"
-                        })
-            
-            # 6. 显示数据库外用户
-            if database_external_users:
-                print(f"\n发现数据库外用户: {len(database_external_users)}个")
-                for user in database_external_users:
-                    print(f"  {user['email']} (user_id: {user['user_id']}, status: {user['status']})")
+            # 3. 显示数据库外用户
+            external_changes = change_set.of(ChangeAction.CREATE_EXTERNAL)
+            if external_changes:
+                print(f"\n发现数据库外用户: {len(external_changes)}个")
+                for change in external_changes:
+                    print(f"  {change.email} (user_id: {change.email_id}, status: {change.overleaf_status})")
             
-            # 7. 显示需要的修复操作
+            # 4. 显示需要的修复操作
+            updates = [c for c in change_set.changes if c.invite_id is not None]
             print(f"\n需要修复的记录数: {len(updates)}")
             for update in updates:
-                print(f"  邀请ID {update['invite_id']}: {update['action']} - {update['reason']}")
+                print(f"  邀请ID {update.invite_id}: {update.action.value} - {update.reason}")
             
-            # 8. 执行修复（如果不是dry_run）
+            # 5. 执行修复（如果不是dry_run）——单个事务批量应用
             if not dry_run:
-                if updates:
-                    print(f"\n执行修复...")
-                    for update in updates:
-                        invite = self.db.get(models.Invite, update["invite_id"])
-                        if update["action"] == "update_email_id":
-                            invite.email_id = update["new_email_id"]
-                        elif update["action"] == "unmark_cleaned":
-                            invite.cleaned = False
-                        elif update["action"] == "mark_cleaned":
-                            invite.cleaned = True
-                
-                # 创建数据库外用户记录
-                if database_external_users:
-                    print(f"\n创建数据库外用户记录...")
-                    import time, json
-                    created_count = 0
-                    for user in database_external_users:
-                        # 创建更完整的result信息
-                        result_info = {
-                            "source": "manual_sync_from_overleaf",
-                            "sync_date": time.strftime("%Y-%m-%d %H:%M:%S"),
-                            "account_manager": account.email,
-                            "overleaf_status": user['status'],
-                            "overleaf_user_id": user['user_id'],
-                            "note": "手动添加的用户，需要联系客户确认过期时间和卡密信息",
-                            "action_required": "请设置过期时间并关联正确的卡密",
-                            "warning": "设置过期时间后，到期会被正常清理删除"
-                        }
-                        
-                        new_invite = models.Invite(
-                            account_id=account.id,
-                            card_id=None,  # 手动添加的用户没有卡密，需要后续关联
-                            email=user['email'],
-                            email_id=user['user_id'] if user['status'] == 'accepted' else None,
-                            expires_at=None,  # 关键：不设置过期时间，标记为手动添加
-                            success=True,  # 已经在Overleaf中存在
-                            result=json.dumps(result_info, ensure_ascii=False),
-                            created_at=int(time.time()),
-                            cleaned=False
-                        )
-                        self.db.add(new_invite)
-                        created_count += 1
-                        print(f"  已创建: {user['email']} (expires_at=NULL, 需要设置过期时间)")
-                    
-                    print(f"✓ 已创建 {created_count} 个数据库外用户记录")
-                
-                # 9. 修正账户计数（基于数据库重新计算）
-                manager = InviteStatusManager()
-                account.invites_sent = manager.calculate_invites_sent(self.db, account)
-                self.db.commit()
+                print(f"\n执行修复...")
+                apply_change_set(self.db, change_set)
+                print(f"✓ 已创建 {len(external_changes)} 个数据库外用户记录")
                 print(f"✓ 账户计数已修正: {account.invites_sent}")
             else:
                 # dry_run模式，只显示预期结果
-                if database_external_users:
-                    print(f"\n[DRY-RUN] 将创建 {len(database_external_users)} 个数据库外用户记录")
+                if external_changes:
+                    print(f"\n[DRY-RUN] 将创建 {len(external_changes)} 个数据库外用户记录")
                 print(f"\n[DRY-RUN] 使用 --apply 参数来实际执行修复")
             
             return {
@@ -277,6 +100,7 @@ class OverleafSyncer:
                 "db_count": account.invites_sent,
                 "overleaf_count": overleaf_count,
                 "updates_needed": len(updates),
+                "change_set": change_set.to_dict(),
                 "success": True
             }
             
@@ -288,8 +112,8 @@ class OverleafSyncer:
                 "success": False
             }
     
-    async def sync_all_accounts(self, dry_run=True):
-        """同步所有账户"""
+    async def sync_all_accounts(self, dry_run=True, lease: JobLease = None):
+        """同步所有账户；lease 为持有的 sync 租约，用于上报共享进度"""
         print("="*80)
         print(f"开始同步所有账户 - {'预览模式' if dry_run else '实际执行'}")
         print(f"时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
@@ -300,6 +124,8 @@ class OverleafSyncer:
         
         for i, account in enumerate(accounts, 1):
             print(f"\n进度: {i}/{len(accounts)}")
+            if lease:
+                await lease.update_progress_async(completed=i - 1, total=len(accounts), current_item=account.email)
             result = await self.sync_account(account, dry_run)
             results.append(result)
             
@@ -341,14 +167,18 @@ async def main():
     command = sys.argv[1]
     dry_run = "--apply" not in sys.argv
     
+    if command not in ("sync", "sync-one"):
+        print(f"未知命令: {command}")
+        return
+    if command == "sync-one" and len(sys.argv) < 3:
+        print("请指定账户邮箱")
+        return
+    
     syncer = OverleafSyncer()
     
-    if command == "sync":
-        await syncer.sync_all_accounts(dry_run)
-        
-    elif command == "sync-one":
-        if len(sys.argv) < 3:
-            print("请指定账户邮箱")
+    async def run(lease: JobLease = None):
+        if command == "sync":
+            await syncer.sync_all_accounts(dry_run, lease)
             return
         
         email = sys.argv[2]
@@ -359,8 +189,17 @@ async def main():
         
         await syncer.sync_account(account, dry_run)
     
-    else:
-        print(f"未知命令: {command}")
+    if dry_run:
+        # 预览只读数据库，不占用租约
+        await run()
+        return
+    
+    try:
+        # 与 /api/v1/sync/all、系统整体维护.py 共用 sync 租约，避免同时写入邀请记录与账户计数
+        async with JobLease(SCOPE_SYNC).hold() as lease:
+            await run(lease)
+    except LeaseHeldError as e:
+        print(f"⏭️ 跳过: {e}")
 
 
 if __name__ == "__main__":
@@ -8,7 +8,6 @@ import os
 import asyncio
 import time
 import logging
-import json
 from datetime import datetime
 
 # 添加项目根目录到Python路径
@@ -16,11 +15,12 @@ project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, project_root)
 
 from database import SessionLocal
-import models
-from overleaf_utils import get_tokens, get_captcha_token, perform_login, refresh_session, get_new_csrf
-import requests
-import re
-import html
+import models, crud
+from sync_scheduler import prioritized_account_ids
+from group_capacity import membership_values
+from job_coordinator import JobLease, LeaseHeldError, SCOPE_EMAIL_IDS
+from sync_engine import members_from_overleaf_users
+from overleaf_utils import open_group_session, fetch_group_members
 
 # 配置日志 - 只输出到控制台
 logging.basicConfig(
@@ -41,64 +41,13 @@ class EmailIdUpdater:
             self.db.close()
     
     async def get_overleaf_members(self, account: models.Account):
-        """获取Overleaf群组成员"""
-        session = requests.Session()
+        """获取Overleaf群组成员（认证与成员页解析复用 overleaf_utils）"""
+        session, new_sess, new_csrf = await open_group_session(account)
+        # 写回刷新后的token
+        crud.update_account_tokens(self.db, account, new_csrf, new_sess)
         
-        # 使用现有token或重新登录
-        if account.session_cookie and account.csrf_token:
-            session.cookies.set(
-                "overleaf_session2", account.session_cookie,
-                domain=".overleaf.com", path="/"
-            )
-        else:
-            # 重新登录
-            logger.info(f"账户 {account.email} 需要重新登录...")
-            csrf0, sess0 = await get_tokens()
-            captcha = get_captcha_token()
-            session = await asyncio.to_thread(
-                perform_login, csrf0, sess0,
-                account.email, account.password, captcha
-            )
-            new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-            csrf_token = await asyncio.to_thread(get_new_csrf, session, account.group_id)
-            
-            # 更新数据库中的token
-            account.session_cookie = new_sess
-            account.csrf_token = csrf_token
-            self.db.commit()
-        
-        # 获取群组成员页面
-        members_url = f"https://www.overleaf.com/manage/groups/{account.group_id}/members"
-        resp = session.get(members_url, headers={
-            "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            "accept-language": "zh-CN,zh;q=0.9",
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
-        })
-        
-        if resp.status_code != 200:
-            raise Exception(f"获取成员数据失败: {resp.status_code}")
-        
-        # 解析HTML中的ol-users meta标签
-        html_content = resp.text
-        meta_pattern = r'<meta\s+name="ol-users"[^>]*content="([^"]*)"'
-        match = re.search(meta_pattern, html_content)
-        
-        if not match:
-            raise Exception("未找到ol-users meta标签")
-        
-        users_content = html.unescape(match.group(1))
-        users_data = json.loads(users_content)
-        
-        # 转换为统一格式
-        members = []
-        for user in users_data:
-            members.append({
-                "email": user.get("email"),
-                "user_id": user.get("_id"),
-                "status": "accepted" if user.get("_id") else "pending"
-            })
-        
-        return members
+        users_data = await asyncio.to_thread(fetch_group_members, session, account.group_id)
+        return members_from_overleaf_users(users_data)
     
     async def update_account_email_ids(self, account: models.Account):
         """更新单个账户的email_id"""
@@ -107,6 +56,10 @@ class EmailIdUpdater:
             
             # 获取Overleaf群组成员数据
             overleaf_members = await self.get_overleaf_members(account)
+
+            # 记录 Overleaf 侧容量快照（有空位时解除 group_full 标记）
+            for key, value in membership_values(overleaf_members, account.max_invites).items():
+                setattr(account, key, value)
             
             # 构建email到user_id的映射
             email_to_user_id = {}
@@ -133,8 +86,8 @@ class EmailIdUpdater:
                     updated_count += 1
                     updated_emails.append(invite.email)
             
+            self.db.commit()
             if updated_count > 0:
-                self.db.commit()
                 logger.info(f"  ✅ 更新了 {updated_count} 个email_id")
                 for email in updated_emails:
                     logger.info(f"    - {email}")
@@ -162,7 +115,8 @@ class EmailIdUpdater:
         """更新所有账户的email_id"""
         logger.info("📧 开始更新所有账户的email_id...")
         
-        accounts = self.db.query(models.Account).all()
+        # 待接受邀请多的账户优先
+        accounts = [self.db.get(models.Account, account_id) for account_id in prioritized_account_ids(self.db)]
         results = {
             "total_accounts": len(accounts),
             "success_accounts": 0,
@@ -209,7 +163,8 @@ async def main():
     updater = EmailIdUpdater()
     
     try:
-        result = await updater.update_all_email_ids()
+        async with JobLease(SCOPE_EMAIL_IDS).hold():
+            result = await updater.update_all_email_ids()
         
         if result["total_updated"] > 0:
             logger.info(f"🎉 更新完成: 共更新 {result['total_updated']} 个邮箱ID")
@@ -218,6 +173,8 @@ async def main():
         
         return result
         
+    except LeaseHeldError as e:
+        logger.info(f"⏭️ 跳过本次更新: {e}")
     except Exception as e:
         logger.error(f"💥 更新失败: {e}")
         sys.exit(1)
@@ -9,10 +9,6 @@ import sys
 import os
 import asyncio
 import logging
-import requests
-import json
-import re
-import html
 from datetime import datetime
 
 # 添加项目根目录到Python路径
@@ -21,14 +17,9 @@ sys.path.insert(0, project_root)
 
 from database import SessionLocal
 from invite_status_manager import InviteStatusManager
-import models
-from overleaf_utils import (
-    get_tokens,
-    get_captcha_token,
-    perform_login,
-    refresh_session,
-    get_new_csrf
-)
+import models, crud
+from sync_engine import ChangeAction, members_from_overleaf_users, reconcile_account
+from overleaf_utils import open_group_session, fetch_group_members
 
 # 配置日志
 logging.basicConfig(
@@ -50,64 +41,13 @@ class DataConsistencyChecker:
             self.db.close()
     
     async def get_overleaf_members(self, account: models.Account):
-        """获取Overleaf群组成员列表"""
-        session = requests.Session()
-        
-        # 使用现有token或重新登录
-        if account.session_cookie and account.csrf_token:
-            session.cookies.set(
-                "overleaf_session2", account.session_cookie,
-                domain=".overleaf.com", path="/"
-            )
-        else:
-            # 重新登录
-            logger.info(f"账户 {account.email} 需要重新登录...")
-            csrf0, sess0 = await get_tokens()
-            captcha = get_captcha_token()
-            session = await asyncio.to_thread(
-                perform_login, csrf0, sess0,
-                account.email, account.password, captcha
-            )
-            new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-            csrf_token = await asyncio.to_thread(get_new_csrf, session, account.group_id)
-            
-            # 更新数据库中的token
-            account.session_cookie = new_sess
-            account.csrf_token = csrf_token
-            self.db.commit()
-        
-        # 获取群组成员页面
-        members_url = f"https://www.overleaf.com/manage/groups/{account.group_id}/members"
-        resp = session.get(members_url, headers={
-            "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            "accept-language": "zh-CN,zh;q=0.9",
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
-        })
-        
-        if resp.status_code != 200:
-            raise Exception(f"获取成员数据失败: {resp.status_code}")
-        
-        # 解析HTML中的ol-users meta标签
-        html_content = resp.text
-        meta_pattern = r'<meta\s+name="ol-users"[^>]*content="([^"]*)"'
-        match = re.search(meta_pattern, html_content)
-        
-        if not match:
-            raise Exception("未找到ol-users meta标签")
-        
-        users_content = html.unescape(match.group(1))
-        users_data = json.loads(users_content)
-        
-        # 转换为统一格式
-        members = []
-        for user in users_data:
-            members.append({
-                "email": user.get("email"),
-                "user_id": user.get("_id"),
-                "status": "accepted" if user.get("_id") else "pending"
-            })
+        """获取Overleaf群组成员（认证与成员页解析复用 overleaf_utils）"""
+        session, new_sess, new_csrf = await open_group_session(account)
+        # 写回刷新后的token
+        crud.update_account_tokens(self.db, account, new_csrf, new_sess)
         
-        return members
+        users_data = await asyncio.to_thread(fetch_group_members, session, account.group_id)
+        return members_from_overleaf_users(users_data)
     
     async def check_account_consistency(self, account: models.Account):
         """检查单个账户的数据一致性"""
@@ -117,52 +57,31 @@ class DataConsistencyChecker:
             # 1. 获取Overleaf真实数据
             overleaf_members = await self.get_overleaf_members(account)
             overleaf_count = len(overleaf_members)
-            overleaf_emails = {member["email"] for member in overleaf_members}
             
-            # 2. 获取数据库中的记录
-            # 活跃记录（cleaned=False）
-            active_invites = (
+            # 2. 对账引擎的变更集预览（只读，不应用；outbox 中未执行完的删除 / 撤销不算错误清理）
+            change_set = reconcile_account(self.db, account, overleaf_members, dry_run=True)
+            active_count = (
                 self.db.query(models.Invite)
-                .filter(models.Invite.account_id == account.id)
-                .filter(models.Invite.cleaned == False)
-                .all()
+                .filter(models.Invite.account_id == account.id, models.Invite.cleaned == False)
+                .count()
             )
-            active_count = len(active_invites)
-            active_emails = {invite.email for invite in active_invites}
-            
-            # 所有记录（包括已清理的）
-            all_invites = (
-                self.db.query(models.Invite)
-                .filter(models.Invite.account_id == account.id)
-                .all()
-            )
-            all_emails = {invite.email for invite in all_invites}
-            
-            # 3. 分析差异
-            # 在Overleaf中但不在活跃记录中的用户（这些需要删除）
-            need_delete = overleaf_emails - active_emails
             
+            # 3. 由变更集得出差异
             # 在Overleaf中但完全不在数据库中的用户（真正的手动用户）
-            truly_manual = overleaf_emails - all_emails
-            
+            truly_manual = {c.email for c in change_set.of(ChangeAction.CREATE_EXTERNAL)}
             # 在活跃记录中但不在Overleaf中的用户（可能是数据库错误）
-            db_orphans = active_emails - overleaf_emails
-            
+            db_orphans = {c.email for c in change_set.of(ChangeAction.MARK_CLEANED)}
             # 被错误标记为cleaned但仍在Overleaf中的用户
-            cleaned_invites = (
-                self.db.query(models.Invite)
-                .filter(models.Invite.account_id == account.id)
-                .filter(models.Invite.cleaned == True)
-                .all()
-            )
-            cleaned_emails = {invite.email for invite in cleaned_invites}
-            wrongly_cleaned = overleaf_emails & cleaned_emails
+            wrongly_cleaned = {c.email for c in change_set.of(ChangeAction.UNMARK_CLEANED)}
+            # 在Overleaf中但不在活跃记录中的用户（这些需要删除）
+            need_delete = truly_manual | wrongly_cleaned
             
             logger.info(f"  Overleaf用户数: {overleaf_count}")
             logger.info(f"  数据库活跃记录: {active_count}")
             logger.info(f"  需要删除用户: {len(need_delete)}")
             logger.info(f"  真正手动用户: {len(truly_manual)}")
             logger.info(f"  错误清理标记: {len(wrongly_cleaned)}")
+            logger.info(f"  对账变更预览: {change_set.summary()}")
             
             return {
                 "account_email": account.email,
@@ -174,7 +93,8 @@ class DataConsistencyChecker:
                 "truly_manual": list(truly_manual),
                 "db_orphans": list(db_orphans),
                 "wrongly_cleaned": list(wrongly_cleaned),
-                "inconsistent": overleaf_count != active_count
+                "change_set": change_set.to_dict(),
+                "inconsistent": not change_set.is_empty
             }
             
         except Exception as e:
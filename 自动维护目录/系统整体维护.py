@@ -9,7 +9,6 @@ import os
 import asyncio
 import time
 import logging
-import json
 from datetime import datetime
 
 # 添加项目根目录到Python路径
@@ -18,11 +17,13 @@ sys.path.insert(0, project_root)
 
 from database import SessionLocal
 from invite_status_manager import InviteStatusManager
-import models
-from overleaf_utils import get_tokens, get_captcha_token, perform_login, refresh_session, get_new_csrf
-import requests
-import re
-import html
+import models, crud
+from settings import settings
+from sync_scheduler import prioritized_account_ids
+import idempotency
+from job_coordinator import JobLease, LeaseHeldError, SCOPE_SYNC, SCOPE_CLEANUP
+from sync_engine import ChangeAction, CountSource, members_from_overleaf_users, reconcile_account
+from overleaf_utils import open_group_session, fetch_group_members
 
 # 配置日志 - 只输出到控制台
 logging.basicConfig(
@@ -44,64 +45,13 @@ class SystemMaintenance:
             self.db.close()
     
     async def get_overleaf_members(self, account: models.Account):
-        """获取Overleaf群组成员"""
-        session = requests.Session()
-        
-        # 使用现有token或重新登录
-        if account.session_cookie and account.csrf_token:
-            session.cookies.set(
-                "overleaf_session2", account.session_cookie,
-                domain=".overleaf.com", path="/"
-            )
-        else:
-            # 重新登录
-            logger.info(f"账户 {account.email} 需要重新登录...")
-            csrf0, sess0 = await get_tokens()
-            captcha = get_captcha_token()
-            session = await asyncio.to_thread(
-                perform_login, csrf0, sess0,
-                account.email, account.password, captcha
-            )
-            new_sess = await asyncio.to_thread(refresh_session, session, csrf0)
-            csrf_token = await asyncio.to_thread(get_new_csrf, session, account.group_id)
-            
-            # 更新数据库中的token
-            account.session_cookie = new_sess
-            account.csrf_token = csrf_token
-            self.db.commit()
+        """获取Overleaf群组成员（认证与成员页解析复用 overleaf_utils）"""
+        session, new_sess, new_csrf = await open_group_session(account)
+        # 写回刷新后的token
+        crud.update_account_tokens(self.db, account, new_csrf, new_sess)
         
-        # 获取群组成员页面
-        members_url = f"https://www.overleaf.com/manage/groups/{account.group_id}/members"
-        resp = session.get(members_url, headers={
-            "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            "accept-language": "zh-CN,zh;q=0.9",
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
-        })
-        
-        if resp.status_code != 200:
-            raise Exception(f"获取成员数据失败: {resp.status_code}")
-        
-        # 解析HTML中的ol-users meta标签
-        html_content = resp.text
-        meta_pattern = r'<meta\s+name="ol-users"[^>]*content="([^"]*)"'
-        match = re.search(meta_pattern, html_content)
-        
-        if not match:
-            raise Exception("未找到ol-users meta标签")
-        
-        users_content = html.unescape(match.group(1))
-        users_data = json.loads(users_content)
-        
-        # 转换为统一格式
-        members = []
-        for user in users_data:
-            members.append({
-                "email": user.get("email"),
-                "user_id": user.get("_id"),
-                "status": "accepted" if user.get("_id") else "pending"
-            })
-        
-        return members
+        users_data = await asyncio.to_thread(fetch_group_members, session, account.group_id)
+        return members_from_overleaf_users(users_data)
     
     async def sync_account_with_overleaf(self, account: models.Account):
         """与Overleaf同步单个账户"""
@@ -112,109 +62,25 @@ class SystemMaintenance:
             overleaf_members = await self.get_overleaf_members(account)
             overleaf_count = len(overleaf_members)
             
-            # 2. 分析数据库中的邀请记录
-            db_invites = (
-                self.db.query(models.Invite)
-                .filter(models.Invite.account_id == account.id)
-                .filter(models.Invite.cleaned == False)
-                .all()
+            # 2. 生成变更集并在单个事务中批量应用（计数以Overleaf真实数据为准）
+            change_set = reconcile_account(
+                self.db, account, overleaf_members,
+                count_source=CountSource.OVERLEAF,
+                source="daily_sync_maintenance"
             )
             
-            db_count = len(db_invites)
-            logger.info(f"  数据库记录: {db_count}, Overleaf实际: {overleaf_count}")
-            
-            # 3. 创建邮箱到Overleaf状态的映射
-            overleaf_status = {}
-            for member in overleaf_members:
-                overleaf_status[member["email"]] = {
-                    "user_id": member["user_id"],
-                    "status": member["status"]
-                }
-            
-            # 4. 检查数据库外用户（只在Overleaf中存在）
-            # 检查所有数据库记录，不仅仅是未清理的
-            all_db_invites = (
-                self.db.query(models.Invite)
-                .filter(models.Invite.account_id == account.id)
-                .all()
+            summary = change_set.summary()
+            updates_applied = (
+                summary[ChangeAction.SET_EMAIL_ID.value]
+                + summary[ChangeAction.MARK_CLEANED.value]
+                + summary[ChangeAction.UNMARK_CLEANED.value]
             )
-            all_db_emails = {invite.email for invite in all_db_invites}
-            database_external_users = []
+            external_users_created = summary[ChangeAction.CREATE_EXTERNAL.value]
             
-            for email, ol_data in overleaf_status.items():
-                if email not in all_db_emails:
-                    database_external_users.append({
-                        "email": email,
-                        "user_id": ol_data["user_id"],
-                        "status": ol_data["status"]
-                    })
-            
-            # 5. 分析需要修复的记录
-            updates_applied = 0
-            for invite in db_invites:
-                if invite.email in overleaf_status:
-                    # 在Overleaf中存在
-                    ol_data = overleaf_status[invite.email]
-                    
-                    if ol_data["status"] == "accepted" and not invite.email_id:
-                        # 数据库显示未接受，但Overleaf显示已接受
-                        invite.email_id = ol_data["user_id"]
-                        updates_applied += 1
-                        logger.info(f"    ✅ 更新email_id: {invite.email}")
-                    
-                    if invite.cleaned:
-                        # 数据库显示已清理，但Overleaf中还存在
-                        invite.cleaned = False
-                        updates_applied += 1
-                        logger.info(f"    ✅ 取消清理标记: {invite.email}")
-                        
-                else:
-                    # 在Overleaf中不存在
-                    if not invite.cleaned:
-                        # 数据库显示未清理，但Overleaf中不存在
-                        invite.cleaned = True
-                        updates_applied += 1
-                        logger.info(f"    ✅ 标记为已清理: {invite.email}")
-            
-            # 6. 创建数据库外用户记录
-            external_users_created = 0
-            if database_external_users:
-                logger.info(f"  发现数据库外用户: {len(database_external_users)}个")
-                
-                for user in database_external_users:
-                    # 创建完整的result信息
-                    result_info = {
-                        "source": "daily_sync_maintenance",
-                        "sync_date": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        "account_manager": account.email,
-                        "overleaf_status": user['status'],
-                        "overleaf_user_id": user['user_id'],
-                        "note": "系统自动检测的数据库外用户，需要联系客户确认",
-                        "action_required": "请设置过期时间并关联正确的卡密",
-                        "warning": "设置过期时间后，到期会被正常清理删除"
-                    }
-                    
-                    new_invite = models.Invite(
-                        account_id=account.id,
-                        card_id=None,  # 手动添加的用户没有卡密
-                        email=user['email'],
-                        email_id=user['user_id'] if user['status'] == 'accepted' else None,
-                        expires_at=None,  # 关键：不设置过期时间，标记为手动添加
-                        success=True,  # 已经在Overleaf中存在
-                        result=json.dumps(result_info, ensure_ascii=False),
-                        created_at=int(time.time()),
-                        cleaned=False
-                    )
-                    self.db.add(new_invite)
-                    external_users_created += 1
-                    logger.info(f"    ✅ 创建手动用户: {user['email']}")
-            
-            if updates_applied > 0 or external_users_created > 0:
-                self.db.commit()
-            
-            # 7. 修正账户计数 - 基于Overleaf真实数据
-            account.invites_sent = overleaf_count
-            self.db.commit()
+            for change in change_set.changes:
+                if change.action == ChangeAction.FIX_COUNT:
+                    continue
+                logger.info(f"    ✅ {change.action.value}: {change.email}")
             
             logger.info(f"  ✅ 同步完成: 修复{updates_applied}条，新增{external_users_created}条，计数{account.invites_sent}")
             
@@ -364,8 +230,8 @@ class SystemMaintenance:
         
         return report
     
-    async def run_full_maintenance(self):
-        """运行完整的系统维护"""
+    async def run_full_maintenance(self, lease: JobLease = None):
+        """运行完整的系统维护；lease 为持有的 sync 租约，用于上报共享进度"""
         logger.info("🚀 开始系统整体维护...")
         
         # 1. 生成维护前报告
@@ -374,11 +240,19 @@ class SystemMaintenance:
         
         # 2. 同步所有账户
         logger.info("🔄 步骤2: 与Overleaf同步所有账户")
-        accounts = self.db.query(models.Account).all()
+        # 按优先级排序：最可能与 Overleaf 不一致的账户先同步
+        accounts = [self.db.get(models.Account, account_id) for account_id in prioritized_account_ids(self.db)]
         sync_results = []
+        max_seconds = settings.MAINTENANCE_SYNC_MAX_SECONDS
+        deadline = time.monotonic() + max_seconds if max_seconds else None
         
         for i, account in enumerate(accounts, 1):
+            if deadline and time.monotonic() >= deadline:
+                logger.info(f"⏱️ 同步达到时间上限，剩余 {len(accounts) - i + 1} 个账户留待下次维护")
+                break
             logger.info(f"📊 进度: {i}/{len(accounts)}")
+            if lease:
+                await lease.update_progress_async(completed=i - 1, total=len(accounts), current_item=account.email)
             result = await self.sync_account_with_overleaf(account)
             sync_results.append(result)
             
@@ -387,7 +261,14 @@ class SystemMaintenance:
         
         # 3. 清理过期邀请
         logger.info("🗑️ 步骤3: 清理过期邀请")
-        expired_cleaned = self.cleanup_expired_invites()
+        try:
+            with JobLease(SCOPE_CLEANUP).hold_sync():
+                expired_cleaned = self.cleanup_expired_invites()
+        except LeaseHeldError as e:
+            logger.info(f"  ⏭️ 跳过: {e}")
+            expired_cleaned = 0
+        purged = idempotency.purge_expired()
+        logger.info(f"  🧹 清理过期幂等记录 {purged} 条")
         
         # 4. 修复账户计数（已在步骤2中基于Overleaf真实数据完成）
         logger.info("🔧 步骤4: 跳过账户计数修复（已在同步中完成）")
@@ -435,10 +316,14 @@ async def main():
     maintenance = SystemMaintenance()
     
     try:
-        result = await maintenance.run_full_maintenance()
+        # 与 /api/v1/sync/all 共用 sync 租约，避免两边同时全量同步
+        async with JobLease(SCOPE_SYNC).hold() as lease:
+            result = await maintenance.run_full_maintenance(lease)
         logger.info("🎉 系统整体维护任务完成")
         return result
         
+    except LeaseHeldError as e:
+        logger.info(f"⏭️ 跳过本次维护: {e}")
     except Exception as e:
         logger.error(f"💥 维护任务失败: {e}")
         sys.exit(1)